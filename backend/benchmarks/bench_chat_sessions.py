@@ -0,0 +1,152 @@
+"""
+GET /api/chat/sessions concurrente en tres variantes:
+
+- "blocking": la secuencia de consultas del handler original con pymongo (N+1: una
+  consulta de mensajes por sesión, cada una bloquea el event loop).
+- "motor": la misma secuencia N+1 con motor.
+- "paginated": el handler actual de main (una agregación por página, sin mensajes).
+
+Además de la latencia se mide el retraso del event loop con un ticker cada 10 ms:
+con pymongo crece con la concurrencia.
+Necesita un mongod; usa una base de datos temporal que borra al terminar.
+Uso (desde backend/):  python benchmarks/bench_chat_sessions.py --mongo mongodb://localhost:27017 [-c 50] [-n 500]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+from pymongo import MongoClient  # noqa: E402
+
+import main  # noqa: E402
+from db_indexes import reconcile_indexes  # noqa: E402
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def seed(database, user_id, sessions: int, messages: int):
+    now = datetime.utcnow()
+    session_docs = [
+        {"_id": ObjectId(), "user_id": user_id, "title": f"Session {i}", "created_at": now, "last_updated": now - timedelta(minutes=i)}
+        for i in range(sessions)
+    ]
+    await database[main.CHAT_SESSIONS_COLLECTION].insert_many(session_docs)
+    await database[main.CHAT_MESSAGES_COLLECTION].insert_many([
+        {"session_id": doc["_id"], "user_id": user_id, "role": "user" if j % 2 == 0 else "assistant",
+         "content": f"Message {j} " + "lorem ipsum " * 40, "timestamp": now + timedelta(seconds=j)}
+        for doc in session_docs for j in range(messages)
+    ])
+
+
+def blocking_handler(database):
+    """La secuencia de consultas del handler original con pymongo, sin ceder el event loop."""
+    async def handler(current_user):
+        user_id = current_user["_id"]
+        database.list_collection_names()
+        database[main.CHAT_SESSIONS_COLLECTION].count_documents({})
+        database[main.CHAT_SESSIONS_COLLECTION].count_documents({"user_id": user_id})
+        sessions = list(database[main.CHAT_SESSIONS_COLLECTION].find({"user_id": user_id}).sort("last_updated", -1))
+        for session in sessions:
+            list(database[main.CHAT_MESSAGES_COLLECTION].find({"session_id": session["_id"]}).sort("timestamp", 1))
+        return sessions
+    return handler
+
+
+def motor_handler(database):
+    """La misma secuencia N+1 con motor."""
+    async def handler(current_user):
+        user_id = current_user["_id"]
+        await database.list_collection_names()
+        await database[main.CHAT_SESSIONS_COLLECTION].count_documents({})
+        await database[main.CHAT_SESSIONS_COLLECTION].count_documents({"user_id": user_id})
+        sessions = await database[main.CHAT_SESSIONS_COLLECTION].find({"user_id": user_id}).sort("last_updated", -1).to_list(length=None)
+        for session in sessions:
+            await database[main.CHAT_MESSAGES_COLLECTION].find({"session_id": session["_id"]}).sort("timestamp", 1).to_list(length=None)
+        return sessions
+    return handler
+
+
+async def paginated_handler(current_user):
+    return await main.get_chat_sessions(limit=main.SESSION_PAGE_DEFAULT, cursor=None, current_user=current_user)
+
+
+async def measure(handler, user, concurrency: int, requests: int):
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await handler(user)
+            latencies.append(time.perf_counter() - started)
+
+    ticking = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticking
+    return {
+        "throughput": requests / elapsed,
+        "p50": statistics.median(latencies),
+        "p99": percentile(latencies, 0.99),
+        "lag_max": max(lags, default=0.0),
+        "lag_p99": percentile(lags, 0.99) if lags else 0.0,
+    }
+
+
+async def run(mongo_uri: str, concurrency: int, requests: int, sessions: int, messages: int):
+    name = f"deepread_sessions_bench_{ObjectId()}"
+    motor_client = AsyncIOMotorClient(mongo_uri, maxPoolSize=main.DB_MAX_POOL_SIZE)
+    sync_client = MongoClient(mongo_uri, maxPoolSize=main.DB_MAX_POOL_SIZE)
+    user = {"_id": ObjectId(), "credits": 0}
+    try:
+        await seed(motor_client[name], user["_id"], sessions, messages)
+        await reconcile_indexes(motor_client[name])
+        main.db = motor_client[name]
+        print(f"{sessions} sessions x {messages} messages, {requests} requests, concurrency {concurrency}")
+        print(f"{'mode':>9} {'req/s':>8} {'p50 (ms)':>9} {'p99 (ms)':>9} {'loop lag p99':>13} {'loop lag max':>13}")
+        modes = (
+            ("blocking", blocking_handler(sync_client[name])),
+            ("motor", motor_handler(main.db)),
+            ("paginated", paginated_handler),
+        )
+        for mode, handler in modes:
+            result = await measure(handler, user, concurrency, requests)
+            print(f"{mode:>9} {result['throughput']:>8.1f} {result['p50'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} "
+                  f"{result['lag_p99'] * 1000:>10.1f} ms {result['lag_max'] * 1000:>10.1f} ms")
+    finally:
+        main.db = None
+        await motor_client.drop_database(name)
+        motor_client.close()
+        sync_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo", required=True, help="MongoDB URI")
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument("-n", "--requests", type=int, default=500)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.mongo, args.concurrency, args.requests, args.sessions, args.messages))
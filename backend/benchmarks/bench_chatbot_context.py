@@ -0,0 +1,106 @@
+"""
+Coste por mensaje del chatbot con el contexto del paper guardado por sesión.
+
+Envía M mensajes a main.chatbot_message con un modelo falso sin latencia y colecciones
+en memoria, en tres variantes:
+
+- "rebuild": lo que se hacía antes en cada mensaje, renderizar y tokenizar el
+  contexto completo (solo la construcción del prompt, sin el handler).
+- "inline": clientes antiguos que siguen enviando título, resumen y código en cada
+  mensaje (el handler compara el digest y reutiliza el prefijo guardado).
+- "stored": PUT del contexto una vez y después solo session_id + message.
+
+Muestra el tamaño de la petición, el tiempo de construir el prompt por mensaje y el
+tiempo total del handler por mensaje.
+Uso (desde backend/):  python benchmarks/bench_chatbot_context.py [-m 50] [--files 12] [--file-lines 150]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeCollection, FakeGenerativeModel  # noqa: E402
+from credit_ledger import InMemoryCreditLedger  # noqa: E402
+
+
+def paper_fields(files: int, file_lines: int):
+    code = "\n".join(f"    x_{i} = attention(q, k, v) * scale + bias_{i}" for i in range(file_lines))
+    suggestions = [{
+        "title": "Linear attention", "language": "Python", "description": "Reference implementation",
+        "codeImplementation": [{"filename": f"module_{j}.py", "code": code} for j in range(files)],
+    }]
+    summary = "We study efficient attention for long documents. " * 60
+    return {"title": "Efficient Attention", "summary": summary, "code_suggestions": suggestions, "document_id": None}
+
+
+def setup():
+    main.db = {name: FakeCollection() for name in (main.CHAT_SESSIONS_COLLECTION, main.CHAT_MESSAGES_COLLECTION, main.CHAT_CONTEXTS_COLLECTION)}
+    main.chat_context_store.collection = main.db[main.CHAT_CONTEXTS_COLLECTION]
+    main.chat_context_store.counters = {key: 0 for key in main.chat_context_store.counters}
+    main.conversation_memory.messages = main.db[main.CHAT_MESSAGES_COLLECTION]
+    main.conversation_memory.contexts = main.db[main.CHAT_CONTEXTS_COLLECTION]
+    main.credit_ledger = InMemoryCreditLedger()
+    main.app.state.llm_provider = FakeGenerativeModel(latency=0)
+    user = {"_id": ObjectId(), "credits": 1_000_000}
+    session_id = ObjectId()
+    main.db[main.CHAT_SESSIONS_COLLECTION].docs[session_id] = {"_id": session_id, "user_id": user["_id"], "title": "Paper", "version": 0}
+    return user, str(session_id)
+
+
+async def run(messages: int, files: int, file_lines: int):
+    fields = paper_fields(files, file_lines)
+    questions = [f"How does module_{i % files}.py relate to section {i % 5} of the paper?" for i in range(messages)]
+    print(f"{messages} messages, {files} code files x {file_lines} lines, chatbot budget {main.prompt_planner.budgets['chatbot']} tokens")
+    print(f"{'mode':>8} {'request bytes':>14} {'prompt build (ms)':>18} {'handler (ms)':>13} {'input tokens':>13}")
+
+    build_times = []
+    for question in questions:
+        started = time.perf_counter()
+        prefix, prefix_tokens, _ = main.render_chatbot_context(fields)
+        main.prompt_planner.count(question)
+        build_times.append(time.perf_counter() - started)
+    legacy_request = {"message": questions[0], "paper_title": fields["title"], "paper_summary": fields["summary"], "code_suggestions": fields["code_suggestions"]}
+    print(f"{'rebuild':>8} {len(json.dumps(legacy_request)):>14} {statistics.median(build_times) * 1000:>18.2f} {'-':>13} {prefix_tokens:>13}")
+
+    for mode in ("inline", "stored"):
+        user, session_id = setup()
+        if mode == "stored":
+            await main.put_chat_context(session_id, main.ChatContextRequest(
+                paper_title=fields["title"], paper_summary=fields["summary"], code_suggestions=fields["code_suggestions"]), user)
+        build_times, handler_times = [], []
+        for question in questions:
+            request = {"session_id": session_id, "message": question}
+            if mode == "inline":
+                request.update(paper_title=fields["title"], paper_summary=fields["summary"], code_suggestions=fields["code_suggestions"])
+            context = await main.chat_context_store.load(ObjectId(session_id), user["_id"])
+            if context is not None:
+                started = time.perf_counter()
+                memory = await main.conversation_memory.load(ObjectId(session_id), context.get("memory"))
+                message, message_tokens, truncated = await main.prepare_chatbot_question(question)
+                main.build_chatbot_prompt(context, message, message_tokens, memory, question_truncated=truncated)
+                build_times.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            result = await main.chatbot_message(request, user)
+            handler_times.append(time.perf_counter() - started)
+        build = f"{statistics.median(build_times) * 1000:.2f}" if build_times else "-"
+        print(f"{mode:>8} {len(json.dumps(request)):>14} {build:>18} {statistics.median(handler_times) * 1000:>13.2f} "
+              f"{result['context']['used_tokens']:>13}")
+        print(f"{'':>8} context store: {main.chat_context_store.stats()}")
+    main.db = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-m", "--messages", type=int, default=50)
+    parser.add_argument("--files", type=int, default=12)
+    parser.add_argument("--file-lines", type=int, default=150)
+    args = parser.parse_args()
+    asyncio.run(run(args.messages, args.files, args.file_lines))
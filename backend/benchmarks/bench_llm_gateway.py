@@ -0,0 +1,114 @@
+"""
+Prueba de carga de la pasarela LLM con el proveedor falso.
+
+Escenarios:
+- carga con 429 intermitentes: éxito gracias a los reintentos, concurrencia máxima acotada
+- proveedor caído (503 siempre): el circuit breaker se abre y las llamadas fallan al momento
+- cliente solo síncrono: las llamadas van a un executor y el event loop no se bloquea
+Uso (desde backend/):  python benchmarks/bench_llm_gateway.py [-n 200]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import llm_gateway  # noqa: E402
+from benchmarks.fakes import FakeGenerativeModel, FakeSyncModel  # noqa: E402
+from llm_gateway import CircuitBreaker, LLMGateway, LLMUnavailableError  # noqa: E402
+
+
+class PeakProbe(FakeGenerativeModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.active = 0
+        self.peak = 0
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            return await super().generate_content_async(prompt, stream=stream, **kwargs)
+        finally:
+            self.active -= 1
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def timed(gateway, route, prompt):
+    started = time.perf_counter()
+    try:
+        await gateway.generate(route, prompt)
+        return True, time.perf_counter() - started
+    except Exception:
+        return False, time.perf_counter() - started
+
+
+async def flaky_load(n: int):
+    llm_gateway.LLM_RETRY_BASE_DELAY = 0.05
+    model = PeakProbe(latency=0.05, jitter=0.05, fail_rate=0.2, fail_code=429)
+    gateway = LLMGateway(lambda: model, max_concurrency=16, route_concurrency=8, breaker=CircuitBreaker(failure_threshold=50))
+    started = time.perf_counter()
+    results = await asyncio.gather(*(timed(gateway, "chatbot" if i % 2 else "summary", "Hi") for i in range(n)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for ok, latency in results if ok]
+    ok = sum(1 for success, _ in results if success)
+    retries = sum(route["retries"] for route in gateway.counters.values())
+    print(f"flaky provider (20% 429): {ok}/{n} ok, {retries} retries, upstream calls={model.calls}, "
+          f"peak concurrency={model.peak} (limit 16, 2 routes x 8), p50={statistics.median(latencies) * 1000:.0f} ms "
+          f"p99={percentile(latencies, 0.99) * 1000:.0f} ms, {n / elapsed:.0f} req/s")
+
+
+async def provider_down(n: int):
+    model = FakeGenerativeModel(latency=0.05, fail_rate=1.0, fail_code=503)
+    gateway = LLMGateway(lambda: model, max_retries=1, breaker=CircuitBreaker(failure_threshold=5, cooldown=30))
+    results = await asyncio.gather(*(timed(gateway, "summary", "Hi") for _ in range(n)), return_exceptions=True)
+    rejected = gateway.counters["summary"]["rejected"]
+    print(f"provider down (503): upstream calls={model.calls} for {n} requests, breaker={gateway.breaker.state}, "
+          f"{rejected} attempts rejected by the open breaker")
+    try:
+        await gateway.generate("summary", "Hi")
+    except LLMUnavailableError:
+        print("  next call rejected immediately with LLMUnavailableError  OK")
+
+
+async def sync_client(n: int):
+    model = FakeSyncModel(latency=0.1)
+    gateway = LLMGateway(lambda: model)
+    max_lag = 0.0
+    done = False
+
+    async def monitor():
+        nonlocal max_lag
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            max_lag = max(max_lag, time.perf_counter() - started - 0.01)
+
+    probe = asyncio.create_task(monitor())
+    started = time.perf_counter()
+    await asyncio.gather(*(gateway.generate("summary", "Hi") for _ in range(n)))
+    elapsed = time.perf_counter() - started
+    done = True
+    await probe
+    gateway.shutdown()
+    print(f"sync-only client: {n} calls of 100 ms in {elapsed:.2f}s, max event-loop lag {max_lag * 1000:.1f} ms")
+
+
+async def run(n: int):
+    await flaky_load(n)
+    await provider_down(min(n, 50))
+    await sync_client(16)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.n))
@@ -0,0 +1,153 @@
+"""
+Ráfaga de logins y latencia del resto de peticiones mientras dura.
+
+Lanza N logins concurrentes contra una colección users en memoria y, a la vez, una
+petición ligera sin autenticación de contraseña cada 10 ms (claims del token + una
+ruta de diagnóstico). Compara:
+
+- "inline": bcrypt.checkpw dentro del handler, como antes (el event loop se para).
+- "pool": main.login con el pool acotado de password_hashing.py.
+
+Muestra logins por segundo, p50/p99 de los logins y p50/p99/máx de las otras
+peticiones. En "inline" cada login no empieza hasta que acaba el anterior, así que su
+latencia parece baja: el coste aparece en las demás peticiones. Con --stale-rounds
+los usuarios tienen hashes de otro coste y se comprueba que login los recalcula.
+Uso (desde backend/):  python benchmarks/bench_login_burst.py [-n 40] [--rounds 12] [--workers 4] [--max-queue 64]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bcrypt  # noqa: E402
+from bson.objectid import ObjectId  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+import main  # noqa: E402
+from password_hashing import PasswordHasher, hash_rounds  # noqa: E402
+
+PASSWORD = "correct horse battery staple"
+PROBE_INTERVAL = 0.01
+
+
+class FakeUsers:
+    """find_one por email y update_one condicionado, como los usa login."""
+
+    def __init__(self, docs):
+        self.by_email = {doc["email"]: doc for doc in docs}
+
+    async def find_one(self, filter, projection=None):
+        doc = self.by_email.get(filter.get("email"))
+        return dict(doc) if doc else None
+
+    async def update_one(self, filter, update):
+        for doc in self.by_email.values():
+            if doc["_id"] == filter["_id"] and doc["password"] == filter["password"]:
+                doc.update(update["$set"])
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def seed(users: int, rounds: int):
+    hashed = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+    docs = [{"_id": ObjectId(), "email": f"student{i}@example.com", "name": f"Student {i}", "password": hashed, "credits": 100}
+            for i in range(users)]
+    main.db = {main.USERS_COLLECTION: FakeUsers(docs)}
+    return docs
+
+
+async def inline_login(credentials: main.UserLogin):
+    """El handler original: bcrypt en el event loop."""
+    db_user = await main.db[main.USERS_COLLECTION].find_one({"email": credentials.email})
+    if not bcrypt.checkpw(credentials.password.encode("utf-8"), db_user["password"].encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid email or password")
+    return main.create_access_token({"sub": str(db_user["_id"])})
+
+
+async def probe_request(header: str):
+    """Una petición que no toca bcrypt: validar el token y leer un endpoint de diagnóstico."""
+    await main.get_token_claims(header)
+    await main.get_llm_gateway_stats()
+
+
+async def burst(login, users, header: str):
+    probe_latencies, login_latencies, rejected = [], [], 0
+    done = asyncio.Event()
+
+    async def prober():
+        while not done.is_set():
+            scheduled = time.perf_counter()
+            await probe_request(header)
+            await asyncio.sleep(PROBE_INTERVAL)
+            # Lo que pasa del intervalo es tiempo que la petición esperó al event loop
+            probe_latencies.append(time.perf_counter() - scheduled - PROBE_INTERVAL)
+
+    async def one(user):
+        nonlocal rejected
+        started = time.perf_counter()
+        try:
+            await login(main.UserLogin(email=user["email"], password=PASSWORD))
+        except HTTPException as e:
+            if e.status_code != 503:
+                raise
+            rejected += 1
+            return
+        login_latencies.append(time.perf_counter() - started)
+
+    probing = asyncio.create_task(prober())
+    await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    await asyncio.gather(*(one(user) for user in users))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await probing
+    return {
+        "throughput": len(login_latencies) / elapsed,
+        "login_p50": statistics.median(login_latencies) if login_latencies else 0.0,
+        "login_p99": percentile(login_latencies, 0.99) if login_latencies else 0.0,
+        "probe_p50": statistics.median(probe_latencies),
+        "probe_p99": percentile(probe_latencies, 0.99),
+        "probe_max": max(probe_latencies),
+        "rejected": rejected,
+    }
+
+
+async def run(logins: int, rounds: int, workers: int, max_queue: int, stale_rounds):
+    header = "Bearer " + main.create_access_token({"sub": str(ObjectId())})
+    print(f"{logins} concurrent logins, bcrypt cost {rounds}, {workers} hashing workers, max queue {max_queue}")
+    print(f"{'mode':>7} {'logins/s':>9} {'login p50':>10} {'login p99':>10} {'other p50':>10} {'other p99':>10} {'other max':>10} {'503s':>5}")
+    for mode in ("inline", "pool"):
+        users = seed(logins, stale_rounds or rounds)
+        main.password_hasher = PasswordHasher(workers=workers, max_queue=max_queue, rounds=rounds)
+        login = inline_login if mode == "inline" else main.login
+        result = await burst(login, users, header)
+        print(f"{mode:>7} {result['throughput']:>9.1f} {result['login_p50'] * 1000:>7.0f} ms {result['login_p99'] * 1000:>7.0f} ms "
+              f"{result['probe_p50'] * 1000:>7.1f} ms {result['probe_p99'] * 1000:>7.1f} ms {result['probe_max'] * 1000:>7.1f} ms {result['rejected']:>5}")
+    if stale_rounds:
+        # Los rehash van en segundo plano: se espera a que termine la cola
+        while main.password_hasher.queued or main.password_hasher.running:
+            await asyncio.sleep(0.05)
+        stored = {hash_rounds(user["password"]) for user in main.db[main.USERS_COLLECTION].by_email.values()}
+        print(f"rehash: stored hashes went from cost {stale_rounds} to {sorted(stored)} "
+              f"({main.password_hasher.counters['rehashed']} rehashed)")
+    print(f"pool stats: {main.password_hasher.stats()}")
+    main.password_hasher.shutdown()
+    main.db = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--logins", type=int, default=40)
+    parser.add_argument("--rounds", type=int, default=12)
+    parser.add_argument("--workers", type=int, default=main.password_hasher.workers)
+    parser.add_argument("--max-queue", type=int, default=64)
+    parser.add_argument("--stale-rounds", type=int, default=None, help="seed hashes with this cost to exercise rehash on login")
+    args = parser.parse_args()
+    asyncio.run(run(args.logins, args.rounds, args.workers, args.max_queue, args.stale_rounds))
@@ -0,0 +1,93 @@
+"""
+Latencia del resumen en una sola llamada frente a map-reduce para papers de 10/30/60 páginas.
+
+Solo se mide la fase de resumen. El modelo falso tarda `--latency` s por llamada
+(generación de la respuesta) más `--per-token` s por token de entrada (prefill), así
+que un prompt con el paper entero es proporcionalmente más lento que varios trozos
+resumidos en paralelo.
+Uso (desde backend/):  python benchmarks/bench_map_reduce.py [--pages 10 30 60]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeGenerativeModel, approx_tokens  # noqa: E402
+from summarization import MAP_CHUNK_TOKENS, MAP_CONCURRENCY, map_reduce_summary  # noqa: E402
+from token_accounting import RequestTokenRecord  # noqa: E402
+
+WORDS = (
+    "attention layer sequence memory linear kernel approximation softmax training tokens model "
+    "experiment baseline accuracy dataset benchmark gradient optimizer variance result method"
+).split()
+WORDS_PER_PAGE = 550
+
+
+def synthetic_paper(pages: int) -> str:
+    rng = random.Random(pages)
+    paragraphs = []
+    for page in range(pages):
+        for _ in range(5):
+            sentences = [" ".join(rng.choice(WORDS) for _ in range(WORDS_PER_PAGE // 25)).capitalize() + "." for _ in range(5)]
+            paragraphs.append(" ".join(sentences))
+        if page % 5 == 0:
+            paragraphs.append(f"{page // 5 + 1} Section {page // 5 + 1}")
+    return "\n\n".join(paragraphs)
+
+
+async def single_pass(model: FakeGenerativeModel, text: str):
+    prompt = await main.build_summary_prompt(main.PaperData(title="Synthetic paper", content=text), text)
+    started = time.perf_counter()
+    await main.partial_summary_generator(RequestTokenRecord())(prompt)
+    return time.perf_counter() - started, 1
+
+
+async def map_reduce(model: FakeGenerativeModel, text: str, concurrency: int):
+    started = time.perf_counter()
+    result = await map_reduce_summary(
+        "Synthetic paper",
+        text,
+        main.partial_summary_generator(RequestTokenRecord()),
+        main.count_tokens,
+        main.SUMMARY_MAP_PROMPT_TEMPLATE,
+        main.SUMMARY_COMBINE_PROMPT_TEMPLATE,
+        main.SUMMARY_REDUCE_PROMPT_TEMPLATE,
+        concurrency=concurrency,
+        reduce_generate=main.partial_summary_generator(RequestTokenRecord(), "summary_reduce")
+    )
+    return time.perf_counter() - started, result.calls
+
+
+async def run(pages_list, latency: float, per_token: float, concurrency: int):
+    try:
+        main.count_tokens("warm up")
+    except Exception:
+        main.count_tokens = lambda text, model_name="cl100k_base": approx_tokens(text)
+    model = FakeGenerativeModel(latency=latency, per_token_latency=per_token)
+    main.app.state.llm_provider = model
+    threshold = main.MAP_REDUCE_TOKEN_THRESHOLD
+
+    print(f"latency={latency}s/call + {per_token * 1000:.2f} ms/input token  threshold={threshold}  chunk={MAP_CHUNK_TOKENS}  concurrency={concurrency}")
+    print(f"{'pages':>5} {'tokens':>8} {'single (s)':>11} {'map-reduce (s)':>15} {'calls':>6} {'speed-up':>9}")
+    for pages in pages_list:
+        text = synthetic_paper(pages)
+        tokens = main.count_tokens(text)
+        single, _ = await single_pass(model, text)
+        mapped, calls = await map_reduce(model, text, concurrency)
+        auto = "map-reduce" if tokens > threshold else "single"
+        print(f"{pages:>5} {tokens:>8} {single:>11.2f} {mapped:>15.2f} {calls:>6} {single / mapped:>8.2f}x   (auto: {auto})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 30, 60])
+    parser.add_argument("--latency", type=float, default=1.5)
+    parser.add_argument("--per-token", type=float, default=0.0002)
+    parser.add_argument("--concurrency", type=int, default=MAP_CONCURRENCY)
+    args = parser.parse_args()
+    asyncio.run(run(args.pages, args.latency, args.per_token, args.concurrency))
@@ -0,0 +1,99 @@
+"""
+Benchmark de extracción de PDFs: implementación en línea (antigua) frente a PdfExtractionEngine.
+
+Mide páginas/segundo y el bloqueo máximo del event loop mientras se extrae. La variante
+"ranges" fuerza el reparto por rangos de páginas (PDF_PARALLEL_MIN_PAGES=1) y comprueba
+que devuelve exactamente el mismo texto y los mismos offsets de página que una sola tarea.
+Uso (desde backend/):  python benchmarks/bench_pdf_extraction.py [--pages 10 40 120]
+"""
+import argparse
+import asyncio
+import os
+import re
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PyPDF2  # noqa: E402
+
+from benchmarks.sample_pdf import make_sample_pdf  # noqa: E402
+from pdf_extraction import PdfExtractionEngine  # noqa: E402
+
+
+async def legacy_extract(contents: bytes) -> str:
+    """Copia de la implementación original de extract_pdf (bloquea el event loop)."""
+    pdf_reader = PyPDF2.PdfReader(BytesIO(contents))
+    extracted_text = ""
+    for page in pdf_reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            extracted_text += page_text + "\n"
+    for i in range(min(2, len(pdf_reader.pages))):
+        page_text_for_meta = pdf_reader.pages[i].extract_text()
+        if page_text_for_meta:
+            re.search(r"(?i)(?:Abstract|Summary)(?:[:.\s\n]|$)(.*?)(?:\n\n|Keywords|$)", page_text_for_meta, re.DOTALL)
+    return extracted_text[:300000]
+
+
+async def measure(extract, contents: bytes):
+    """Ejecuta `extract` mientras un latido de 5 ms mide el retraso máximo del loop."""
+    max_stall = 0.0
+    done = asyncio.Event()
+
+    async def heartbeat():
+        nonlocal max_stall
+        interval = 0.005
+        while not done.is_set():
+            before = time.perf_counter()
+            await asyncio.sleep(interval)
+            max_stall = max(max_stall, time.perf_counter() - before - interval)
+
+    ticker = asyncio.create_task(heartbeat())
+    await asyncio.sleep(0.02)  # Deja arrancar el latido
+    started = time.perf_counter()
+    text = await extract(contents)
+    elapsed = time.perf_counter() - started
+    done.set()
+    await ticker
+    return elapsed, max_stall, text
+
+
+async def main(page_counts):
+    engine = PdfExtractionEngine()
+    engine.start()
+    ranges = PdfExtractionEngine(max_workers=max(2, engine.max_workers), parallel_min_pages=1)
+    ranges.start()
+    # Calentamiento: arranca los procesos hijos antes de medir
+    await engine.extract(make_sample_pdf(pages=2))
+    await ranges.extract(make_sample_pdf(pages=2))
+
+    print(f"{'pages':>6} {'variant':>8} {'pages/s':>10} {'elapsed ms':>11} {'max stall ms':>13} {'chars':>8}")
+    for pages in page_counts:
+        contents = make_sample_pdf(pages=pages)
+
+        results = {}
+
+        async def engine_extract(data):
+            results["engine"] = await engine.extract(data)
+            return results["engine"].text
+
+        async def ranges_extract(data):
+            results["ranges"] = await ranges.extract(data)
+            return results["ranges"].text
+
+        for name, extract in (("legacy", legacy_extract), ("engine", engine_extract), ("ranges", ranges_extract)):
+            elapsed, stall, text = await measure(extract, contents)
+            print(f"{pages:>6} {name:>8} {pages / elapsed:>10.1f} {elapsed * 1000:>11.1f} {stall * 1000:>13.1f} {len(text):>8}")
+        single, split = results["engine"], results["ranges"]
+        assert (split.text, split.page_offsets, split.pages_extracted) == (single.text, single.page_offsets, single.pages_extracted), pages
+    engine.shutdown()
+    ranges.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 40, 120])
+    args = parser.parse_args()
+    asyncio.run(main(args.pages))
@@ -0,0 +1,61 @@
+"""
+Tiempo hasta el primer byte de /api/process-paper frente a /api/process-paper/stream.
+
+Usa un modelo falso que tarda `--latency` s en empezar a responder y emite chunks
+cada `--chunk-delay` s, así que el total es comparable en ambos modos.
+Uso (desde backend/):  python benchmarks/bench_stream_ttfb.py
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeGenerativeModel, approx_tokens  # noqa: E402
+
+
+def paper(tag: str):
+    return main.PaperData(title="Streaming paper", content=f"Abstract\nWe study attention.\n3 Method\nLinear attention. [{tag}]\n")
+
+
+async def run(latency: float, chunk_delay: float):
+    main.db = None
+    try:
+        main.count_tokens("warm up")
+    except Exception:
+        main.count_tokens = lambda text, model_name="cl100k_base": approx_tokens(text)
+    main.app.state.llm_provider = FakeGenerativeModel(latency=latency, chunk_delay=chunk_delay, chunk_chars=16)
+    user = {"_id": ObjectId(), "credits": 10_000}
+
+    started = time.perf_counter()
+    await main.process_paper(paper("blocking"), user)
+    blocking_total = time.perf_counter() - started
+    print(f"process-paper        ttfb={blocking_total * 1000:8.1f} ms  total={blocking_total * 1000:8.1f} ms")
+
+    started = time.perf_counter()
+    response = await main.process_paper_stream(paper("stream"), user)
+    first_event = first_token = None
+    events = {}
+    async for raw in response.body_iterator:
+        now = time.perf_counter() - started
+        event = raw.split("\n", 1)[0].removeprefix("event: ")
+        events[event] = events.get(event, 0) + 1
+        first_event = first_event if first_event is not None else now
+        if event == "summary_token" and first_token is None:
+            first_token = now
+    total = time.perf_counter() - started
+    print(f"process-paper/stream ttfb={first_event * 1000:8.1f} ms  first token={first_token * 1000:8.1f} ms  total={total * 1000:8.1f} ms")
+    print(f"events: {events}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=1.5)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    args = parser.parse_args()
+    asyncio.run(run(args.latency, args.chunk_delay))
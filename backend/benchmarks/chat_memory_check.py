@@ -0,0 +1,138 @@
+"""
+Comprobaciones de la memoria de conversación del chatbot (conversation_memory.py).
+
+Envía N mensajes a main.chatbot_message en una misma sesión, con el modelo falso y
+colecciones en memoria, y comprueba que:
+
+1. El prompt incluye los turnos recientes (el bot ve la conversación).
+2. Los tokens de entrada por mensaje no crecen con la longitud de la conversación.
+3. La compactación es incremental: covered_until avanza siempre hacia delante, el
+   resumen se guarda en el contexto y cada compactación solo resume turnos nuevos.
+4. Si la llamada de resumen falla, el mensaje se responde igual (sin los turnos viejos).
+5. Los turnos antiguos sin memory_tokens se cuentan en el pool de tokenización, no en
+   el hilo del event loop.
+
+Uso (desde backend/):  python benchmarks/chat_memory_check.py [-m 60]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeCollection, FakeGenerativeModel  # noqa: E402
+from conversation_memory import SUMMARY_HEADER, TURNS_HEADER, ConversationMemory  # noqa: E402
+from credit_ledger import InMemoryCreditLedger  # noqa: E402
+
+
+class FlakySummaries(FakeGenerativeModel):
+    """Falla las llamadas de resumen de memoria mientras failing sea True."""
+
+    failing = False
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        if self.failing and "memoria de una conversación" in prompt:
+            self.calls += 1
+            raise RuntimeError("summary backend down")
+        return await super().generate_content_async(prompt, stream=stream, **kwargs)
+
+
+def setup():
+    main.db = {name: FakeCollection() for name in (main.CHAT_SESSIONS_COLLECTION, main.CHAT_MESSAGES_COLLECTION, main.CHAT_CONTEXTS_COLLECTION)}
+    main.chat_context_store.collection = main.db[main.CHAT_CONTEXTS_COLLECTION]
+    main.conversation_memory.messages = main.db[main.CHAT_MESSAGES_COLLECTION]
+    main.conversation_memory.contexts = main.db[main.CHAT_CONTEXTS_COLLECTION]
+    main.conversation_memory.counters = {key: 0 for key in main.conversation_memory.counters}
+    main.credit_ledger = InMemoryCreditLedger()
+    main.app.state.llm_provider = FlakySummaries(latency=0)
+    user = {"_id": ObjectId(), "credits": 1_000_000}
+    session_id = ObjectId()
+    main.db[main.CHAT_SESSIONS_COLLECTION].docs[session_id] = {"_id": session_id, "user_id": user["_id"], "title": "Paper", "version": 0}
+    return user, session_id
+
+
+async def run(messages: int):
+    user, session_id = setup()
+    await main.put_chat_context(str(session_id), main.ChatContextRequest(
+        paper_title="Efficient Attention", paper_summary="We study efficient attention for long documents. " * 20), user)
+    model = main.app.state.llm_provider
+    contexts = main.db[main.CHAT_CONTEXTS_COLLECTION]
+
+    used, watermarks = [], []
+    for i in range(messages):
+        result = await main.chatbot_message({"session_id": str(session_id), "message": f"Question {i} about the kernel trick in section {i % 7}?"}, user)
+        used.append(result["context"]["used_tokens"])
+        memory = (await contexts.find_one({"_id": session_id}) or {}).get("memory")
+        if memory and (not watermarks or watermarks[-1] != memory["covered_until"]):
+            watermarks.append(memory["covered_until"])
+
+    chatbot_prompts = [prompt for prompt in model.prompts if "Pregunta del usuario" in prompt]
+    print(f"{messages} messages, memory budget {main.conversation_memory.budget} tokens, "
+          f"summary {main.conversation_memory.summary_tokens} tokens, max turns {main.conversation_memory.max_turns}")
+    print(f"  input tokens: first {used[0]}, max {max(used)}, last {used[-1]}")
+    print(f"  memory stats: {main.conversation_memory.stats()}")
+
+    # 1. Los turnos anteriores llegan al prompt
+    assert TURNS_HEADER in chatbot_prompts[1] and "Question 0" in chatbot_prompts[1], "second message does not see the first turn"
+    assert f"Question {messages - 2}" in chatbot_prompts[-1]
+
+    # 2. Acotado: lo que no es memoria ni pregunta es el prefijo fijo
+    ceiling = used[0] + main.conversation_memory.budget + main.conversation_memory.summary_tokens
+    assert max(used) <= ceiling, f"input tokens grew to {max(used)} (ceiling {ceiling})"
+    late = used[messages // 2:]
+    assert max(late) - min(late) <= main.conversation_memory.budget, f"input tokens are not flat: {min(late)}..{max(late)}"
+
+    # 3. Compactación incremental con el resumen guardado
+    stored = (await contexts.find_one({"_id": session_id}))["memory"]
+    assert stored["summary"] and SUMMARY_HEADER in chatbot_prompts[-1], "summary not stored or not in the prompt"
+    keys = [(mark["timestamp"], mark["_id"]) for mark in watermarks]
+    assert keys == sorted(keys) and len(set(keys)) == len(keys), "covered_until moved backwards"
+    counters = main.conversation_memory.counters
+    assert counters["compactions"] >= 2 and counters["compacted_turns"] == stored["compacted_turns"]
+    assert counters["compacted_turns"] <= 2 * messages, "turns were summarized more than once"
+    print(f"  compactions: {counters['compactions']}, turns summarized: {counters['compacted_turns']} of {2 * messages}")
+
+    # 4. Fallo del resumen: el mensaje se responde y la memoria no cambia
+    model.failing = True
+    for i in range(6):
+        result = await main.chatbot_message({"session_id": str(session_id), "message": f"Follow-up {i} while summaries fail?"}, user)
+        assert result["context"]["used_tokens"] <= ceiling
+    assert main.conversation_memory.counters["compaction_failures"] >= 1
+    assert (await contexts.find_one({"_id": session_id}))["memory"]["covered_until"] == stored["covered_until"]
+    model.failing = False
+    await main.chatbot_message({"session_id": str(session_id), "message": "And now?"}, user)
+    assert (await contexts.find_one({"_id": session_id}))["memory"]["covered_until"] != stored["covered_until"], "compaction did not resume"
+    print(f"  summary failures: {main.conversation_memory.counters['compaction_failures']} (messages still answered)")
+
+    # 5. Turnos antiguos sin memory_tokens
+    counted_on = set()
+
+    def count(text):
+        counted_on.add(threading.current_thread().name)
+        return main.prompt_planner.count(text)
+
+    legacy = FakeCollection()
+    legacy_session = ObjectId()
+    started = datetime.utcnow()
+    for i in range(8):
+        await legacy.insert_one({"session_id": legacy_session, "content_type": "chat_message", "role": "user",
+                                 "content": f"Legacy question {i}", "timestamp": started + timedelta(seconds=i)})
+    window = await ConversationMemory(count, legacy).load(legacy_session, None)
+    assert len(window.turns) == 8 and all(turn["memory_tokens"] > 0 for turn in window.turns), window.report()
+    assert counted_on and threading.current_thread().name not in counted_on, counted_on
+    print(f"  legacy turns: {len(window.turns)} counted in {sorted(counted_on)}")
+    main.db = None
+    print("ok")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-m", "--messages", type=int, default=60)
+    args = parser.parse_args()
+    asyncio.run(run(args.messages))
@@ -0,0 +1,99 @@
+"""
+Comprobaciones de los ids de mensaje en /api/chat/sessions/sync y en el guardado completo.
+
+1. Un id de cliente con forma de ObjectId que coincide con el _id de un mensaje de otra
+   sesión se guarda como client_id: no choca con ese _id ni lo modifica.
+2. Un mensaje que emitió el servidor (sin client_id) se edita por su _id en su sesión.
+3. El payload de un mensaje se encuentra por cualquiera de los dos ids.
+4. Ids repetidos en una petición: 422. Un choque de clave única en Mongo: 409, no 500.
+
+Uso (desde backend/):  python benchmarks/chat_sync_check.py
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+from pymongo.errors import BulkWriteError  # noqa: E402
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeCollection  # noqa: E402
+
+
+def setup():
+    main.db = {
+        main.CHAT_SESSIONS_COLLECTION: FakeCollection(),
+        main.CHAT_MESSAGES_COLLECTION: FakeCollection(unique=("session_id", "client_id")),
+    }
+    user = {"_id": ObjectId()}
+    sessions = []
+    for title in ("First", "Second"):
+        session_id = ObjectId()
+        main.db[main.CHAT_SESSIONS_COLLECTION].docs[session_id] = {"_id": session_id, "user_id": user["_id"], "title": title, "version": 1}
+        sessions.append(session_id)
+    return user, sessions
+
+
+async def expect_status(status: int, call):
+    try:
+        await call
+    except HTTPException as e:
+        assert e.status_code == status, (e.status_code, e.detail)
+        return e.detail
+    raise AssertionError(f"expected HTTP {status}")
+
+
+async def run():
+    user, (first, second) = setup()
+    messages = main.db[main.CHAT_MESSAGES_COLLECTION]
+    # Mensaje emitido por el servidor en la primera sesión (p. ej. el resumen de un paper)
+    server_message = await messages.insert_one({"session_id": first, "user_id": user["_id"], "role": "assistant",
+                                                "content": "Server summary", "timestamp": datetime.utcnow(), "paper_data": {"title": "P"}})
+    server_id = str(server_message.inserted_id)
+
+    # 1. El mismo id, enviado por el cliente en otra sesión
+    result = await main.sync_chat_session(main.ChatSessionSyncRequest(
+        id=str(second), title="Second", base_version=1,
+        upserts=[main.ChatMessage(id=server_id, content="Client copy", role="user")]), user)
+    assert result["upserted"] == 1, result
+    copy = [doc for doc in messages.docs.values() if doc["session_id"] == second]
+    assert len(copy) == 1 and copy[0]["client_id"] == server_id and copy[0]["_id"] != server_message.inserted_id, copy
+    assert messages.docs[server_message.inserted_id]["content"] == "Server summary"
+    print("ObjectId-shaped client id from another session: stored under client_id, no _id clash  OK")
+
+    # 2. Edición del mensaje del servidor en su propia sesión
+    result = await main.sync_chat_session(main.ChatSessionSyncRequest(
+        id=str(first), title="First", base_version=1,
+        upserts=[main.ChatMessage(id=server_id, content="Edited summary", role="assistant", paperData={"title": "P"})]), user)
+    assert result["modified"] == 1 and result["upserted"] == 0, result
+    assert messages.docs[server_message.inserted_id]["content"] == "Edited summary"
+    print("server-issued id in its own session: updated in place by _id  OK")
+
+    # 3. Payload por cualquiera de los dos ids
+    payload = await main.get_chat_message_payload(str(first), server_id, user)
+    assert payload["paperData"] == {"title": "P"}, payload
+    assert (await main.get_chat_message_payload(str(second), server_id, user))["paperData"] is None
+    print("payload lookup by _id or client_id within the session  OK")
+
+    # 4. Duplicados
+    duplicated = [main.ChatMessage(id="c-1", content="a", role="user"), main.ChatMessage(id="c-1", content="b", role="user")]
+    await expect_status(422, main.sync_chat_session(main.ChatSessionSyncRequest(id=str(second), title="Second", base_version=2, upserts=duplicated), user))
+    await expect_status(422, main.save_chat_session(main.SaveChatSessionRequest(session=main.ChatSession(id=str(second), title="Second", messages=duplicated)), current_user=user))
+
+    async def conflicting_bulk_write(operations, ordered=True):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": 11000, "errmsg": "E11000 duplicate key"}]})
+
+    messages.bulk_write = conflicting_bulk_write
+    detail = await expect_status(409, main.sync_chat_session(main.ChatSessionSyncRequest(
+        id=str(second), title="Second", base_version=2, upserts=[main.ChatMessage(id="c-2", content="x", role="user")]), user))
+    print(f"duplicate ids: 422 for a repeated id in the request, 409 on a unique-key clash ({detail!r})  OK")
+    main.db = None
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
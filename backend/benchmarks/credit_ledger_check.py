@@ -0,0 +1,157 @@
+"""
+Comprobaciones del libro de créditos (credit_ledger.py) con peticiones concurrentes.
+
+1. Reservas concurrentes contra un saldo limitado: nunca se gasta más de lo que hay.
+2. process-paper concurrente con papers distintos: los que no caben reciben 402 y el
+   saldo final coincide con la suma de lo cobrado en los logs.
+3. Si la llamada al LLM falla, la reserva se devuelve entera.
+4. Si el coste real supera la reserva, el exceso se cobra solo hasta el saldo
+   disponible: el saldo nunca queda en negativo y el log registra lo cobrado.
+
+Por defecto usa InMemoryCreditLedger; con --mongo URI prueba MongoCreditLedger contra
+un mongod real (usa una base de datos temporal que borra al terminar).
+Uso (desde backend/):  python benchmarks/credit_ledger_check.py [--mongo mongodb://localhost:27017]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeGenerativeModel  # noqa: E402
+from credit_ledger import InMemoryCreditLedger, InsufficientCredits, MongoCreditLedger  # noqa: E402
+
+
+async def make_ledger(mongo_uri, user_id, credits):
+    if not mongo_uri:
+        ledger = InMemoryCreditLedger()
+        ledger.balances[user_id] = credits
+        return ledger, None
+    from motor.motor_asyncio import AsyncIOMotorClient
+    client = AsyncIOMotorClient(mongo_uri)
+    database = client[f"deepread_ledger_check_{ObjectId()}"]
+    await database.users.insert_one({"_id": user_id, "credits": credits})
+    ledger = MongoCreditLedger(client, database.users, database.credit_logs)
+    print(f"  mongo ledger, transactions={await ledger.detect_transactions()}")
+    return ledger, (client, database)
+
+
+async def balance_of(ledger, user_id):
+    if isinstance(ledger, InMemoryCreditLedger):
+        return ledger.balances[user_id]
+    return (await ledger.users.find_one({"_id": user_id}))["credits"]
+
+
+async def logged_total(ledger, user_id):
+    if isinstance(ledger, InMemoryCreditLedger):
+        return sum(entry["amount"] for entry in ledger.logs if entry["user_id"] == user_id)
+    entries = await ledger.logs.find({"user_id": user_id}).to_list(length=None)
+    return sum(entry["amount"] for entry in entries)
+
+
+async def concurrent_reservations(mongo_uri):
+    user_id = ObjectId()
+    ledger, cleanup = await make_ledger(mongo_uri, user_id, 100)
+
+    async def chat_turn():
+        try:
+            reservation = await ledger.reserve(user_id, 10)
+        except InsufficientCredits:
+            return False
+        await asyncio.sleep(0.01)
+        await ledger.settle(reservation, 7, "check")
+        return True
+
+    results = await asyncio.gather(*(chat_turn() for _ in range(50)))
+    balance = await balance_of(ledger, user_id)
+    # Con reservas de 10 y cobros de 7, lo devuelto permite algún turno más que 100/10
+    assert balance >= 0, balance
+    assert balance == 100 - 7 * sum(results), (balance, sum(results))
+    assert await logged_total(ledger, user_id) == 100 - balance
+    print(f"concurrent reservations: {sum(results)}/50 accepted, balance {balance} >= 0, logs match  OK")
+    return cleanup
+
+
+async def concurrent_process_paper(mongo_uri):
+    user_id = ObjectId()
+    ledger, cleanup = await make_ledger(mongo_uri, user_id, 60)
+    main.credit_ledger = ledger
+    main.app.state.llm_provider = FakeGenerativeModel(latency=0.2)
+    user = {"_id": user_id, "credits": 60}
+
+    async def request(i):
+        paper = main.PaperData(title=f"Ledger {i}", content=f"Abstract\nLedger check paper {i} {ObjectId()}.\n3 Method\nx\n")
+        try:
+            return await main.process_paper(paper, user)
+        except HTTPException as e:
+            return e.status_code
+
+    results = await asyncio.gather(*(request(i) for i in range(20)))
+    served = [result for result in results if not isinstance(result, int)]
+    rejected = [result for result in results if result == 402]
+    balance = await balance_of(ledger, user_id)
+    assert len(served) + len(rejected) == len(results), results
+    assert balance >= 0 and balance == 60 - await logged_total(ledger, user_id), balance
+    print(f"concurrent process-paper: {len(served)} served, {len(rejected)} rejected with 402, final balance {balance}  OK")
+    return cleanup
+
+
+async def refund_on_failure(mongo_uri):
+    user_id = ObjectId()
+    ledger, cleanup = await make_ledger(mongo_uri, user_id, 50)
+    main.credit_ledger = ledger
+    main.app.state.llm_provider = FakeGenerativeModel(latency=0.01, fail=RuntimeError("upstream down"))
+    paper = main.PaperData(title="Refund", content=f"Abstract\nRefund check {ObjectId()}.\n")
+    try:
+        await main.process_paper(paper, {"_id": user_id, "credits": 50})
+        raise AssertionError("expected the pipeline to fail")
+    except HTTPException as e:
+        status = e.status_code
+    balance = await balance_of(ledger, user_id)
+    assert balance == 50, balance
+    print(f"failed LLM call (HTTP {status}): reservation refunded, balance {balance}  OK")
+    return cleanup
+
+
+async def overage_capped(mongo_uri):
+    user_id = ObjectId()
+    ledger, cleanup = await make_ledger(mongo_uri, user_id, 30)
+    # Hay saldo para el exceso: se cobra entero
+    reservation = await ledger.reserve(user_id, 10)
+    balance = await ledger.settle(reservation, 15, "check")
+    assert balance == 15 == await balance_of(ledger, user_id), balance
+    # No hay saldo para todo el exceso: se cobra lo disponible y el saldo queda en 0
+    reservation = await ledger.reserve(user_id, 10)
+    balance = await ledger.settle(reservation, 40, "check")
+    assert balance == 0 == await balance_of(ledger, user_id), balance
+    assert await logged_total(ledger, user_id) == 30
+    print(f"overage beyond the balance: charged up to the balance, final balance {balance}, logs match  OK")
+    return cleanup
+
+
+async def run(mongo_uri):
+    main.db = None
+    cleanups = []
+    try:
+        cleanups.append(await concurrent_reservations(mongo_uri))
+        cleanups.append(await concurrent_process_paper(mongo_uri))
+        cleanups.append(await refund_on_failure(mongo_uri))
+        cleanups.append(await overage_capped(mongo_uri))
+    finally:
+        for cleanup in cleanups:
+            if cleanup:
+                client, database = cleanup
+                await client.drop_database(database.name)
+    print(main.credit_ledger.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo", default=None, help="MongoDB URI (default: in-memory ledger)")
+    args = parser.parse_args()
+    asyncio.run(run(args.mongo))
@@ -0,0 +1,292 @@
+"""
+Modelo generativo falso con la misma interfaz que google.generativeai.GenerativeModel,
+para probar y medir el backend sin gastar cuota de Gemini, y una colección de motor
+en memoria (FakeCollection) para los scripts que no necesitan un mongod.
+
+Los tipos de respuesta compartidos viven en llm_providers (también los usa FakeProvider).
+"""
+import asyncio
+import json
+import random
+import time
+from types import SimpleNamespace
+
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from llm_providers import (  # noqa: F401  (re-exportados para los scripts de benchmarks)
+    FAKE_PROJECT,
+    FAKE_SUMMARY,
+    FakeAPIError,
+    FakeResponse,
+    FakeStreamResponse,
+    approx_tokens,
+    split_chunks,
+)
+
+
+class FakeGenerativeModel:
+    """
+    Responde con un resumen o con el JSON de un proyecto según el prompt.
+
+    latency: segundos fijos por llamada; per_token_latency: segundos extra por token
+    de entrada (simula que los prompts largos tardan más); fail: excepción a lanzar;
+    fail_rate: probabilidad de responder con FakeAPIError(fail_code).
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        per_token_latency: float = 0.0,
+        jitter: float = 0.0,
+        fail: Exception = None,
+        chunk_chars: int = 40,
+        chunk_delay: float = 0.01,
+        fail_rate: float = 0.0,
+        fail_code: int = 429,
+    ):
+        self.latency = latency
+        self.per_token_latency = per_token_latency
+        self.jitter = jitter
+        self.fail = fail
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.fail_rate = fail_rate
+        self.fail_code = fail_code
+        self.calls = 0
+        self.prompts = []
+
+    def _reply_for(self, prompt: str) -> str:
+        if "JSON" in prompt:
+            return json.dumps(FAKE_PROJECT)
+        return FAKE_SUMMARY
+
+    def _delay_for(self, prompt: str) -> float:
+        return self.latency + approx_tokens(prompt) * self.per_token_latency + random.uniform(0, self.jitter)
+
+    def _maybe_fail(self):
+        if self.fail is not None:
+            raise self.fail
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise FakeAPIError(self.fail_code)
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        self.calls += 1
+        self.prompts.append(prompt)
+        if stream:
+            # En streaming la latencia fija es el tiempo hasta el primer chunk
+            await asyncio.sleep(self.latency)
+            self._maybe_fail()
+            chunks = split_chunks(self._reply_for(prompt), self.chunk_chars)
+            return FakeStreamResponse(chunks, prompt, [self.chunk_delay] * len(chunks))
+        await asyncio.sleep(self._delay_for(prompt))
+        self._maybe_fail()
+        return FakeResponse(self._reply_for(prompt), prompt)
+
+
+class FakeSyncModel:
+    """Cliente solo síncrono (sin generate_content_async): bloquea el hilo que lo llama."""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, prompt, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        return FakeResponse(FAKE_SUMMARY, prompt)
+
+
+def _lookup(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+def _matches(doc, filter) -> bool:
+    """Subconjunto de los filtros de MongoDB que usa la aplicación: igualdad, $in, $gt/$gte/$lt/$lte, $or, $and."""
+    for key, condition in filter.items():
+        if key == "$or":
+            if not any(_matches(doc, option) for option in condition):
+                return False
+            continue
+        if key == "$and":
+            if not all(_matches(doc, option) for option in condition):
+                return False
+            continue
+        value = _lookup(doc, key)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, operand in condition.items():
+                if op == "$in" and value not in operand:
+                    return False
+                if op in ("$gt", "$gte", "$lt", "$lte") and value is None:
+                    return False
+                if (op == "$gt" and not value > operand) or (op == "$gte" and not value >= operand) \
+                        or (op == "$lt" and not value < operand) or (op == "$lte" and not value <= operand):
+                    return False
+                if op == "$exists" and (value is not None) != operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    if any(projection.values()):
+        return {key: value for key, value in doc.items() if key == "_id" or projection.get(key)}
+    return {key: value for key, value in doc.items() if projection.get(key, 1)}
+
+
+class FakeCursor:
+    def __init__(self, docs, projection):
+        self._docs = docs
+        self._projection = projection
+        self._limit = None
+
+    def sort(self, keys):
+        for field, direction in reversed(keys):
+            self._docs.sort(key=lambda doc: doc.get(field), reverse=direction < 0)
+        return self
+
+    def limit(self, count):
+        self._limit = count
+        return self
+
+    def _results(self):
+        docs = self._docs[:self._limit] if self._limit else self._docs
+        return [_project(doc, self._projection) for doc in docs]
+
+    async def to_list(self, length=None):
+        return self._results()
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._results():
+            yield doc
+
+
+class FakeCollection:
+    """
+    Colección de motor en memoria: find_one/find/insert_one/update_one/replace_one/delete_one
+    con filtros simples, y insert_many/delete_many/bulk_write. unique: campos (además de _id)
+    cuya combinación es única entre los documentos que los tienen, como un índice único parcial.
+    """
+
+    def __init__(self, unique=()):
+        self.docs = {}
+        self.queries = 0
+        self.unique = tuple(unique)
+
+    def _duplicate(self, doc) -> bool:
+        existing = self.docs.get(doc["_id"])
+        if existing is not None and existing is not doc:
+            return True
+        if self.unique and all(doc.get(field) is not None for field in self.unique):
+            key = tuple(doc[field] for field in self.unique)
+            return any(other is not doc and tuple(other.get(field) for field in self.unique) == key for other in self.docs.values())
+        return False
+
+    async def insert_many(self, docs):
+        for index, doc in enumerate(docs):
+            doc.setdefault("_id", ObjectId())
+            if self._duplicate(doc):
+                raise BulkWriteError({"writeErrors": [{"index": index, "code": 11000, "errmsg": "E11000 duplicate key"}], "nInserted": index})
+            self.docs[doc["_id"]] = dict(doc)
+        return SimpleNamespace(inserted_ids=[doc["_id"] for doc in docs])
+
+    async def delete_many(self, filter):
+        found = self._find(filter)
+        for doc in found:
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=len(found))
+
+    async def bulk_write(self, operations, ordered=True):
+        upserted = modified = deleted = 0
+        errors = []
+        for index, operation in enumerate(operations):
+            if isinstance(operation, DeleteOne):
+                deleted += (await self.delete_one(operation._filter)).deleted_count
+                continue
+            assert isinstance(operation, UpdateOne)
+            found = self._find(operation._filter)
+            if not found and not operation._upsert:
+                continue
+            doc = dict(found[0]) if found else {key: value for key, value in operation._filter.items() if not key.startswith("$")}
+            doc.setdefault("_id", ObjectId())
+            doc.update(operation._doc.get("$set", {}))
+            if not found:
+                doc.update(operation._doc.get("$setOnInsert", {}))
+            for key in operation._doc.get("$unset", {}):
+                doc.pop(key, None)
+            if not found and self._duplicate(doc):
+                errors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key"})
+                if ordered:
+                    break
+                continue
+            self.docs[doc["_id"]] = doc
+            upserted, modified = upserted + (not found), modified + bool(found)
+        if errors:
+            raise BulkWriteError({"writeErrors": errors, "nUpserted": upserted, "nModified": modified})
+        return SimpleNamespace(upserted_count=upserted, modified_count=modified, deleted_count=deleted)
+
+    def _find(self, filter):
+        if "_id" in filter and not isinstance(filter["_id"], dict):
+            doc = self.docs.get(filter["_id"])
+            return [doc] if doc is not None and _matches(doc, filter) else []
+        return [doc for doc in self.docs.values() if _matches(doc, filter)]
+
+    async def find_one(self, filter, projection=None, **kwargs):
+        self.queries += 1
+        found = self._find(filter)
+        return _project(found[0], projection) if found else None
+
+    def find(self, filter=None, projection=None):
+        self.queries += 1
+        return FakeCursor(self._find(filter or {}), projection)
+
+    async def insert_one(self, doc):
+        doc.setdefault("_id", ObjectId())
+        self.docs[doc["_id"]] = dict(doc)
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    async def update_one(self, filter, update, upsert=False):
+        found = self._find(filter)
+        if not found and not upsert:
+            return SimpleNamespace(matched_count=0, modified_count=0, upserted_id=None)
+        doc = found[0] if found else {key: value for key, value in filter.items() if not key.startswith("$") and "." not in key}
+        doc.setdefault("_id", ObjectId())
+        for key, value in update.get("$set", {}).items():
+            doc[key] = value
+        self.docs[doc["_id"]] = doc
+        return SimpleNamespace(matched_count=len(found), modified_count=len(found), upserted_id=None if found else doc["_id"])
+
+    async def find_one_and_update(self, filter, update, projection=None, return_document=False, **kwargs):
+        """$set/$inc sobre el primer documento que cumple el filtro; devuelve el de antes o el de después."""
+        found = self._find(filter)
+        if not found:
+            return None
+        doc = found[0]
+        before = dict(doc)
+        doc.update(update.get("$set", {}))
+        for key, amount in update.get("$inc", {}).items():
+            doc[key] = (doc.get(key) or 0) + amount
+        return _project(doc if return_document else before, projection)
+
+    async def replace_one(self, filter, doc, upsert=False):
+        found = self._find(filter)
+        if found or upsert:
+            self.docs[filter["_id"]] = dict(doc, _id=filter["_id"])
+        return SimpleNamespace(matched_count=len(found))
+
+    async def delete_one(self, filter):
+        found = self._find(filter)
+        if found:
+            del self.docs[found[0]["_id"]]
+        return SimpleNamespace(deleted_count=len(found))
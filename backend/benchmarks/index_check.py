@@ -0,0 +1,88 @@
+"""
+Comprueba que todas las consultas de la aplicación usan un índice (db_indexes.py).
+
+Por defecto crea una base de datos temporal con datos de ejemplo, muestra el plan de
+cada consulta sin índices, reconcilia INDEX_SPECS y vuelve a ejecutar explain():
+termina con código 1 si alguna consulta sigue con COLLSCAN o con un SORT en memoria.
+Con --database NAME revisa una base de datos existente sin tocarla (salvo --reconcile).
+Uso (desde backend/):  python benchmarks/index_check.py --mongo mongodb://localhost:27017 [--database deepread]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+
+from db_indexes import UNCHECKED_QUERIES, check_query_plans, reconcile_indexes  # noqa: E402
+
+
+async def seed(database, users: int = 50, sessions_per_user: int = 5, messages_per_session: int = 8):
+    now = datetime.utcnow()
+    user_docs, session_docs, message_docs, log_docs = [], [], [], []
+    for u in range(users):
+        user_id = ObjectId()
+        user_docs.append({"_id": user_id, "email": f"user{u}@example.com", "name": f"User {u}", "credits": 100})
+        log_docs.append({"user_id": user_id, "type": "deduction", "amount": 3, "timestamp": now})
+        for s in range(sessions_per_user):
+            session_id = ObjectId()
+            session_docs.append({"_id": session_id, "user_id": user_id, "title": f"Session {s}", "last_updated": now - timedelta(minutes=s)})
+            for m in range(messages_per_session):
+                content_type = ("summary", "code_suggestion", None)[m % 3]
+                message_docs.append({"session_id": session_id, "user_id": user_id, "role": "assistant", "content": "x",
+                                     "content_type": content_type, "timestamp": now + timedelta(seconds=m)})
+    await database.users.insert_many(user_docs)
+    await database.chat_sessions.insert_many(session_docs)
+    await database.chat_messages.insert_many(message_docs)
+    await database.credit_logs.insert_many(log_docs)
+    await database.jobs.insert_many([{"status": ("queued", "running", "succeeded")[i % 3], "created_at": now} for i in range(200)])
+    await database.pdf_extractions.insert_many([{"_id": f"{i:064x}", "size": 10, "last_access": now} for i in range(200)])
+
+
+def print_plans(title, plans):
+    print(title)
+    for plan in plans:
+        status = "OK " if plan["indexed"] else "BAD"
+        print(f"  {status} {plan['collection']:<16} {plan['query']:<28} {' > '.join(plan['stages'])}")
+    return [plan for plan in plans if not plan["indexed"]]
+
+
+async def run(mongo_uri: str, database_name, reconcile: bool) -> int:
+    client = AsyncIOMotorClient(mongo_uri)
+    temporary = database_name is None
+    database = client[database_name or f"deepread_index_check_{ObjectId()}"]
+    try:
+        if temporary:
+            await seed(database)
+            print_plans("without indexes:", await check_query_plans(database))
+        report = None
+        if temporary or reconcile:
+            report = await reconcile_indexes(database)
+            print("reconciliation: " + ", ".join(f"{k}={v}" for k, v in report.items() if v))
+        unindexed = print_plans("with declared indexes:", await check_query_plans(database))
+        print("not checked (full-collection by design): " + "; ".join(UNCHECKED_QUERIES))
+        if report and report["failed"]:
+            print(f"FAILED: indexes could not be built: {report['failed']}")
+            return 1
+        if unindexed:
+            print(f"FAILED: {len(unindexed)} query shape(s) not index-backed")
+            return 1
+        print("all query shapes are index-backed  OK")
+        return 0
+    finally:
+        if temporary:
+            await client.drop_database(database.name)
+        client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mongo", required=True, help="MongoDB URI")
+    parser.add_argument("--database", default=None, help="existing database to check (default: temporary seeded database)")
+    parser.add_argument("--reconcile", action="store_true", help="reconcile the declared indexes before checking --database")
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.mongo, args.database, args.reconcile)))
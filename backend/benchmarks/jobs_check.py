@@ -0,0 +1,185 @@
+"""
+Comprobación de la cola de trabajos con el store en memoria y un modelo falso.
+
+Verifica que la concurrencia está acotada, que el estado avanza por las etapas hasta
+el ProcessedPaper final y que un trabajo interrumpido (lease vencido) se reencola al
+reiniciar o se da por fallido tras JOB_MAX_ATTEMPTS intentos. Con un lease corto:
+
+- el latido mantiene vivo un trabajo cuya llamada al LLM dura más que el lease, y otro
+  worker que arranca no lo reencola;
+- si el lease se pierde de verdad, la reserva se devuelve al recuperarlo, la ejecución
+  antigua descarta su resultado sin cobrar y el usuario paga una sola vez.
+Uso (desde backend/):  python benchmarks/jobs_check.py [-n 8] [--workers 2]
+"""
+import argparse
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+
+from credit_ledger import InMemoryCreditLedger  # noqa: E402
+
+import jobs  # noqa: E402
+import main  # noqa: E402
+from benchmarks.fakes import FakeGenerativeModel, approx_tokens  # noqa: E402
+
+PAPER_TEXT = "Abstract\nWe study efficient attention.\n3 Method\nLinear attention.\n4 Experiments\nIt works.\n"
+
+
+class ConcurrencyProbe(FakeGenerativeModel):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.active = 0
+        self.peak = 0
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            return await super().generate_content_async(prompt, stream=stream, **kwargs)
+        finally:
+            self.active -= 1
+
+
+def paper_payload(tag: str):
+    return {"paper": {"title": f"Paper {tag}", "content": f"{PAPER_TEXT} [{tag}]"}, "credits_at_submit": 10_000}
+
+
+async def bounded_concurrency(n: int, workers: int):
+    model = ConcurrencyProbe(latency=0.1)
+    main.app.state.llm_provider = model
+    pool = jobs.JobWorkerPool(jobs.InMemoryJobStore(), concurrency=workers)
+    pool.register(main.PROCESS_PAPER_JOB, main.run_process_paper_job)
+    await pool.start()
+    submitted = [await pool.enqueue(main.PROCESS_PAPER_JOB, ObjectId(), paper_payload(str(i))) for i in range(n)]
+
+    stages_seen = set()
+    while True:
+        current = [await pool.store.get(job["_id"]) for job in submitted]
+        stages_seen.update(job["stage"] for job in current)
+        if all(job["status"] in jobs.TERMINAL_STATUSES for job in current):
+            break
+        await asyncio.sleep(0.02)
+    await pool.stop()
+
+    assert all(job["status"] == jobs.JOB_SUCCEEDED for job in current), [job.get("error") for job in current]
+    assert all(main.ProcessedPaper(**job["result"]).summary for job in current)
+    assert model.peak <= workers, f"{model.peak} concurrent LLM calls with {workers} workers"
+    print(f"bounded concurrency: {n} jobs, peak {model.peak} concurrent calls with {workers} workers  OK")
+    print(f"stages observed: {sorted(stages_seen)}")
+
+
+async def restart_recovery():
+    store = jobs.InMemoryJobStore()
+    crashed = jobs.new_job(main.PROCESS_PAPER_JOB, ObjectId(), paper_payload("crashed"))
+    exhausted = jobs.new_job(main.PROCESS_PAPER_JOB, ObjectId(), paper_payload("exhausted"))
+    expired = datetime.utcnow() - timedelta(seconds=1)
+    crashed.update(status=jobs.JOB_RUNNING, attempts=1, worker_id="dead-worker", lease_expires_at=expired)
+    exhausted.update(status=jobs.JOB_RUNNING, attempts=jobs.JOB_MAX_ATTEMPTS, worker_id="dead-worker", lease_expires_at=expired)
+    await store.create(crashed)
+    await store.create(exhausted)
+
+    main.app.state.llm_provider = FakeGenerativeModel(latency=0.01)
+    pool = jobs.JobWorkerPool(store, concurrency=1)
+    pool.register(main.PROCESS_PAPER_JOB, main.run_process_paper_job)
+    await pool.start()
+    for _ in range(200):
+        if (await store.get(crashed["_id"]))["status"] in jobs.TERMINAL_STATUSES:
+            break
+        await asyncio.sleep(0.02)
+    await pool.stop()
+
+    assert (await store.get(crashed["_id"]))["status"] == jobs.JOB_SUCCEEDED
+    assert (await store.get(exhausted["_id"]))["status"] == jobs.JOB_FAILED
+    print("restart recovery: interrupted job re-run, exhausted job failed cleanly  OK")
+
+
+async def wait_for(store, job_id, condition, timeout: float = 5.0):
+    for _ in range(int(timeout / 0.02)):
+        job = await store.get(job_id)
+        if condition(job):
+            return job
+        await asyncio.sleep(0.02)
+    raise AssertionError(f"job {job_id} stuck: {await store.get(job_id)}")
+
+
+async def heartbeat_keeps_lease():
+    jobs.JOB_LEASE_SECONDS = 0.3
+    store = jobs.InMemoryJobStore()
+    model = FakeGenerativeModel(latency=0.5)
+    main.app.state.llm_provider = model
+    pool = jobs.JobWorkerPool(store, concurrency=1)
+    pool.heartbeat_interval = 0.1
+    pool.register(main.PROCESS_PAPER_JOB, main.run_process_paper_job)
+    await pool.start()
+    job = await pool.enqueue(main.PROCESS_PAPER_JOB, ObjectId(), paper_payload("heartbeat"))
+    await wait_for(store, job["_id"], lambda current: current["stage"] == "summary")
+    recoveries = []
+    while (await store.get(job["_id"]))["status"] == jobs.JOB_RUNNING:
+        # Otro worker arrancando mientras la llamada lenta sigue en curso
+        recoveries.append(await store.recover_stale())
+        await asyncio.sleep(0.05)
+    await pool.stop()
+    done = await store.get(job["_id"])
+    assert done["status"] == jobs.JOB_SUCCEEDED and done["attempts"] == 1, done
+    assert not any(recovered["requeued"] for recovered in recoveries) and model.calls == 2
+    print(f"heartbeat: {model.latency}s LLM calls with a {jobs.JOB_LEASE_SECONDS}s lease, {len(recoveries)} recovery scans, never requeued  OK")
+
+
+async def lost_lease_bills_once():
+    jobs.JOB_LEASE_SECONDS = 0.2
+    store = jobs.InMemoryJobStore()
+    main.credit_ledger = ledger = InMemoryCreditLedger()
+    main.app.state.llm_provider = FakeGenerativeModel(latency=0.6)
+    stalled = jobs.JobWorkerPool(store, concurrency=1)
+    stalled.heartbeat_interval = 60  # Simula un worker colgado que no renueva el lease
+    stalled.register(main.PROCESS_PAPER_JOB, main.run_process_paper_job)
+    await stalled.start()
+    user_id = ObjectId()
+    job = await stalled.enqueue(main.PROCESS_PAPER_JOB, user_id, paper_payload("lost-lease"))
+    first = await wait_for(store, job["_id"], lambda current: (current["reservation"] or {}).get("state") == jobs.RESERVATION_HELD)
+    held = first["reservation"]["amount"]
+    await asyncio.sleep(jobs.JOB_LEASE_SECONDS * 1.5)
+
+    rescuer = jobs.JobWorkerPool(store, concurrency=1)
+    rescuer.register(main.PROCESS_PAPER_JOB, main.run_process_paper_job)
+    rescuer.on_reservation_released(main.refund_job_reservation)
+    await rescuer.start()
+    done = await wait_for(store, job["_id"], lambda current: current["status"] in jobs.TERMINAL_STATUSES)
+    await asyncio.sleep(0.7)  # La ejecución antigua termina su llamada e intenta liquidar
+    await stalled.stop()
+    await rescuer.stop()
+
+    assert done["status"] == jobs.JOB_SUCCEEDED and done["attempts"] == 2, done
+    charged = [entry["amount"] for entry in ledger.logs if entry["user_id"] == user_id]
+    assert len(charged) == 1, f"job billed {len(charged)} times: {charged}"
+    assert ledger.balances[user_id] == 10_000 - charged[0], (ledger.balances[user_id], charged)
+    print(f"lost lease: first run's {held}-credit hold refunded, job billed once ({charged[0]} credits)  OK")
+
+
+async def main_check(n: int, workers: int):
+    main.db = None
+    try:
+        main.count_tokens("warm up")
+    except Exception:
+        main.count_tokens = lambda text, model_name="cl100k_base": approx_tokens(text)
+    await bounded_concurrency(n, workers)
+    await restart_recovery()
+    lease = jobs.JOB_LEASE_SECONDS
+    try:
+        await heartbeat_keeps_lease()
+        await lost_lease_bills_once()
+    finally:
+        jobs.JOB_LEASE_SECONDS = lease
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+    asyncio.run(main_check(args.n, args.workers))
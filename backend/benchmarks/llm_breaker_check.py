@@ -0,0 +1,145 @@
+"""
+Comprobaciones del circuit breaker de la pasarela LLM (llm_gateway.py).
+
+1. Tras N fallos el breaker se abre y rechaza sin llamar al proveedor.
+2. Pasado el cooldown, si la llamada de prueba se cancela (cliente desconectado) el
+   breaker no se queda bloqueado: la siguiente llamada vuelve a probar y lo cierra.
+3. Lo mismo si la prueba se queda sin plazo antes de llegar al proveedor.
+4. Los clientes sin API asíncrona reciben los kwargs de generación.
+5. Un error no reintentable (400) en la llamada de prueba no cierra el breaker ni
+   reinicia la cuenta de fallos: la prueba se suelta y la siguiente vuelve a probar.
+6. El plazo incluye la espera de hueco: una llamada encolada más allá del plazo falla
+   con 504 sin llegar al proveedor.
+
+Uso (desde backend/):  python benchmarks/llm_breaker_check.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeAPIError, FakeResponse  # noqa: E402
+from llm_gateway import CircuitBreaker, LLMGateway, LLMUnavailableError  # noqa: E402
+
+COOLDOWN = 0.05
+
+
+class ScriptedModel:
+    """fail: lanza fail_code (503 por defecto); latency: segundos por llamada."""
+
+    def __init__(self):
+        self.fail = False
+        self.fail_code = 503
+        self.latency = 0.0
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.fail:
+            raise FakeAPIError(self.fail_code)
+        return FakeResponse("ok", prompt)
+
+
+class SyncModel:
+    def __init__(self):
+        self.kwargs = None
+
+    def generate_content(self, prompt, **kwargs):
+        self.kwargs = kwargs
+        return FakeResponse("ok", prompt)
+
+
+async def open_breaker(gateway: LLMGateway, model: ScriptedModel):
+    model.fail = True
+    for _ in range(gateway.breaker.failure_threshold):
+        try:
+            await gateway.generate("check", "prompt")
+        except FakeAPIError:
+            pass
+    assert gateway.breaker.state == "open", gateway.stats()
+    calls = model.calls
+    try:
+        await gateway.generate("check", "prompt")
+        raise AssertionError("open breaker let a call through")
+    except LLMUnavailableError:
+        pass
+    assert model.calls == calls
+    model.fail = False
+    await asyncio.sleep(COOLDOWN * 1.5)
+    assert gateway.breaker.state == "half_open"
+
+
+async def run():
+    model = ScriptedModel()
+    gateway = LLMGateway(lambda: model, max_retries=0, breaker=CircuitBreaker(failure_threshold=3, cooldown=COOLDOWN))
+
+    # 1 y 2. Prueba cancelada
+    await open_breaker(gateway, model)
+    model.latency = 0.2
+    probe = asyncio.create_task(gateway.generate("check", "prompt"))
+    await asyncio.sleep(0.02)
+    probe.cancel()
+    try:
+        await probe
+    except asyncio.CancelledError:
+        pass
+    model.latency = 0.0
+    await gateway.generate("check", "prompt")
+    assert gateway.breaker.state == "closed", gateway.stats()
+    print("cancelled probe: breaker closes on the next call  OK")
+
+    # 3. Prueba sin plazo
+    await open_breaker(gateway, model)
+    gateway.deadline = 0
+    try:
+        await gateway.generate("check", "prompt")
+    except Exception as e:
+        assert type(e).__name__ == "LLMDeadlineExceeded", e
+    gateway.deadline = 5
+    await gateway.generate("check", "prompt")
+    assert gateway.breaker.state == "closed", gateway.stats()
+    print("probe past its deadline: breaker closes on the next call  OK")
+
+    # 4. kwargs en clientes síncronos
+    sync_model = SyncModel()
+    sync_gateway = LLMGateway(lambda: sync_model)
+    await sync_gateway.generate("check", "prompt", generation_config={"temperature": 0.2})
+    assert sync_model.kwargs == {"generation_config": {"temperature": 0.2}}, sync_model.kwargs
+    sync_gateway.shutdown()
+    print("sync client receives generation kwargs  OK")
+
+    # 5. 400 en la llamada de prueba
+    await open_breaker(gateway, model)
+    failures = gateway.breaker.failures
+    model.fail, model.fail_code = True, 400
+    try:
+        await gateway.generate("check", "bad prompt")
+        raise AssertionError("expected the 400 to propagate")
+    except FakeAPIError:
+        pass
+    assert gateway.breaker.state == "half_open" and gateway.breaker.failures == failures, gateway.stats()
+    model.fail, model.fail_code = False, 503
+    await gateway.generate("check", "prompt")
+    assert gateway.breaker.state == "closed", gateway.stats()
+    print("non-retryable error on the probe: breaker stays half-open, next probe closes it  OK")
+
+    # 6. La espera de hueco cuenta para el plazo (el único hueco global está ocupado)
+    idle = ScriptedModel()
+    queued = LLMGateway(lambda: idle, max_concurrency=1, max_retries=0, deadline=0.1)
+    await queued._global.acquire()
+    try:
+        await queued.generate("check", "prompt")
+        raise AssertionError("queued call got the full deadline after waiting")
+    except Exception as e:
+        assert type(e).__name__ == "LLMDeadlineExceeded", e
+    finally:
+        queued._global.release()
+    assert idle.calls == 0 and queued.counters["check"]["slot_timeouts"] == 1, queued.stats()
+    assert queued._routes["check"]._value == queued.route_concurrency, "route slot leaked"
+    print("slot wait counts toward the deadline: queued call failed with 504 before reaching the provider  OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
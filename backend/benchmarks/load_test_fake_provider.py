@@ -0,0 +1,95 @@
+"""
+Prueba de carga de process-paper con el proveedor falso de llm_providers (sin red).
+
+Equivale a arrancar la API con LLM_PROVIDER=fake: latencias lognormales, chunks en
+streaming con su propio ritmo, conteo de tokens y fallos inyectados. Después graba
+las respuestas en cassettes y comprueba que el replay da las mismas respuestas sin
+llamar al proveedor.
+Uso (desde backend/):  python benchmarks/load_test_fake_provider.py [-n 100] [--fail-rate 0.05]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("LLM_PROVIDER", "fake")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+
+import llm_gateway  # noqa: E402
+import main  # noqa: E402
+from benchmarks.fakes import approx_tokens  # noqa: E402
+from llm_providers import CassetteProvider, FakeProvider  # noqa: E402
+
+
+def paper(i: int):
+    return main.PaperData(title=f"Paper {i}", content=f"Abstract\nPaper number {i}.\n3 Method\nLinear attention.\n4 Experiments\nIt works.\n")
+
+
+def user():
+    return {"_id": ObjectId(), "credits": 10_000}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def timed_request(i: int):
+    started = time.perf_counter()
+    try:
+        result = await main.process_paper(paper(i), user())
+        return True, time.perf_counter() - started, result.summary
+    except Exception:
+        return False, time.perf_counter() - started, None
+
+
+async def load(n: int, provider):
+    main.app.state.llm_provider = provider
+    started = time.perf_counter()
+    results = await asyncio.gather(*(timed_request(i) for i in range(n)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for ok, latency, _ in results if ok]
+    ok = len(latencies)
+    print(f"  {ok}/{n} ok in {elapsed:.2f}s ({n / elapsed:.1f} papers/s)  "
+          f"p50={statistics.median(latencies):.2f}s p95={percentile(latencies, 0.95):.2f}s p99={percentile(latencies, 0.99):.2f}s")
+    return [summary for _, _, summary in results]
+
+
+async def run(n: int, fail_rate: float):
+    main.db = None
+    try:
+        main.count_tokens("warm up")
+    except Exception:
+        main.count_tokens = lambda text, model_name="cl100k_base": approx_tokens(text)
+    llm_gateway.LLM_RETRY_BASE_DELAY = 0.1
+
+    fake = FakeProvider(seed=7, latency="lognormal:0.8,0.4", chunk_delay="fixed:0.01", fail_rate=fail_rate, fail_code=429)
+    print(f"fake provider: latency {fake.latency.spec}, {fail_rate:.0%} injected 429s")
+    await load(n, fake)
+    print(f"  upstream calls={fake.calls}  gateway={main.llm_gateway.stats()['routes']}")
+
+    cassette_dir = tempfile.mkdtemp(prefix="deepread-cassettes-")
+    recorder = CassetteProvider("record", cassette_dir, inner=FakeProvider(seed=7, latency="fixed:0.05", chunk_delay="fixed:0.0"))
+    print(f"record into {cassette_dir}")
+    main.result_cache.memory.clear()
+    recorded = await load(min(n, 20), recorder)
+
+    replayer = CassetteProvider("replay", cassette_dir, model_name=recorder.model_name)
+    print("replay")
+    main.result_cache.memory.clear()
+    replayed = await load(min(n, 20), replayer)
+    assert recorded == replayed, "replayed responses differ from the recording"
+    print(f"  replay identical to recording, cassette hits={replayer.hits} misses={replayer.misses}  OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=100)
+    parser.add_argument("--fail-rate", type=float, default=0.05)
+    args = parser.parse_args()
+    asyncio.run(run(args.n, args.fail_rate))
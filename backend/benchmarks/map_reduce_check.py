@@ -0,0 +1,97 @@
+"""
+Comprobaciones del resumen map-reduce (summarization.py).
+
+1. Si un trozo falla, las llamadas hermanas en curso o en espera se cancelan (no siguen
+   gastando cuota) y el error llega al llamante.
+2. Los parciales que no caben en el reduce se condensan con la plantilla combine, no
+   con la del map como si fueran un trozo del paper.
+3. El reduce va por su propia ruta del gateway (summary_reduce), no por summary_map.
+
+Uso (desde backend/):  python benchmarks/map_reduce_check.py
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeGenerativeModel, approx_tokens  # noqa: E402
+from summarization import map_reduce_summary  # noqa: E402
+from token_accounting import RequestTokenRecord  # noqa: E402
+
+PARAGRAPH = "Linear attention approximates the softmax kernel with random features and keeps memory linear. " * 8
+
+
+def count(text: str) -> int:
+    return approx_tokens(text)
+
+
+async def failing_chunk_cancels_siblings():
+    started, cancelled = [], []
+
+    async def generate(prompt):
+        index = len(started)
+        started.append(index)
+        try:
+            if index == 1:
+                await asyncio.sleep(0.01)
+                raise RuntimeError("chunk 2 failed")
+            await asyncio.sleep(1)
+            return "partial", 10, 10
+        except asyncio.CancelledError:
+            cancelled.append(index)
+            raise
+
+    text = "\n\n".join(PARAGRAPH for _ in range(40))
+    try:
+        await map_reduce_summary("Paper", text, generate, count, "{chunk}", "{partial_summaries}", "{partial_summaries}", chunk_tokens=300, concurrency=4)
+        raise AssertionError("expected the failing chunk to propagate")
+    except RuntimeError as e:
+        assert str(e) == "chunk 2 failed", e
+    await asyncio.sleep(0.05)
+    assert len(started) == 4 and sorted(cancelled) == [0, 2, 3], (started, cancelled)
+    print(f"failing chunk: {len(cancelled)} in-flight siblings cancelled, queued chunks never started  OK")
+
+
+async def regroup_uses_combine_template():
+    prompts = []
+
+    async def generate(prompt):
+        prompts.append(prompt)
+        return PARAGRAPH, count(prompt), count(PARAGRAPH)  # Parciales largos: obligan a reagrupar
+
+    text = "\n\n".join(PARAGRAPH for _ in range(30))
+    result = await map_reduce_summary("Paper", text, generate, count, "MAP {part}/{parts}\n{chunk}",
+                                      "COMBINE {group}/{groups}\n{partial_summaries}", "REDUCE\n{partial_summaries}",
+                                      chunk_tokens=600, concurrency=4)
+    kinds = [prompt.split(" ", 1)[0].split("\n", 1)[0] for prompt in prompts]
+    assert kinds.count("COMBINE") >= 1 and kinds[-1] == "REDUCE", kinds
+    assert kinds.index("COMBINE") > max(i for i, kind in enumerate(kinds) if kind == "MAP"), kinds
+    print(f"regroup: {kinds.count('MAP')} map, {kinds.count('COMBINE')} combine, 1 reduce call ({result.calls} calls)  OK")
+
+
+async def reduce_has_its_own_route():
+    main.app.state.llm_provider = FakeGenerativeModel(latency=0)
+    before = {route: dict(counters) for route, counters in main.llm_gateway.counters.items()}
+    text = "\n\n".join(PARAGRAPH for _ in range(20))
+    record = RequestTokenRecord()
+    await map_reduce_summary("Paper", text, main.partial_summary_generator(record), count,
+                             main.SUMMARY_MAP_PROMPT_TEMPLATE, main.SUMMARY_COMBINE_PROMPT_TEMPLATE, main.SUMMARY_REDUCE_PROMPT_TEMPLATE,
+                             chunk_tokens=500, reduce_generate=main.partial_summary_generator(record, "summary_reduce"))
+
+    def calls(route):
+        return main.llm_gateway.counters.get(route, {}).get("calls", 0) - before.get(route, {}).get("calls", 0)
+
+    assert calls("summary_reduce") == 1 and calls("summary_map") >= 2, main.llm_gateway.counters
+    print(f"routes: {calls('summary_map')} summary_map calls, {calls('summary_reduce')} summary_reduce call  OK")
+
+
+async def run():
+    await failing_chunk_cancels_siblings()
+    await regroup_uses_combine_template()
+    await reduce_has_its_own_route()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
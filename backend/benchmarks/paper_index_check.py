@@ -0,0 +1,152 @@
+"""
+Comprobaciones y tiempos del índice BM25 de fragmentos del paper (paper_index.py).
+
+Con un paper sintético de --pages páginas (cada sección con su propio vocabulario):
+
+1. Construcción: fragmentos, términos, postings y bytes del índice en arrays.
+2. Relevancia: una pregunta sobre una sección recupera fragmentos de esa sección, y
+   nunca de las referencias.
+3. Presupuesto: los fragmentos elegidos (con etiquetas) caben en max_tokens.
+4. Persistencia: el índice se construye una vez aunque lo pidan 10 peticiones a la
+   vez, y otro proceso (un store nuevo) lo carga de la colección sin reconstruirlo.
+5. Chatbot: el índice no existe hasta que la sesión guarda su contexto con el
+   document_id; entonces se construye una sola vez (en segundo plano o en el primer
+   retrieve) y main.chatbot_message añade los fragmentos al prompt y sus tokens a
+   los de entrada.
+
+Uso (desde backend/):  python benchmarks/paper_index_check.py [--pages 30] [--queries 200]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeCollection, FakeGenerativeModel  # noqa: E402
+from credit_ledger import InMemoryCreditLedger  # noqa: E402
+from paper_index import PASSAGES_HEADER, PaperIndex, PaperIndexStore  # noqa: E402
+from pdf_extraction import build_section_index  # noqa: E402
+
+DOCUMENT_ID = "ab" * 32
+FILLER = "the proposed system is evaluated carefully and the observations are reported in detail for each setting"
+SECTIONS = [
+    ("Abstract", "we introduce sparse routing transformers for long document understanding"),
+    ("1 Introduction", "long documents motivate efficient attention because quadratic cost limits context length"),
+    ("2 Method", "the router assigns tokens to experts using a learned gating temperature tau and a load balancing loss"),
+    ("3 Experiments", "we benchmark on arxiv pubmed and govreport with rouge metrics and ablate the number of experts"),
+    ("4 Conclusion", "future work includes multilingual routing and hardware aware kernels"),
+    ("References", "vaswani attention is all you need neurips gating temperature tau load balancing"),
+]
+QUESTIONS = {
+    "method": "How is the gating temperature tau chosen for the router?",
+    "experiments": "Which datasets and rouge metrics were used in the benchmark?",
+    "introduction": "Why does quadratic cost limit the context length?",
+}
+
+
+def synthetic_paper(pages: int):
+    per_section = max(1, pages // len(SECTIONS))
+    parts, page_offsets, length = [], [], 0
+    for heading, topic in SECTIONS:
+        parts.append(f"\n{heading}\n")
+        length += len(parts[-1])
+        for page in range(per_section):
+            page_offsets.append(length)
+            paragraphs = [f"{topic} {FILLER} case {page}-{i}." if i % 3 == 0 else f"{FILLER} case {page}-{i}." for i in range(30)]
+            parts.append("\n".join(paragraphs) + "\n")
+            length += len(parts[-1])
+    text = "".join(parts)
+    sections = [section.model_dump() for section in build_section_index(text, page_offsets)]
+    return {"content": text, "sections": sections, "page_offsets": page_offsets}
+
+
+async def run(pages: int, queries: int):
+    document = synthetic_paper(pages)
+    count = main.prompt_planner.count
+    started = time.perf_counter()
+    index = PaperIndex.build(document["content"], document["sections"], document["page_offsets"], count)
+    build_ms = (time.perf_counter() - started) * 1000
+    postings = len(index.postings)
+    print(f"{len(document['content']) // 1024} KB of text, {pages} pages, sections {[section['kind'] for section in document['sections']]}")
+    print(f"  build: {build_ms:.0f} ms, {index.chunk_count} chunks, {len(index.terms)} terms, {postings} postings, "
+          f"{index.nbytes // 1024} KB ({index.nbytes / postings:.1f} bytes/posting)")
+
+    # 2. Relevancia
+    for kind, question in QUESTIONS.items():
+        hits = index.search(question, 4)
+        kinds = [index.kind_of(chunk_id) for chunk_id, _ in hits]
+        assert kinds and kinds[0] == kind, f"{question!r} retrieved {kinds}"
+        assert "references" not in kinds
+    timings = []
+    for i in range(queries):
+        started = time.perf_counter()
+        index.search(list(QUESTIONS.values())[i % len(QUESTIONS)], 4)
+        timings.append(time.perf_counter() - started)
+    print(f"  query: median {statistics.median(timings) * 1000:.2f} ms over {queries} queries")
+
+    # 3 y 4. Presupuesto y persistencia
+    collection = FakeCollection()
+    loads = 0
+
+    async def load_document(document_id):
+        nonlocal loads
+        loads += 1
+        return document if document_id == DOCUMENT_ID else None
+
+    store = PaperIndexStore(count, load_document, collection)
+    indexes = await asyncio.gather(*(store.get(DOCUMENT_ID) for _ in range(10)))
+    assert all(built is indexes[0] for built in indexes) and store.counters["built"] == 1, store.stats()
+    for budget in (150, 400, 800):
+        retrieval = await store.retrieve(DOCUMENT_ID, QUESTIONS["method"], budget, 4)
+        assert retrieval.tokens <= budget and (retrieval.passages or budget < 250), (budget, retrieval.report())
+        print(f"  budget {budget}: {len(retrieval.passages)} passages, {retrieval.tokens} tokens, "
+              f"sections {[passage['section'] for passage in retrieval.passages]}")
+    assert await store.get("cd" * 32) is None and store.counters["missing"] == 1
+
+    reopened = PaperIndexStore(count, load_document, collection)
+    loads_before = loads
+    started = time.perf_counter()
+    loaded = await reopened.get(DOCUMENT_ID)
+    load_ms = (time.perf_counter() - started) * 1000
+    assert reopened.counters == {**reopened.counters, "built": 0, "loaded": 1} and loads == loads_before, reopened.stats()
+    assert loaded.search(QUESTIONS["experiments"], 4) == index.search(QUESTIONS["experiments"], 4)
+    stored_bytes = sum(len(data) for data in collection.docs[DOCUMENT_ID]["arrays"].values()) + len(collection.docs[DOCUMENT_ID]["terms"])
+    print(f"  persisted: {stored_bytes // 1024} KB compressed, lazy load {load_ms:.1f} ms, stats {reopened.stats()}")
+
+    # 5. Chatbot con document_id
+    main.db = {name: FakeCollection() for name in (main.CHAT_SESSIONS_COLLECTION, main.CHAT_MESSAGES_COLLECTION, main.CHAT_CONTEXTS_COLLECTION)}
+    main.chat_context_store.collection = main.db[main.CHAT_CONTEXTS_COLLECTION]
+    main.conversation_memory.messages = main.db[main.CHAT_MESSAGES_COLLECTION]
+    main.conversation_memory.contexts = main.db[main.CHAT_CONTEXTS_COLLECTION]
+    main.paper_index_store = PaperIndexStore(count, load_document, FakeCollection())
+    main.credit_ledger = InMemoryCreditLedger()
+    main.app.state.llm_provider = model = FakeGenerativeModel(latency=0)
+    user = {"_id": ObjectId(), "credits": 1_000_000}
+    session_id = ObjectId()
+    main.db[main.CHAT_SESSIONS_COLLECTION].docs[session_id] = {"_id": session_id, "user_id": user["_id"], "title": "Paper", "version": 0}
+    assert main.paper_index_store.counters["built"] == 0
+    await main.put_chat_context(str(session_id), main.ChatContextRequest(
+        paper_title="Sparse Routing Transformers", paper_summary="We introduce sparse routing transformers.", document_id=DOCUMENT_ID), user)
+    result = await main.chatbot_message({"session_id": str(session_id), "message": QUESTIONS["method"]}, user)
+    retrieval = result["context"]["retrieval"]
+    assert PASSAGES_HEADER in model.prompts[-1] and "gating temperature tau" in model.prompts[-1]
+    assert retrieval["passages"] and retrieval["passages"][0]["section"] == "method"
+    assert 0 < retrieval["tokens"] <= main.CHATBOT_RETRIEVAL_TOKENS
+    assert main.paper_index_store.counters["built"] == 1, main.paper_index_store.stats()
+    print(f"  chatbot: {len(retrieval['passages'])} passages, {retrieval['tokens']} of {result['context']['used_tokens']} input tokens")
+    main.db = None
+    print("ok")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=30)
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.pages, args.queries))
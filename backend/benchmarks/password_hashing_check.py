@@ -0,0 +1,71 @@
+"""
+Comprobaciones del pool de bcrypt (password_hashing.py).
+
+1. Si la petición que espera un hash se cancela, su hueco sigue ocupado hasta que el
+   hilo de bcrypt termina: la siguiente operación espera en el event loop en vez de
+   encolarse en el executor detrás del trabajo huérfano.
+2. Con PASSWORD_HASH_MAX_QUEUE operaciones esperando, la siguiente se rechaza con
+   PasswordHasherBusy (503 en main.py) en lugar de acumularse.
+
+Uso (desde backend/):  python benchmarks/password_hashing_check.py
+"""
+import asyncio
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from password_hashing import PasswordHasher, PasswordHasherBusy  # noqa: E402
+
+
+async def cancelled_request_keeps_slot():
+    hasher = PasswordHasher(workers=1, max_queue=4, queue_timeout=5)
+    release = threading.Event()
+    orphan = asyncio.create_task(hasher._run(release.wait))
+    await asyncio.sleep(0.05)
+    orphan.cancel()
+    await asyncio.sleep(0.05)
+    follower = asyncio.create_task(hasher._run(lambda: "done"))
+    await asyncio.sleep(0.05)
+    try:
+        assert hasher.running == 1, hasher.stats()  # El hilo sigue calculando
+        assert not follower.done() and hasher.queued == 1, hasher.stats()
+    finally:
+        release.set()
+    assert await asyncio.wait_for(follower, timeout=2) == "done"
+    assert hasher.running == 0 and hasher.queued == 0, hasher.stats()
+    hasher.shutdown()
+    print("cancelled request: slot held until the bcrypt thread finished, next call waited on the loop  OK")
+
+
+async def full_queue_rejects():
+    hasher = PasswordHasher(workers=1, max_queue=2, queue_timeout=5)
+    release = threading.Event()
+    tasks = []
+    try:
+        for _ in range(3):
+            tasks.append(asyncio.create_task(hasher._run(release.wait)))
+            await asyncio.sleep(0.02)
+        assert hasher.running == 1 and hasher.queued == 2, hasher.stats()
+        try:
+            await hasher._run(lambda: None)
+            raise AssertionError("expected PasswordHasherBusy")
+        except PasswordHasherBusy:
+            pass
+    finally:
+        release.set()
+    await asyncio.gather(*tasks)
+    assert hasher.counters["rejected"] == 1 and hasher.running == 0, hasher.stats()
+    hasher.shutdown()
+    print(f"full queue: 1 running + {hasher.max_queue} waiting, next call rejected  OK")
+
+
+async def run():
+    await cancelled_request_keeps_slot()
+    await full_queue_rejects()
+    print("ok")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,101 @@
+"""
+Comprobación de concurrencia del single-flight de /api/process-paper.
+
+Lanza N peticiones idénticas contra process_paper con un modelo falso y verifica que
+solo hay una ejecución del pipeline (2 llamadas: resumen + código), que los errores
+llegan a todos los llamantes y que cancelar al líder no deja sin respuesta al resto.
+También comprueba que la caché de resultados distingue el título: el mismo texto con
+otro título no reutiliza un resumen generado con el título anterior.
+Uso (desde backend/):  python benchmarks/singleflight_check.py [-n 50]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+from fastapi import HTTPException  # noqa: E402
+
+import main  # noqa: E402
+from benchmarks.fakes import FakeGenerativeModel, approx_tokens  # noqa: E402
+
+PAPER_TEXT = "Abstract\nWe study efficient attention.\n3 Method\nLinear attention.\n4 Experiments\nIt works.\n"
+
+
+def fake_user():
+    return {"_id": ObjectId(), "credits": 10_000}
+
+
+def paper(tag: str):
+    return main.PaperData(title=f"Paper {tag}", content=f"{PAPER_TEXT} [{tag}]")
+
+
+async def identical_requests(n: int):
+    model = FakeGenerativeModel(latency=0.2)
+    main.app.state.llm_provider = model
+    results = await asyncio.gather(*(main.process_paper(paper("identical"), fake_user()) for _ in range(n)))
+    assert model.calls == 2, f"expected one pipeline run (2 LLM calls), got {model.calls}"
+    assert len({result.summary for result in results}) == 1
+    print(f"identical requests: {n} callers -> {model.calls} upstream calls  OK")
+
+
+async def error_propagation(n: int):
+    model = FakeGenerativeModel(latency=0.1, fail=RuntimeError("upstream 500"))
+    main.app.state.llm_provider = model
+    outcomes = await asyncio.gather(*(main.process_paper(paper("failing"), fake_user()) for _ in range(n)), return_exceptions=True)
+    assert all(isinstance(outcome, HTTPException) and outcome.status_code == 500 for outcome in outcomes), outcomes
+    assert model.calls == 1, f"expected the failing summary call once, got {model.calls}"
+    print(f"error propagation: {n} callers all got HTTP 500 from {model.calls} upstream call  OK")
+
+
+async def leader_cancellation(n: int):
+    model = FakeGenerativeModel(latency=0.2)
+    main.app.state.llm_provider = model
+    leader = asyncio.create_task(main.process_paper(paper("cancel"), fake_user()))
+    await asyncio.sleep(0.01)
+    followers = [asyncio.create_task(main.process_paper(paper("cancel"), fake_user())) for _ in range(n - 1)]
+    await asyncio.sleep(0.05)
+    leader.cancel()
+    results = await asyncio.gather(*followers)
+    assert leader.cancelled()
+    assert model.calls == 2, f"expected one pipeline run, got {model.calls} calls"
+    assert all(result.summary for result in results)
+    print(f"leader cancellation: {len(results)} followers served by {model.calls} upstream calls  OK")
+
+
+async def title_in_cache_key():
+    model = FakeGenerativeModel(latency=0)
+    main.app.state.llm_provider = model
+    content = f"{PAPER_TEXT} [titled]"
+    first = await main.process_paper(main.PaperData(title="Linear Attention", content=content), fake_user())
+    assert model.calls == 2 and "Linear Attention" in model.prompts[0]
+    await main.process_paper(main.PaperData(title="  linear   ATTENTION ", content=content), fake_user())
+    assert model.calls == 2, "same title with other spacing/case should hit the cache"
+    second = await main.process_paper(main.PaperData(title="Kernelized Transformers", content=content), fake_user())
+    assert model.calls == 4, f"another title reused a cached result ({model.calls} calls)"
+    assert "Kernelized Transformers" in model.prompts[2] and second.summary and first.summary
+    print(f"title in cache key: same text under a new title regenerated ({model.calls} upstream calls)  OK")
+
+
+async def main_check(n: int):
+    main.db = None  # Sin base de datos: se comprueba solo el pipeline y el reparto del resultado
+    try:
+        main.count_tokens("warm up")
+    except Exception:
+        # Sin red no se puede descargar el vocabulario de tiktoken; basta una aproximación
+        main.count_tokens = lambda text, model_name="cl100k_base": approx_tokens(text)
+    await identical_requests(n)
+    await error_propagation(n)
+    await leader_cancellation(n)
+    await title_in_cache_key()
+    assert main.paper_flights.in_flight() == 0
+    print(main.paper_flights.stats())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main_check(args.n))
@@ -0,0 +1,138 @@
+"""
+Comprobación de la caché de usuarios de get_current_user (user_cache.py).
+
+Con una colección users falsa que cuenta las consultas verifica que N peticiones
+concurrentes del mismo usuario hacen una sola lectura, que los cobros escriben el
+saldo en la caché (write-through), que las entradas caducan con el TTL, que una
+carga solapada con un cobro no guarda un saldo antiguo, que el hash de la
+contraseña no se cachea y que get_token_claims no consulta la base de datos.
+Uso (desde backend/):  python benchmarks/user_cache_check.py [-n 200]
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bson.objectid import ObjectId  # noqa: E402
+
+import main  # noqa: E402
+from credit_ledger import InMemoryCreditLedger  # noqa: E402
+from user_cache import UserCache  # noqa: E402
+
+
+class FakeUsers:
+    """find_one de motor sobre un dict, con latencia y contador de consultas."""
+
+    def __init__(self, latency: float = 0.02):
+        self.docs = {}
+        self.latency = latency
+        self.queries = 0
+
+    async def find_one(self, filter, projection=None):
+        self.queries += 1
+        await asyncio.sleep(self.latency)
+        doc = self.docs.get(filter["_id"])
+        if doc is None:
+            return None
+        excluded = {field for field, value in (projection or {}).items() if not value}
+        return {key: value for key, value in doc.items() if key not in excluded}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def setup(ttl: float = 30):
+    users = FakeUsers()
+    user_id = ObjectId()
+    users.docs[user_id] = {"_id": user_id, "email": "a@example.com", "name": "A", "password": "$2b$hash", "credits": 100}
+    main.db = {main.USERS_COLLECTION: users}
+    main.credit_ledger = InMemoryCreditLedger()
+    clock = FakeClock()
+    main.user_cache = UserCache(ttl=ttl, max_entries=100, enabled=True, clock=clock)
+    header = "Bearer " + main.create_access_token({"sub": str(user_id)})
+    return users, user_id, header, clock
+
+
+async def concurrent_misses(n: int):
+    users, _, header, _ = setup()
+    results = await asyncio.gather(*(main.get_current_user(header) for _ in range(n)))
+    assert users.queries == 1, f"expected one query for {n} concurrent misses, got {users.queries}"
+    assert all("password" not in user for user in results)
+    for _ in range(n):
+        await main.get_current_user(header)
+    stats = main.user_cache.stats()
+    assert users.queries == 1 and stats["hits"] == n, stats
+    print(f"concurrent misses: {2 * n} requests -> {users.queries} query, hit rate {stats['hit_rate']}  OK")
+
+
+async def credit_write_through():
+    users, user_id, header, _ = setup()
+    user = await main.get_current_user(header)
+    reservation = await main.reserve_credits(str(user_id), 30, None, user["credits"])
+    assert (await main.get_current_user(header))["credits"] == 70
+    await main.settle_credits(reservation, 10, user["credits"], "test", {})
+    assert (await main.get_current_user(header))["credits"] == 90
+    await main.charge_credits(str(user_id), 5, None, 90, "test", {})
+    assert (await main.get_current_user(header))["credits"] == 85
+    reservation = await main.reserve_credits(str(user_id), 20, None, 85)
+    await main.refund_credits(reservation)
+    assert (await main.get_current_user(header))["credits"] == 85
+    assert users.queries == 1, f"credit changes should not re-read the user, got {users.queries} queries"
+    print(f"write-through: reserve/settle/charge/refund visible with {users.queries} query  OK")
+
+
+async def ttl_expiry():
+    users, _, header, clock = setup(ttl=5)
+    await main.get_current_user(header)
+    clock.now += 4
+    await main.get_current_user(header)
+    clock.now += 2
+    await main.get_current_user(header)
+    stats = main.user_cache.stats()
+    assert users.queries == 2 and stats["expired"] == 1, stats
+    print("ttl: entry served before expiry and reloaded after  OK")
+
+
+async def load_overlapping_write():
+    users, user_id, header, _ = setup()
+    loading = asyncio.create_task(main.get_current_user(header))
+    await asyncio.sleep(0.005)  # La lectura ya ha empezado
+    main.user_cache.update_credits(user_id, 40)
+    users.docs[user_id]["credits"] = 40
+    await loading
+    assert (await main.get_current_user(header))["credits"] == 40
+    assert main.user_cache.stats()["loads_discarded"] == 1
+    main.user_cache.invalidate(user_id)
+    await main.get_current_user(header)
+    assert users.queries == 3, users.queries
+    print("overlapping load: stale read discarded, invalidate forces a reload  OK")
+
+
+async def claims_only():
+    users, user_id, header, _ = setup()
+    main.db = None
+    user = await main.get_token_claims(header)
+    assert user == {"_id": user_id} and users.queries == 0
+    print("claims only: user id from the token, no database  OK")
+
+
+async def run(n: int):
+    await concurrent_misses(n)
+    await credit_write_through()
+    await ttl_expiry()
+    await load_overlapping_write()
+    await claims_only()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--requests", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests))
@@ -0,0 +1,111 @@
+"""
+Contexto del paper de cada sesión de chat, guardado en el servidor.
+
+El chatbot recibía en cada mensaje el título, el resumen y todas las sugerencias de
+código, y en cada mensaje volvía a montar y a tokenizar el mismo contexto. Ahora:
+
+- PUT /api/chat/sessions/{id}/context guarda los campos del paper y el prefijo del
+  prompt ya renderizado (contexto + instrucciones), con su número de tokens.
+- El chatbot solo recibe session_id y message: lee el prefijo con una consulta por
+  _id y le añade la pregunta; solo se cuentan los tokens de la pregunta.
+- El prefijo es idéntico en todos los mensajes de la sesión y va al principio del
+  prompt, que es lo que necesita la caché de prefijos del proveedor.
+- Si vuelven a llegar los mismos campos (mismo digest) no se renderiza nada; si
+  cambian las plantillas o el presupuesto (otra versión) el prefijo se renderiza de
+  nuevo a partir de los campos guardados la primera vez que se lee.
+"""
+import hashlib
+import json
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from bson.objectid import ObjectId
+
+CONTEXT_FIELDS = ("title", "summary", "code_suggestions", "document_id")
+SUMMARY_PREVIEW_CHARS = 300
+
+# Lo que se lee en cada mensaje (sin los campos del paper)
+PREFIX_PROJECTION = {"fields": 0}
+
+
+def context_digest(fields: Dict[str, Any]) -> str:
+    canonical = json.dumps({key: fields.get(key) for key in CONTEXT_FIELDS}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def summary_preview(summary: str) -> str:
+    return summary[:SUMMARY_PREVIEW_CHARS] + "..." if summary else ""
+
+
+class ChatContextStore:
+    """
+    render(fields) -> (prefix, prefix_tokens, plan_summary). version identifica las
+    plantillas y presupuestos con los que se renderizó un prefijo.
+    """
+
+    def __init__(self, render: Callable[[Dict[str, Any]], Tuple[str, int, Dict[str, Any]]], version: str, collection=None):
+        self.render = render
+        self.version = version
+        self.collection = collection
+        self.counters = {"rendered": 0, "unchanged": 0, "loaded": 0, "rerendered": 0, "missing": 0}
+
+    def _entry(self, session_id: ObjectId, user_id: ObjectId, fields: Dict[str, Any], digest: str) -> Dict[str, Any]:
+        prefix, prefix_tokens, plan = self.render(fields)
+        return {
+            "_id": session_id,
+            "user_id": user_id,
+            "fields": fields,
+            "digest": digest,
+            "version": self.version,
+            "prefix": prefix,
+            "prefix_tokens": prefix_tokens,
+            "plan": plan,
+            "title": fields.get("title") or "",
+            "document_id": fields.get("document_id"),
+            "summary_preview": summary_preview(fields.get("summary") or ""),
+            "updated_at": datetime.utcnow(),
+        }
+
+    async def _write(self, entry: Dict[str, Any], upsert: bool = False):
+        # $set y no replace: el documento también guarda la memoria de la conversación (conversation_memory.py)
+        fields = {key: value for key, value in entry.items() if key not in ("_id", "user_id")}
+        await self.collection.update_one({"_id": entry["_id"], "user_id": entry["user_id"]}, {"$set": fields}, upsert=upsert)
+
+    async def save(self, session_id: ObjectId, user_id: ObjectId, fields: Dict[str, Any]) -> Dict[str, Any]:
+        """Guarda el contexto de la sesión; la sesión debe ser del usuario (se comprueba antes)."""
+        fields = {key: fields.get(key) for key in CONTEXT_FIELDS}
+        digest = context_digest(fields)
+        current = await self.collection.find_one({"_id": session_id, "user_id": user_id}, PREFIX_PROJECTION)
+        if current is not None and current.get("digest") == digest and current.get("version") == self.version:
+            self.counters["unchanged"] += 1
+            return current
+        entry = self._entry(session_id, user_id, fields, digest)
+        await self._write(entry, upsert=True)
+        self.counters["rendered"] += 1
+        entry.pop("fields")
+        return {**entry, "memory": (current or {}).get("memory")}
+
+    async def load(self, session_id: ObjectId, user_id: ObjectId) -> Optional[Dict[str, Any]]:
+        """El prefijo renderizado de la sesión, o None si no tiene contexto."""
+        current = await self.collection.find_one({"_id": session_id, "user_id": user_id}, PREFIX_PROJECTION)
+        if current is None:
+            self.counters["missing"] += 1
+            return None
+        if current.get("version") == self.version:
+            self.counters["loaded"] += 1
+            return current
+        # Renderizado con otras plantillas: se rehace una vez con los campos guardados
+        stored = await self.collection.find_one({"_id": session_id, "user_id": user_id}, {"fields": 1, "digest": 1})
+        if stored is None:
+            return None
+        entry = self._entry(session_id, user_id, stored["fields"], stored["digest"])
+        await self._write(entry)
+        self.counters["rerendered"] += 1
+        entry.pop("fields")
+        return {**entry, "memory": current.get("memory")}
+
+    async def delete(self, session_id: ObjectId, user_id: ObjectId):
+        await self.collection.delete_one({"_id": session_id, "user_id": user_id})
+
+    def stats(self) -> Dict[str, Any]:
+        return {"version": self.version, **self.counters}
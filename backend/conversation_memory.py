@@ -0,0 +1,199 @@
+"""
+Memoria de conversación del chatbot, acotada por tokens.
+
+Los turnos del chatbot se guardaban en chat_messages pero el prompt nunca los
+incluía: el bot no recordaba nada. Meter el historial completo haría crecer el coste
+de cada mensaje sin límite. Ahora:
+
+- load() lee los últimos CHAT_MEMORY_MAX_TURNS turnos de la sesión posteriores a lo
+  ya resumido, con una consulta sobre el índice (session_id, timestamp, _id).
+- Los turnos más recientes entran en el prompt mientras quepan en CHAT_MEMORY_TOKENS;
+  cada mensaje guarda sus tokens (memory_tokens) para no volver a tokenizarlo. Los
+  mensajes antiguos que no los tienen se cuentan en el pool de tokenización.
+- Cuando no caben todos, compact() resume los más antiguos junto con el resumen
+  anterior (incremental: nunca se vuelve a resumir toda la conversación) y guarda el
+  resumen y hasta qué mensaje cubre en el contexto de la sesión (chat_contexts). Se
+  compacta hasta dejar CHAT_MEMORY_COMPACT_TARGET del presupuesto, para no tener que
+  compactar en cada mensaje.
+
+El tamaño del prompt queda acotado por resumen + turnos recientes, sea cual sea la
+longitud de la conversación.
+"""
+import os
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+
+from token_accounting import run_in_token_pool
+
+CHAT_MEMORY_MAX_TURNS = int(os.getenv("CHAT_MEMORY_MAX_TURNS", "20"))
+CHAT_MEMORY_TOKENS = int(os.getenv("CHAT_MEMORY_TOKENS", "1000"))
+CHAT_MEMORY_SUMMARY_TOKENS = int(os.getenv("CHAT_MEMORY_SUMMARY_TOKENS", "250"))
+# Tras compactar, los turnos recientes ocupan como mucho esta fracción de CHAT_MEMORY_TOKENS
+CHAT_MEMORY_COMPACT_TARGET = float(os.getenv("CHAT_MEMORY_COMPACT_TARGET", "0.5"))
+
+# content_type de los mensajes del chatbot en chat_messages
+CHAT_TURN_TYPES = ["chat_message", "chat_response"]
+ROLE_LABELS = {"user": "Usuario", "assistant": "Asistente"}
+SUMMARY_HEADER = "RESUMEN DE LA CONVERSACIÓN ANTERIOR:\n"
+TURNS_HEADER = "CONVERSACIÓN RECIENTE:\n"
+TURN_PROJECTION = {"role": 1, "content": 1, "timestamp": 1, "memory_tokens": 1}
+
+
+def after_watermark(session_id: ObjectId, covered_until: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Turnos del chatbot de la sesión posteriores al último mensaje ya resumido."""
+    query: Dict[str, Any] = {"session_id": session_id, "content_type": {"$in": CHAT_TURN_TYPES}}
+    if covered_until:
+        timestamp, last_id = covered_until["timestamp"], covered_until["_id"]
+        query["timestamp"] = {"$gte": timestamp}
+        query["$or"] = [{"timestamp": {"$gt": timestamp}}, {"_id": {"$gt": last_id}}]
+    return query
+
+
+def render_turns(turns: List[Dict[str, Any]]) -> str:
+    return "".join(f"{ROLE_LABELS.get(turn.get('role'), 'Usuario')}: {turn.get('content', '')}\n" for turn in turns)
+
+
+class MemoryWindow:
+    """Lo que entra en el prompt (resumen + turnos recientes) y lo que quedó fuera."""
+
+    def __init__(self, state: Dict[str, Any], turns: List[Dict[str, Any]], overflow: List[Dict[str, Any]], has_older: bool):
+        self.state = state
+        self.summary = state.get("summary") or ""
+        self.summary_tokens = state.get("summary_tokens", 0)
+        self.turns = turns  # En orden cronológico
+        self.overflow = overflow  # Turnos cargados que no cupieron, más antiguos que self.turns
+        self.has_older = has_older  # Hay turnos sin resumir anteriores a los cargados
+
+    @property
+    def needs_compaction(self) -> bool:
+        return bool(self.overflow) or self.has_older
+
+    @property
+    def turn_tokens(self) -> int:
+        return sum(turn["memory_tokens"] for turn in self.turns)
+
+    def render(self) -> str:
+        text = ""
+        if self.summary:
+            text += f"{SUMMARY_HEADER}{self.summary}\n\n"
+        if self.turns:
+            text += f"{TURNS_HEADER}{render_turns(self.turns)}\n"
+        return text
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "summary_tokens": self.summary_tokens,
+            "turns": len(self.turns),
+            "turn_tokens": self.turn_tokens,
+            "compacted_turns": self.state.get("compacted_turns", 0),
+            "dropped_turns": len(self.overflow),
+        }
+
+
+class ConversationMemory:
+    def __init__(self, count_tokens: Callable[[str], int], messages=None, contexts=None,
+                 max_turns: int = CHAT_MEMORY_MAX_TURNS, budget: int = CHAT_MEMORY_TOKENS,
+                 summary_tokens: int = CHAT_MEMORY_SUMMARY_TOKENS, compact_target: float = CHAT_MEMORY_COMPACT_TARGET):
+        self.count_tokens = count_tokens
+        self.messages = messages
+        self.contexts = contexts
+        self.max_turns = max_turns
+        self.budget = budget
+        self.summary_tokens = summary_tokens
+        self.compact_target = compact_target
+        self.counters = {"loads": 0, "compactions": 0, "compacted_turns": 0, "compaction_conflicts": 0, "compaction_failures": 0}
+
+    def _count_all(self, texts: List[str]) -> List[int]:
+        return [self.count_tokens(text) for text in texts]
+
+    async def _with_tokens(self, turns: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # Mensajes anteriores a memory_tokens: se cuentan al cargarlos, todos en una tarea
+        # del pool de tokenización (fuera del event loop, como el planificador)
+        missing = [turn for turn in turns if turn.get("memory_tokens") is None]
+        if missing:
+            counts = await run_in_token_pool(self._count_all, [turn.get("content", "") for turn in missing])
+            for turn, tokens in zip(missing, counts):
+                turn["memory_tokens"] = tokens
+        return turns
+
+    def _split(self, turns: List[Dict[str, Any]], budget: int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """(más antiguos que no caben, recientes que caben en budget), ambos cronológicos."""
+        used, start = 0, len(turns)
+        while start > 0 and used + turns[start - 1]["memory_tokens"] <= budget:
+            start -= 1
+            used += turns[start]["memory_tokens"]
+        return turns[:start], turns[start:]
+
+    async def load(self, session_id: ObjectId, state: Optional[Dict[str, Any]]) -> MemoryWindow:
+        state = state or {}
+        cursor = self.messages.find(after_watermark(session_id, state.get("covered_until")), TURN_PROJECTION)
+        newest = await cursor.sort([("timestamp", -1), ("_id", -1)]).limit(self.max_turns + 1).to_list(length=None)
+        has_older = len(newest) > self.max_turns
+        turns = await self._with_tokens(list(reversed(newest[:self.max_turns])))
+        overflow, recent = self._split(turns, self.budget)
+        self.counters["loads"] += 1
+        return MemoryWindow(state, recent, overflow, has_older)
+
+    async def compact(self, session_id: ObjectId, user_id: ObjectId, window: MemoryWindow,
+                      summarize: Callable[[str, str, int], Awaitable[str]]) -> MemoryWindow:
+        """
+        Resume en el resumen guardado los turnos que sobran (y los anteriores a la ventana
+        si los hay). summarize(resumen_anterior, turnos, max_tokens) llama al LLM. Si otra
+        petición compactó a la vez, o la llamada falla, devuelve la ventana sin los turnos
+        que no cabían.
+        """
+        older, keep = self._split(window.turns, int(self.budget * self.compact_target))
+        batch = window.overflow + older
+        if window.has_older:
+            first_loaded = (batch or keep)[0]
+            # Turnos sin resumir anteriores a la ventana cargada, en orden cronológico
+            query = after_watermark(session_id, window.state.get("covered_until"))
+            query["$and"] = [{"timestamp": {"$lte": first_loaded["timestamp"]}},
+                             {"$or": [{"timestamp": {"$lt": first_loaded["timestamp"]}}, {"_id": {"$lt": first_loaded["_id"]}}]}]
+            cursor = self.messages.find(query, TURN_PROJECTION).sort([("timestamp", 1), ("_id", 1)]).limit(self.max_turns)
+            earlier = await self._with_tokens([turn async for turn in cursor])
+            # Si hay más de los que caben en una compactación, se resume solo el tramo más antiguo
+            # (lo resumido tiene que ser siempre contiguo a covered_until)
+            batch = earlier if len(earlier) >= self.max_turns else earlier + batch
+        trimmed = MemoryWindow(window.state, window.turns, [], False)
+        if not batch:
+            return trimmed
+
+        try:
+            summary = await summarize(window.summary, render_turns(batch), self.summary_tokens)
+        except Exception as e:
+            print(f"Chat memory compaction failed for session {session_id}: {type(e).__name__}: {e}")
+            self.counters["compaction_failures"] += 1
+            return trimmed
+
+        previous = window.state.get("covered_until") or {}
+        last = batch[-1]
+        state = {
+            "summary": summary,
+            "summary_tokens": await run_in_token_pool(self.count_tokens, summary),
+            "covered_until": {"timestamp": last["timestamp"], "_id": last["_id"]},
+            "compacted_turns": window.state.get("compacted_turns", 0) + len(batch),
+            "updated_at": datetime.utcnow(),
+        }
+        # Solo si nadie ha compactado desde que se leyó la memoria (null también casa con "sin memoria")
+        result = await self.contexts.update_one(
+            {"_id": session_id, "user_id": user_id, "memory.covered_until._id": previous.get("_id")},
+            {"$set": {"memory": state}},
+        )
+        if result.matched_count == 0:
+            self.counters["compaction_conflicts"] += 1
+            return trimmed
+        self.counters["compactions"] += 1
+        self.counters["compacted_turns"] += len(batch)
+        return MemoryWindow(state, keep, [], False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_turns": self.max_turns,
+            "budget": self.budget,
+            "summary_tokens": self.summary_tokens,
+            "compact_target": self.compact_target,
+            **self.counters,
+        }
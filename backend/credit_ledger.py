@@ -0,0 +1,285 @@
+"""
+Libro de créditos: reserva atómica y liquidación.
+
+Antes se leían los créditos del usuario al autenticar, se comprobaban en local y al
+final se hacía un $inc y un insert en credit_logs por separado: con peticiones
+concurrentes un usuario podía gastar más de lo que tenía. Ahora:
+
+1. reserve(): descuenta el coste estimado con un find_one_and_update condicionado a
+   credits >= estimado (una sola operación; si no hay saldo no se descuenta nada).
+2. settle(): tras la llamada al LLM ajusta la diferencia entre lo reservado y el coste
+   real (si el coste supera la reserva, el exceso se cobra como mucho hasta el saldo
+   disponible, sin dejarlo en negativo) y escribe la entrada del log en la misma
+   transacción (si el despliegue de Mongo admite transacciones; si no, el log usa el id
+   de la reserva como _id).
+3. refund(): si la petición falla se devuelve la reserva completa.
+
+charge() reserva y liquida un importe conocido de una vez (resultados en caché).
+InMemoryCreditLedger tiene la misma interfaz para pruebas y despliegues sin base de datos.
+"""
+import os
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+# auto: se usan transacciones si el servidor es un replica set o un mongos
+CREDIT_LEDGER_TRANSACTIONS = os.getenv("CREDIT_LEDGER_TRANSACTIONS", "auto").lower()
+
+
+class InsufficientCredits(Exception):
+    def __init__(self, required: int, available: Optional[int]):
+        super().__init__(f"Insufficient credits. Required: ~{required}, Available: {available}.")
+        self.required = required
+        self.available = available
+
+
+class AccountNotFound(Exception):
+    pass
+
+
+class CreditReservation:
+    def __init__(self, user_id: ObjectId, amount: int, session_id: Optional[ObjectId], balance: Optional[int]):
+        self.id = ObjectId()
+        self.user_id = user_id
+        self.amount = amount
+        self.session_id = session_id
+        self.balance = balance  # Saldo tras la reserva
+        self.settled = False
+        self.created_at = datetime.utcnow()
+
+
+def _log_entry(reservation: CreditReservation, amount: int, reason: str, details: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "_id": reservation.id,
+        "user_id": reservation.user_id,
+        "session_id": reservation.session_id,
+        "type": "deduction",
+        "amount": amount,
+        "reason": reason,
+        "timestamp": datetime.utcnow(),
+        "details": {**(details or {}), "reserved": reservation.amount},
+    }
+
+
+class MongoCreditLedger:
+    """Colecciones de motor; con transacciones, settle y charge van en una sola transacción."""
+
+    def __init__(self, client, users, logs, use_transactions: Optional[bool] = None):
+        self.client = client
+        self.users = users
+        self.logs = logs
+        self.use_transactions = use_transactions
+        self.counters = {"reserved": 0, "rejected": 0, "settled": 0, "refunded": 0, "charged": 0}
+
+    async def detect_transactions(self) -> bool:
+        if self.use_transactions is None:
+            if CREDIT_LEDGER_TRANSACTIONS in ("on", "true"):
+                self.use_transactions = True
+            elif CREDIT_LEDGER_TRANSACTIONS in ("off", "false"):
+                self.use_transactions = False
+            else:
+                hello = await self.client.admin.command("hello")
+                self.use_transactions = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+        return self.use_transactions
+
+    async def _take(self, user_id: ObjectId, amount: int, session=None) -> int:
+        user = await self.users.find_one_and_update(
+            {"_id": user_id, "credits": {"$gte": amount}},
+            {"$inc": {"credits": -amount}},
+            projection={"credits": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if user is not None:
+            return user["credits"]
+        # Solo en el camino de error: distinguir saldo insuficiente de usuario inexistente
+        current = await self.users.find_one({"_id": user_id}, {"credits": 1}, session=session)
+        if current is None:
+            raise AccountNotFound(f"User {user_id} not found")
+        raise InsufficientCredits(amount, current.get("credits", 0))
+
+    async def reserve(self, user_id: ObjectId, amount: int, session_id: Optional[ObjectId] = None, opening_balance: Optional[int] = None) -> CreditReservation:
+        if amount <= 0:
+            return CreditReservation(user_id, 0, session_id, opening_balance)
+        try:
+            balance = await self._take(user_id, amount)
+        except InsufficientCredits:
+            self.counters["rejected"] += 1
+            raise
+        self.counters["reserved"] += 1
+        return CreditReservation(user_id, amount, session_id, balance)
+
+    async def _charge_overage(self, user_id: ObjectId, extra: int, session=None):
+        """Cobra el exceso sobre la reserva sin dejar el saldo en negativo. Devuelve (cobrado, saldo)."""
+        user = await self.users.find_one_and_update(
+            {"_id": user_id, "credits": {"$gte": extra}},
+            {"$inc": {"credits": -extra}},
+            projection={"credits": 1},
+            return_document=ReturnDocument.AFTER,
+            session=session,
+        )
+        if user is not None:
+            return extra, user["credits"]
+        # Saldo insuficiente para el exceso: se cobra solo lo disponible (una sola actualización atómica)
+        before = await self.users.find_one_and_update(
+            {"_id": user_id},
+            [{"$set": {"credits": {"$max": [0, {"$subtract": ["$credits", extra]}]}}}],
+            projection={"credits": 1},
+            return_document=ReturnDocument.BEFORE,
+            session=session,
+        )
+        if before is None:
+            return 0, None
+        previous = max(0, before.get("credits", 0))
+        return min(extra, previous), max(0, previous - extra)
+
+    async def _settle(self, reservation: CreditReservation, amount: int, reason: str, details, session=None) -> Optional[int]:
+        balance = reservation.balance
+        adjustment = reservation.amount - amount
+        if adjustment > 0:
+            # Devuelve lo que sobró de la reserva
+            user = await self.users.find_one_and_update(
+                {"_id": reservation.user_id},
+                {"$inc": {"credits": adjustment}},
+                projection={"credits": 1},
+                return_document=ReturnDocument.AFTER,
+                session=session,
+            )
+            balance = user["credits"] if user else None
+        elif adjustment < 0:
+            # El coste real superó la reserva: el exceso se limita al saldo disponible
+            extra, balance = await self._charge_overage(reservation.user_id, -adjustment, session=session)
+            if extra < -adjustment:
+                details = {**(details or {}), "uncollected": -adjustment - extra}
+                amount = reservation.amount + extra
+        if session is None:
+            # Sin transacción el saldo ya está ajustado: si el log falla no se debe reembolsar
+            reservation.settled = True
+        if amount > 0:
+            await self.logs.insert_one(_log_entry(reservation, amount, reason, details), session=session)
+        return balance
+
+    async def _in_transaction(self, fn, *args):
+        if not self.use_transactions:
+            return await fn(*args)
+        async with await self.client.start_session() as session:
+            return await session.with_transaction(lambda s: fn(*args, session=s))
+
+    async def settle(self, reservation: CreditReservation, amount: int, reason: str, details: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        """
+        Liquida la reserva al coste real y registra el movimiento. Devuelve el saldo final.
+
+        Si el coste real supera la reserva, el exceso se cobra solo hasta el saldo
+        disponible (el saldo nunca queda en negativo); el log registra lo cobrado de
+        verdad y lo que quedó sin cobrar en details.uncollected.
+        """
+        if reservation.settled:
+            raise ValueError("Credit reservation already settled")
+        balance = await self._in_transaction(self._settle, reservation, amount, reason, details)
+        reservation.settled = True
+        self.counters["settled"] += 1
+        return balance
+
+    async def refund(self, reservation: CreditReservation) -> Optional[int]:
+        """Devuelve la reserva completa (la petición falló antes de liquidar)."""
+        if reservation.settled:
+            return reservation.balance
+        reservation.settled = True
+        if reservation.amount <= 0:
+            return reservation.balance
+        user = await self.users.find_one_and_update(
+            {"_id": reservation.user_id},
+            {"$inc": {"credits": reservation.amount}},
+            projection={"credits": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        self.counters["refunded"] += 1
+        return user["credits"] if user else None
+
+    async def _charge(self, user_id: ObjectId, amount: int, session_id, reason: str, details, session=None) -> int:
+        balance = await self._take(user_id, amount, session=session)
+        reservation = CreditReservation(user_id, amount, session_id, balance)
+        await self._settle(reservation, amount, reason, details, session=session)
+        return balance
+
+    async def charge(self, user_id: ObjectId, amount: int, reason: str, details: Optional[Dict[str, Any]] = None, session_id: Optional[ObjectId] = None, opening_balance: Optional[int] = None) -> Optional[int]:
+        """Cobro de un importe ya conocido: descuento condicionado + log en una transacción."""
+        if amount <= 0:
+            return opening_balance
+        try:
+            balance = await self._in_transaction(self._charge, user_id, amount, session_id, reason, details)
+        except InsufficientCredits:
+            self.counters["rejected"] += 1
+            raise
+        self.counters["charged"] += 1
+        return balance
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "mongo", "transactions": self.use_transactions, **self.counters}
+
+
+class InMemoryCreditLedger:
+    """Misma interfaz que MongoCreditLedger; las cuentas se abren con opening_balance la primera vez."""
+
+    def __init__(self):
+        self.balances: Dict[ObjectId, int] = {}
+        self.logs = []
+        self.counters = {"reserved": 0, "rejected": 0, "settled": 0, "refunded": 0, "charged": 0}
+
+    async def detect_transactions(self) -> bool:
+        return False
+
+    def _take(self, user_id: ObjectId, amount: int, opening_balance: Optional[int]) -> int:
+        balance = self.balances.setdefault(user_id, opening_balance or 0)
+        if balance < amount:
+            self.counters["rejected"] += 1
+            raise InsufficientCredits(amount, balance)
+        self.balances[user_id] = balance - amount
+        return self.balances[user_id]
+
+    async def reserve(self, user_id: ObjectId, amount: int, session_id: Optional[ObjectId] = None, opening_balance: Optional[int] = None) -> CreditReservation:
+        if amount <= 0:
+            return CreditReservation(user_id, 0, session_id, self.balances.get(user_id, opening_balance))
+        balance = self._take(user_id, amount, opening_balance)
+        self.counters["reserved"] += 1
+        return CreditReservation(user_id, amount, session_id, balance)
+
+    async def settle(self, reservation: CreditReservation, amount: int, reason: str, details: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        if reservation.settled:
+            raise ValueError("Credit reservation already settled")
+        reservation.settled = True
+        if reservation.user_id in self.balances:
+            balance = self.balances[reservation.user_id]
+            extra = amount - reservation.amount
+            if extra > balance:
+                # Mismo tope que MongoCreditLedger: el exceso no deja el saldo en negativo
+                details = {**(details or {}), "uncollected": extra - balance}
+                amount = reservation.amount + balance
+            self.balances[reservation.user_id] = balance + reservation.amount - amount
+        if amount > 0:
+            self.logs.append(_log_entry(reservation, amount, reason, details))
+        self.counters["settled"] += 1
+        return self.balances.get(reservation.user_id, reservation.balance)
+
+    async def refund(self, reservation: CreditReservation) -> Optional[int]:
+        if not reservation.settled:
+            reservation.settled = True
+            if reservation.amount > 0:
+                self.balances[reservation.user_id] += reservation.amount
+                self.counters["refunded"] += 1
+        return self.balances.get(reservation.user_id, reservation.balance)
+
+    async def charge(self, user_id: ObjectId, amount: int, reason: str, details: Optional[Dict[str, Any]] = None, session_id: Optional[ObjectId] = None, opening_balance: Optional[int] = None) -> Optional[int]:
+        if amount <= 0:
+            return self.balances.get(user_id, opening_balance)
+        balance = self._take(user_id, amount, opening_balance)
+        reservation = CreditReservation(user_id, amount, session_id, balance)
+        reservation.settled = True
+        self.logs.append(_log_entry(reservation, amount, reason, details))
+        self.counters["charged"] += 1
+        return balance
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "transactions": False, **self.counters}
@@ -0,0 +1,206 @@
+"""
+Índices de MongoDB declarados en un solo sitio.
+
+Ninguna colección tenía índices: el login por email, los mensajes de una sesión, el
+historial de resúmenes y la lista de sesiones acababan en COLLSCAN, y register
+esperaba un DuplicateKeyError que sin índice único nunca llegaba.
+
+- INDEX_SPECS declara los índices de cada colección. reconcile_indexes() los compara
+  con los que existen al arrancar: crea los que faltan, reconstruye los que tienen el
+  mismo nombre con otra definición y avisa de los no declarados (solo los borra con
+  DB_DROP_UNDECLARED_INDEXES=true).
+- query_shapes() recoge la forma de cada consulta de main.py y de los stores;
+  check_query_plans() ejecuta explain() sobre todas y marca las que no usan índice
+  (ver benchmarks/index_check.py).
+"""
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson.objectid import ObjectId
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+
+DB_DROP_UNDECLARED_INDEXES = os.getenv("DB_DROP_UNDECLARED_INDEXES", "false").lower() == "true"
+
+# Etapas del plan que indican que la consulta no está respaldada por un índice
+UNINDEXED_STAGES = ("COLLSCAN", "SORT")
+
+
+class IndexSpec:
+    def __init__(self, collection: str, keys: List[Tuple[str, int]], name: Optional[str] = None, **options):
+        self.collection = collection
+        self.keys = list(keys)
+        self.name = name or "_".join(f"{field}_{direction}" for field, direction in self.keys)
+        self.options = options
+
+    def same_keys(self, info: Dict[str, Any]) -> bool:
+        return [(field, int(direction)) for field, direction in info["key"].items()] == self.keys
+
+    def matches(self, info: Dict[str, Any]) -> bool:
+        return self.same_keys(info) and all(info.get(option) == value for option, value in self.options.items())
+
+    def model(self) -> IndexModel:
+        return IndexModel(self.keys, name=self.name, **self.options)
+
+    def describe(self) -> str:
+        return f"{self.collection}.{self.name}"
+
+
+# Los nombres de colección son los de main.py (USERS_COLLECTION, CHAT_MESSAGES_COLLECTION...)
+INDEX_SPECS: List[IndexSpec] = [
+    # Login y register (el índice único es el que produce el DuplicateKeyError)
+    IndexSpec("users", [("email", 1)], name="email_unique", unique=True),
+    # Lista paginada de sesiones del usuario, más recientes primero (_id desempata el cursor)
+    IndexSpec("chat_sessions", [("user_id", 1), ("last_updated", -1), ("_id", -1)]),
+    # Mensajes de una sesión en orden, paginados por cursor (_id desempata)
+    IndexSpec("chat_messages", [("session_id", 1), ("timestamp", 1), ("_id", 1)]),
+    # Upserts de la sincronización incremental: mensajes creados por el cliente, con su id
+    IndexSpec("chat_messages", [("session_id", 1), ("client_id", 1)], name="session_client_id_unique",
+              unique=True, partialFilterExpression={"client_id": {"$exists": True}}),
+    # Historial paginado de resúmenes y código del usuario (_id desempata el cursor)
+    IndexSpec("chat_messages", [("user_id", 1), ("content_type", 1), ("timestamp", -1), ("_id", -1)]),
+    # Movimientos de créditos de un usuario
+    IndexSpec("credit_logs", [("user_id", 1), ("timestamp", -1)]),
+    # Cola de trabajos (también lo crea MongoJobStore.ensure_indexes con el mismo nombre)
+    IndexSpec("jobs", [("status", 1), ("created_at", 1)]),
+    # Expulsión LRU de la caché de extracciones
+    IndexSpec("pdf_extractions", [("last_access", 1)]),
+]
+
+
+class QueryShape:
+    """Una consulta tal y como la hace la aplicación, con valores de ejemplo para explain()."""
+
+    def __init__(self, name: str, collection: str, filter: Dict[str, Any], sort: Optional[List[Tuple[str, int]]] = None):
+        self.name = name
+        self.collection = collection
+        self.filter = filter
+        self.sort = sort
+
+
+def query_shapes() -> List[QueryShape]:
+    user_id, session_id, now = ObjectId(), ObjectId(), datetime.utcnow()
+    return [
+        QueryShape("get_current_user", "users", {"_id": user_id}),
+        QueryShape("login/register by email", "users", {"email": "someone@example.com"}),
+        QueryShape("processed history page", "chat_messages",
+                   {"user_id": user_id, "content_type": {"$in": ["summary", "code_suggestion"]}}, [("timestamp", -1), ("_id", -1)]),
+        QueryShape("processed history after cursor", "chat_messages",
+                   {"user_id": user_id, "content_type": {"$in": ["summary", "code_suggestion"]}, "timestamp": {"$lte": now},
+                    "$or": [{"timestamp": {"$lt": now}}, {"_id": {"$lt": session_id}}]},
+                   [("timestamp", -1), ("_id", -1)]),
+        QueryShape("processed history by type", "chat_messages",
+                   {"user_id": user_id, "content_type": "summary"}, [("timestamp", -1), ("_id", -1)]),
+        QueryShape("session messages", "chat_messages", {"session_id": session_id}, [("timestamp", 1)]),
+        QueryShape("latest message page", "chat_messages", {"session_id": session_id}, [("timestamp", -1), ("_id", -1)]),
+        QueryShape("message page before cursor", "chat_messages",
+                   {"session_id": session_id, "timestamp": {"$lte": now}, "$or": [{"timestamp": {"$lt": now}}, {"_id": {"$lt": session_id}}]},
+                   [("timestamp", -1), ("_id", -1)]),
+        QueryShape("message page after cursor", "chat_messages",
+                   {"session_id": session_id, "timestamp": {"$gte": now}, "$or": [{"timestamp": {"$gt": now}}, {"_id": {"$gt": session_id}}]},
+                   [("timestamp", 1), ("_id", 1)]),
+        QueryShape("message payload", "chat_messages", {"_id": session_id, "session_id": session_id}),
+        QueryShape("sync upsert by client id", "chat_messages", {"session_id": session_id, "client_id": "client-message-id"}),
+        QueryShape("session last message", "chat_messages", {"session_id": session_id}, [("timestamp", -1)]),
+        QueryShape("delete session messages", "chat_messages", {"session_id": session_id, "user_id": user_id}),
+        QueryShape("user sessions", "chat_sessions", {"user_id": user_id}, [("last_updated", -1), ("_id", -1)]),
+        QueryShape("user sessions after cursor", "chat_sessions",
+                   {"user_id": user_id, "last_updated": {"$lte": now}, "$or": [{"last_updated": {"$lt": now}}, {"_id": {"$lt": session_id}}]},
+                   [("last_updated", -1), ("_id", -1)]),
+        QueryShape("session by owner", "chat_sessions", {"_id": session_id, "user_id": user_id}),
+        QueryShape("chat context by session", "chat_contexts", {"_id": session_id, "user_id": user_id}),
+        QueryShape("paper index by document", "paper_indexes", {"_id": "0" * 64}),
+        QueryShape("chat memory turns", "chat_messages",
+                   {"session_id": session_id, "content_type": {"$in": ["chat_message", "chat_response"]}}, [("timestamp", -1), ("_id", -1)]),
+        QueryShape("chat memory turns after summary", "chat_messages",
+                   {"session_id": session_id, "content_type": {"$in": ["chat_message", "chat_response"]}, "timestamp": {"$gte": now},
+                    "$or": [{"timestamp": {"$gt": now}}, {"_id": {"$gt": session_id}}]},
+                   [("timestamp", -1), ("_id", -1)]),
+        QueryShape("credit logs by user", "credit_logs", {"user_id": user_id}, [("timestamp", -1)]),
+        QueryShape("claim next job", "jobs", {"status": "queued"}, [("created_at", 1)]),
+        QueryShape("extraction cache eviction", "pdf_extractions", {}, [("last_access", 1)]),
+    ]
+
+
+# Se ejecutan sobre una colección entera a propósito (diagnóstico o limpieza al arrancar)
+UNCHECKED_QUERIES = (
+    "count_documents({}) y distinct en /api/debug/db-status",
+    "processed_results.delete_many con $ne en ResultCache.purge_stale",
+)
+
+
+async def reconcile_indexes(db, specs: List[IndexSpec] = INDEX_SPECS, drop_undeclared: bool = DB_DROP_UNDECLARED_INDEXES) -> Dict[str, List[str]]:
+    """Deja los índices de cada colección como están declarados. Nunca lanza: los fallos van al informe."""
+    report: Dict[str, List[str]] = {"created": [], "rebuilt": [], "unchanged": [], "undeclared": [], "dropped": [], "failed": []}
+    by_collection: Dict[str, List[IndexSpec]] = {}
+    for spec in specs:
+        by_collection.setdefault(spec.collection, []).append(spec)
+
+    for collection_name, collection_specs in by_collection.items():
+        collection = db[collection_name]
+        existing = {info["name"]: info async for info in collection.list_indexes()}
+        satisfied = {"_id_"}
+        for spec in collection_specs:
+            try:
+                current = existing.get(spec.name)
+                if current is not None and spec.matches(current):
+                    report["unchanged"].append(spec.describe())
+                    satisfied.add(spec.name)
+                    continue
+                equivalent = next((name for name, info in existing.items() if name != spec.name and spec.matches(info)), None)
+                if equivalent is not None:
+                    # Ya existe con otro nombre (creado a mano): vale igual
+                    report["unchanged"].append(f"{collection_name}.{equivalent}")
+                    satisfied.add(equivalent)
+                    continue
+                # Mismo nombre o mismas claves con otras opciones: hay que quitarlo antes de crear el declarado
+                stale = [name for name, info in existing.items() if name == spec.name or (name != "_id_" and spec.same_keys(info))]
+                for name in stale:
+                    await collection.drop_index(name)
+                    del existing[name]
+                await collection.create_indexes([spec.model()])
+                report["rebuilt" if stale else "created"].append(spec.describe())
+                satisfied.add(spec.name)
+            except OperationFailure as e:
+                # p. ej. emails duplicados que impiden el índice único
+                print(f"Could not build index {spec.describe()}: {e}")
+                report["failed"].append(f"{spec.describe()}: {e}")
+
+        for name in existing:
+            if name in satisfied:
+                continue
+            if drop_undeclared:
+                await collection.drop_index(name)
+                report["dropped"].append(f"{collection_name}.{name}")
+            else:
+                report["undeclared"].append(f"{collection_name}.{name}")
+    return report
+
+
+def _plan_stages(plan: Any) -> List[str]:
+    """Todas las etapas de un plan (clásico o SBE), recorriendo inputStage/inputStages/queryPlan."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_plan_stages(value))
+    return stages
+
+
+async def explain_shape(db, shape: QueryShape) -> Dict[str, Any]:
+    cursor = db[shape.collection].find(shape.filter)
+    if shape.sort:
+        cursor = cursor.sort(shape.sort)
+    explained = await cursor.explain()
+    stages = _plan_stages(explained.get("queryPlanner", {}).get("winningPlan", {}))
+    unindexed = [stage for stage in stages if stage in UNINDEXED_STAGES]
+    return {"query": shape.name, "collection": shape.collection, "stages": stages, "indexed": not unindexed}
+
+
+async def check_query_plans(db, shapes: Optional[List[QueryShape]] = None) -> List[Dict[str, Any]]:
+    return [await explain_shape(db, shape) for shape in (shapes or query_shapes())]
@@ -0,0 +1,58 @@
+"""
+Documentos extraídos referenciables por document_id.
+
+/api/extract-pdf devuelve un `document_id` (el SHA-256 del PDF); /api/process-paper y
+el chatbot pueden referenciarlo en lugar de reenviar hasta 300 KB de texto desde el
+navegador.
+
+El texto no se guarda dos veces: el document_id es la misma clave que la caché de
+extracciones (extraction_cache.py), así que un documento se resuelve a través de ella
+y hereda su LRU en memoria y la poda por bytes del nivel persistente. Si la entrada ya
+se ha podado, el documento no existe y el cliente tiene que volver a subir el PDF.
+"""
+import re
+from typing import Any, Dict, Optional
+
+from extraction_cache import ExtractionCache
+from pdf_extraction import ExtractedPdf, build_section_index
+
+DOCUMENT_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_valid_document_id(document_id: str) -> bool:
+    return bool(document_id and DOCUMENT_ID_PATTERN.match(document_id))
+
+
+def as_document(extracted: ExtractedPdf) -> Dict[str, Any]:
+    return {
+        "content": extracted.text,
+        "page_count": extracted.page_count,
+        "abstract": extracted.abstract,
+        "authors": extracted.authors,
+        "page_offsets": extracted.page_offsets,
+        "sections": [section.model_dump() for section in extracted.sections],
+    }
+
+
+class DocumentStore:
+    """Vista por document_id sobre la caché de extracciones (misma clave, mismo almacenamiento)."""
+
+    def __init__(self, extractions: ExtractionCache):
+        self.extractions = extractions
+
+    async def save(self, document_id: str, extracted: ExtractedPdf) -> Dict[str, Any]:
+        """El PDF ya está en la caché de extracciones bajo este digest: solo se asegura que siga en memoria."""
+        if self.extractions.memory.get(document_id) is None:
+            await self.extractions.put(document_id, extracted)
+        return as_document(extracted)
+
+    async def load(self, document_id: str) -> Optional[Dict[str, Any]]:
+        if not is_valid_document_id(document_id):
+            return None
+        extracted = await self.extractions.get(document_id)
+        if extracted is None:
+            return None
+        if not extracted.sections:
+            # Entradas de caché anteriores al índice de secciones (se completa en memoria)
+            extracted.sections = build_section_index(extracted.text, extracted.page_offsets)
+        return as_document(extracted)
@@ -0,0 +1,218 @@
+"""
+Caché direccionada por contenido para el texto extraído de PDFs.
+
+La clave es el SHA-256 de los bytes subidos. Hay dos niveles: un LRU en memoria
+acotado por bytes y, detrás, un nivel persistente (MongoDB o disco) también
+acotado por tamaño. Una subida repetida se resuelve sin tocar PyPDF2.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo import ASCENDING
+
+from lru import LRUCache
+from pdf_extraction import ExtractedPdf
+
+PDF_CACHE_MEMORY_MAX_BYTES = int(os.getenv("PDF_CACHE_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+PDF_CACHE_MEMORY_MAX_ENTRIES = int(os.getenv("PDF_CACHE_MEMORY_MAX_ENTRIES", "512"))
+PDF_CACHE_BACKING_MAX_BYTES = int(os.getenv("PDF_CACHE_BACKING_MAX_BYTES", str(1024 * 1024 * 1024)))
+# Cada cuánto se recalcula el total de bytes del nivel Mongo con un aggregate
+PDF_CACHE_RESYNC_SECONDS = float(os.getenv("PDF_CACHE_RESYNC_SECONDS", "300"))
+# La poda deja el nivel Mongo en esta fracción de max_bytes, para no podar en cada inserción
+PDF_CACHE_PRUNE_TARGET = float(os.getenv("PDF_CACHE_PRUNE_TARGET", "0.9"))
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "deepread-pdf-cache"))
+
+
+def content_digest(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+def _entry_size(extracted: ExtractedPdf) -> int:
+    return len(extracted.text) + len(extracted.abstract or "") + len(extracted.authors or "") + 64
+
+
+class MongoExtractionStore:
+    """
+    Nivel persistente en una colección de MongoDB (un documento por digest; colección de motor).
+
+    El total de bytes se lleva en memoria: se calcula con un aggregate la primera vez y
+    se vuelve a sincronizar cada PDF_CACHE_RESYNC_SECONDS (otros procesos también
+    escriben). Cada put solo suma y resta, y la poda solo corre cuando el total pasa de
+    max_bytes: recorre el índice de last_access hasta bajar a PDF_CACHE_PRUNE_TARGET.
+    """
+
+    name = "mongo"
+
+    def __init__(self, collection, max_bytes: int = PDF_CACHE_BACKING_MAX_BYTES, resync_seconds: float = PDF_CACHE_RESYNC_SECONDS):
+        self.collection = collection
+        self.max_bytes = max_bytes
+        self.resync_seconds = resync_seconds
+        self.total_bytes: Optional[int] = None
+        self._synced_at = 0.0
+        self.prunes = 0
+
+    async def ensure_indexes(self):
+        # Mismo nombre que en db_indexes.INDEX_SPECS: la poda recorre last_access en orden
+        await self.collection.create_index([("last_access", ASCENDING)], name="last_access_1")
+
+    async def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        doc = await self.collection.find_one_and_update(
+            {"_id": digest},
+            {"$set": {"last_access": datetime.utcnow()}},
+            projection={"extracted": 1},
+        )
+        return doc["extracted"] if doc else None
+
+    async def _sync_total(self):
+        totals = await self.collection.aggregate([{"$group": {"_id": None, "bytes": {"$sum": "$size"}}}]).to_list(length=1)
+        self.total_bytes = totals[0]["bytes"] if totals else 0
+        self._synced_at = time.monotonic()
+
+    async def put(self, digest: str, extracted: Dict[str, Any], size: int):
+        now = datetime.utcnow()
+        previous = await self.collection.find_one_and_replace(
+            {"_id": digest},
+            {"extracted": extracted, "size": size, "created_at": now, "last_access": now},
+            projection={"size": 1},
+            upsert=True,
+        )
+        if self.total_bytes is None or time.monotonic() - self._synced_at >= self.resync_seconds:
+            await self._sync_total()
+        else:
+            self.total_bytes += size - (previous or {}).get("size", 0)
+        if self.total_bytes > self.max_bytes:
+            await self.prune()
+
+    async def prune(self):
+        """Elimina los documentos menos usados recientemente hasta quedar bajo max_bytes."""
+        if self.total_bytes is None:
+            await self._sync_total()
+        if self.total_bytes <= self.max_bytes:
+            return
+        excess = self.total_bytes - int(self.max_bytes * PDF_CACHE_PRUNE_TARGET)
+        to_delete, freed = [], 0
+        async for doc in self.collection.find({}, {"size": 1}).sort("last_access", ASCENDING):
+            if freed >= excess:
+                break
+            to_delete.append(doc["_id"])
+            freed += doc.get("size", 0)
+        if to_delete:
+            await self.collection.delete_many({"_id": {"$in": to_delete}})
+            self.total_bytes -= freed
+            self.prunes += 1
+
+
+class DiskExtractionStore:
+    """Nivel persistente en disco: un fichero JSON por digest, poda por mtime. La E/S va a un hilo."""
+
+    name = "disk"
+
+    def __init__(self, directory: str = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_BACKING_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, f"{digest}.json")
+
+    async def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self._get, digest)
+
+    async def put(self, digest: str, extracted: Dict[str, Any], size: int):
+        await asyncio.to_thread(self._put, digest, extracted)
+
+    def _get(self, digest: str) -> Optional[Dict[str, Any]]:
+        path = self._path(digest)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                extracted = json.load(f)
+            os.utime(path)  # Marca el acceso para la poda LRU
+            return extracted
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _put(self, digest: str, extracted: Dict[str, Any]):
+        tmp_path = self._path(digest) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(extracted, f)
+        os.replace(tmp_path, self._path(digest))
+        self.prune()
+
+    def prune(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        excess = sum(size for _, size, _ in entries) - self.max_bytes
+        for _, size, filename in sorted(entries):
+            if excess <= 0:
+                break
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+            excess -= size
+
+
+class ExtractionCache:
+    def __init__(
+        self,
+        max_bytes: int = PDF_CACHE_MEMORY_MAX_BYTES,
+        max_entries: int = PDF_CACHE_MEMORY_MAX_ENTRIES,
+        backing=None,
+    ):
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes, sizeof=_entry_size)
+        self.backing = backing
+        self.backing_hits = 0
+        self.backing_misses = 0
+        self.backing_errors = 0
+
+    async def get(self, digest: str) -> Optional[ExtractedPdf]:
+        extracted = self.memory.get(digest)
+        if extracted is not None:
+            return extracted
+        if self.backing is None:
+            return None
+        try:
+            stored = await self.backing.get(digest)
+        except Exception as e:
+            self.backing_errors += 1
+            print(f"Extraction cache backing get failed: {e}")
+            return None
+        if stored is None:
+            self.backing_misses += 1
+            return None
+        self.backing_hits += 1
+        extracted = ExtractedPdf(**stored)
+        self.memory.put(digest, extracted)  # Promoción al nivel en memoria
+        return extracted
+
+    async def put(self, digest: str, extracted: ExtractedPdf):
+        self.memory.put(digest, extracted)
+        if self.backing is None:
+            return
+        try:
+            await self.backing.put(digest, extracted.model_dump(), _entry_size(extracted))
+        except Exception as e:
+            self.backing_errors += 1
+            print(f"Extraction cache backing put failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory": self.memory.stats(),
+            "backing": {
+                "type": self.backing.name if self.backing else None,
+                "max_bytes": self.backing.max_bytes if self.backing else None,
+                "bytes": getattr(self.backing, "total_bytes", None),
+                "hits": self.backing_hits,
+                "misses": self.backing_misses,
+                "errors": self.backing_errors,
+            },
+        }
@@ -0,0 +1,401 @@
+"""
+Cola de trabajos asíncrona para tareas largas (procesamiento de papers).
+
+El endpoint crea el trabajo y devuelve su id al momento; un pool de workers con
+concurrencia acotada lo ejecuta y va guardando etapa, progreso y resultado. Los
+trabajos se persisten en MongoDB con un "lease" que un latido renueva cada
+JOB_LEASE_SECONDS/3 mientras el trabajo corre: si el proceso se cae a mitad, al
+arrancar otro worker se reencolan (o se marcan como fallidos tras JOB_MAX_ATTEMPTS
+intentos). El dueño de un trabajo es el par (worker_id, intento): una ejecución que ha
+perdido el lease no puede escribir el resultado ni liquidar créditos.
+
+La reserva de créditos de un trabajo se anota en el propio documento (held -> settling
+-> refunded) para que solo una de las partes la liquide o la devuelva: el worker que lo
+termina o el que lo recupera tras una caída.
+
+Los workers pueden ir dentro del proceso de la API o en un proceso aparte
+(ver worker.py). InMemoryJobStore sirve como sustituto local para pruebas.
+"""
+import asyncio
+import os
+import socket
+import traceback
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "2"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+JOB_HEARTBEAT_SECONDS = JOB_LEASE_SECONDS / 3
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+TERMINAL_STATUSES = (JOB_SUCCEEDED, JOB_FAILED)
+
+# Estados de la reserva de créditos asociada a un trabajo
+RESERVATION_HELD = "held"
+RESERVATION_SETTLING = "settling"
+RESERVATION_REFUNDED = "refunded"
+
+INTERRUPTED_ERROR = "Job interrupted (worker restarted) too many times"
+
+
+class JobLeaseLost(Exception):
+    """El trabajo ya no pertenece a esta ejecución: su lease venció y se reencoló o se dio por fallido."""
+
+
+def _owner(job_id: ObjectId, worker_id: str, attempt: int) -> Dict[str, Any]:
+    return {"_id": job_id, "worker_id": worker_id, "attempts": attempt, "status": JOB_RUNNING}
+
+
+def _recovered_fields(attempts: int, now: datetime) -> Dict[str, Any]:
+    """Campos de un trabajo con el lease vencido: fallido si agotó los intentos, si no a la cola."""
+    if attempts >= JOB_MAX_ATTEMPTS:
+        return {"status": JOB_FAILED, "stage": JOB_FAILED, "error": INTERRUPTED_ERROR, "updated_at": now, "finished_at": now}
+    return {"status": JOB_QUEUED, "stage": JOB_QUEUED, "progress": 0.0, "worker_id": None, "updated_at": now}
+
+
+def new_job(job_type: str, user_id: ObjectId, payload: Dict[str, Any]) -> Dict[str, Any]:
+    now = datetime.utcnow()
+    return {
+        "_id": ObjectId(),
+        "type": job_type,
+        "user_id": user_id,
+        "payload": payload,
+        "status": JOB_QUEUED,
+        "stage": JOB_QUEUED,
+        "progress": 0.0,
+        "result": None,
+        "error": None,
+        "attempts": 0,
+        "worker_id": None,
+        "lease_expires_at": None,
+        "reservation": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+class MongoJobStore:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def ensure_indexes(self):
+        # claim_next busca por estado en orden de llegada; el dueño consulta por _id
+        await self.collection.create_index([("status", 1), ("created_at", 1)])
+
+    async def create(self, job: Dict[str, Any]):
+        await self.collection.insert_one(job)
+
+    async def get(self, job_id: ObjectId) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"_id": job_id})
+
+    async def claim_next(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Reclama atómicamente el trabajo en cola más antiguo."""
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {"status": JOB_QUEUED},
+            {
+                "$set": {
+                    "status": JOB_RUNNING,
+                    "worker_id": worker_id,
+                    "started_at": now,
+                    "updated_at": now,
+                    "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def update(self, job_id: ObjectId, worker_id: str, attempt: int, fields: Dict[str, Any]) -> bool:
+        """Actualiza un trabajo solo si esta ejecución (worker e intento) sigue siendo su dueña."""
+        fields = {**fields, "updated_at": datetime.utcnow()}
+        result = await self.collection.update_one(_owner(job_id, worker_id, attempt), {"$set": fields})
+        return result.matched_count == 1
+
+    async def move_reservation(self, job_id: ObjectId, reservation_id: ObjectId, from_states, to_state: str, owner: Optional[Dict[str, Any]] = None) -> bool:
+        """Cambia el estado de la reserva del trabajo si está en from_states (y, si se indica, con ese dueño)."""
+        query = {**(owner or {"_id": job_id}), "reservation.id": reservation_id, "reservation.state": {"$in": list(from_states)}}
+        result = await self.collection.update_one(query, {"$set": {"reservation.state": to_state, "updated_at": datetime.utcnow()}})
+        return result.matched_count == 1
+
+    async def recover_stale(self) -> Dict[str, Any]:
+        """
+        Trabajos 'running' con el lease vencido (worker caído o reinicio): se reencolan o se dan
+        por fallidos. Si tenían una reserva de créditos sin liquidar, se marca como devuelta en la
+        misma actualización y se incluye en "released" para que el llamante la reembolse.
+        """
+        now = datetime.utcnow()
+        stale = {"status": JOB_RUNNING, "lease_expires_at": {"$lt": now}}
+        recovered = {"requeued": 0, "failed": 0, "released": []}
+        async for job in self.collection.find(stale, {"attempts": 1, "reservation": 1}):
+            reservation = job.get("reservation")
+            held = bool(reservation) and reservation.get("state") == RESERVATION_HELD
+            fields = _recovered_fields(job["attempts"], now)
+            if held:
+                fields["reservation.state"] = RESERVATION_REFUNDED
+            # Condicionado a lo leído: si el worker renovó el lease o tocó la reserva entretanto, no se recupera
+            query = {**stale, "_id": job["_id"], "attempts": job["attempts"],
+                     "reservation.state": RESERVATION_HELD if held else {"$ne": RESERVATION_HELD}}
+            result = await self.collection.update_one(query, {"$set": fields})
+            if result.modified_count:
+                recovered["failed" if fields["status"] == JOB_FAILED else "requeued"] += 1
+                if held:
+                    recovered["released"].append(reservation)
+        return recovered
+
+
+class InMemoryJobStore:
+    """Misma interfaz que MongoJobStore, en memoria (pruebas y despliegues sin base de datos)."""
+
+    def __init__(self):
+        self.jobs: Dict[ObjectId, Dict[str, Any]] = {}
+
+    async def ensure_indexes(self):
+        pass
+
+    async def create(self, job: Dict[str, Any]):
+        self.jobs[job["_id"]] = dict(job)
+
+    async def get(self, job_id: ObjectId) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        return dict(job) if job else None
+
+    async def claim_next(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        queued = [job for job in self.jobs.values() if job["status"] == JOB_QUEUED]
+        if not queued:
+            return None
+        job = min(queued, key=lambda job: job["created_at"])
+        now = datetime.utcnow()
+        job.update({
+            "status": JOB_RUNNING,
+            "worker_id": worker_id,
+            "started_at": now,
+            "updated_at": now,
+            "lease_expires_at": now + timedelta(seconds=JOB_LEASE_SECONDS),
+            "attempts": job["attempts"] + 1,
+        })
+        return dict(job)
+
+    def _owned(self, job_id: ObjectId, worker_id: str, attempt: int) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(job_id)
+        if job is None or job["worker_id"] != worker_id or job["attempts"] != attempt or job["status"] != JOB_RUNNING:
+            return None
+        return job
+
+    async def update(self, job_id: ObjectId, worker_id: str, attempt: int, fields: Dict[str, Any]) -> bool:
+        job = self._owned(job_id, worker_id, attempt)
+        if job is None:
+            return False
+        job.update(fields, updated_at=datetime.utcnow())
+        return True
+
+    async def move_reservation(self, job_id: ObjectId, reservation_id: ObjectId, from_states, to_state: str, owner: Optional[Dict[str, Any]] = None) -> bool:
+        job = self._owned(job_id, owner["worker_id"], owner["attempts"]) if owner else self.jobs.get(job_id)
+        reservation = job.get("reservation") if job else None
+        if not reservation or reservation["id"] != reservation_id or reservation["state"] not in from_states:
+            return False
+        reservation["state"] = to_state
+        job["updated_at"] = datetime.utcnow()
+        return True
+
+    async def recover_stale(self) -> Dict[str, Any]:
+        now = datetime.utcnow()
+        recovered = {"requeued": 0, "failed": 0, "released": []}
+        for job in self.jobs.values():
+            if job["status"] == JOB_RUNNING and job["lease_expires_at"] and job["lease_expires_at"] < now:
+                job.update(_recovered_fields(job["attempts"], now))
+                recovered["failed" if job["status"] == JOB_FAILED else "requeued"] += 1
+                reservation = job.get("reservation")
+                if reservation and reservation["state"] == RESERVATION_HELD:
+                    reservation["state"] = RESERVATION_REFUNDED
+                    recovered["released"].append(dict(reservation))
+        return recovered
+
+
+class JobContext:
+    """
+    Lo que recibe el handler de un trabajo: informar de su avance y ligar a la ejecución
+    actual (worker + intento) la reserva de créditos que liquida al terminar.
+    """
+
+    def __init__(self, pool: "JobWorkerPool", job: Dict[str, Any]):
+        self._pool = pool
+        self.job = job
+        self.attempt = job["attempts"]
+        self.reservation_id: Optional[ObjectId] = None
+
+    @property
+    def owner(self) -> Dict[str, Any]:
+        return _owner(self.job["_id"], self._pool.worker_id, self.attempt)
+
+    def _lost(self, when: str = "") -> JobLeaseLost:
+        return JobLeaseLost(f"Job {self.job['_id']} attempt {self.attempt} lost its lease{when}")
+
+    async def update(self, fields: Dict[str, Any]) -> bool:
+        """Escribe en el trabajo (renovando el lease) si esta ejecución sigue siendo su dueña."""
+        fields = {**fields, "lease_expires_at": datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)}
+        return await self._pool.store.update(self.job["_id"], self._pool.worker_id, self.attempt, fields)
+
+    async def report(self, stage: str, progress: float):
+        # No lanza: el avance se publica desde el pipeline, que puede estar compartido con otras peticiones
+        if not await self.update({"stage": stage, "progress": progress}):
+            print(f"Job {self.job['_id']} attempt {self.attempt} no longer owns its lease")
+
+    async def ensure_owner(self):
+        if not await self.update({}):
+            raise self._lost()
+
+    async def hold_reservation(self, reservation):
+        """Anota en el trabajo la reserva de créditos, para que se devuelva si el worker se cae."""
+        held = {"id": reservation.id, "user_id": reservation.user_id, "amount": reservation.amount, "state": RESERVATION_HELD}
+        if not await self.update({"reservation": held}):
+            raise self._lost()
+        self.reservation_id = reservation.id
+
+    async def claim_reservation(self):
+        """Antes de liquidar: solo el dueño actual puede pasar la reserva a 'settling'."""
+        if self.reservation_id is None:
+            return await self.ensure_owner()
+        claimed = await self._pool.store.move_reservation(self.job["_id"], self.reservation_id, (RESERVATION_HELD,), RESERVATION_SETTLING, owner=self.owner)
+        if not claimed:
+            raise self._lost(" before settling")
+
+    async def release_reservation(self, reservation) -> bool:
+        """
+        True si esta ejecución debe devolver la reserva: no estaba ligada al trabajo o nadie
+        la ha devuelto aún. False si ya la devolvió quien recuperó el trabajo.
+        """
+        if self.reservation_id != reservation.id:
+            return True
+        return await self._pool.store.move_reservation(self.job["_id"], reservation.id, (RESERVATION_HELD, RESERVATION_SETTLING), RESERVATION_REFUNDED)
+
+
+JobHandler = Callable[[Dict[str, Any], JobContext], Awaitable[Dict[str, Any]]]
+ReservationRelease = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class JobWorkerPool:
+    """
+    N workers asyncio que reclaman trabajos del store y los ejecutan con el handler
+    registrado para su tipo. enqueue() despierta a los workers sin esperar al sondeo.
+    """
+
+    def __init__(self, store, concurrency: int = JOB_WORKER_CONCURRENCY):
+        self.store = store
+        self.concurrency = max(1, concurrency)
+        self.heartbeat_interval = JOB_HEARTBEAT_SECONDS
+        self.handlers: Dict[str, JobHandler] = {}
+        self.release_reservation: Optional[ReservationRelease] = None
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.running = 0
+
+    def register(self, job_type: str, handler: JobHandler):
+        self.handlers[job_type] = handler
+
+    def on_reservation_released(self, release: ReservationRelease):
+        """release(reservation) devuelve los créditos de un trabajo recuperado tras una caída."""
+        self.release_reservation = release
+
+    async def enqueue(self, job_type: str, user_id: ObjectId, payload: Dict[str, Any]) -> Dict[str, Any]:
+        job = new_job(job_type, user_id, payload)
+        await self.store.create(job)
+        self._wakeup.set()
+        return job
+
+    async def start(self):
+        if self._tasks:
+            return
+        await self.store.ensure_indexes()
+        recovered = await self.store.recover_stale()
+        released = recovered.pop("released", [])
+        if any(recovered.values()):
+            print(f"Recovered interrupted jobs: {recovered}, {len(released)} credit reservation(s) released")
+        for reservation in released:
+            if self.release_reservation is None:
+                print(f"No reservation release handler: reservation {reservation['id']} left held")
+                continue
+            try:
+                await self.release_reservation(reservation)
+            except Exception as e:
+                print(f"Releasing reservation {reservation['id']} failed: {e}")
+        self._tasks = [asyncio.create_task(self._worker_loop(i)) for i in range(self.concurrency)]
+        print(f"Job worker pool {self.worker_id} started with {self.concurrency} worker(s)")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker_loop(self, index: int):
+        while True:
+            try:
+                job = await self.store.claim_next(self.worker_id)
+            except Exception as e:
+                print(f"Job worker {index}: claim failed: {e}")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job)
+
+    async def _heartbeat(self, ctx: JobContext):
+        """Renueva el lease mientras el handler corre (una etapa larga puede pasar minutos sin informar)."""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                if not await ctx.update({}):
+                    print(f"Job {ctx.job['_id']} attempt {ctx.attempt} lost its lease, heartbeat stopped")
+                    return
+            except Exception as e:
+                print(f"Job {ctx.job['_id']} heartbeat failed: {e}")
+
+    async def _run(self, job: Dict[str, Any]):
+        handler = self.handlers.get(job["type"])
+        ctx = JobContext(self, job)
+        heartbeat = asyncio.create_task(self._heartbeat(ctx))
+        self.running += 1
+        try:
+            if handler is None:
+                raise ValueError(f"No handler registered for job type '{job['type']}'")
+            result = await handler(job, ctx)
+            await ctx.update({
+                "status": JOB_SUCCEEDED, "stage": "done", "progress": 1.0,
+                "result": result, "finished_at": datetime.utcnow(),
+            })
+        except asyncio.CancelledError:
+            # Parada del worker: se deja el lease vencer y otro worker lo reencola al arrancar
+            raise
+        except JobLeaseLost as e:
+            # Otro worker ya tiene el trabajo (o lo dio por fallido): esta ejecución no escribe nada
+            print(f"{e}, result discarded")
+        except Exception as e:
+            detail = getattr(e, "detail", None) or str(e)
+            print(f"Job {job['_id']} failed: {type(e).__name__}: {detail}")
+            traceback.print_exc()
+            await ctx.update({
+                "status": JOB_FAILED, "stage": JOB_FAILED, "error": str(detail),
+                "status_code": getattr(e, "status_code", 500), "finished_at": datetime.utcnow(),
+            })
+        finally:
+            heartbeat.cancel()
+            self.running -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"worker_id": self.worker_id, "workers": len(self._tasks), "running": self.running}
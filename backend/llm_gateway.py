@@ -0,0 +1,300 @@
+"""
+Pasarela única para las llamadas al LLM.
+
+Todas las rutas (resumen, código, chatbot...) pasan por aquí en lugar de repetir el
+mismo patrón de obtener el modelo y llamarlo. La pasarela añade:
+- un semáforo global y otro por ruta, para acotar la concurrencia hacia el proveedor
+- reintentos con backoff exponencial y jitter ante 429/5xx
+- un plazo máximo por llamada (incluidas la espera de hueco y los reintentos)
+- las llamadas síncronas siempre en un executor, nunca en el event loop
+- un circuit breaker que falla al momento cuando el proveedor está caído
+"""
+import asyncio
+import os
+import random
+import time
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_ROUTE_CONCURRENCY = int(os.getenv("LLM_ROUTE_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+LLM_CALL_DEADLINE = float(os.getenv("LLM_CALL_DEADLINE", "120"))
+LLM_SYNC_WORKERS = int(os.getenv("LLM_SYNC_WORKERS", "8"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class LLMGatewayError(Exception):
+    status_code = 503
+
+
+class LLMUnavailableError(LLMGatewayError):
+    """El circuit breaker está abierto: no se llama al proveedor."""
+    status_code = 503
+
+
+class LLMDeadlineExceeded(LLMGatewayError):
+    status_code = 504
+
+
+def error_status_code(exc: BaseException) -> Optional[int]:
+    """Código HTTP de un error del proveedor (google.api_core expone .code; otros clientes .status_code)."""
+    for attribute in ("code", "status_code"):
+        value = getattr(exc, attribute, None)
+        if isinstance(value, int):
+            return value
+    return None
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    return error_status_code(exc) in RETRYABLE_STATUS_CODES
+
+
+class CircuitBreaker:
+    """
+    Cerrado -> abierto tras N fallos seguidos; pasado el cooldown deja pasar una sola
+    llamada de prueba (semiabierto) y se cierra si sale bien.
+    """
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def check(self):
+        """Comprobación previa a encolarse: no ocupa el hueco de la llamada de prueba."""
+        if self.state == "open":
+            raise LLMUnavailableError("AI provider temporarily unavailable (circuit open)")
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probe_in_flight):
+            raise LLMUnavailableError("AI provider temporarily unavailable (circuit open)")
+        if state == "half_open":
+            self._probe_in_flight = True
+
+    def abandon_probe(self):
+        """
+        La llamada de prueba no dice nada del proveedor (cancelada, sin plazo o rechazada por
+        la petición en sí): se suelta sin contarla como éxito ni como fallo y otra puede probar.
+        """
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.times_opened += 1
+            self.opened_at = time.monotonic()
+
+
+class GatewayStream:
+    """
+    Respuesta en streaming a través de la pasarela: mantiene los semáforos mientras se
+    itera y expone usage_metadata de la respuesta subyacente al terminar.
+    """
+
+    def __init__(self, gateway: "LLMGateway", route: str, prompt: Any, kwargs: Dict[str, Any]):
+        self._gateway = gateway
+        self._route = route
+        self._prompt = prompt
+        self._kwargs = kwargs
+        self._response = None
+
+    @property
+    def usage_metadata(self):
+        return getattr(self._response, "usage_metadata", None)
+
+    async def __aiter__(self):
+        gateway = self._gateway
+        gateway._check_breaker(self._route)
+        deadline = time.monotonic() + gateway.deadline
+        async with gateway._slots(self._route, deadline):
+            # Solo se reintenta el establecimiento: una vez emitido un chunk no se puede repetir
+            self._response = await gateway._with_retries(
+                self._route, deadline, lambda: gateway._model().generate_content_async(self._prompt, stream=True, **self._kwargs)
+            )
+            try:
+                async for chunk in self._response:
+                    if time.monotonic() > deadline:
+                        raise LLMDeadlineExceeded(f"LLM stream for '{self._route}' exceeded {gateway.deadline:.0f}s")
+                    yield chunk
+            except LLMGatewayError:
+                raise
+            except Exception as exc:
+                if is_retryable(exc):
+                    gateway.breaker.record_failure()
+                raise
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        get_model: Callable[[], Any],
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        route_concurrency: int = LLM_ROUTE_CONCURRENCY,
+        max_retries: int = LLM_MAX_RETRIES,
+        deadline: float = LLM_CALL_DEADLINE,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.get_model = get_model
+        self.max_concurrency = max_concurrency
+        self.route_concurrency = route_concurrency
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        self._global = asyncio.Semaphore(max_concurrency)
+        self._routes: Dict[str, asyncio.Semaphore] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    def _model(self):
+        model = self.get_model()
+        if model is None:
+            raise LLMUnavailableError("AI client not available")
+        return model
+
+    def _count(self, route: str, key: str, amount: int = 1):
+        route_counters = self.counters.setdefault(route, {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "slot_timeouts": 0, "in_flight": 0})
+        route_counters[key] += amount
+
+    def _check_breaker(self, route: str):
+        try:
+            self.breaker.check()
+        except LLMUnavailableError:
+            self._count(route, "rejected")
+            raise
+
+    async def _acquire(self, semaphore: asyncio.Semaphore, route: str, deadline: float):
+        """Espera un hueco sin pasarse del plazo de la llamada (la cola también cuenta)."""
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            await asyncio.wait_for(semaphore.acquire(), timeout=remaining)
+        except asyncio.TimeoutError:
+            self._count(route, "slot_timeouts")
+            raise LLMDeadlineExceeded(f"LLM call for '{route}' exceeded {self.deadline:.0f}s waiting for a slot") from None
+
+    @asynccontextmanager
+    async def _slots(self, route: str, deadline: float):
+        route_semaphore = self._routes.setdefault(route, asyncio.Semaphore(self.route_concurrency))
+        await self._acquire(route_semaphore, route, deadline)
+        try:
+            await self._acquire(self._global, route, deadline)
+            try:
+                self._count(route, "in_flight")
+                try:
+                    yield
+                finally:
+                    self._count(route, "in_flight", -1)
+            finally:
+                self._global.release()
+        finally:
+            route_semaphore.release()
+
+    async def _call_sync(self, fn, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=LLM_SYNC_WORKERS, thread_name_prefix="llm-sync")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, lambda: fn(*args))
+
+    async def _with_retries(self, route: str, deadline: float, attempt_fn):
+        attempt = 0
+        while True:
+            try:
+                self.breaker.before_call()
+            except LLMUnavailableError:
+                self._count(route, "rejected")
+                raise
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.breaker.abandon_probe()
+                raise LLMDeadlineExceeded(f"LLM call for '{route}' exceeded {self.deadline:.0f}s")
+            self._count(route, "calls")
+            try:
+                result = await asyncio.wait_for(attempt_fn(), timeout=remaining)
+                self.breaker.record_success()
+                return result
+            except asyncio.CancelledError:
+                # Cliente desconectado o SingleFlight cancelado: no dice nada del proveedor,
+                # pero si era la llamada de prueba hay que soltarla o el breaker no se cierra nunca
+                self.breaker.abandon_probe()
+                raise
+            except Exception as exc:
+                self._count(route, "failures")
+                if is_retryable(exc):
+                    self.breaker.record_failure()
+                else:
+                    # Un 400 o un prompt bloqueado no dicen si el proveedor está caído: no cambian
+                    # el estado del breaker (tampoco lo cierran si era la llamada de prueba)
+                    self.breaker.abandon_probe()
+                if isinstance(exc, asyncio.TimeoutError) and time.monotonic() >= deadline:
+                    raise LLMDeadlineExceeded(f"LLM call for '{route}' exceeded {self.deadline:.0f}s") from exc
+                if attempt >= self.max_retries or not is_retryable(exc):
+                    raise
+                # Backoff exponencial con "full jitter", sin pasarse del plazo
+                delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * (2 ** attempt)))
+                if time.monotonic() + delay >= deadline:
+                    raise
+                attempt += 1
+                self._count(route, "retries")
+                print(f"LLM call for '{route}' failed ({type(exc).__name__}: {exc}); retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def generate(self, route: str, prompt: Any, **kwargs):
+        """Llamada completa (no streaming). Devuelve la respuesta del proveedor tal cual."""
+        self._check_breaker(route)
+        # El plazo empieza antes de esperar hueco: una llamada encolada no recibe el plazo entero después
+        deadline = time.monotonic() + self.deadline
+        async with self._slots(route, deadline):
+
+            async def attempt():
+                model = self._model()
+                generate_async = getattr(model, "generate_content_async", None)
+                if generate_async is not None:
+                    return await generate_async(prompt, **kwargs)
+                # Cliente sin API asíncrona: a un hilo, nunca bloqueando el event loop
+                return await self._call_sync(lambda: model.generate_content(prompt, **kwargs))
+
+            return await self._with_retries(route, deadline, attempt)
+
+    def stream(self, route: str, prompt: Any, **kwargs) -> GatewayStream:
+        return GatewayStream(self, route, prompt, kwargs)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "breaker": {"state": self.breaker.state, "consecutive_failures": self.breaker.failures, "times_opened": self.breaker.times_opened},
+            "max_concurrency": self.max_concurrency,
+            "route_concurrency": self.route_concurrency,
+            "routes": self.counters,
+        }
@@ -0,0 +1,356 @@
+"""
+Proveedores de LLM intercambiables detrás de get_ai_client().
+
+Todos exponen la interfaz de google.generativeai.GenerativeModel que usa la pasarela:
+generate_content_async(prompt, stream=False) -> respuesta con .text y .usage_metadata
+(en streaming, un iterable asíncrono de chunks con .text).
+
+- GeminiProvider: el modelo real.
+- FakeProvider: local y determinista (misma semilla + mismo prompt = misma latencia,
+  mismo fallo y misma respuesta), con distribuciones de latencia, ritmo de chunks en
+  streaming, conteo de tokens e inyección de fallos. Permite hacer pruebas de carga
+  de toda la API sin red ni cuota.
+- CassetteProvider: graba en disco las respuestas de otro proveedor y las reproduce.
+
+Se elige con LLM_PROVIDER (gemini | fake) y LLM_CASSETTE_MODE (off | record | replay).
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+LLM_CASSETTE_MODE = os.getenv("LLM_CASSETTE_MODE", "off")
+LLM_CASSETTE_DIR = os.getenv("LLM_CASSETTE_DIR", os.path.join(tempfile.gettempdir(), "deepread-llm-cassettes"))
+# En replay: "recorded" respeta los tiempos grabados, "none" responde al instante
+LLM_REPLAY_TIMING = os.getenv("LLM_REPLAY_TIMING", "none")
+
+LLM_FAKE_SEED = int(os.getenv("LLM_FAKE_SEED", "0"))
+LLM_FAKE_LATENCY = os.getenv("LLM_FAKE_LATENCY", "lognormal:1.0,0.35")
+LLM_FAKE_PER_TOKEN_LATENCY = float(os.getenv("LLM_FAKE_PER_TOKEN_LATENCY", "0.0001"))
+LLM_FAKE_CHUNK_CHARS = int(os.getenv("LLM_FAKE_CHUNK_CHARS", "40"))
+LLM_FAKE_CHUNK_DELAY = os.getenv("LLM_FAKE_CHUNK_DELAY", "fixed:0.02")
+LLM_FAKE_FAIL_RATE = float(os.getenv("LLM_FAKE_FAIL_RATE", "0"))
+LLM_FAKE_FAIL_CODE = int(os.getenv("LLM_FAKE_FAIL_CODE", "503"))
+
+FAKE_SUMMARY = (
+    "The paper introduces a memory efficient attention mechanism that scales linearly with "
+    "sequence length. It evaluates the method on language modelling and long document "
+    "classification, matching the accuracy of full attention while using far less memory."
+)
+
+FAKE_PROJECT = {
+    "title": "Linear Attention Playground",
+    "description": "Implements the paper's linear attention layer and compares it with softmax attention.",
+    "language": "Python",
+    "codeImplementation": [
+        {"filename": "attention.py", "code": "import numpy as np\n\ndef linear_attention(q, k, v):\n    return q @ (k.T @ v)\n"},
+        {"filename": "requirements.txt", "code": "numpy"},
+    ],
+}
+
+
+def approx_tokens(text: str) -> int:
+    return max(1, len(text) // 4) if text else 0
+
+
+def usage_for(prompt_tokens: int, output_tokens: int):
+    return SimpleNamespace(
+        prompt_token_count=prompt_tokens,
+        candidates_token_count=output_tokens,
+        total_token_count=prompt_tokens + output_tokens,
+    )
+
+
+class FakeAPIError(Exception):
+    """Error del proveedor con código HTTP, como las excepciones de google.api_core."""
+
+    def __init__(self, code: int, message: str = "fake upstream error"):
+        super().__init__(f"{code} {message}")
+        self.code = code
+
+
+class FakeResponse:
+    def __init__(self, text: str, prompt: str, usage=None):
+        self.text = text
+        self.usage_metadata = usage or usage_for(approx_tokens(prompt), approx_tokens(text))
+
+
+class FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeStreamResponse:
+    """Respuesta en streaming: iterable asíncrono de chunks; usage_metadata al terminar."""
+
+    def __init__(self, chunks: List[str], prompt: str, chunk_delays: List[float], usage=None):
+        self._chunks = chunks
+        self._prompt = prompt
+        self._delays = chunk_delays
+        self._usage = usage
+        self.usage_metadata = None
+
+    async def __aiter__(self):
+        for chunk, delay in zip(self._chunks, self._delays):
+            if delay:
+                await asyncio.sleep(delay)
+            yield FakeChunk(chunk)
+        self.usage_metadata = self._usage or FakeResponse("".join(self._chunks), self._prompt).usage_metadata
+
+
+def split_chunks(text: str, chunk_chars: int) -> List[str]:
+    return [text[start:start + chunk_chars] for start in range(0, len(text), chunk_chars)] or [""]
+
+
+class LatencyDistribution:
+    """
+    'fixed:0.5', 'uniform:0.2,1.0', 'normal:0.8,0.2' o 'lognormal:<mediana>,<sigma>'
+    (la más realista para APIs: cola larga a la derecha). Nunca devuelve negativos.
+    """
+
+    def __init__(self, spec: str):
+        kind, _, params = spec.partition(":")
+        self.kind = kind.strip().lower()
+        self.params = [float(value) for value in params.split(",") if value.strip()]
+        if self.kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution '{spec}'")
+        self.spec = spec
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.params[0], self.params[1]))
+        median, sigma = self.params
+        return median * rng.lognormvariate(0.0, sigma)
+
+
+class GeminiProvider:
+    name = "google"
+
+    def __init__(self, model_name: str, api_key: str):
+        from google.generativeai.client import configure
+        from google.generativeai.generative_models import GenerativeModel
+        configure(api_key=api_key)
+        self.model_name = model_name
+        self._model = GenerativeModel(model_name)
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        return await self._model.generate_content_async(prompt, stream=stream, **kwargs)
+
+
+class FakeProvider:
+    """Proveedor local determinista para pruebas de carga sin red."""
+
+    name = "fake"
+
+    def __init__(
+        self,
+        seed: int = LLM_FAKE_SEED,
+        latency: str = LLM_FAKE_LATENCY,
+        per_token_latency: float = LLM_FAKE_PER_TOKEN_LATENCY,
+        chunk_chars: int = LLM_FAKE_CHUNK_CHARS,
+        chunk_delay: str = LLM_FAKE_CHUNK_DELAY,
+        fail_rate: float = LLM_FAKE_FAIL_RATE,
+        fail_code: int = LLM_FAKE_FAIL_CODE,
+    ):
+        self.seed = seed
+        self.latency = LatencyDistribution(latency)
+        self.per_token_latency = per_token_latency
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = LatencyDistribution(chunk_delay)
+        self.fail_rate = fail_rate
+        self.fail_code = fail_code
+        self.model_name = f"fake-{latency}"
+        self.calls = 0
+        self._attempts: Dict[str, int] = {}
+
+    def _rng(self, prompt: str) -> random.Random:
+        # La n-ésima llamada con el mismo prompt siempre se comporta igual, pero un reintento
+        # no repite necesariamente el fallo del intento anterior
+        prompt_key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        attempt = self._attempts.get(prompt_key, 0)
+        self._attempts[prompt_key] = attempt + 1
+        digest = hashlib.sha256(f"{self.seed}:{attempt}:{prompt_key}".encode("utf-8")).digest()
+        return random.Random(int.from_bytes(digest[:8], "big"))
+
+    def reply_for(self, prompt: str) -> str:
+        if "JSON" in prompt:
+            return json.dumps(FAKE_PROJECT)
+        return FAKE_SUMMARY
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        self.calls += 1
+        prompt = str(prompt)
+        rng = self._rng(prompt)
+        text = self.reply_for(prompt)
+        usage = usage_for(approx_tokens(prompt), approx_tokens(text))
+        first_byte = self.latency.sample(rng) + usage.prompt_token_count * self.per_token_latency
+        fails = self.fail_rate > 0 and rng.random() < self.fail_rate
+        if stream:
+            # En streaming la latencia es el tiempo hasta el primer chunk; luego cada chunk tiene su retardo
+            await asyncio.sleep(first_byte)
+            if fails:
+                raise FakeAPIError(self.fail_code)
+            chunks = split_chunks(text, self.chunk_chars)
+            return FakeStreamResponse(chunks, prompt, [self.chunk_delay.sample(rng) for _ in chunks], usage)
+        # Sin streaming se espera además a la generación completa
+        await asyncio.sleep(first_byte + sum(self.chunk_delay.sample(rng) for _ in split_chunks(text, self.chunk_chars)))
+        if fails:
+            raise FakeAPIError(self.fail_code)
+        return FakeResponse(text, prompt, usage)
+
+
+class RecordingStream:
+    """Deja pasar los chunks del proveedor real según llegan y graba la cassette al terminar."""
+
+    def __init__(self, cassette: "CassetteProvider", response, path: str, prompt: str, started: float):
+        self._cassette = cassette
+        self._response = response
+        self._path = path
+        self._prompt = prompt
+        self._started = started
+
+    @property
+    def usage_metadata(self):
+        return getattr(self._response, "usage_metadata", None)
+
+    async def __aiter__(self):
+        chunks, delays = [], []
+        first_byte = time.monotonic() - self._started
+        previous = time.monotonic()
+        async for chunk in self._response:
+            now = time.monotonic()
+            delays.append(now - previous)
+            previous = now
+            try:
+                chunks.append(chunk.text or "")
+            except (ValueError, AttributeError):
+                chunks.append("")
+            yield chunk
+        self._cassette._save(self._path, {
+            "prompt_preview": self._prompt[:200],
+            "chunks": chunks,
+            "delays": delays,
+            "usage": self._cassette._usage_dict(self.usage_metadata),
+            "first_byte": first_byte,
+        })
+
+
+class CassetteMiss(Exception):
+    """No hay grabación para este prompt en modo replay."""
+
+    code = 404
+
+
+class CassetteProvider:
+    """
+    record: llama al proveedor interno y guarda texto, chunks, uso y tiempos en
+    <dir>/<sha256(modelo + prompt)>.json. replay: responde solo desde disco.
+    """
+
+    def __init__(self, mode: str, directory: str = LLM_CASSETTE_DIR, inner=None, model_name: str = "", timing: str = LLM_REPLAY_TIMING):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode '{mode}'")
+        if mode == "record" and inner is None:
+            raise ValueError("Recording cassettes needs an inner provider")
+        self.mode = mode
+        self.directory = directory
+        self.inner = inner
+        self.model_name = model_name or getattr(inner, "model_name", "")
+        self.timing = timing
+        self.name = getattr(inner, "name", "cassette")
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, prompt: str, stream: bool) -> str:
+        key = hashlib.sha256(f"{self.model_name}\0{'stream' if stream else 'full'}\0{prompt}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def _usage_dict(usage) -> Optional[Dict[str, int]]:
+        if usage is None:
+            return None
+        return {
+            "prompt_token_count": getattr(usage, "prompt_token_count", 0) or 0,
+            "candidates_token_count": getattr(usage, "candidates_token_count", 0) or 0,
+        }
+
+    def _save(self, path: str, record: Dict[str, Any]):
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(temp_path, path)
+
+    async def generate_content_async(self, prompt, stream: bool = False, **kwargs):
+        prompt = str(prompt)
+        path = self._path(prompt, stream)
+        if self.mode == "replay":
+            return await self._replay(path, prompt, stream)
+
+        started = time.monotonic()
+        response = await self.inner.generate_content_async(prompt, stream=stream, **kwargs)
+        if not stream:
+            self._save(path, {
+                "prompt_preview": prompt[:200],
+                "text": response.text,
+                "usage": self._usage_dict(getattr(response, "usage_metadata", None)),
+                "first_byte": time.monotonic() - started,
+            })
+            return response
+        return RecordingStream(self, response, path, prompt, started)
+
+    async def _replay(self, path: str, prompt: str, stream: bool):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            raise CassetteMiss(f"No cassette recorded for this prompt ({os.path.basename(path)})")
+        self.hits += 1
+        usage = record.get("usage")
+        usage = usage_for(usage["prompt_token_count"], usage["candidates_token_count"]) if usage else None
+        recorded_timing = self.timing == "recorded"
+        if recorded_timing:
+            await asyncio.sleep(record.get("first_byte", 0))
+        if stream:
+            chunks = record.get("chunks") or split_chunks(record.get("text", ""), LLM_FAKE_CHUNK_CHARS)
+            delays = record.get("delays") if recorded_timing and record.get("delays") else [0.0] * len(chunks)
+            return FakeStreamResponse(chunks, prompt, delays, usage)
+        text = record["text"] if "text" in record else "".join(record.get("chunks", []))
+        return FakeResponse(text, prompt, usage)
+
+
+def provider_model_id(model_name: str, provider: Optional[str] = None, cassette_mode: Optional[str] = None) -> str:
+    """
+    Identificador del modelo para cachés compartidas: las respuestas falsas, grabadas o
+    reproducidas de cassettes nunca se mezclan con las reales del modelo de producción.
+    """
+    provider = provider or LLM_PROVIDER
+    cassette_mode = cassette_mode or LLM_CASSETTE_MODE
+    model_id = model_name if provider == "gemini" else f"{provider}:{model_name}"
+    if cassette_mode in ("record", "replay"):
+        model_id = f"cassette-{cassette_mode}:{model_id}"
+    return model_id
+
+
+def create_provider(model_name: str, api_key: str):
+    """Proveedor según LLM_PROVIDER, envuelto en cassettes si LLM_CASSETTE_MODE lo pide."""
+    if LLM_PROVIDER == "fake":
+        provider = FakeProvider()
+    elif LLM_PROVIDER == "gemini":
+        provider = None if LLM_CASSETTE_MODE == "replay" else GeminiProvider(model_name, api_key)
+    else:
+        raise ValueError(f"Unknown LLM_PROVIDER '{LLM_PROVIDER}'")
+    if LLM_CASSETTE_MODE in ("record", "replay"):
+        provider = CassetteProvider(LLM_CASSETTE_MODE, inner=provider, model_name=model_name)
+    return provider
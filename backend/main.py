@@ -1,28 +1,46 @@
 from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Body, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from bson.objectid import ObjectId
 from datetime import datetime, timedelta
 import jwt
-import bcrypt
 import os
-from io import BytesIO
-import PyPDF2
 import re
 import json
 import uvicorn
 from dotenv import load_dotenv
 import math
-import tiktoken
 import time
 import traceback
 import secrets
+import asyncio
+from functools import lru_cache
 import google.generativeai as genai
-from google.generativeai.client import configure  # Import configure function for API key setup
+from pdf_extraction import PdfExtractionEngine, DocumentSection, build_section_index, select_sections, strip_sections
+from extraction_cache import ExtractionCache, MongoExtractionStore, DiskExtractionStore, content_digest
+from document_store import DocumentStore
+from singleflight import SingleFlight
+from streaming import sse_event, chunk_text, CodeFileStreamParser
+from result_cache import ProcessedResultCache, prompt_version, cache_hit_cost, RESULT_CACHE_BILLING_POLICY
+from summarization import map_reduce_summary, map_partial_summaries, MAP_REDUCE_TOKEN_THRESHOLD, MAP_CHUNK_TOKENS
+from prompt_planner import PromptPlanner, PromptSlot, truncate_to_tokens
+from token_accounting import count_tokens, count_tokens_async, run_in_token_pool, TokenUsage, RequestTokenRecord
+import token_accounting
+from llm_gateway import LLMGateway, LLMGatewayError
+from llm_providers import create_provider, provider_model_id, LLM_PROVIDER, LLM_CASSETTE_MODE
+from credit_ledger import MongoCreditLedger, InMemoryCreditLedger, CreditReservation, InsufficientCredits, AccountNotFound
+from db_indexes import reconcile_indexes
+from user_cache import UserCache, USER_CACHE_EXCLUDED_FIELDS
+from password_hashing import PasswordHasher, PasswordHasherBusy
+from chat_context import ChatContextStore
+from conversation_memory import ConversationMemory, MemoryWindow, CHAT_MEMORY_TOKENS, CHAT_MEMORY_SUMMARY_TOKENS
+from paper_index import PaperIndexStore, Retrieval
+from jobs import JobWorkerPool, JobContext, MongoJobStore, InMemoryJobStore, JOB_SUCCEEDED, JOB_FAILED
 # Add a global 'text' variable with a default value
 # This is a defensive measure against the NameError
 text = ""
@@ -48,6 +66,24 @@ USERS_COLLECTION = "users"
 CHAT_SESSIONS_COLLECTION = "chat_sessions" # ADDED
 CHAT_MESSAGES_COLLECTION = "chat_messages" # ADDED
 CREDIT_LOGS_COLLECTION = "credit_logs" # ADDED to define the collection name
+PDF_EXTRACTIONS_COLLECTION = "pdf_extractions" # Caché de texto extraído por SHA-256
+PROCESSED_RESULTS_COLLECTION = "processed_results" # Caché global de resúmenes y código generados
+JOBS_COLLECTION = "jobs" # Trabajos en segundo plano (procesamiento de papers)
+CHAT_CONTEXTS_COLLECTION = "chat_contexts" # Contexto del paper renderizado por sesión de chat (_id = session_id)
+PAPER_INDEXES_COLLECTION = "paper_indexes" # Índice BM25 de fragmentos por document_id
+
+# Listado paginado de sesiones (barra lateral)
+SESSION_PAGE_DEFAULT = int(os.getenv("SESSION_PAGE_DEFAULT", "20"))
+SESSION_PAGE_MAX = int(os.getenv("SESSION_PAGE_MAX", "100"))
+SESSION_PREVIEW_CHARS = int(os.getenv("SESSION_PREVIEW_CHARS", "120"))
+# Historial de papers procesados
+HISTORY_PAGE_DEFAULT = int(os.getenv("HISTORY_PAGE_DEFAULT", "20"))
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "100"))
+HISTORY_PREVIEW_CHARS = int(os.getenv("HISTORY_PREVIEW_CHARS", "300"))
+PROCESSED_HISTORY_CONTENT_TYPES = ["summary", "code_suggestion"]
+# Mensajes de una sesión por página (los más recientes primero)
+MESSAGE_PAGE_DEFAULT = int(os.getenv("MESSAGE_PAGE_DEFAULT", "50"))
+MESSAGE_PAGE_MAX = int(os.getenv("MESSAGE_PAGE_MAX", "200"))
 
 # API Keys
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "") # API Key for Google Gemini
@@ -101,45 +137,98 @@ class ChatMessage(BaseModel):
     processedData: Optional[dict] = None
     timestamp: Optional[datetime] = None
     content_type: Optional[str] = None # Ensured content_type is present
+    # Cuando se piden los mensajes sin payloads: indican si hay paperData/processedData que pedir aparte
+    hasPaperData: Optional[bool] = None
+    hasProcessedData: Optional[bool] = None
 
 # Database connection setup
 client = None
 db = None
 MAX_DB_CONNECT_RETRIES = 5  # Aumentado a 5 intentos
-DB_CONNECT_TIMEOUT = 15000  # 15 segundos de timeout para selección de servidor
-DB_SOCKET_TIMEOUT = 45000   # 45 segundos de timeout para operaciones de socket
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "15000"))  # ms, selección de servidor y conexión
+DB_SOCKET_TIMEOUT = int(os.getenv("DB_SOCKET_TIMEOUT", "45000"))    # ms, operaciones de socket
+# Pool de conexiones de motor: todas las peticiones lo comparten desde el event loop
+DB_MAX_POOL_SIZE = int(os.getenv("DB_MAX_POOL_SIZE", "100"))
+DB_MIN_POOL_SIZE = int(os.getenv("DB_MIN_POOL_SIZE", "5"))
+DB_MAX_IDLE_TIME = int(os.getenv("DB_MAX_IDLE_TIME", "60000"))          # ms
+DB_WAIT_QUEUE_TIMEOUT = int(os.getenv("DB_WAIT_QUEUE_TIMEOUT", "10000"))  # ms esperando una conexión libre
+# Crear/ajustar al arrancar los índices declarados en db_indexes.py
+DB_RECONCILE_INDEXES = os.getenv("DB_RECONCILE_INDEXES", "true").lower() == "true"
 
 # Ensure MongoDB client and database are robustly handled
 @app.on_event("startup")
 async def startup_db_client():
-    global client, db
+    global client, db, credit_ledger
     try:
         # Initialize MongoDB connection
-        client = MongoClient(MONGODB_URI)
+        client = AsyncIOMotorClient(
+            MONGODB_URI,
+            maxPoolSize=DB_MAX_POOL_SIZE,
+            minPoolSize=DB_MIN_POOL_SIZE,
+            maxIdleTimeMS=DB_MAX_IDLE_TIME,
+            waitQueueTimeoutMS=DB_WAIT_QUEUE_TIMEOUT,
+            serverSelectionTimeoutMS=DB_CONNECT_TIMEOUT,
+            connectTimeoutMS=DB_CONNECT_TIMEOUT,
+            socketTimeoutMS=DB_SOCKET_TIMEOUT,
+        )
         if client:
-            client.admin.command('ping')  # Test connection
+            await client.admin.command('ping')  # Test connection
             db = client[DATABASE_NAME]
-            print("MongoDB connection established.")
+            print(f"MongoDB connection established (pool {DB_MIN_POOL_SIZE}-{DB_MAX_POOL_SIZE}).")
+            if DB_RECONCILE_INDEXES:
+                app.state.index_report = await reconcile_indexes(db)
+                print("Indexes reconciled: " + ", ".join(f"{k}={len(v)}" for k, v in app.state.index_report.items()))
+            extraction_cache.backing = MongoExtractionStore(db[PDF_EXTRACTIONS_COLLECTION])
+            await extraction_cache.backing.ensure_indexes()
+            paper_index_store.collection = db[PAPER_INDEXES_COLLECTION]
+            result_cache.collection = db[PROCESSED_RESULTS_COLLECTION]
+            # Entradas generadas con otro modelo/prompts ya nunca se usarán: se limpian en segundo plano
+            asyncio.create_task(result_cache.purge_stale())
+            job_pool.store = MongoJobStore(db[JOBS_COLLECTION])
+            chat_context_store.collection = db[CHAT_CONTEXTS_COLLECTION]
+            conversation_memory.messages = db[CHAT_MESSAGES_COLLECTION]
+            conversation_memory.contexts = db[CHAT_CONTEXTS_COLLECTION]
+            credit_ledger = MongoCreditLedger(client, db[USERS_COLLECTION], db[CREDIT_LOGS_COLLECTION])
+            print(f"Credit ledger transactions: {await credit_ledger.detect_transactions()}")
         else:
             raise Exception("MongoDB client is None.")
             
-        # Initialize Google AI client
-        try:
-            # Configure API key and initialize Google generative model
-            configure(api_key=GOOGLE_API_KEY)
-            from google.generativeai.generative_models import GenerativeModel
-            model = GenerativeModel(GOOGLE_MODEL_NAME)
-            app.state.google_model = model
-            print(f"Google AI client initialized successfully with model: {GOOGLE_MODEL_NAME}")
-        except Exception as e:
-            print(f"Error initializing Google AI client: {e}")
-            traceback.print_exc()
-            app.state.google_model = None
-            
     except Exception as e:
         print(f"Error connecting to MongoDB: {e}")
         client = None
         db = None
+        extraction_cache.backing = DiskExtractionStore()
+
+    # Initialize the LLM provider (Gemini, local fake or cassettes; see llm_providers.py)
+    try:
+        app.state.llm_provider = create_provider(GOOGLE_MODEL_NAME, GOOGLE_API_KEY)
+        print(f"LLM provider initialized: {LLM_PROVIDER} (cassettes: {LLM_CASSETTE_MODE}, model: {GOOGLE_MODEL_NAME})")
+    except Exception as e:
+        print(f"Error initializing LLM provider: {e}")
+        traceback.print_exc()
+        app.state.llm_provider = None
+
+    if JOB_WORKERS_IN_PROCESS:
+        await job_pool.start()
+
+# Motor de extracción de PDFs (el pool de procesos se crea en el primer uso)
+pdf_engine = PdfExtractionEngine()
+# Caché del texto extraído; el nivel persistente se elige en el arranque (Mongo o disco)
+extraction_cache = ExtractionCache()
+# Documentos extraídos por document_id, resueltos a través de la caché de extracciones (el cliente solo maneja el id)
+document_store = DocumentStore(extraction_cache)
+# Cola de trabajos: en Mongo si hay conexión; los workers pueden ir aparte (python worker.py)
+job_pool = JobWorkerPool(InMemoryJobStore())
+JOB_WORKERS_IN_PROCESS = os.getenv("JOB_WORKERS_IN_PROCESS", "true").lower() == "true"
+JOB_WATCH_INTERVAL = float(os.getenv("JOB_WATCH_INTERVAL", "0.5"))
+PROCESS_PAPER_JOB = "process_paper"
+# Reservas y liquidaciones de créditos (en Mongo si hay conexión; ver credit_ledger.py)
+credit_ledger = InMemoryCreditLedger()
+# Usuarios autenticados por _id con TTL; los cobros actualizan los créditos (ver user_cache.py)
+user_cache = UserCache()
+user_loads = SingleFlight()
+# bcrypt en un pool acotado, nunca en el event loop (ver password_hashing.py)
+password_hasher = PasswordHasher()
 
 # Handle cases where db or client is None
 def get_collection(collection_name):
@@ -150,6 +239,11 @@ def get_collection(collection_name):
 @app.on_event("shutdown")
 async def shutdown_db_client():
     global client
+    await job_pool.stop()
+    pdf_engine.shutdown()
+    llm_gateway.shutdown()
+    token_accounting.shutdown()
+    password_hasher.shutdown()
     if client:
         print("Cerrando conexión a MongoDB...")
         client.close()
@@ -175,9 +269,26 @@ class UserResponse(BaseModel):
     name: str
     credits: int
 
-class LoginResponse(Token): # Uses ChatMessage, so ChatMessage must be defined first
+class LoginResponse(Token):
     user: UserResponse
-    processed_paper_messages: List[ChatMessage] = []
+    # El historial de papers procesados ya no va aquí: /api/history/processed-papers
+
+# Historial de resúmenes y código generados (paginado, solo extractos)
+class ProcessedPaperHistoryItem(BaseModel):
+    id: str
+    content_type: str
+    title: Optional[str] = None
+    document_id: Optional[str] = None
+    preview: str = ""
+    timestamp: datetime
+
+class ProcessedPaperHistoryResponse(BaseModel):
+    items: List[ProcessedPaperHistoryItem]
+    next_cursor: Optional[str] = None # Pasar como ?cursor= para la página siguiente
+
+class ProcessedPaperHistoryEntry(ProcessedPaperHistoryItem):
+    content: str
+    paper_context: Optional[dict] = None
 
 # Nuevos modelos para la funcionalidad de chat
 class ChatSession(BaseModel):
@@ -194,13 +305,66 @@ class ChatSessionResponse(BaseModel):
     title: str
     lastUpdated: datetime
     messages: List[ChatMessage]
+    version: int = 0 # Se incrementa con cada guardado; la sincronización rechaza versiones antiguas
+    # Paginación de mensajes: before_cursor/after_cursor se pasan como ?before= / ?after=
+    has_more_before: bool = False
+    has_more_after: bool = False
+    before_cursor: Optional[str] = None
+    after_cursor: Optional[str] = None
+
+class ChatSessionSyncRequest(BaseModel):
+    id: Optional[str] = None # Sin id (o "default"/"new") se crea la sesión
+    title: str
+    lastUpdated: Optional[datetime] = None
+    base_version: int = 0 # Versión de la sesión sobre la que el cliente hizo los cambios
+    upserts: List[ChatMessage] = [] # Solo mensajes nuevos o modificados
+    deleted_ids: List[str] = []
+    verify: bool = False # Releer la sesión y contar sus mensajes tras escribir
+
+class ChatSessionSyncResponse(BaseModel):
+    id: str
+    version: int
+    lastUpdated: datetime
+    upserted: int = 0
+    modified: int = 0
+    deleted: int = 0
+    verification: Optional[Dict[str, Any]] = None
+
+class ChatMessagePayload(BaseModel):
+    id: str
+    paperData: Optional[dict] = None
+    processedData: Optional[dict] = None
+
+class ChatSessionSummary(BaseModel):
+    id: str
+    title: str
+    lastUpdated: datetime
+    messageCount: int = 0
+    lastMessagePreview: Optional[str] = None
+    lastMessageRole: Optional[str] = None
 
 class ChatSessionsResponse(BaseModel):
-    sessions: List[ChatSession]
+    sessions: List[ChatSessionSummary]
+    next_cursor: Optional[str] = None # Pasar como ?cursor= para la página siguiente
+
+class ChatContextRequest(BaseModel):
+    paper_title: str = ""
+    paper_summary: str = ""
+    code_suggestions: List[dict] = []
+    document_id: Optional[str] = None
+
+class ChatContextResponse(BaseModel):
+    session_id: str
+    digest: str # Cambia solo si cambian los campos del paper
+    prefix_tokens: int
+    context: Dict[str, Any] # Qué se recortó al ajustar el contexto al presupuesto
 
 class PaperData(BaseModel):
     title: str
-    content: str
+    content: Optional[str] = None
+    document_id: Optional[str] = None # Referencia a un documento ya extraído en el servidor
+    page_offsets: Optional[List[int]] = None # Offset de inicio de cada página en content
+    sections: Optional[List[DocumentSection]] = None # Índice de secciones detectadas
 
 class CodeFile(BaseModel):
     filename: str
@@ -216,6 +380,7 @@ class ProcessedPaper(BaseModel):
     summary: str
     projectSuggestions: List[ProjectSuggestion]
     credits_remaining: Optional[int] = None # Added credits_remaining
+    token_usage: Optional[Dict[str, Any]] = None # Per-call tokens and cost of this request
 
 # Authentication utilities
 def create_access_token(data: dict):
@@ -225,10 +390,8 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(authorization: Optional[str] = Header(None, alias="Authorization")):
-    if db is None:
-        raise HTTPException(status_code=503, detail="Database connection not available")
-
+def token_subject(authorization: Optional[str]) -> ObjectId:
+    """Validates the bearer token and returns the user id from its `sub` claim."""
     if not authorization:
         raise HTTPException(status_code=401, detail="Not authenticated: Authorization header missing or empty.")
 
@@ -246,22 +409,94 @@ async def get_current_user(authorization: Optional[str] = Header(None, alias="Au
         raise HTTPException(status_code=401, detail="Token has expired.")
     except jwt.PyJWTError: # Catches other JWT errors like invalid signature, malformed token etc.
         raise HTTPException(status_code=401, detail="Invalid token.")
+    if not ObjectId.is_valid(user_id):
+        raise HTTPException(status_code=401, detail="Invalid token.")
+    return ObjectId(user_id)
+
+async def load_user(user_id: ObjectId) -> Optional[dict]:
+    """Reads the user (without the password hash) and caches it; concurrent misses share one query."""
+    async def load():
+        load_started = user_cache.begin_load()
+        user = await db[USERS_COLLECTION].find_one({"_id": user_id}, {field: 0 for field in USER_CACHE_EXCLUDED_FIELDS})
+        if user is not None:
+            user_cache.put(user, load_started)
+        return user
+    user, _ = await user_loads.do(user_id, load)
+    return dict(user) if user is not None else None
+
+async def get_current_user(authorization: Optional[str] = Header(None, alias="Authorization")):
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database connection not available")
 
-    user = db[USERS_COLLECTION].find_one({"_id": ObjectId(user_id)})
+    user_id = token_subject(authorization)
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await load_user(user_id)
     if user is None:
         raise HTTPException(status_code=401, detail="User not found for the given token.")
 
     return user
 
+async def get_token_claims(authorization: Optional[str] = Header(None, alias="Authorization")):
+    """
+    Claims-only alternative to get_current_user: the user comes from the token alone,
+    without touching the database. Only `_id` is set, so handlers that need live
+    credits, email or name must keep using get_current_user. A deleted user's token
+    stays accepted here until it expires; every query these handlers make is scoped
+    by user_id, so it only ever sees that user's (now orphaned) data.
+    """
+    user_id = token_subject(authorization)
+    user_cache.counters["claims_only"] += 1
+    return {"_id": user_id}
+
 # Utility function to get appropriate AI client
 def get_ai_client():
-    """Returns the Google AI client or raises an error."""
-    if hasattr(app.state, "google_model") and app.state.google_model:
-        print("Using Google AI model")
-        return {"client": app.state.google_model, "type": "google"}
+    """Returns the configured LLM provider or raises an error."""
+    if llm_gateway.breaker.state == "open":
+        raise HTTPException(status_code=503, detail="Google AI temporarily unavailable, please retry shortly.")
+    provider = getattr(app.state, "llm_provider", None)
+    if provider:
+        return {"client": provider, "type": getattr(provider, "name", "google")}
     else:
         raise HTTPException(status_code=503, detail="Google AI client not available.")
 
+def current_provider():
+    """Provider used by the LLM gateway; created on demand if startup could not initialize it."""
+    if not getattr(app.state, "llm_provider", None):
+        app.state.llm_provider = create_provider(GOOGLE_MODEL_NAME, GOOGLE_API_KEY)
+    return app.state.llm_provider
+
+# Single entry point for LLM calls: concurrency limits, retries, deadlines and circuit breaker
+llm_gateway = LLMGateway(current_provider)
+
+def password_busy_error(exc: PasswordHasherBusy) -> HTTPException:
+    return HTTPException(status_code=503, detail="Server busy, please retry shortly.", headers={"Retry-After": str(exc.retry_after)})
+
+async def hash_password(password: str) -> str:
+    """bcrypt hash computed in the password hashing pool (503 when its queue is full)."""
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy as e:
+        raise password_busy_error(e)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    try:
+        return await password_hasher.verify(password, hashed)
+    except PasswordHasherBusy as e:
+        raise password_busy_error(e)
+
+async def rehash_password(user_id: ObjectId, password: str, old_hash: str):
+    """Re-hashes with the configured cost; skipped (retried on a later login) if the pool is busy."""
+    try:
+        new_hash = await password_hasher.hash(password)
+        # Conditional on the old hash: a password change in between wins
+        await db[USERS_COLLECTION].update_one({"_id": user_id, "password": old_hash}, {"$set": {"password": new_hash}})
+        password_hasher.counters["rehashed"] += 1
+    except PasswordHasherBusy:
+        pass
+    except Exception as e:
+        print(f"Password rehash failed for {user_id}: {e}")
+
 # Authentication Endpoints
 @app.post("/api/register", response_model=Token)
 async def register(user: UserCreate):
@@ -269,18 +504,18 @@ async def register(user: UserCreate):
         raise HTTPException(status_code=503, detail="Database connection not available")
     
     try:
-        hashed_password = bcrypt.hashpw(user.password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = await hash_password(user.password)
         
         user_data = {
             "email": user.email,
-            "password": hashed_password.decode('utf-8'),
+            "password": hashed_password,
             "name": user.name,
             "created_at": datetime.utcnow(),
             "credits": 500  # Initial credits for new user (integer)
         }
         
         try:
-            result = db[USERS_COLLECTION].insert_one(user_data)
+            result = await db[USERS_COLLECTION].insert_one(user_data)
             user_id = str(result.inserted_id)
             
             access_token = create_access_token({"sub": user_id})
@@ -290,6 +525,8 @@ async def register(user: UserCreate):
         except Exception as e:
             print(f"MongoDB insertion error: {str(e)}")
             raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Registration error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
@@ -299,12 +536,18 @@ async def login(user: UserLogin):
     if db is None:
         raise HTTPException(status_code=503, detail="Database connection not available")
     
-    db_user = db[USERS_COLLECTION].find_one({"email": user.email})
+    load_started = user_cache.begin_load()
+    db_user = await db[USERS_COLLECTION].find_one({"email": user.email})
     if not db_user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    if not bcrypt.checkpw(user.password.encode('utf-8'), db_user["password"].encode('utf-8')):
+    if not await verify_password(user.password, db_user["password"]):
         raise HTTPException(status_code=401, detail="Invalid email or password")
+    if password_hasher.needs_rehash(db_user["password"]):
+        # Hash with an outdated cost: replaced in the background, the login does not wait for it
+        asyncio.create_task(rehash_password(db_user["_id"], user.password, db_user["password"]))
+    # The client calls /api/user right after logging in
+    user_cache.put(db_user, load_started)
     
     user_id_str = str(db_user["_id"])
     access_token = create_access_token({"sub": user_id_str})
@@ -317,32 +560,82 @@ async def login(user: UserLogin):
         credits=db_user.get("credits", 0)
     )
     
-    # Fetch processed paper messages
-    processed_messages = []
-    if db is not None:
-        message_cursor = db[CHAT_MESSAGES_COLLECTION].find({ # UPDATED
-            "user_id": ObjectId(user_id_str),
-            "content_type": {"$in": ["summary", "code_suggestion"]}
-        }).sort("timestamp", -1) # Sort by most recent first
-        
-        for msg_doc in message_cursor:
-            processed_messages.append(ChatMessage(
-                id=str(msg_doc["_id"]),
-                content=msg_doc["content"],
-                role=msg_doc["role"],
-                timestamp=msg_doc["timestamp"],
-                paperData=msg_doc.get("paper_context"), # Use paper_context here
-                processedData=None, # Or decide how to populate this
-                content_type=msg_doc.get("content_type") # Added content_type
-            ))
-            
     return LoginResponse(
         access_token=access_token,
         token_type="bearer",
-        user=user_response,
-        processed_paper_messages=processed_messages
+        user=user_response
     )
 
+def history_item_from_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    paper_context = doc.get("paper_context") or {}
+    return {
+        "id": str(doc["_id"]),
+        "content_type": doc["content_type"],
+        "title": paper_context.get("title"),
+        "document_id": paper_context.get("document_id"),
+        "timestamp": doc["timestamp"],
+    }
+
+@app.get("/api/history/processed-papers", response_model=ProcessedPaperHistoryResponse)
+async def get_processed_paper_history(limit: int = HISTORY_PAGE_DEFAULT, cursor: Optional[str] = None,
+                                      content_type: Optional[str] = None, current_user: dict = Depends(get_token_claims)):
+    """
+    Resúmenes y código generados por el usuario, más recientes primero, paginados por
+    cursor. Solo se devuelve un extracto; el contenido completo de una entrada se pide en
+    /api/history/processed-papers/{message_id}.
+    """
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database connection not available")
+    if content_type is not None and content_type not in PROCESSED_HISTORY_CONTENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"content_type must be one of {PROCESSED_HISTORY_CONTENT_TYPES}")
+
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    # Índice (user_id, content_type, timestamp, _id): con $in se mezclan los rangos ya ordenados
+    query: Dict[str, Any] = {
+        "user_id": current_user["_id"],
+        "content_type": content_type if content_type else {"$in": PROCESSED_HISTORY_CONTENT_TYPES},
+    }
+    if cursor:
+        query.update(decode_cursor(cursor, "timestamp"))
+    projection = {
+        "content_type": 1,
+        "timestamp": 1,
+        "paper_context.title": 1,
+        "paper_context.document_id": 1,
+        "preview": {"$substrCP": [{"$ifNull": ["$content", ""]}, 0, HISTORY_PREVIEW_CHARS]},
+    }
+    docs = await db[CHAT_MESSAGES_COLLECTION].find(query, projection) \
+        .sort([("timestamp", -1), ("_id", -1)]) \
+        .limit(limit + 1) \
+        .to_list(length=limit + 1)
+    page = docs[:limit]
+    return {
+        "items": [{**history_item_from_doc(doc), "preview": doc.get("preview", "")} for doc in page],
+        "next_cursor": encode_cursor(page[-1]["timestamp"], page[-1]["_id"]) if len(docs) > limit else None,
+    }
+
+@app.get("/api/history/processed-papers/{message_id}", response_model=ProcessedPaperHistoryEntry)
+async def get_processed_paper_history_entry(message_id: str, current_user: dict = Depends(get_token_claims)):
+    """Una entrada completa del historial (resumen o código generado)."""
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database connection not available")
+    if not ObjectId.is_valid(message_id):
+        raise HTTPException(status_code=400, detail=f"Invalid message ID format: {message_id}")
+
+    doc = await db[CHAT_MESSAGES_COLLECTION].find_one(
+        {"_id": ObjectId(message_id), "user_id": current_user["_id"], "content_type": {"$in": PROCESSED_HISTORY_CONTENT_TYPES}},
+        {"content_type": 1, "timestamp": 1, "content": 1, "paper_context": 1},
+    )
+    if doc is None:
+        raise HTTPException(status_code=404, detail="History entry not found")
+    content = doc.get("content") or ""
+    return {
+        **history_item_from_doc(doc),
+        "preview": content[:HISTORY_PREVIEW_CHARS],
+        "content": content,
+        "paper_context": doc.get("paper_context"),
+    }
+
 @app.get("/api/user", response_model=UserResponse)
 async def get_user(current_user: dict = Depends(get_current_user)):
     return {
@@ -354,42 +647,31 @@ async def get_user(current_user: dict = Depends(get_current_user)):
 
 # PDF Processing Endpoint
 @app.post("/api/extract-pdf", response_model=PaperData)
-async def extract_pdf(file: UploadFile = File(...)):
+async def extract_pdf(file: UploadFile = File(...), include_content: bool = True):
     if file.filename is None or not file.filename.endswith(".pdf"):
         raise HTTPException(status_code=400, detail="File must be a PDF")
     
     try:
         contents = await file.read()
-        pdf_reader = PyPDF2.PdfReader(BytesIO(contents))
-        extracted_text = ""  # Definir variable para texto extraído
-        for page_num, page in enumerate(pdf_reader.pages):
-            page_text = page.extract_text()
-            if page_text:
-                extracted_text += page_text + "\n"
-        
-        title = file.filename.replace(".pdf", "")
-        authors = None
-        abstract = None
-        
-        # Attempt to extract abstract and authors from the first few pages
-        # This is a basic heuristic and might need refinement
-        for i in range(min(2, len(pdf_reader.pages))): # Check first 2 pages
-            page_text_for_meta = pdf_reader.pages[i].extract_text()
-            if page_text_for_meta:
-                if not abstract:
-                    # Regex for abstract: case-insensitive, looks for "Abstract" followed by content until next common section or double newline
-                    abstract_match = re.search(r"(?i)(?:Abstract|Summary)(?:[:.\s\n]|$)(.*?)(?:\n\n|Keywords|Introduction|1\.\s|I\.\s|Motivation|Background|Related Work|$)", page_text_for_meta, re.DOTALL)
-                    if abstract_match:
-                        abstract_candidate = abstract_match.group(1).strip()
-                        # Further clean common non-abstract text if it starts with it
-                        abstract_candidate = re.sub(r"^(?:[\d.]*\s*)?(?:Introduction|Motivation|Background|Related Work)\s*", "", abstract_candidate, flags=re.IGNORECASE).strip()
-                        if len(abstract_candidate) > 50: # Basic check for meaningful abstract
-                            abstract = abstract_candidate[:4000] # Increased limit for abstract
+        digest = content_digest(contents)
+        extracted = await extraction_cache.get(digest)
+        if extracted is None:
+            # La extracción se hace fuera del event loop, en el pool de procesos
+            extracted = await pdf_engine.extract(contents)
+            await extraction_cache.put(digest, extracted)
+        if not extracted.sections:
+            # Entradas de caché anteriores al índice de secciones
+            extracted.sections = build_section_index(extracted.text, extracted.page_offsets)
+        document = await document_store.save(digest, extracted)
 
         title = file.filename.replace(".pdf", "") if file.filename else "Untitled"
         paper_data = PaperData(
             title=title,
-            content=extracted_text[:300000]  # Usar la variable extraída, con límite aumentado
+            # Los clientes nuevos piden include_content=false y trabajan solo con el document_id
+            content=extracted.text if include_content else None,  # Ya limitado a PDF_TEXT_LIMIT caracteres
+            document_id=digest,
+            page_offsets=extracted.page_offsets,
+            sections=extracted.sections
         )
         return paper_data
         
@@ -408,76 +690,73 @@ CODE_GEN_COST_PER_TOKEN = 2 / TOKEN_TO_CREDIT_RATIO # Example: Code generation i
 ESTIMATED_SUMMARY_OUTPUT_TOKENS = 500  # Increased from a typical 300-word summary to give buffer
 ESTIMATED_CODE_OUTPUT_TOKENS = 1500    # Estimate for advanced code snippets
 
-# Helper function to calculate token count using tiktoken
-def count_tokens(text: str, model_name: str = "cl100k_base") -> int:
-    """Counts tokens in a string using tiktoken."""
-    if not text: # Handle empty strings
-        return 0
-    try:
-        encoding = tiktoken.get_encoding(model_name)
-    except Exception:
-        encoding = tiktoken.get_encoding("cl100k_base") 
-    return len(encoding.encode(text))
-
-# Helper function to deduct credits
-async def deduct_credits(user_id: str, amount: int):
-    if db is None:
-        raise HTTPException(status_code=503, detail="Database connection not available")
-    db[USERS_COLLECTION].update_one(
-        {"_id": ObjectId(user_id)},
-        {"$inc": {"credits": -amount}}
-    )
-
-@app.post("/api/process-paper", response_model=ProcessedPaper)
-async def process_paper(paper_data: PaperData, current_user: dict = Depends(get_current_user)):
-    user_id = str(current_user["_id"])
-    user_credits = current_user.get("credits", 0)
-    session_id = ObjectId() # Generate a unique session ID for this interaction
+def insufficient_credits_error(exc: InsufficientCredits) -> HTTPException:
+    return HTTPException(status_code=402, detail=f"Insufficient credits. Required: ~{exc.required}, Available: {exc.available}.")
 
+async def reserve_credits(user_id: str, amount: int, session_id: ObjectId, user_credits: int) -> CreditReservation:
+    """Atomically reserves the estimated cost (402 if the balance does not cover it)."""
     try:
-        # --- Pre-computation of Estimated Cost ---
-        paper_context_for_prompt = f"Title: {paper_data.title}\n"
-        content_for_estimation = paper_data.content[:20000] if paper_data.content else ""
-        paper_context_for_prompt += f"Content (excerpt):\n{content_for_estimation}..."
-
-        pre_summary_prompt_for_estimation = f"""
-        Analyze this research paper excerpt and provide a summary.
-        Paper Context:
-        {paper_context_for_prompt}
-        Summary (250-300 words):
-        """
-        estimated_summary_input_tokens = count_tokens(pre_summary_prompt_for_estimation)
-        estimated_summary_cost = (estimated_summary_input_tokens + ESTIMATED_SUMMARY_OUTPUT_TOKENS) * SUMMARY_COST_PER_TOKEN
-
-        estimated_code_input_base_for_estimation = f"Title: {paper_data.title}\n"
-        estimated_code_input_base_for_estimation += f"Summary: [estimated {ESTIMATED_SUMMARY_OUTPUT_TOKENS} tokens summary]"
-        
-        estimated_code_input_tokens = count_tokens(estimated_code_input_base_for_estimation) + ESTIMATED_SUMMARY_OUTPUT_TOKENS
-        estimated_code_gen_cost = (estimated_code_input_tokens + ESTIMATED_CODE_OUTPUT_TOKENS) * CODE_GEN_COST_PER_TOKEN
-        
-        estimated_total_cost = estimated_summary_cost + estimated_code_gen_cost
-        integer_estimated_total_cost = math.ceil(estimated_total_cost)
-
-        if user_credits < integer_estimated_total_cost:
-            raise HTTPException(
-                status_code=402,
-                detail=f"Insufficient credits. Required: ~{integer_estimated_total_cost}, Available: {user_credits}."
-            )
-        # --- End of Pre-computation ---
+        reservation = await credit_ledger.reserve(ObjectId(user_id), amount, session_id, opening_balance=user_credits)
+    except InsufficientCredits as e:
+        raise insufficient_credits_error(e)
+    except AccountNotFound:
+        user_cache.invalidate(ObjectId(user_id))
+        raise HTTPException(status_code=401, detail="User not found")
+    if reservation.amount > 0:
+        user_cache.update_credits(reservation.user_id, reservation.balance)
+    return reservation
+
+async def charge_credits(user_id: str, amount: int, session_id: ObjectId, user_credits: int, reason: str, details: dict) -> int:
+    """Charges a known amount and logs it in one step. Returns the remaining balance."""
+    try:
+        balance = await credit_ledger.charge(ObjectId(user_id), amount, reason, details, session_id=session_id, opening_balance=user_credits)
+    except InsufficientCredits as e:
+        raise insufficient_credits_error(e)
+    except AccountNotFound:
+        user_cache.invalidate(ObjectId(user_id))
+        raise HTTPException(status_code=401, detail="User not found")
+    if amount > 0:
+        user_cache.update_credits(ObjectId(user_id), balance)
+    return balance if balance is not None else max(0, user_credits - amount)
+
+async def settle_credits(reservation: CreditReservation, amount: int, user_credits: int, reason: str, details: dict) -> int:
+    """Settles a reservation at the actual cost and logs it. Returns the remaining balance."""
+    balance = await credit_ledger.settle(reservation, amount, reason, details)
+    if reservation.amount != amount:
+        user_cache.update_credits(reservation.user_id, balance)
+    return balance if balance is not None else user_credits - amount
+
+async def refund_credits(reservation: CreditReservation) -> Optional[int]:
+    """Returns a whole reservation after a failed request."""
+    already_settled = reservation.settled
+    balance = await credit_ledger.refund(reservation)
+    if not already_settled and reservation.amount > 0:
+        user_cache.update_credits(reservation.user_id, balance)
+    return balance
+
+# Resolve the paper text either from the inline content or from a stored document
+# The section index is always rebuilt for inline content (client-sent offsets are not trusted)
+async def resolve_paper_content(paper_data: PaperData) -> PaperData:
+    if paper_data.content:
+        # Offsets sent by the client are discarded: they would steer the abstract scan window and section pages
+        return paper_data.model_copy(update={"page_offsets": None, "sections": build_section_index(paper_data.content, None)})
+    if not paper_data.document_id:
+        raise HTTPException(status_code=400, detail="Either content or document_id is required")
+    document = await document_store.load(paper_data.document_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found. Please upload the PDF again.")
+    sections = [DocumentSection(**section) for section in document["sections"]]
+    return paper_data.model_copy(update={
+        "content": document["content"],
+        "page_offsets": document.get("page_offsets"),
+        "sections": sections
+    })
 
-        ai_info = get_ai_client()
-        ai_client = ai_info["client"]
-        client_type = ai_info["type"]
-        
-        # Define label variable here to ensure it's available in scope
-        label = "ArxivPaper"  # Default label for the paper
-        
-        # 1. Generate summary
-        # Full content for actual prompt
-        summary_prompt_full_context = f"Title: {paper_data.title}\n"
-        summary_prompt_full_context += f"Full Content:\n{paper_data.content}" # Use full content here
+# Secciones que se usan como extracto del paper para el prompt de código
+CODE_EXCERPT_SECTIONS = ("method", "experiments", "results")
 
-        summary_prompt = f"""
+# Prompt templates (module level so the result cache can version them)
+SUMMARY_PROMPT_TEMPLATE = """
         You are an expert academic research assistant. Your task is to meticulously analyze the provided research paper and generate a comprehensive, clear, and concise summary. 
         The summary should be between 300-500 words and accurately reflect the paper's core arguments, methodology, key findings, and main conclusions. 
         Ensure you capture the essence and significant contributions of the paper. Focus on extracting actionable insights and technical details relevant for understanding and potentially implementing concepts from the paper.
@@ -487,92 +766,8 @@ async def process_paper(paper_data: PaperData, current_user: dict = Depends(get_
         
         Provide only the summary itself, without any additional conversational text, formatting, or section titles like "Summary:".
         """
-        
-        actual_summary_input_tokens = count_tokens(summary_prompt)
-        summary_text = ""
-
-        try:
-            if client_type == "google":
-                # Use the GenerativeModel class to generate content
-                if hasattr(app.state, "google_model") and app.state.google_model:
-                    model = app.state.google_model
-                else:
-                    # If model not available in app state, create a new one
-                    from google.generativeai.generative_models import GenerativeModel
-                    model = GenerativeModel(GOOGLE_MODEL_NAME)
-                
-                # Use generate_content instead of generate_content_async if there are issues
-                try:
-                    summary_response = await model.generate_content_async(
-                        summary_prompt
-                    )
-                    summary_text = summary_response.text
-                except AttributeError:
-                    # Fallback to synchronous version if async is not available
-                    print("Falling back to synchronous generate_content")
-                    summary_response = model.generate_content(
-                        summary_prompt
-                    )
-                    summary_text = summary_response.text
-            else:
-                raise HTTPException(status_code=500, detail="Unsupported AI client type for summary.")
-        except Exception as e_summary_ai: # Catch any exception from summary AI call
-            print(f"Error during AI summary generation ({client_type}): {type(e_summary_ai).__name__}: {str(e_summary_ai)}")
-            import traceback
-            traceback.print_exc()
-            raise HTTPException(status_code=500, detail=f"{client_type.capitalize()} AI summary generation failed: {str(e_summary_ai)}")
-        
-        actual_summary_output_tokens = count_tokens(summary_text)
-        actual_summary_cost = (actual_summary_input_tokens + actual_summary_output_tokens) * SUMMARY_COST_PER_TOKEN
-        integer_actual_summary_cost = math.ceil(actual_summary_cost)
-
-        if db is not None:
-            summary_message_record = {
-                "user_id": ObjectId(user_id),
-                "session_id": session_id,
-                "role": "assistant",
-                "content_type": "summary",
-                "content": summary_text,
-                "input_tokens": actual_summary_input_tokens,
-                "output_tokens": actual_summary_output_tokens,
-                "estimated_cost": integer_actual_summary_cost, # Storing the actual cost now
-                "timestamp": datetime.utcnow(),
-                "paper_context": {
-                    "title": paper_data.title, 
-                    "content_preview": paper_data.content[:500] + "..." if paper_data.content else ""
-                }
-            }
-            db[CHAT_MESSAGES_COLLECTION].insert_one(summary_message_record)
 
-        summary = summary_text.strip()
-        summary = re.sub(r'<think>.*?</think>', '', summary, flags=re.DOTALL).strip()
-        markdown_match = re.search(r'```(?:text|markdown)?\s*\n([\s\S]*?)\n```', summary, re.IGNORECASE)
-        if markdown_match:
-            summary = markdown_match.group(1).strip()
-        else:
-            generic_markdown_match = re.search(r'```\s*\n([\s\S]*?)\n```', summary, re.IGNORECASE)
-            if generic_markdown_match:
-                summary = generic_markdown_match.group(1).strip()
-        prefix_patterns = [
-            r"^\s*here(?:\'s| is) the summary:\s*",
-            r"^\s*okay, here is the summary:\s*",
-            r"^\s*summary\s*[:：]*\s*",
-        ]
-        for pattern in prefix_patterns:
-            summary = re.sub(pattern, "", summary, flags= re.IGNORECASE).strip()
-        summary = summary.strip()
-
-        # 2. Generate code implementation
-        project_suggestions = []
-        
-        code_prompt_full_context = f"Paper Title: {paper_data.title}\n"
-        code_prompt_full_context += f"Generated Comprehensive Summary of the Paper: {summary}\n"
-        # Include a larger excerpt of original content for code generation context, especially if abstract is short or missing
-        # This helps ground the code generation in the paper's specifics.
-        key_excerpt_limit = 5000
-        code_prompt_full_context += f"Key Excerpt from Original Paper Content (for additional context):\n{paper_data.content[:key_excerpt_limit]}...\n"
-
-        code_prompt = f"""
+CODE_PROMPT_TEMPLATE = """
         You are an AI assistant specialized in generating advanced, practical, and well-structured code implementations based on academic research papers.
         Analyze the provided information from the paper, including its title, authors (if available), abstract (if available), a comprehensive summary, and key excerpts from the original content:
         {code_prompt_full_context}
@@ -596,7 +791,7 @@ async def process_paper(paper_data: PaperData, current_user: dict = Depends(get_
           "codeImplementation": [
             {{
               "filename": "main.py",
-              "code": "# Python code for main.py\n# Implements the core topic modeling pipeline.\nimport numpy as np\nfrom sklearn.cluster import KMeans\nfrom transformers import AutoTokenizer, AutoModel\n\n# Placeholder for actual implementation\ndef load_and_preprocess_data(texts):\n    # ... text cleaning, tokenization ...\n    return texts\n\ndef get_embeddings(texts, model_name='bert-base-uncased'):\n    tokenizer = AutoTokenizer.from_pretrained(model_name)\n    model = AutoModel.from_pretrained(model_name)\n    inputs = tokenizer(texts, padding=True, truncation=True, return_tensors='pt')\n    outputs = model(**inputs)\n    return outputs.last_hidden_state[:, 0, :].detach().numpy() # CLS token embeddings\n\ndef cluster_embeddings(embeddings, num_topics=10):\n    kmeans = KMeans(n_clusters=num_topics, random_state=42, n_init='auto')\n    kmeans.fit(embeddings)\n    return kmeans.labels_\n\ndef main():\n    sample_texts = [\"This is a document about machine learning.\", \"Deep learning is a subset of AI.\", \"Natural language processing is fascinating.\"]\n    processed_texts = load_and_preprocess_data(sample_texts)\n    embeddings = get_embeddings(processed_texts)\n    topic_labels = cluster_embeddings(embeddings)\n    for text, label in zip(sample_texts, topic_labels):\n        print(f'[Topic {label}] {text}')\n\nif __name__ == '__main__':\n    main()"
+              "code": "# Python code for main.py\n# Implements the core topic modeling pipeline.\nimport numpy as np\nfrom sklearn.cluster import KMeans\nfrom transformers import AutoTokenizer, AutoModel\n\n# Placeholder for actual implementation\ndef load_and_preprocess_data(texts):\n    # ... text cleaning, tokenization ...\n    return texts\n\ndef get_embeddings(texts, model_name='bert-base-uncased'):\n    tokenizer = AutoTokenizer.from_pretrained(model_name)\n    model = AutoModel.from_pretrained(model_name)\n    inputs = tokenizer(texts, padding=True, truncation=True, return_tensors='pt')\n    outputs = model(**inputs)\n    return outputs.last_hidden_state[:, 0, :].detach().numpy() # CLS token embeddings\n\ndef cluster_embeddings(embeddings, num_topics=10):\n    kmeans = KMeans(n_clusters=num_topics, random_state=42, n_init='auto')\n    kmeans.fit(embeddings)\n    return kmeans.labels_\n\ndef main():\n    sample_texts = [\"This is a document about machine learning.\", \"Deep learning is a subset of AI.\", \"Natural language processing is fascinating.\"]\n    processed_texts = load_and_preprocess_data(sample_texts)\n    embeddings = get_embeddings(processed_texts)\n    topic_labels = cluster_embeddings(embeddings)\n    for text, label in zip(sample_texts, topic_labels):\n        print(f'[Topic {{label}}] {{text}}')\n\nif __name__ == '__main__':\n    main()"
             }},
             {{
               "filename": "requirements.txt",
@@ -605,174 +800,576 @@ async def process_paper(paper_data: PaperData, current_user: dict = Depends(get_
           ]
         }}
         """
-        actual_code_input_tokens = count_tokens(code_prompt)
-        code_implementation_str = ""
 
-        try:
-            if client_type == "google":
-                # Use the GenerativeModel class to generate content
-                if hasattr(app.state, "google_model") and app.state.google_model:
-                    model = app.state.google_model
-                else:
-                    # If model not available in app state, create a new one
-                    from google.generativeai.generative_models import GenerativeModel
-                    model = GenerativeModel(GOOGLE_MODEL_NAME)
-                
-                # Use generate_content instead of generate_content_async if there are issues
-                try:
-                    code_response = await model.generate_content_async(
-                        code_prompt
-                    )
-                    code_implementation_str = code_response.text
-                except AttributeError:
-                    # Fallback to synchronous version if async is not available
-                    print("Falling back to synchronous generate_content for code generation")
-                    code_response = model.generate_content(
-                        code_prompt
-                    )
-                    code_implementation_str = code_response.text
-            else:
-                raise HTTPException(status_code=500, detail="Unsupported AI client type for code generation.")
-        except Exception as e_code_ai: # Catch any exception from code AI call
-            print(f"Error during AI code generation ({client_type}): {type(e_code_ai).__name__}: {str(e_code_ai)}")
-            import traceback
-            traceback.print_exc()
-            raise HTTPException(status_code=500, detail=f"{client_type.capitalize()} AI code generation failed: {str(e_code_ai)}")
-        
-        actual_code_output_tokens = count_tokens(code_implementation_str)
-        actual_code_gen_cost = (actual_code_input_tokens + actual_code_output_tokens) * CODE_GEN_COST_PER_TOKEN
-        integer_actual_code_gen_cost = math.ceil(actual_code_gen_cost)
-
-        cleaned_code_implementation_str = re.sub(r'<think>.*?</think>', '', code_implementation_str, flags= re.DOTALL).strip()
-        json_markdown_match = re.search(r'```(?:json)?\s*\n([\s\S]*?)\n```', cleaned_code_implementation_str, re.IGNORECASE)
-        if json_markdown_match:
-            cleaned_code_implementation_str = json_markdown_match.group(1).strip()
-        
-        code_prefix_patterns = [
-            r"^\s*here(?:\'s| is) the json(?: output| code)?:\s*",
-            r"^\s*okay, here is the json(?: output| code)?:\s*",
-        ]
-        for pattern in code_prefix_patterns:
-            cleaned_code_implementation_str = re.sub(pattern, "", cleaned_code_implementation_str, flags=re.IGNORECASE).strip()
+# Map-reduce summary for long papers (see summarization.py)
+SUMMARY_MAP_PROMPT_TEMPLATE = """
+        You are an expert academic research assistant. Below is part {part} of {parts} of the research paper "{title}".
+        Write a dense 150-250 word summary of this part only. Keep the problem statement, methods, algorithms, datasets,
+        key numbers and findings it contains; skip anything that is not in this part.
+
+        Part {part} of {parts}:
+        {chunk}
+
+        Provide only the summary of this part, without any additional conversational text or headings.
+        """
+
+SUMMARY_COMBINE_PROMPT_TEMPLATE = """
+        You are an expert academic research assistant. The research paper "{title}" was summarized part by part, and there
+        are too many partial summaries to combine at once. Below is group {group} of {groups} of those partial summaries.
+        Condense them into a single dense 250-400 word summary that keeps the methods, algorithms, datasets, key numbers
+        and findings they mention, in paper order, without repeating what several parts say.
+
+        Partial summaries, in paper order:
+        {partial_summaries}
+
+        Provide only the condensed summary, without any additional conversational text or headings.
+        """
+
+SUMMARY_REDUCE_PROMPT_TEMPLATE = """
+        You are an expert academic research assistant. The research paper "{title}" was too long to read at once, so it was
+        summarized part by part. Combine the partial summaries below into a comprehensive, clear, and concise summary of the whole paper.
+        The summary should be between 300-500 words and accurately reflect the paper's core arguments, methodology, key findings, and main conclusions.
+        Remove repetition between parts and focus on actionable insights and technical details relevant for implementing concepts from the paper.
 
-        if db is not None:
-            code_message_record = {
+        Partial summaries, in paper order:
+        {partial_summaries}
+
+        Provide only the summary itself, without any additional conversational text, formatting, or section titles like "Summary:".
+        """
+
+# Token budgets per prompt type (summary, code, chatbot); see prompt_planner.py
+prompt_planner = PromptPlanner()
+# Generous character cap for pre-selecting text that the planner then trims by tokens
+CHARS_PER_TOKEN_UPPER_BOUND = 6
+ESTIMATED_PARTIAL_SUMMARY_TOKENS = 350
+
+@lru_cache(maxsize=16)
+def template_tokens(template: str) -> int:
+    """Token count of a prompt template's fixed text (cached, templates never change at runtime)."""
+    return prompt_planner.count(template)
+
+# Bump when the way the prompts are filled changes without touching the templates
+PROMPT_REVISION = 3
+PROMPT_VERSION = prompt_version(
+    SUMMARY_PROMPT_TEMPLATE,
+    CODE_PROMPT_TEMPLATE,
+    SUMMARY_MAP_PROMPT_TEMPLATE,
+    SUMMARY_COMBINE_PROMPT_TEMPLATE,
+    SUMMARY_REDUCE_PROMPT_TEMPLATE,
+    ",".join(CODE_EXCERPT_SECTIONS),
+    f"map-reduce>{MAP_REDUCE_TOKEN_THRESHOLD}/{MAP_CHUNK_TOKENS}",
+    json.dumps(prompt_planner.budgets, sort_keys=True),
+    revision=PROMPT_REVISION
+)
+
+# Resultados compartidos entre usuarios: clave = hash del contenido + título + modelo + versión de prompts
+result_cache = ProcessedResultCache(provider_model_id(GOOGLE_MODEL_NAME), PROMPT_VERSION)
+# Ejecuciones del pipeline en curso, por la misma clave que la caché de resultados
+paper_flights = SingleFlight()
+
+async def serve_cached_result(entry: dict, paper_data: PaperData, user_id: str, user_credits: int, session_id: ObjectId, reservation: Optional[CreditReservation] = None) -> ProcessedPaper:
+    """
+    Answers process_paper from the result cache, billing according to RESULT_CACHE_BILLING_POLICY.
+    A coalesced follower passes the reservation it already holds, which is settled at the cache-hit cost.
+    """
+    cost = cache_hit_cost(entry)
+    billing_details = {
+        "cache_key": entry["_id"],
+        "billing_policy": RESULT_CACHE_BILLING_POLICY,
+        "paper_title": paper_data.title
+    }
+    if reservation is not None:
+        credits_remaining = await settle_credits(reservation, cost, user_credits, "Paper processing (cached result)", billing_details)
+    else:
+        credits_remaining = await charge_credits(user_id, cost, session_id, user_credits, "Paper processing (cached result)", billing_details)
+
+    summary = entry["summary"]
+    project_suggestions = [ProjectSuggestion(**suggestion) for suggestion in entry["project_suggestions"]]
+
+    if db is not None:
+        now = datetime.utcnow()
+        # Same history records as a fresh run, so the user's processed papers stay complete
+        await db[CHAT_MESSAGES_COLLECTION].insert_many([
+            {
+                "user_id": ObjectId(user_id),
+                "session_id": session_id,
+                "role": "assistant",
+                "content_type": "summary",
+                "content": summary,
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "estimated_cost": cost,
+                "cached": True,
+                "timestamp": now,
+                "paper_context": {
+                    "title": paper_data.title,
+                    "document_id": paper_data.document_id,
+                    "content_preview": paper_data.content[:500] + "..." if paper_data.content else ""
+                }
+            },
+            {
                 "user_id": ObjectId(user_id),
                 "session_id": session_id,
                 "role": "assistant",
                 "content_type": "code_suggestion",
-                "content": cleaned_code_implementation_str, # Store the cleaned JSON string
-                "input_tokens": actual_code_input_tokens,
-                "output_tokens": actual_code_output_tokens,
-                "estimated_cost": integer_actual_code_gen_cost, # Storing actual cost
-                "timestamp": datetime.utcnow(),
+                "content": json.dumps(entry["project_suggestions"]),
+                "input_tokens": 0,
+                "output_tokens": 0,
+                "estimated_cost": 0,
+                "cached": True,
+                "timestamp": now,
                 "paper_context": {
-                    "title": paper_data.title, 
+                    "title": paper_data.title,
                     "summary_preview": summary[:300] + "..." if summary else ""
                 }
             }
-            db[CHAT_MESSAGES_COLLECTION].insert_one(code_message_record)
+        ])
 
-        try:
-            # Ensure the string is not empty before parsing
-            if not cleaned_code_implementation_str:
-                raise ValueError("LLM returned an empty string for code implementation.")
-            
-            project_data_list = json.loads(cleaned_code_implementation_str)
-            
-            if isinstance(project_data_list, dict):
-                project_data_list = [project_data_list]
+    return ProcessedPaper(
+        summary=summary,
+        projectSuggestions=project_suggestions,
+        credits_remaining=credits_remaining
+    )
 
-            if not isinstance(project_data_list, list) or not project_data_list:
-                 raise ValueError("Parsed JSON is not a list or is an empty list.")
+async def build_summary_prompt(paper_data: PaperData, paper_body: str, body_tokens: Optional[int] = None) -> str:
+    # Full content for actual prompt, cut on a token boundary if it exceeds the summary budget.
+    # body_tokens is the count the caller already has; the plan only re-encodes the body to truncate it, off the event loop
+    plan = await prompt_planner.plan_async("summary", [
+        PromptSlot("title", paper_data.title, priority=0, truncatable=False),
+        PromptSlot("content", paper_body, priority=1, tokens=body_tokens), # Full content without back matter
+    ], scaffold=SUMMARY_PROMPT_TEMPLATE + "Title: \nFull Content:\n")
+    plan.log_if_trimmed(f"for '{paper_data.title}'")
+    summary_prompt_full_context = f"Title: {plan.slots['title']}\n"
+    summary_prompt_full_context += f"Full Content:\n{plan.slots['content']}"
+    return SUMMARY_PROMPT_TEMPLATE.format(summary_prompt_full_context=summary_prompt_full_context)
+
+CODE_PROMPT_LABELS = "Paper Title: \nGenerated Comprehensive Summary of the Paper: \nKey Excerpt from Original Paper Content (for additional context):\n...\n"
+
+async def build_code_prompt(paper_data: PaperData, summary: str, paper_body: str) -> str:
+    # Include an excerpt of original content for code generation context, especially if abstract is short or missing
+    # This helps ground the code generation in the paper's specifics. The planner trims it to the code budget.
+    key_excerpt_limit = prompt_planner.budgets["code"] * CHARS_PER_TOKEN_UPPER_BOUND
+    # Prefer the method/experiments/results sections over an arbitrary prefix of the paper
+    key_excerpt = select_sections(paper_data.content, paper_data.sections or [], CODE_EXCERPT_SECTIONS, key_excerpt_limit)
+    if not key_excerpt:
+        key_excerpt = paper_body[:key_excerpt_limit]
+    plan = await prompt_planner.plan_async("code", [
+        PromptSlot("title", paper_data.title, priority=0, truncatable=False),
+        PromptSlot("summary", summary, priority=1),
+        PromptSlot("excerpt", key_excerpt, priority=2),
+    ], scaffold=CODE_PROMPT_TEMPLATE + CODE_PROMPT_LABELS)
+    plan.log_if_trimmed(f"for '{paper_data.title}'")
+    code_prompt_full_context = f"Paper Title: {plan.slots['title']}\n"
+    code_prompt_full_context += f"Generated Comprehensive Summary of the Paper: {plan.slots['summary']}\n"
+    if plan.slots["excerpt"]:
+        code_prompt_full_context += f"Key Excerpt from Original Paper Content (for additional context):\n{plan.slots['excerpt']}...\n"
+    return CODE_PROMPT_TEMPLATE.format(code_prompt_full_context=code_prompt_full_context)
+
+def estimate_processing_cost(body_tokens: int) -> int:
+    """
+    Pre-computation of the estimated cost (summary + code generation) in integer credits,
+    bounded by the same token budgets the prompts are built with.
+    """
+    summary_scaffold_tokens = template_tokens(SUMMARY_PROMPT_TEMPLATE)
+
+    if body_tokens > MAP_REDUCE_TOKEN_THRESHOLD:
+        # Map-reduce: every part is read once, plus a reduce prompt over the partial summaries
+        parts = math.ceil(body_tokens / MAP_CHUNK_TOKENS)
+        estimated_summary_input_tokens = body_tokens + parts * template_tokens(SUMMARY_MAP_PROMPT_TEMPLATE)
+        estimated_summary_input_tokens += template_tokens(SUMMARY_REDUCE_PROMPT_TEMPLATE) + parts * ESTIMATED_PARTIAL_SUMMARY_TOKENS
+        estimated_summary_output_tokens = parts * ESTIMATED_PARTIAL_SUMMARY_TOKENS + ESTIMATED_SUMMARY_OUTPUT_TOKENS
+    else:
+        estimated_summary_input_tokens = min(summary_scaffold_tokens + body_tokens, prompt_planner.budgets["summary"])
+        estimated_summary_output_tokens = ESTIMATED_SUMMARY_OUTPUT_TOKENS
+    estimated_summary_cost = (estimated_summary_input_tokens + estimated_summary_output_tokens) * SUMMARY_COST_PER_TOKEN
 
-            for project_data in project_data_list:
-                if not isinstance(project_data, dict):
-                    print(f"Skipping non-dict item in project list: {project_data}")
-                    continue
+    estimated_code_input_tokens = min(
+        template_tokens(CODE_PROMPT_TEMPLATE) + ESTIMATED_SUMMARY_OUTPUT_TOKENS + body_tokens,
+        prompt_planner.budgets["code"]
+    )
+    estimated_code_gen_cost = (estimated_code_input_tokens + ESTIMATED_CODE_OUTPUT_TOKENS) * CODE_GEN_COST_PER_TOKEN
+    
+    estimated_total_cost = estimated_summary_cost + estimated_code_gen_cost
+    return math.ceil(estimated_total_cost)
 
-                raw_code_impl = project_data.get("codeImplementation", project_data.get("code"))
-                code_files = []
-
-                if isinstance(raw_code_impl, list):
-                    for file_obj in raw_code_impl:
-                        if isinstance(file_obj, dict) and "filename" in file_obj and "code" in file_obj:
-                            code_files.append(CodeFile(filename=str(file_obj["filename"]), code=str(file_obj["code"])))
-                        else:
-                            print(f"Skipping malformed file object in codeImplementation list: {file_obj}")
-                elif isinstance(raw_code_impl, str):
-                    lang = project_data.get("language", "python").lower()
-                    default_filename = f"script.{'py' if lang == 'python' else 'js' if lang == 'javascript' else 'txt'}"
-                    code_files.append(CodeFile(filename=default_filename, code=raw_code_impl))
-                
-                if not code_files and raw_code_impl: # If raw_code_impl was present but not parsed into code_files
-                    print(f"Code implementation was present but not parsed into files. Raw: {raw_code_impl}")
-                    code_files.append(CodeFile(filename="unparsed_code.txt", code=str(raw_code_impl)))
-                elif not code_files: # If no code files could be made at all
-                    code_files.append(CodeFile(filename="empty_script.txt", code="# Code generation failed, was empty, or format was not recognized."))
-
-                project_suggestions.append(
-                    ProjectSuggestion(
-                        title=str(project_data.get("title", "Untitled Project")),
-                        description=str(project_data.get("description", "No description provided.")),
-                        codeImplementation=code_files,
-                        language=str(project_data.get("language", "Python"))
-                    )
-                )
-            if not project_suggestions:
-                raise ValueError("JSON was parsed, but no valid project data was processed into suggestions.")
+class PaperPipelineResult(BaseModel):
+    summary: str
+    raw_summary: str
+    project_suggestions: List[ProjectSuggestion]
+    raw_code_output: str
+    summary_input_tokens: int
+    summary_output_tokens: int
+    summary_cost: int
+    code_input_tokens: int
+    code_output_tokens: int
+    code_gen_cost: int
+    cacheable: bool
+    token_usage: Dict[str, Any] = {}
+
+    def as_cache_entry(self, key: str) -> dict:
+        return {
+            "_id": key,
+            "summary": self.summary,
+            "project_suggestions": [suggestion.model_dump() for suggestion in self.project_suggestions],
+            "summary_cost": self.summary_cost,
+            "code_gen_cost": self.code_gen_cost
+        }
+
+def clean_summary_output(summary_text: str) -> str:
+    summary = summary_text.strip()
+    summary = re.sub(r'<think>.*?</think>', '', summary, flags=re.DOTALL).strip()
+    markdown_match = re.search(r'```(?:text|markdown)?\s*\n([\s\S]*?)\n```', summary, re.IGNORECASE)
+    if markdown_match:
+        summary = markdown_match.group(1).strip()
+    else:
+        generic_markdown_match = re.search(r'```\s*\n([\s\S]*?)\n```', summary, re.IGNORECASE)
+        if generic_markdown_match:
+            summary = generic_markdown_match.group(1).strip()
+    prefix_patterns = [
+        r"^\s*here(?:\'s| is) the summary:\s*",
+        r"^\s*okay, here is the summary:\s*",
+        r"^\s*summary\s*[:：]*\s*",
+    ]
+    for pattern in prefix_patterns:
+        summary = re.sub(pattern, "", summary, flags= re.IGNORECASE).strip()
+    summary = summary.strip()
+    return summary
+
+def clean_code_output(code_implementation_str: str) -> str:
+    cleaned_code_implementation_str = re.sub(r'<think>.*?</think>', '', code_implementation_str, flags= re.DOTALL).strip()
+    json_markdown_match = re.search(r'```(?:json)?\s*\n([\s\S]*?)\n```', cleaned_code_implementation_str, re.IGNORECASE)
+    if json_markdown_match:
+        cleaned_code_implementation_str = json_markdown_match.group(1).strip()
+    
+    code_prefix_patterns = [
+        r"^\s*here(?:\'s| is) the json(?: output| code)?:\s*",
+        r"^\s*okay, here is the json(?: output| code)?:\s*",
+    ]
+    for pattern in code_prefix_patterns:
+        cleaned_code_implementation_str = re.sub(pattern, "", cleaned_code_implementation_str, flags=re.IGNORECASE).strip()
+
+    return cleaned_code_implementation_str
+
+def parse_project_suggestions(cleaned_code_implementation_str: str):
+    """Parses the code generation JSON into ProjectSuggestions. Returns (suggestions, cacheable)."""
+    project_suggestions = []
+    cacheable_result = True # Fallback outputs are never stored in the result cache
+    try:
+        # Ensure the string is not empty before parsing
+        if not cleaned_code_implementation_str:
+            raise ValueError("LLM returned an empty string for code implementation.")
+        
+        project_data_list = json.loads(cleaned_code_implementation_str)
+        
+        if isinstance(project_data_list, dict):
+            project_data_list = [project_data_list]
+
+        if not isinstance(project_data_list, list) or not project_data_list:
+             raise ValueError("Parsed JSON is not a list or is an empty list.")
+
+        for project_data in project_data_list:
+            if not isinstance(project_data, dict):
+                print(f"Skipping non-dict item in project list: {project_data}")
+                continue
+
+            raw_code_impl = project_data.get("codeImplementation", project_data.get("code"))
+            code_files = []
+
+            if isinstance(raw_code_impl, list):
+                for file_obj in raw_code_impl:
+                    if isinstance(file_obj, dict) and "filename" in file_obj and "code" in file_obj:
+                        code_files.append(CodeFile(filename=str(file_obj["filename"]), code=str(file_obj["code"])))
+                    else:
+                        print(f"Skipping malformed file object in codeImplementation list: {file_obj}")
+            elif isinstance(raw_code_impl, str):
+                lang = project_data.get("language", "python").lower()
+                default_filename = f"script.{'py' if lang == 'python' else 'js' if lang == 'javascript' else 'txt'}"
+                code_files.append(CodeFile(filename=default_filename, code=raw_code_impl))
+            
+            if not code_files and raw_code_impl: # If raw_code_impl was present but not parsed into code_files
+                print(f"Code implementation was present but not parsed into files. Raw: {raw_code_impl}")
+                code_files.append(CodeFile(filename="unparsed_code.txt", code=str(raw_code_impl)))
+            elif not code_files: # If no code files could be made at all
+                code_files.append(CodeFile(filename="empty_script.txt", code="# Code generation failed, was empty, or format was not recognized."))
 
-        except Exception as e_json_parsing:
-            error_message = f"Error parsing JSON or processing project data: {str(e_json_parsing)}. Raw LLM output: {cleaned_code_implementation_str[:1000]}..."
-            print(error_message)
-            # Fallback: provide the raw (but cleaned) string as a single code file
             project_suggestions.append(
                 ProjectSuggestion(
-                    title="Generated Code (Fallback)",
-                    description=f"Could not fully parse structured JSON output from LLM. Error: {str(e_json_parsing)}. Displaying the raw attempt.",
-                    codeImplementation=[CodeFile(filename="llm_output_fallback.txt", code=cleaned_code_implementation_str if cleaned_code_implementation_str else "# Code generation failed or LLM returned empty.")],
-                    language="text"
+                    title=str(project_data.get("title", "Untitled Project")),
+                    description=str(project_data.get("description", "No description provided.")),
+                    codeImplementation=code_files,
+                    language=str(project_data.get("language", "Python"))
                 )
             )
-        
-        if not project_suggestions: # Final safety net
-            project_suggestions = [
-                ProjectSuggestion(
-                    title="Advanced Implementation (Final Fallback)", 
-                    description="The system was unable to generate or parse a code suggestion. This is a default placeholder.", 
-                    codeImplementation=[CodeFile(filename="final_fallback_script.py", code="# Default fallback: No code generated or parsed.")], 
-                    language="Python"
-                )
-            ]
-
-        # Deduct actual cost
-        actual_total_cost = integer_actual_summary_cost + integer_actual_code_gen_cost
-        if db is not None:
-            db[USERS_COLLECTION].update_one(
-                {"_id": ObjectId(user_id)},
-                {"$inc": {"credits": -actual_total_cost}}
+        if not project_suggestions:
+            raise ValueError("JSON was parsed, but no valid project data was processed into suggestions.")
+
+    except Exception as e_json_parsing:
+        error_message = f"Error parsing JSON or processing project data: {str(e_json_parsing)}. Raw LLM output: {cleaned_code_implementation_str[:1000]}..."
+        print(error_message)
+        cacheable_result = False
+        # Fallback: provide the raw (but cleaned) string as a single code file
+        project_suggestions.append(
+            ProjectSuggestion(
+                title="Generated Code (Fallback)",
+                description=f"Could not fully parse structured JSON output from LLM. Error: {str(e_json_parsing)}. Displaying the raw attempt.",
+                codeImplementation=[CodeFile(filename="llm_output_fallback.txt", code=cleaned_code_implementation_str if cleaned_code_implementation_str else "# Code generation failed or LLM returned empty.")],
+                language="text"
             )
-            # Log the credit deduction
-            credit_log_entry = {
-                "user_id": ObjectId(user_id),
-                "session_id": session_id, # Link to the specific interaction
-                "type": "deduction",
-                "amount": actual_total_cost,
-                "reason": "Paper processing (summary and code generation)",
-                "timestamp": datetime.utcnow(),
-                "details": {
-                    "summary_cost": integer_actual_summary_cost,
-                    "code_gen_cost": integer_actual_code_gen_cost,
-                    "paper_title": paper_data.title
-                }
+        )
+    
+    if not project_suggestions: # Final safety net
+        cacheable_result = False
+        project_suggestions = [
+            ProjectSuggestion(
+                title="Advanced Implementation (Final Fallback)", 
+                description="The system was unable to generate or parse a code suggestion. This is a default placeholder.", 
+                codeImplementation=[CodeFile(filename="final_fallback_script.py", code="# Default fallback: No code generated or parsed.")], 
+                language="Python"
+            )
+        ]
+
+    return project_suggestions, cacheable_result
+
+def partial_summary_generator(token_record: RequestTokenRecord, route: str = "summary_map"):
+    """
+    Adapts the LLM gateway to the generate(prompt) -> (text, input_tokens, output_tokens) used by summarization.
+    Every call is added to token_record under the summary phase.
+    """
+    async def generate(prompt: str):
+        response = await llm_gateway.generate(route, prompt)
+        usage = await TokenUsage.from_response(route, response, prompt, response.text, SUMMARY_COST_PER_TOKEN)
+        token_record.add("summary", usage)
+        return response.text, usage.input_tokens, usage.output_tokens
+    return generate
+
+def llm_http_error(what: str, exc: Exception) -> HTTPException:
+    """Maps an LLM failure to the HTTPException returned by the endpoints (503/504 for gateway errors)."""
+    if isinstance(exc, LLMGatewayError):
+        return HTTPException(status_code=exc.status_code, detail=f"Google AI {what} unavailable: {str(exc)}")
+    return HTTPException(status_code=500, detail=f"Google AI {what} failed: {str(exc)}")
+
+async def run_paper_pipeline(paper_data: PaperData, paper_body: str, on_stage=None, paper_tokens: Optional[int] = None) -> PaperPipelineResult:
+    """
+    Runs the summary + code generation LLM calls for a paper. It is user independent
+    (no billing, no DB writes) so concurrent identical requests can share one run.
+    on_stage(stage, progress), if given, is awaited before each LLM call.
+    paper_tokens is the body token count when the caller already has it (it is counted once per request).
+    Billing uses the usage metadata reported by the provider for every call.
+    """
+    token_record = RequestTokenRecord()
+
+    # 1. Generate summary
+    if on_stage:
+        await on_stage("summary", 0.1)
+
+    try:
+        if paper_tokens is None:
+            paper_tokens = await count_tokens_async(paper_body)
+        if paper_tokens > MAP_REDUCE_TOKEN_THRESHOLD:
+            # Papers largos: resúmenes parciales en paralelo y un reduce final
+            map_reduce = await map_reduce_summary(
+                paper_data.title,
+                paper_body,
+                partial_summary_generator(token_record),
+                count_tokens,
+                SUMMARY_MAP_PROMPT_TEMPLATE,
+                SUMMARY_COMBINE_PROMPT_TEMPLATE,
+                SUMMARY_REDUCE_PROMPT_TEMPLATE,
+                reduce_generate=partial_summary_generator(token_record, "summary_reduce")
+            )
+            print(f"Map-reduce summary for '{paper_data.title}': {paper_tokens} tokens, {map_reduce.chunks} chunks, {map_reduce.calls} calls")
+            summary_text = map_reduce.summary
+        else:
+            summary_prompt = await build_summary_prompt(paper_data, paper_body, paper_tokens)
+            summary_response = await llm_gateway.generate("summary", summary_prompt)
+            summary_text = summary_response.text
+            token_record.add("summary", await TokenUsage.from_response("summary", summary_response, summary_prompt, summary_text, SUMMARY_COST_PER_TOKEN))
+    except HTTPException:
+        raise
+    except Exception as e_summary_ai: # Catch any exception from summary AI call
+        print(f"Error during AI summary generation: {type(e_summary_ai).__name__}: {str(e_summary_ai)}")
+        traceback.print_exc()
+        raise llm_http_error("summary generation", e_summary_ai)
+
+    summary = clean_summary_output(summary_text)
+
+    # 2. Generate code implementation
+    if on_stage:
+        await on_stage("code", 0.5)
+    code_prompt = await build_code_prompt(paper_data, summary, paper_body)
+
+    try:
+        code_response = await llm_gateway.generate("code", code_prompt)
+        code_implementation_str = code_response.text
+    except Exception as e_code_ai: # Catch any exception from code AI call
+        print(f"Error during AI code generation: {type(e_code_ai).__name__}: {str(e_code_ai)}")
+        traceback.print_exc()
+        raise llm_http_error("code generation", e_code_ai)
+
+    token_record.add("code", await TokenUsage.from_response("code", code_response, code_prompt, code_implementation_str, CODE_GEN_COST_PER_TOKEN))
+
+    cleaned_code_implementation_str = clean_code_output(code_implementation_str)
+    project_suggestions, cacheable_result = parse_project_suggestions(cleaned_code_implementation_str)
+
+    return PaperPipelineResult(
+        summary=summary,
+        raw_summary=summary_text,
+        project_suggestions=project_suggestions,
+        raw_code_output=cleaned_code_implementation_str,
+        summary_input_tokens=token_record.input_tokens("summary"),
+        summary_output_tokens=token_record.output_tokens("summary"),
+        summary_cost=token_record.credits("summary"),
+        code_input_tokens=token_record.input_tokens("code"),
+        code_output_tokens=token_record.output_tokens("code"),
+        code_gen_cost=token_record.credits("code"),
+        cacheable=cacheable_result,
+        token_usage=token_record.as_dict()
+    )
+
+async def settle_paper_processing(pipeline: PaperPipelineResult, paper_data: PaperData, user_id: str, user_credits: int, session_id: ObjectId, result_cache_key: str, reservation: CreditReservation) -> int:
+    """
+    Stores the history records, settles the credit reservation at the actual cost (with its
+    credit log entry) and fills the result cache. Returns the remaining balance.
+    """
+    summary = pipeline.summary
+    project_suggestions = pipeline.project_suggestions
+    integer_actual_summary_cost = pipeline.summary_cost
+    integer_actual_code_gen_cost = pipeline.code_gen_cost
+
+    if db is not None:
+        summary_message_record = {
+            "user_id": ObjectId(user_id),
+            "session_id": session_id,
+            "role": "assistant",
+            "content_type": "summary",
+            "content": pipeline.raw_summary,
+            "input_tokens": pipeline.summary_input_tokens,
+            "output_tokens": pipeline.summary_output_tokens,
+            "estimated_cost": integer_actual_summary_cost, # Storing the actual cost now
+            "timestamp": datetime.utcnow(),
+            "paper_context": {
+                "title": paper_data.title, 
+                "document_id": paper_data.document_id,
+                "content_preview": paper_data.content[:500] + "..." if paper_data.content else ""
+            }
+        }
+        await db[CHAT_MESSAGES_COLLECTION].insert_one(summary_message_record)
+
+        code_message_record = {
+            "user_id": ObjectId(user_id),
+            "session_id": session_id,
+            "role": "assistant",
+            "content_type": "code_suggestion",
+            "content": pipeline.raw_code_output, # Store the cleaned JSON string
+            "input_tokens": pipeline.code_input_tokens,
+            "output_tokens": pipeline.code_output_tokens,
+            "estimated_cost": integer_actual_code_gen_cost, # Storing actual cost
+            "timestamp": datetime.utcnow(),
+            "paper_context": {
+                "title": paper_data.title, 
+                "summary_preview": summary[:300] + "..." if summary else ""
             }
-            db[CREDIT_LOGS_COLLECTION].insert_one(credit_log_entry)
+        }
+        await db[CHAT_MESSAGES_COLLECTION].insert_one(code_message_record)
+
+    # Settle the reservation at the actual cost
+    actual_total_cost = integer_actual_summary_cost + integer_actual_code_gen_cost
+    credits_remaining = await settle_credits(
+        reservation,
+        actual_total_cost,
+        user_credits,
+        "Paper processing (summary and code generation)",
+        {
+            "summary_cost": integer_actual_summary_cost,
+            "code_gen_cost": integer_actual_code_gen_cost,
+            "paper_title": paper_data.title,
+            "token_usage": pipeline.token_usage
+        }
+    )
+
+    if pipeline.cacheable:
+        await result_cache.put(
+            result_cache_key,
+            summary,
+            [suggestion.model_dump() for suggestion in project_suggestions],
+            integer_actual_summary_cost,
+            integer_actual_code_gen_cost
+        )
 
-        return ProcessedPaper(
-            summary=summary,
-            projectSuggestions=project_suggestions,
-            credits_remaining=user_credits - actual_total_cost # Return updated credits
+    return credits_remaining
+
+async def process_paper_for_user(paper_data: PaperData, user_id: str, user_credits: int, session_id: ObjectId, on_stage=None, lease: Optional[JobContext] = None) -> ProcessedPaper:
+    """
+    Cache lookup, credit reservation, (coalesced) pipeline run and settlement for one user.
+    Shared by /api/process-paper and the background job worker; on_stage(stage, progress)
+    is awaited as the pipeline advances. The reservation is refunded if anything fails before settling.
+    A job passes its lease: the reservation is recorded on the job and only settled while the job is still owned.
+    """
+    result_cache_key = result_cache.key_for(paper_data.content, paper_data.title)
+    cached_entry = await result_cache.get(result_cache_key)
+    if cached_entry is not None:
+        print(f"Result cache hit for paper '{paper_data.title}'")
+        if lease is not None:
+            await lease.ensure_owner()
+        return await serve_cached_result(cached_entry, paper_data, user_id, user_credits, session_id)
+
+    # Las referencias y agradecimientos no aportan nada al resumen: se eliminan del prompt
+    paper_body = strip_sections(paper_data.content, paper_data.sections or [])
+
+    # --- Pre-computation of Estimated Cost ---
+    # The body is tokenized once here (off the event loop) and reused by the pipeline
+    paper_tokens = await count_tokens_async(paper_body)
+    integer_estimated_total_cost = estimate_processing_cost(paper_tokens)
+    # --- End of Pre-computation ---
+
+    # Fails fast with 503 before joining (or starting) a pipeline run
+    get_ai_client()
+
+    # Conditional decrement: concurrent requests can never spend more than the balance
+    reservation = await reserve_credits(user_id, integer_estimated_total_cost, session_id, user_credits)
+    try:
+        if lease is not None:
+            # Recorded on the job so a worker that recovers it after a crash refunds the hold
+            await lease.hold_reservation(reservation)
+        # Peticiones idénticas concurrentes comparten una única ejecución del pipeline LLM
+        pipeline, is_owner = await paper_flights.do(
+            result_cache_key,
+            lambda: run_paper_pipeline(paper_data, paper_body, on_stage=on_stage, paper_tokens=paper_tokens)
         )
+        if not is_owner:
+            # Quien no lanzó la ejecución recibe el resultado compartido, facturado como un acierto de caché
+            print(f"Coalesced process-paper request for '{paper_data.title}'")
+            if lease is not None:
+                await lease.claim_reservation()
+            return await serve_cached_result(pipeline.as_cache_entry(result_cache_key), paper_data, user_id, user_credits, session_id, reservation=reservation)
+
+        if on_stage:
+            await on_stage("settling", 0.9)
+        if lease is not None:
+            # A job whose lease was lost has been requeued: only the current run may bill
+            await lease.claim_reservation()
+        credits_remaining = await settle_paper_processing(pipeline, paper_data, user_id, user_credits, session_id, result_cache_key, reservation)
+    finally:
+        if not reservation.settled:
+            if lease is None or await lease.release_reservation(reservation):
+                await refund_credits(reservation)
+
+    return ProcessedPaper(
+        summary=pipeline.summary,
+        projectSuggestions=pipeline.project_suggestions,
+        credits_remaining=credits_remaining, # Return updated credits
+        token_usage=pipeline.token_usage
+    )
+
+@app.post("/api/process-paper", response_model=ProcessedPaper)
+async def process_paper(paper_data: PaperData, current_user: dict = Depends(get_current_user)):
+    paper_data = await resolve_paper_content(paper_data)
+    user_id = str(current_user["_id"])
+    user_credits = current_user.get("credits", 0)
+    session_id = ObjectId() # Generate a unique session ID for this interaction
+
+    try:
+        return await process_paper_for_user(paper_data, user_id, user_credits, session_id)
 
     except HTTPException as http_exc: # Specific catch for HTTPExceptions
         raise http_exc
@@ -812,11 +1409,246 @@ async def process_paper(paper_data: PaperData, current_user: dict = Depends(get_
             log_error_to_db(error_log)
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e_outer)}")
 
+# Background jobs for paper processing
+class JobSubmitResponse(BaseModel):
+    job_id: str
+    status: str
+
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    stage: str
+    progress: float
+    attempts: int
+    error: Optional[str] = None
+    result: Optional[ProcessedPaper] = None
+    created_at: datetime
+    updated_at: datetime
+
+def job_status_response(job: dict) -> JobStatusResponse:
+    return JobStatusResponse(
+        job_id=str(job["_id"]),
+        status=job["status"],
+        stage=job["stage"],
+        progress=job["progress"],
+        attempts=job["attempts"],
+        error=job.get("error"),
+        result=job.get("result"),
+        created_at=job["created_at"],
+        updated_at=job["updated_at"]
+    )
+
+async def run_process_paper_job(job: dict, ctx: JobContext) -> dict:
+    """Job handler: same flow as /api/process-paper, with the user's credits read when the job runs."""
+    user = None
+    if db is not None:
+        user = await db[USERS_COLLECTION].find_one({"_id": job["user_id"]}, {"credits": 1})
+        if user is None:
+            raise HTTPException(status_code=401, detail="User not found")
+    user_credits = user.get("credits", 0) if user else job["payload"].get("credits_at_submit", 0)
+    paper_data = await resolve_paper_content(PaperData(**job["payload"]["paper"]))
+    await ctx.report("preparing", 0.05)
+    processed = await process_paper_for_user(paper_data, str(job["user_id"]), user_credits, job["_id"], on_stage=ctx.report, lease=ctx)
+    return processed.model_dump()
+
+async def refund_job_reservation(held: dict):
+    """Refunds the credit reservation of a job that was requeued or failed after its worker died."""
+    reservation = CreditReservation(held["user_id"], held["amount"], None, None)
+    reservation.id = held["id"]
+    balance = await refund_credits(reservation)
+    print(f"Refunded {held['amount']} credits held by an interrupted job (user {held['user_id']}, balance {balance})")
+
+job_pool.register(PROCESS_PAPER_JOB, run_process_paper_job)
+job_pool.on_reservation_released(refund_job_reservation)
+
+async def load_user_job(job_id: str, current_user: dict) -> dict:
+    if not ObjectId.is_valid(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = await job_pool.store.get(ObjectId(job_id))
+    if job is None or job["user_id"] != current_user["_id"]:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.post("/api/jobs/process-paper", response_model=JobSubmitResponse, status_code=202)
+async def submit_process_paper_job(paper_data: PaperData, current_user: dict = Depends(get_current_user)):
+    """Queues paper processing and returns at once; poll GET /api/jobs/{job_id} (or watch its events)."""
+    # Se valida ya (400/404 inmediatos) en lugar de descubrirlo en el worker
+    resolved = await resolve_paper_content(paper_data)
+    if paper_data.document_id:
+        # El worker recarga el texto del document store: no se copia el documento en el trabajo
+        payload_paper = paper_data.model_dump(exclude={"content", "sections"})
+    else:
+        payload_paper = resolved.model_dump(exclude={"sections"})
+    job = await job_pool.enqueue(
+        PROCESS_PAPER_JOB,
+        current_user["_id"],
+        {"paper": payload_paper, "credits_at_submit": current_user.get("credits", 0)}
+    )
+    return JobSubmitResponse(job_id=str(job["_id"]), status=job["status"])
+
+@app.get("/api/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job_status(job_id: str, current_user: dict = Depends(get_token_claims)):
+    return job_status_response(await load_user_job(job_id, current_user))
+
+@app.get("/api/jobs/{job_id}/events")
+async def watch_job(job_id: str, current_user: dict = Depends(get_token_claims)):
+    """SSE alternative to polling: a 'status' event on every change, then 'complete' or 'error'."""
+    job = await load_user_job(job_id, current_user)
+
+    async def event_stream():
+        current = job
+        last_seen = None
+        while True:
+            snapshot = (current["status"], current["stage"], current["progress"])
+            if snapshot != last_seen:
+                last_seen = snapshot
+                status = job_status_response(current)
+                if current["status"] == JOB_SUCCEEDED:
+                    yield sse_event("complete", status.model_dump())
+                    return
+                if current["status"] == JOB_FAILED:
+                    yield sse_event("error", {"job_id": job_id, "detail": current.get("error"), "status_code": current.get("status_code", 500)})
+                    return
+                yield sse_event("status", status.model_dump(exclude={"result"}))
+            await asyncio.sleep(JOB_WATCH_INTERVAL)
+            current = await job_pool.store.get(job["_id"]) or current
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# Streaming variant of process-paper (Server-Sent Events)
+@app.post("/api/process-paper/stream")
+async def process_paper_stream(paper_data: PaperData, current_user: dict = Depends(get_current_user)):
+    """
+    Same pipeline as /api/process-paper, streamed as SSE events:
+    start, [summary_progress], summary_token, summary_complete, code_progress, code_file, complete (or error).
+    Credits are deducted once at the end, from the actual token usage.
+    """
+    paper_data = await resolve_paper_content(paper_data)
+    user_id = str(current_user["_id"])
+    user_credits = current_user.get("credits", 0)
+    session_id = ObjectId()
+
+    result_cache_key = result_cache.key_for(paper_data.content, paper_data.title)
+    cached_entry = await result_cache.get(result_cache_key)
+    paper_body = strip_sections(paper_data.content, paper_data.sections or [])
+    paper_tokens = None
+    reservation = None
+    if cached_entry is None:
+        # Credit and AI availability checks happen before streaming so they keep their HTTP status codes
+        paper_tokens = await count_tokens_async(paper_body)
+        integer_estimated_total_cost = estimate_processing_cost(paper_tokens)
+        get_ai_client()
+        reservation = await reserve_credits(user_id, integer_estimated_total_cost, session_id, user_credits)
+
+    async def event_stream():
+        yield sse_event("start", {"cached": cached_entry is not None})
+        try:
+            if cached_entry is not None:
+                processed = await serve_cached_result(cached_entry, paper_data, user_id, user_credits, session_id)
+                yield sse_event("summary_complete", {"summary": processed.summary})
+                for suggestion in processed.projectSuggestions:
+                    for code_file in suggestion.codeImplementation:
+                        yield sse_event("code_file", code_file.model_dump())
+                yield sse_event("complete", processed.model_dump())
+                return
+
+            # 1. Summary, token by token
+            token_record = RequestTokenRecord()
+            summary_route = "summary"
+            if paper_tokens > MAP_REDUCE_TOKEN_THRESHOLD:
+                # Papers largos: la fase map va en paralelo y se emite en streaming el reduce
+                yield sse_event("summary_progress", {"mode": "map_reduce", "tokens": paper_tokens})
+                mapped = await map_partial_summaries(
+                    paper_data.title,
+                    paper_body,
+                    partial_summary_generator(token_record),
+                    count_tokens,
+                    SUMMARY_MAP_PROMPT_TEMPLATE,
+                    SUMMARY_COMBINE_PROMPT_TEMPLATE
+                )
+                yield sse_event("summary_progress", {"mode": "map_reduce", "chunks": mapped.chunks, "calls": mapped.calls})
+                summary_prompt = SUMMARY_REDUCE_PROMPT_TEMPLATE.format(title=paper_data.title, partial_summaries=mapped.summary)
+                summary_route = "summary_reduce"
+            else:
+                summary_prompt = await build_summary_prompt(paper_data, paper_body, paper_tokens)
+            summary_parts = []
+            summary_response = llm_gateway.stream(summary_route, summary_prompt)
+            async for chunk in summary_response:
+                text_chunk = chunk_text(chunk)
+                if text_chunk:
+                    summary_parts.append(text_chunk)
+                    yield sse_event("summary_token", {"text": text_chunk})
+            summary_text = "".join(summary_parts)
+            token_record.add("summary", await TokenUsage.from_response(summary_route, summary_response, summary_prompt, summary_text, SUMMARY_COST_PER_TOKEN))
+            summary = clean_summary_output(summary_text)
+            yield sse_event("summary_complete", {"summary": summary})
+
+            # 2. Code generation, emitting each CodeFile as soon as its JSON object is complete
+            code_prompt = await build_code_prompt(paper_data, summary, paper_body)
+            code_parser = CodeFileStreamParser()
+            code_response = llm_gateway.stream("code", code_prompt)
+            async for chunk in code_response:
+                text_chunk = chunk_text(chunk)
+                if not text_chunk:
+                    continue
+                new_files = code_parser.feed(text_chunk)
+                yield sse_event("code_progress", {"chars": len(code_parser.buffer)})
+                for code_file in new_files:
+                    yield sse_event("code_file", code_file)
+            code_implementation_str = code_parser.buffer
+            token_record.add("code", await TokenUsage.from_response("code", code_response, code_prompt, code_implementation_str, CODE_GEN_COST_PER_TOKEN))
+
+            cleaned_code_implementation_str = clean_code_output(code_implementation_str)
+            project_suggestions, cacheable_result = parse_project_suggestions(cleaned_code_implementation_str)
+            pipeline = PaperPipelineResult(
+                summary=summary,
+                raw_summary=summary_text,
+                project_suggestions=project_suggestions,
+                raw_code_output=cleaned_code_implementation_str,
+                summary_input_tokens=token_record.input_tokens("summary"),
+                summary_output_tokens=token_record.output_tokens("summary"),
+                summary_cost=token_record.credits("summary"),
+                code_input_tokens=token_record.input_tokens("code"),
+                code_output_tokens=token_record.output_tokens("code"),
+                code_gen_cost=token_record.credits("code"),
+                cacheable=cacheable_result,
+                token_usage=token_record.as_dict()
+            )
+            credits_remaining = await settle_paper_processing(pipeline, paper_data, user_id, user_credits, session_id, result_cache_key, reservation)
+            yield sse_event("complete", ProcessedPaper(
+                summary=summary,
+                projectSuggestions=project_suggestions,
+                credits_remaining=credits_remaining,
+                token_usage=pipeline.token_usage
+            ).model_dump())
+        except HTTPException as http_exc:
+            yield sse_event("error", {"status_code": http_exc.status_code, "detail": http_exc.detail})
+        except LLMGatewayError as gateway_exc:
+            yield sse_event("error", {"status_code": gateway_exc.status_code, "detail": f"Google AI unavailable: {str(gateway_exc)}"})
+        except Exception as e:
+            print(f"Error in process_paper_stream: {type(e).__name__}: {str(e)}")
+            traceback.print_exc()
+            yield sse_event("error", {"status_code": 500, "detail": f"An unexpected error occurred: {str(e)}"})
+        finally:
+            # Error or client disconnect before settling: the reservation goes back to the user
+            if reservation is not None and not reservation.settled:
+                await refund_credits(reservation)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 def log_error_to_db(error_details: dict):
     """Logs an error to the database."""
     try:
         # Remove the specific error logging to ERROR_LOGS_COLLECTION
-        # db[ERROR_LOGS_COLLECTION].insert_one(error_log)
+        # await db[ERROR_LOGS_COLLECTION].insert_one(error_log)
         print(f"Error logged (in theory): {error_details}")
     except Exception as e:
         print(f"Failed to log error: {str(e)}")
@@ -826,13 +1658,191 @@ async def root():
     return {"message": "DeepRead API is running"}
 
 # Chatbot API for paper-specific conversations
+CHATBOT_CONTEXT_TEMPLATE = """Eres un asistente experto en papers académicos y programación que ayuda a los usuarios a entender investigaciones científicas y su implementación práctica.
+
+CONTEXTO DEL PAPER:
+Título: {paper_title}
+Resumen: {paper_summary}{code_implementation_context}
+
+INSTRUCCIONES:
+- Responde de forma concisa y clara, usando la información del resumen y código proporcionado
+- Si se incluyen fragmentos del paper, básate en ellos para los detalles concretos e indica la sección o página
+- Si el usuario pregunta sobre código específico, refiere directamente a los archivos y fragmentos de código disponibles
+- Puedes explicar cómo funciona el código, qué hace cada parte, y cómo se relaciona con el paper
+- Si el usuario pregunta sobre modificaciones o mejoras al código, proporciona sugerencias específicas
+- Usa un tono profesional pero amigable, como un tutor técnico
+- No uses asteriscos, negritas excesivas ni formato markdown complejo
+- Si no tienes información específica sobre algo, reconócelo claramente
+- Mantén respuestas entre 100-300 palabras máximo
+- Para preguntas sobre código, puedes ser más técnico y específico
+- Termina con una pregunta de seguimiento relevante al paper o código
+
+"""
+
+# Lo único que cambia entre mensajes de una sesión; va después del prefijo guardado.
+# passages son los fragmentos del paper recuperados para la pregunta (ver paper_index.py) y
+# conversation es la memoria de la conversación (resumen + turnos recientes, ver conversation_memory.py)
+CHATBOT_QUESTION_TEMPLATE = """{passages}{conversation}Pregunta del usuario: {message}
+
+Respuesta clara y específica:"""
+
+CHAT_MEMORY_SUMMARY_TEMPLATE = """Estás manteniendo la memoria de una conversación entre un usuario y un asistente sobre un paper académico.
+
+Resumen anterior de la conversación:
+{summary}
+
+Nuevos turnos de la conversación:
+{turns}
+
+Escribe un resumen actualizado que integre el resumen anterior y los nuevos turnos: qué preguntó el usuario, qué se le explicó y qué decisiones o dudas quedan abiertas. Conserva nombres de archivos, funciones y conceptos concretos.
+Máximo {max_words} palabras, en texto plano, sin encabezados ni texto adicional."""
+
+# Tokens reserved for the user's question and for the conversation memory; the stored context gets the rest of the chatbot budget
+CHATBOT_QUESTION_MAX_TOKENS = int(os.getenv("CHATBOT_QUESTION_MAX_TOKENS", "600"))
+CHATBOT_MEMORY_RESERVED_TOKENS = CHAT_MEMORY_TOKENS + CHAT_MEMORY_SUMMARY_TOKENS + 32  # + encabezados y etiquetas de turno
+# Paper passages retrieved per question (header and labels included in the budget)
+CHATBOT_RETRIEVAL_TOKENS = int(os.getenv("CHATBOT_RETRIEVAL_TOKENS", "800"))
+CHATBOT_RETRIEVAL_TOP_K = int(os.getenv("CHATBOT_RETRIEVAL_TOP_K", "4"))
+CHATBOT_CONTEXT_VERSION = prompt_version(
+    CHATBOT_CONTEXT_TEMPLATE,
+    CHATBOT_QUESTION_TEMPLATE,
+    f"chatbot:{prompt_planner.budgets['chatbot']}/{CHATBOT_QUESTION_MAX_TOKENS}/{CHATBOT_MEMORY_RESERVED_TOKENS}/{CHATBOT_RETRIEVAL_TOKENS}",
+)
+
+def render_chatbot_context(fields: Dict[str, Any]):
+    """
+    Renders the per-session prompt prefix (paper context + instructions) within the
+    chatbot budget minus the question reserve: title first, then the summary, then
+    project headers, then code files in order. Returns (prefix, prefix_tokens, plan summary).
+    """
+    slots = [
+        PromptSlot("title", fields.get("title") or "", priority=0, truncatable=False),
+        PromptSlot("summary", fields.get("summary") or "", priority=1),
+    ]
+    projects = []
+    for i, suggestion in enumerate(fields.get("code_suggestions") or []):
+        if not isinstance(suggestion, dict):
+            continue
+        header = f"\n--- PROYECTO {i+1}: {suggestion.get('title', f'Implementation {i+1}')} ---\n"
+        header += f"Lenguaje: {suggestion.get('language', 'Unknown')}\n"
+        header += f"Descripción: {suggestion.get('description', 'No description available')}\n"
+        slots.append(PromptSlot(f"project:{i}", header, priority=2))
+        files = []
+        code_files = suggestion.get('codeImplementation', [])
+        if code_files and isinstance(code_files, list):
+            for j, code_file in enumerate(code_files):
+                if isinstance(code_file, dict):
+                    filename = code_file.get('filename', f'file_{j+1}')
+                    slot_name = f"code:{i}:{filename}"
+                    file_text = f"\n** Archivo: {filename} **\n{code_file.get('code', 'No code available')}\n"
+                    slots.append(PromptSlot(slot_name, file_text, priority=3))
+                    files.append(slot_name)
+        projects.append((f"project:{i}", files))
+
+    scaffold = CHATBOT_CONTEXT_TEMPLATE.format(paper_title="", paper_summary="", code_implementation_context="")
+    budget = (prompt_planner.budgets["chatbot"] - CHATBOT_QUESTION_MAX_TOKENS - CHATBOT_MEMORY_RESERVED_TOKENS - CHATBOT_RETRIEVAL_TOKENS
+              - template_tokens(CHATBOT_QUESTION_TEMPLATE.format(passages="", conversation="", message="")))
+    plan = prompt_planner.plan("chatbot", slots, scaffold=scaffold, budget=budget)
+
+    code_implementation_context = ""
+    if projects:
+        code_implementation_context = "\n\nIMPLEMENTACIONES DE CÓDIGO DISPONIBLES:\n"
+        for project_slot, files in projects:
+            code_implementation_context += plan.slots[project_slot]
+            kept_files = [plan.slots[slot_name] for slot_name in files if plan.slots[slot_name]]
+            if kept_files:
+                code_implementation_context += f"ARCHIVOS DE CÓDIGO:\n" + "".join(kept_files)
+            code_implementation_context += "\n" + "="*60 + "\n"
+
+    prefix = CHATBOT_CONTEXT_TEMPLATE.format(
+        paper_title=plan.slots["title"],
+        paper_summary=plan.slots["summary"],
+        code_implementation_context=code_implementation_context,
+    )
+    # The plan already counted every slot and the scaffold: no need to tokenize the prefix again
+    return prefix, plan.used_tokens, plan.summary()
+
+# Prompt prefix per chat session, rendered once (see chat_context.py)
+chat_context_store = ChatContextStore(render_chatbot_context, CHATBOT_CONTEXT_VERSION)
+# Last turns within a token budget plus a running summary of the older ones (see conversation_memory.py)
+conversation_memory = ConversationMemory(prompt_planner.count)
+# BM25 index over paper chunks per document_id, built on first use by a chat (see paper_index.py)
+paper_index_store = PaperIndexStore(prompt_planner.count, document_store.load)
+
+async def prepare_chatbot_question(message: str):
+    """
+    Counts the question (large ones off the event loop) and cuts it to the question
+    reserve. Returns (message, message_tokens, truncated).
+    """
+    message_tokens = await prompt_planner.count_async(message)
+    if message_tokens <= CHATBOT_QUESTION_MAX_TOKENS:
+        return message, message_tokens, False
+    message = await run_in_token_pool(truncate_to_tokens, message, CHATBOT_QUESTION_MAX_TOKENS, prompt_planner.encoding)
+    return message, CHATBOT_QUESTION_MAX_TOKENS, True
+
+def build_chatbot_prompt(context: Dict[str, Any], message: str, message_tokens: int, memory: MemoryWindow,
+                         retrieval: Optional[Retrieval] = None, question_truncated: bool = False):
+    """
+    Appends the retrieved paper passages, the conversation memory and the question (already
+    counted by prepare_chatbot_question) to the session's stored prefix. Nothing is tokenized
+    here: passages and memory turns carry their own token counts. Returns (prompt, input_tokens, context report).
+    """
+    retrieval = retrieval or Retrieval()
+    prompt = context["prefix"] + CHATBOT_QUESTION_TEMPLATE.format(passages=retrieval.render(), conversation=memory.render(), message=message)
+    memory_tokens = memory.summary_tokens + memory.turn_tokens
+    input_tokens = (context["prefix_tokens"] + template_tokens(CHATBOT_QUESTION_TEMPLATE.format(passages="", conversation="", message=""))
+                    + retrieval.tokens + memory_tokens + message_tokens)
+    report = {
+        **context["plan"],
+        "budget": prompt_planner.budgets["chatbot"],
+        "used_tokens": input_tokens,
+        "prefix_tokens": context["prefix_tokens"],
+        "question_truncated": question_truncated,
+        "memory": memory.report(),
+        "retrieval": retrieval.report(),
+    }
+    return prompt, input_tokens, report
+
+async def summarize_chat_turns(summary: str, turns: str, max_tokens: int, token_record: RequestTokenRecord) -> str:
+    """Folds older chatbot turns into the running summary (one LLM call, billed with the message)."""
+    prompt = CHAT_MEMORY_SUMMARY_TEMPLATE.format(summary=summary or "(ninguno)", turns=turns, max_words=int(max_tokens * 0.7))
+    response = await llm_gateway.generate("chat_memory", prompt)
+    token_record.add("chat_memory", await TokenUsage.from_response("chat_memory", response, prompt, response.text, SUMMARY_COST_PER_TOKEN))
+    return truncate_to_tokens(response.text.strip(), max_tokens, prompt_planner.encoding)
+
+async def set_chat_context(session_id: str, user_id: ObjectId, fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Stores the paper context of an owned session (re-rendered only if it changed)."""
+    session = await get_owned_session(session_id, user_id)
+    return await chat_context_store.save(session["_id"], user_id, fields)
+
+@app.put("/api/chat/sessions/{session_id}/context", response_model=ChatContextResponse)
+async def put_chat_context(session_id: str, request: ChatContextRequest, current_user: dict = Depends(get_token_claims)):
+    """
+    Guarda el contexto del paper de la sesión para el chatbot. Después basta con
+    enviar session_id y message a /api/chatbot/message.
+    """
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database connection not available")
+    context = await set_chat_context(session_id, current_user["_id"], {
+        "title": request.paper_title,
+        "summary": request.paper_summary,
+        "code_suggestions": request.code_suggestions,
+        "document_id": request.document_id,
+    })
+    if request.document_id:
+        # Índice BM25 del paper en segundo plano, solo cuando hay un chat que lo va a usar
+        paper_index_store.schedule(request.document_id)
+    return {"session_id": session_id, "digest": context["digest"], "prefix_tokens": context["prefix_tokens"], "context": context["plan"]}
+
 @app.post("/api/chatbot/message")
 async def chatbot_message(
     request: dict, 
     current_user: dict = Depends(get_current_user)
 ):
     """
-    Handles chatbot conversations about papers using the summary and code suggestions as context.
+    Handles chatbot conversations about papers. The summary and code suggestions come from
+    the session context stored with PUT /api/chat/sessions/{session_id}/context, so the
+    request only needs session_id and message (the inline paper fields are still accepted).
     """
     if db is None:
         raise HTTPException(status_code=503, detail="Database connection not available")
@@ -843,119 +1853,78 @@ async def chatbot_message(
     # Extract request data
     session_id = request.get("session_id")
     message = request.get("message", "").strip()
-    paper_title = request.get("paper_title", "")
-    paper_summary = request.get("paper_summary", "")
-    code_suggestions = request.get("code_suggestions", [])
     
     if not message:
         raise HTTPException(status_code=400, detail="Message is required")
     
     if not session_id:
         raise HTTPException(status_code=400, detail="Session ID is required")
+    if not ObjectId.is_valid(session_id):
+        raise HTTPException(status_code=400, detail="Invalid session ID format")
     
+    reservation = None
     try:
+        if any(key in request for key in ("paper_title", "paper_summary", "code_suggestions")):
+            # Older clients still send the whole paper context with every message
+            context = await set_chat_context(session_id, current_user["_id"], {
+                "title": request.get("paper_title", ""),
+                "summary": request.get("paper_summary", ""),
+                "code_suggestions": request.get("code_suggestions", []),
+                "document_id": request.get("document_id"),
+            })
+        else:
+            context = await chat_context_store.load(ObjectId(session_id), current_user["_id"])
+            if context is None:
+                raise HTTPException(status_code=409, detail="Paper context not set for this chat session")
+        paper_title = context["title"]
+        paper_context = {"title": paper_title, "document_id": context["document_id"], "summary_preview": context["summary_preview"]}
+
+        # Recent turns within the memory budget (older ones are compacted below, once reserved)
+        memory = await conversation_memory.load(ObjectId(session_id), context.get("memory"))
+        message, message_tokens, question_truncated = await prepare_chatbot_question(message)
+        # Top-k paper chunks for this question within the retrieval budget (none without a document_id)
+        retrieval = await paper_index_store.retrieve(context["document_id"], message, CHATBOT_RETRIEVAL_TOKENS, CHATBOT_RETRIEVAL_TOP_K)
+        # Stored prefix + passages + memory + question; only the question was tokenized
+        chatbot_prompt, estimated_input_tokens, chatbot_context = build_chatbot_prompt(
+            context, message, message_tokens, memory, retrieval, question_truncated)
+        if question_truncated:
+            print(f"Chatbot question truncated to {CHATBOT_QUESTION_MAX_TOKENS} tokens for chat session {session_id}")
+
         # Estimate cost for the chatbot response
-        estimated_input_tokens = count_tokens(message + paper_title + paper_summary + str(code_suggestions))
         estimated_output_tokens = 300  # Reasonable estimate for chatbot responses
         estimated_cost = (estimated_input_tokens + estimated_output_tokens) * SUMMARY_COST_PER_TOKEN
         integer_estimated_cost = math.ceil(estimated_cost)
         
-        # Check if user has enough credits
-        if user_credits < integer_estimated_cost:
-            raise HTTPException(
-                status_code=402,
-                detail=f"Insufficient credits. Required: ~{integer_estimated_cost}, Available: {user_credits}."
+        # Fails fast with 503 when the AI client is missing or the upstream circuit is open
+        get_ai_client()
+
+        # Reserve the estimate atomically (402 if the balance does not cover it)
+        reservation = await reserve_credits(user_id, integer_estimated_cost, ObjectId(session_id), user_credits)
+        token_record = RequestTokenRecord()
+
+        if memory.needs_compaction:
+            # Turns that no longer fit are folded into the stored summary (its cost is settled with this message)
+            memory = await conversation_memory.compact(
+                ObjectId(session_id), current_user["_id"], memory,
+                lambda summary, turns, max_tokens: summarize_chat_turns(summary, turns, max_tokens, token_record),
             )
-        
-        # Get AI client
-        ai_info = get_ai_client()
-        ai_client = ai_info["client"]
-        client_type = ai_info["type"]
-        
-        # Create enhanced context for the chatbot
-        code_implementation_context = ""
-        if code_suggestions:
-            code_implementation_context = "\n\nIMPLEMENTACIONES DE CÓDIGO DISPONIBLES:\n"
-            for i, suggestion in enumerate(code_suggestions):
-                if isinstance(suggestion, dict):
-                    title = suggestion.get('title', f'Implementation {i+1}')
-                    description = suggestion.get('description', 'No description available')
-                    language = suggestion.get('language', 'Unknown')
-                    code_files = suggestion.get('codeImplementation', [])
-                    
-                    code_implementation_context += f"\n--- PROYECTO {i+1}: {title} ---\n"
-                    code_implementation_context += f"Lenguaje: {language}\n"
-                    code_implementation_context += f"Descripción: {description}\n"
-                    
-                    # Incluir el código real de todos los archivos
-                    if code_files and isinstance(code_files, list):
-                        code_implementation_context += f"ARCHIVOS DE CÓDIGO:\n"
-                        for j, code_file in enumerate(code_files):
-                            if isinstance(code_file, dict):
-                                filename = code_file.get('filename', f'file_{j+1}')
-                                code_content = code_file.get('code', 'No code available')
-                                code_implementation_context += f"\n** Archivo: {filename} **\n"
-                                # Limitar el código a las primeras 2000 caracteres para evitar prompts muy largos
-                                if len(code_content) > 2000:
-                                    code_implementation_context += f"{code_content[:2000]}...\n[CÓDIGO TRUNCADO - {len(code_content) - 2000} caracteres más]\n"
-                                else:
-                                    code_implementation_context += f"{code_content}\n"
-                    code_implementation_context += "\n" + "="*60 + "\n"
-        
-        # Create the enhanced prompt for the chatbot
-        chatbot_prompt = f"""Eres un asistente experto en papers académicos y programación que ayuda a los usuarios a entender investigaciones científicas y su implementación práctica.
-
-CONTEXTO DEL PAPER:
-Título: {paper_title}
-Resumen: {paper_summary}{code_implementation_context}
-
-INSTRUCCIONES:
-- Responde de forma concisa y clara, usando la información del resumen y código proporcionado
-- Si el usuario pregunta sobre código específico, refiere directamente a los archivos y fragmentos de código disponibles
-- Puedes explicar cómo funciona el código, qué hace cada parte, y cómo se relaciona con el paper
-- Si el usuario pregunta sobre modificaciones o mejoras al código, proporciona sugerencias específicas
-- Usa un tono profesional pero amigable, como un tutor técnico
-- No uses asteriscos, negritas excesivas ni formato markdown complejo
-- Si no tienes información específica sobre algo, reconócelo claramente
-- Mantén respuestas entre 100-300 palabras máximo
-- Para preguntas sobre código, puedes ser más técnico y específico
-- Termina con una pregunta de seguimiento relevante al paper o código
-
-Pregunta del usuario: {message}
-
-Respuesta clara y específica:"""
-        
-        # Count actual input tokens
-        actual_input_tokens = count_tokens(chatbot_prompt)
+            chatbot_prompt, estimated_input_tokens, chatbot_context = build_chatbot_prompt(
+                context, message, message_tokens, memory, retrieval, question_truncated)
         
         # Get response from AI
         try:
-            if client_type == "google":
-                if hasattr(app.state, "google_model") and app.state.google_model:
-                    model = app.state.google_model
-                else:
-                    from google.generativeai.generative_models import GenerativeModel
-                    model = GenerativeModel(GOOGLE_MODEL_NAME)
-                
-                try:
-                    response = await model.generate_content_async(chatbot_prompt)
-                    bot_response = response.text
-                except AttributeError:
-                    print("Falling back to synchronous generate_content for chatbot")
-                    response = model.generate_content(chatbot_prompt)
-                    bot_response = response.text
-            else:
-                raise HTTPException(status_code=500, detail="Unsupported AI client type for chatbot.")
+            response = await llm_gateway.generate("chatbot", chatbot_prompt)
+            bot_response = response.text
         except Exception as e:
-            print(f"Error during AI chatbot generation ({client_type}): {type(e).__name__}: {str(e)}")
-            import traceback
+            print(f"Error during AI chatbot generation: {type(e).__name__}: {str(e)}")
             traceback.print_exc()
-            raise HTTPException(status_code=500, detail=f"Chatbot AI generation failed: {str(e)}")
+            raise llm_http_error("chatbot generation", e)
         
-        # Calculate actual cost
-        actual_output_tokens = count_tokens(bot_response)
-        actual_cost = (actual_input_tokens + actual_output_tokens) * SUMMARY_COST_PER_TOKEN
-        integer_actual_cost = math.ceil(actual_cost)
+        # Calculate actual cost from the usage reported by the provider
+        chat_usage = token_record.add("chatbot", await TokenUsage.from_response("chatbot", response, chatbot_prompt, bot_response, SUMMARY_COST_PER_TOKEN))
+        actual_input_tokens = chat_usage.input_tokens
+        actual_output_tokens = chat_usage.output_tokens
+        integer_actual_cost = token_record.credits()
         
         # Clean the response
         cleaned_response = bot_response.strip()
@@ -968,13 +1937,11 @@ Respuesta clara y específica:"""
             "role": "user",
             "content_type": "chat_message",
             "content": message,
+            "memory_tokens": message_tokens, # Para la memoria de la conversación, sin volver a tokenizar
             "timestamp": datetime.utcnow(),
-            "paper_context": {
-                "title": paper_title,
-                "summary_preview": paper_summary[:300] + "..." if paper_summary else ""
-            }
+            "paper_context": paper_context
         }
-        db[CHAT_MESSAGES_COLLECTION].insert_one(user_message_record)
+        await db[CHAT_MESSAGES_COLLECTION].insert_one(user_message_record)
         
         # Save bot response to database
         bot_message_record = {
@@ -986,45 +1953,37 @@ Respuesta clara y específica:"""
             "input_tokens": actual_input_tokens,
             "output_tokens": actual_output_tokens,
             "estimated_cost": integer_actual_cost,
+            "memory_tokens": await prompt_planner.count_async(cleaned_response),
             "timestamp": datetime.utcnow(),
-            "paper_context": {
-                "title": paper_title,
-                "summary_preview": paper_summary[:300] + "..." if paper_summary else ""
-            }
+            "paper_context": paper_context
         }
-        db[CHAT_MESSAGES_COLLECTION].insert_one(bot_message_record)
+        await db[CHAT_MESSAGES_COLLECTION].insert_one(bot_message_record)
         
-        # Deduct credits
-        if db is not None:
-            db[USERS_COLLECTION].update_one(
-                {"_id": ObjectId(user_id)},
-                {"$inc": {"credits": -integer_actual_cost}}
-            )
-            
-            # Log the credit deduction
-            credit_log_entry = {
-                "user_id": ObjectId(user_id),
-                "session_id": ObjectId(session_id),
-                "type": "deduction",
-                "amount": integer_actual_cost,
-                "reason": "Chatbot conversation",
-                "timestamp": datetime.utcnow(),
-                "details": {
-                    "chatbot_cost": integer_actual_cost,
-                    "paper_title": paper_title,
-                    "message_length": len(message)
-                }
+        # Settle the reservation at the actual cost, together with its credit log entry
+        credits_remaining = await settle_credits(
+            reservation,
+            integer_actual_cost,
+            user_credits,
+            "Chatbot conversation",
+            {
+                "chatbot_cost": integer_actual_cost,
+                "paper_title": paper_title,
+                "message_length": len(message),
+                "token_usage": token_record.as_dict()
             }
-            db[CREDIT_LOGS_COLLECTION].insert_one(credit_log_entry)
+        )
         
         return {
             "response": cleaned_response,
-            "credits_remaining": user_credits - integer_actual_cost,
+            "credits_remaining": credits_remaining,
             "tokens_used": {
                 "input": actual_input_tokens,
                 "output": actual_output_tokens,
-                "total": actual_input_tokens + actual_output_tokens
-            }
+                "total": actual_input_tokens + actual_output_tokens,
+                "source": chat_usage.source
+            },
+            "token_usage": token_record.as_dict(),
+            "context": chatbot_context
         }
         
     except HTTPException as http_exc:
@@ -1034,13 +1993,209 @@ Respuesta clara y específica:"""
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Chatbot error: {str(e)}")
+    finally:
+        if reservation is not None and not reservation.settled:
+            await refund_credits(reservation)
+
+# Campos grandes de cada mensaje (el paper y el código generado completos)
+MESSAGE_PAYLOAD_FIELDS = {"paper_data": "paperData", "processed_data": "processedData"}
+
+async def server_message_ids(session_id: ObjectId, message_ids: List[str]) -> set:
+    """The ObjectId-shaped ids in message_ids that are _ids the server issued for this session's messages."""
+    candidates = list({ObjectId(message_id) for message_id in message_ids if ObjectId.is_valid(message_id)})
+    if not candidates:
+        return set()
+    docs = await db[CHAT_MESSAGES_COLLECTION].find({"session_id": session_id, "_id": {"$in": candidates}}, {"_id": 1}).to_list(length=None)
+    return {doc["_id"] for doc in docs}
+
+def message_key(message_id: str, server_ids: set = frozenset()) -> Dict[str, Any]:
+    """
+    Key used to write a message: _id only for ids the server issued in this session (server_ids);
+    anything else, even if it looks like an ObjectId, is the client's own id and goes under client_id.
+    """
+    if ObjectId.is_valid(message_id) and ObjectId(message_id) in server_ids:
+        return {"_id": ObjectId(message_id)}
+    return {"client_id": message_id}
+
+def message_match(message_id: str) -> Dict[str, Any]:
+    """Filter to find a message by the id the client knows it by (always combined with its session_id)."""
+    if ObjectId.is_valid(message_id):
+        return {"$or": [{"_id": ObjectId(message_id)}, {"client_id": message_id}]}
+    return {"client_id": message_id}
+
+def is_duplicate_key_error(exc: Exception) -> bool:
+    if isinstance(exc, DuplicateKeyError):
+        return True
+    if isinstance(exc, BulkWriteError):
+        return any(error.get("code") == 11000 for error in exc.details.get("writeErrors", []))
+    return False
+
+def duplicate_message_error() -> HTTPException:
+    return HTTPException(status_code=409, detail="A message id in this chat session is already in use; reload the session and retry")
+
+def message_fields(msg: ChatMessage, now: datetime) -> Dict[str, Any]:
+    fields = {"content": msg.content, "role": msg.role, "timestamp": msg.timestamp or now}
+    if msg.content_type:
+        fields["content_type"] = msg.content_type
+    if msg.paperData:
+        fields["paper_data"] = msg.paperData
+    if msg.processedData:
+        fields["processed_data"] = msg.processedData
+    return fields
+
+def message_projection(include_payloads: bool) -> Optional[Dict[str, Any]]:
+    """Without payloads, only flags saying whether each message has them are returned."""
+    if include_payloads:
+        return None
+    return {
+        "client_id": 1,
+        "content": 1,
+        "role": 1,
+        "timestamp": 1,
+        "content_type": 1,
+        "has_paper_data": {"$ne": [{"$type": "$paper_data"}, "missing"]},
+        "has_processed_data": {"$ne": [{"$type": "$processed_data"}, "missing"]},
+    }
+
+def message_from_doc(msg: Dict[str, Any]) -> ChatMessage:
+    message = {
+        "id": msg.get("client_id") or str(msg["_id"]),
+        "content": msg["content"],
+        "role": msg["role"],
+        "timestamp": msg["timestamp"],
+        "content_type": msg.get("content_type"),
+    }
+    for field, key in MESSAGE_PAYLOAD_FIELDS.items():
+        if field in msg:
+            message[key] = msg[field]
+    if "has_paper_data" in msg:
+        message["hasPaperData"] = msg["has_paper_data"]
+        message["hasProcessedData"] = msg["has_processed_data"]
+    return ChatMessage(**message)
+
+async def load_message_page(session_object_id: ObjectId, limit: int = MESSAGE_PAGE_DEFAULT, before: Optional[str] = None,
+                            after: Optional[str] = None, include_payloads: bool = True) -> Dict[str, Any]:
+    """
+    One page of a session's messages in chronological order. Without a cursor it is
+    the most recent page; `before` pages towards older messages and `after` towards newer ones.
+    """
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either 'before' or 'after', not both")
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+    query: Dict[str, Any] = {"session_id": session_object_id}
+    if before:
+        query.update(decode_cursor(before, "timestamp", older=True))
+    if after:
+        query.update(decode_cursor(after, "timestamp", older=False))
+    direction = 1 if after else -1
+    docs = await db[CHAT_MESSAGES_COLLECTION].find(query, message_projection(include_payloads)) \
+        .sort([("timestamp", direction), ("_id", direction)]) \
+        .limit(limit + 1) \
+        .to_list(length=limit + 1)
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    if not after:
+        docs.reverse()
+    return {
+        "messages": [message_from_doc(doc) for doc in docs],
+        # Con cursor, del otro lado queda al menos el mensaje del propio cursor
+        "has_more_before": has_more if not after else True,
+        "has_more_after": has_more if after else bool(before),
+        "before_cursor": encode_cursor(docs[0]["timestamp"], docs[0]["_id"]) if docs else before,
+        "after_cursor": encode_cursor(docs[-1]["timestamp"], docs[-1]["_id"]) if docs else after,
+    }
+
+async def verify_chat_session(session_object_id: ObjectId) -> Dict[str, Any]:
+    """Re-reads a session after writing it (opt-in: costs two extra queries)."""
+    stored = await db[CHAT_SESSIONS_COLLECTION].find_one({"_id": session_object_id}, {"version": 1})
+    return {
+        "session_exists": stored is not None,
+        "version": stored.get("version", 0) if stored else None,
+        "message_count": await db[CHAT_MESSAGES_COLLECTION].count_documents({"session_id": session_object_id}),
+    }
 
 # Endpoints para la gestión de chats
+@app.post("/api/chat/sessions/sync", response_model=ChatSessionSyncResponse)
+async def sync_chat_session(request: ChatSessionSyncRequest, current_user: dict = Depends(get_token_claims)):
+    """
+    Sincronización incremental de una sesión: el cliente envía solo los mensajes nuevos
+    o modificados (y los borrados) junto con la versión de la sesión que tenía.
+    La versión se comprueba e incrementa en una sola operación (409 si otro guardado
+    se adelantó) y los mensajes se aplican con un único bulk_write de upserts.
+    """
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database connection not available")
+
+    user_id = current_user["_id"]
+    now = datetime.utcnow()
+    last_updated = request.lastUpdated or now
+    creating_new = not request.id or request.id in ("default", "new") or not ObjectId.is_valid(request.id)
+    upsert_ids = [msg.id for msg in request.upserts]
+    if not all(upsert_ids):
+        raise HTTPException(status_code=400, detail="Every synced message needs an id")
+    if len(set(upsert_ids)) != len(upsert_ids):
+        raise HTTPException(status_code=422, detail="The same message id appears more than once in upserts")
+
+    try:
+        if creating_new:
+            session_doc = {"user_id": user_id, "title": request.title, "last_updated": last_updated, "version": 1}
+            session_object_id = (await db[CHAT_SESSIONS_COLLECTION].insert_one(session_doc)).inserted_id
+            version = session_doc["version"]
+        else:
+            session_object_id = ObjectId(request.id)
+            # Las sesiones anteriores al versionado no tienen el campo: cuentan como versión 0
+            expected_version = request.base_version if request.base_version else {"$in": [0, None]}
+            updated = await db[CHAT_SESSIONS_COLLECTION].find_one_and_update(
+                {"_id": session_object_id, "user_id": user_id, "version": expected_version},
+                {"$set": {"title": request.title, "last_updated": last_updated}, "$inc": {"version": 1}},
+                projection={"version": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+            if updated is None:
+                current = await db[CHAT_SESSIONS_COLLECTION].find_one({"_id": session_object_id, "user_id": user_id}, {"version": 1})
+                if current is None:
+                    raise HTTPException(status_code=404, detail="Chat session not found")
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Chat session version conflict: client has {request.base_version}, server has {current.get('version', 0)}"
+                )
+            version = updated["version"]
+
+        operations = []
+        server_ids = set() if creating_new else await server_message_ids(session_object_id, upsert_ids)
+        for msg in request.upserts:
+            fields = message_fields(msg, now)
+            update = {"$set": fields, "$setOnInsert": {"user_id": user_id}}
+            cleared = {field: "" for field in MESSAGE_PAYLOAD_FIELDS if field not in fields}
+            if cleared:
+                update["$unset"] = cleared
+            operations.append(UpdateOne({"session_id": session_object_id, **message_key(msg.id, server_ids)}, update, upsert=True))
+        for message_id in request.deleted_ids:
+            operations.append(DeleteOne({"session_id": session_object_id, **message_match(message_id)}))
+
+        response = {"id": str(session_object_id), "version": version, "lastUpdated": last_updated}
+        if operations:
+            result = await db[CHAT_MESSAGES_COLLECTION].bulk_write(operations, ordered=False)
+            response.update(upserted=result.upserted_count, modified=result.modified_count, deleted=result.deleted_count)
+        if request.verify:
+            response["verification"] = await verify_chat_session(session_object_id)
+        return response
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        if is_duplicate_key_error(e):
+            raise duplicate_message_error()
+        print(f"Error syncing chat session: {str(e)}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Error syncing chat session: {str(e)}")
+
 @app.post("/api/chat/sessions", response_model=ChatSessionResponse)
-async def save_chat_session(request: SaveChatSessionRequest, current_user: dict = Depends(get_current_user)):
+async def save_chat_session(request: SaveChatSessionRequest, verify: bool = False, current_user: dict = Depends(get_token_claims)):
     """
     Guarda o actualiza una sesión de chat completa.
     Si la sesión tiene un ID, se actualiza. Si no, se crea una nueva.
+    Para guardados frecuentes usar /api/chat/sessions/sync, que solo envía los cambios.
     """
     if db is None:
         raise HTTPException(status_code=503, detail="Database connection not available")
@@ -1057,16 +2212,16 @@ async def save_chat_session(request: SaveChatSessionRequest, current_user: dict
         session.lastUpdated = now
         
     print(f"Session to save: id={session.id}, title={session.title}, messages={len(session.messages)}")
-    
-    # Verificar que la colección existe y crearla si no existe
-    if CHAT_SESSIONS_COLLECTION not in db.list_collection_names(): # UPDATED
-        print(f"Collection {CHAT_SESSIONS_COLLECTION} doesn't exist, will be created automatically")
+    message_ids = [msg.id for msg in session.messages if msg.id]
+    if len(set(message_ids)) != len(message_ids):
+        raise HTTPException(status_code=422, detail="The same message id appears more than once in the session")
     
     # Preparar el documento para MongoDB
     session_doc = {
         "user_id": user_id,  # Usar directamente el ObjectId
         "title": session.title,
-        "last_updated": session.lastUpdated
+        "last_updated": session.lastUpdated,
+        "version": 1
     }
     
     try:
@@ -1079,18 +2234,20 @@ async def save_chat_session(request: SaveChatSessionRequest, current_user: dict
                 session_object_id = ObjectId(session.id)
                 print(f"Updating existing session with ID: {session.id}")
                 
-                # Actualizar sesión existente
-                result = db[CHAT_SESSIONS_COLLECTION].update_one( # UPDATED
+                # Actualizar sesión existente (un guardado completo también cuenta como versión nueva)
+                updated = await db[CHAT_SESSIONS_COLLECTION].find_one_and_update(
                     {"_id": session_object_id, "user_id": user_id},
-                    {"$set": {"title": session.title, "last_updated": session.lastUpdated}}
+                    {"$set": {"title": session.title, "last_updated": session.lastUpdated}, "$inc": {"version": 1}},
+                    projection={"version": 1},
+                    return_document=ReturnDocument.AFTER,
                 )
                 
-                if result.matched_count == 0:
+                if updated is None:
                     print(f"No session found with ID {session.id} for user {user_id_str}, creating new")
                     creating_new = True
                 else:
-                    print(f"Session updated: {result.modified_count} document(s) modified")
                     session_id = session.id
+                    version = updated["version"]
             except Exception as e:
                 print(f"Invalid session ID format: {session.id}, error: {str(e)}")
                 creating_new = True
@@ -1098,20 +2255,22 @@ async def save_chat_session(request: SaveChatSessionRequest, current_user: dict
         if creating_new:
             # Crear nueva sesión
             print("Creating new chat session")
-            result = db[CHAT_SESSIONS_COLLECTION].insert_one(session_doc) # UPDATED
+            result = await db[CHAT_SESSIONS_COLLECTION].insert_one(session_doc) # UPDATED
             session_id = str(result.inserted_id)
+            version = session_doc["version"]
             print(f"Created new session with ID: {session_id}")
         
         # Manejar los mensajes
         session_object_id = ObjectId(session_id)
         
-        # Verificar que la colección de mensajes existe
-        if CHAT_MESSAGES_COLLECTION not in db.list_collection_names(): # UPDATED
-            print(f"Collection {CHAT_MESSAGES_COLLECTION} doesn't exist, will be created automatically")
-        
+        # Ids que el servidor asignó a mensajes de esta sesión: son los únicos que se conservan como _id
+        server_ids = set()
+        if not creating_new:
+            server_ids = await server_message_ids(session_object_id, message_ids)
+
         # Primero eliminar los mensajes existentes si estamos actualizando
         if not creating_new:
-            delete_result = db[CHAT_MESSAGES_COLLECTION].delete_many({"session_id": session_object_id}) # UPDATED
+            delete_result = await db[CHAT_MESSAGES_COLLECTION].delete_many({"session_id": session_object_id}) # UPDATED
             print(f"Deleted {delete_result.deleted_count} existing message(s)")
         
         # Insertar los nuevos mensajes
@@ -1121,208 +2280,186 @@ async def save_chat_session(request: SaveChatSessionRequest, current_user: dict
                 message_doc = {
                     "user_id": user_id,  # Usar directamente el ObjectId
                     "session_id": session_object_id,
-                    "content": msg.content,
-                    "role": msg.role,
-                    "timestamp": msg.timestamp or now
+                    **message_fields(msg, now)
                 }
-                
-                # Si tiene paperData o processedData, incluirlos
-                if msg.paperData:
-                    message_doc["paper_data"] = msg.paperData
-                if msg.processedData:
-                    message_doc["processed_data"] = msg.processedData
+                # Se conserva el id de cada mensaje para que no cambie en cada guardado
+                if msg.id:
+                    message_doc.update(message_key(msg.id, server_ids))
                 
                 messages_to_insert.append(message_doc)
             
             if messages_to_insert:
-                insert_result = db[CHAT_MESSAGES_COLLECTION].insert_many(messages_to_insert) # UPDATED
+                insert_result = await db[CHAT_MESSAGES_COLLECTION].insert_many(messages_to_insert) # UPDATED
                 print(f"Inserted {len(insert_result.inserted_ids)} message(s)")
         
-        # Verificar que la sesión se creó/actualizó correctamente
-        verification = db[CHAT_SESSIONS_COLLECTION].find_one({"_id": session_object_id}) # UPDATED
-        if verification:
-            print(f"Verified session exists: {verification.get('title', 'No title')}")
-        else:
-            print(f"WARNING: Could not verify session with ID {session_id}")
-        
-        # Verificar el número de mensajes guardados
-        messages_count = db[CHAT_MESSAGES_COLLECTION].count_documents({"session_id": session_object_id})  # UPDATED
-        print(f"Verified {messages_count} message(s) for session {session_id}")
-
-        # Obtener mensajes desde la base de datos en lugar de usar session.messages
-        messages = []
-        messages_cursor = db[CHAT_MESSAGES_COLLECTION].find({"session_id": session_object_id}).sort("timestamp", 1)
-        for msg in messages_cursor:
-            msg_data = {
-                "id": str(msg["_id"]),
-                "content": msg["content"],
-                "role": msg["role"],
-                "timestamp": msg["timestamp"]
-            }
-            if "paper_data" in msg:
-                msg_data["paperData"] = msg["paper_data"]
-            if "processed_data" in msg:
-                msg_data["processedData"] = msg["processed_data"]
-            messages.append(ChatMessage(**msg_data))
+        if verify:
+            print(f"Verification: {await verify_chat_session(session_object_id)}")
 
-        # Devolver la sesión guardada con sus mensajes
+        # Devolver la sesión guardada con su página de mensajes más reciente (sin payloads:
+        # el cliente ya los tiene y se pueden pedir por mensaje)
+        page = await load_message_page(session_object_id, include_payloads=False)
         return {
             "id": session_id,
             "title": session.title,
             "lastUpdated": session.lastUpdated or now,
-            "messages": messages
+            "version": version,
+            **page
         }
     
     except Exception as e:
+        if is_duplicate_key_error(e):
+            raise duplicate_message_error()
         print(f"Error saving chat session: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error saving chat session: {str(e)}")
 
+def encode_cursor(value: datetime, doc_id: ObjectId) -> str:
+    """Opaque pagination cursor: a timestamp plus _id as a tie-breaker."""
+    return f"{value.isoformat()}_{doc_id}"
+
+def decode_cursor(cursor: str, field: str, older: bool = True) -> Dict[str, Any]:
+    """Filter for the documents strictly older (or newer) than the cursor on (field, _id)."""
+    try:
+        value, doc_id = cursor.rsplit("_", 1)
+        value, doc_id = datetime.fromisoformat(value), ObjectId(doc_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid pagination cursor")
+    strict, bound = ("$lt", "$lte") if older else ("$gt", "$gte")
+    # El rango sobre el campo acota el recorrido del índice; el $or solo desempata
+    return {
+        field: {bound: value},
+        "$or": [{field: {strict: value}}, {"_id": {strict: doc_id}}],
+    }
+
+def session_summaries_pipeline(match: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    """One aggregation for a page of sessions, with message count and last-message preview."""
+    return [
+        {"$match": match},
+        {"$sort": {"last_updated": -1, "_id": -1}},
+        {"$limit": limit},
+        # Ambos $lookup usan el índice (session_id, timestamp) de chat_messages
+        {"$lookup": {
+            "from": CHAT_MESSAGES_COLLECTION, "localField": "_id", "foreignField": "session_id", "as": "message_count",
+            "pipeline": [{"$count": "n"}],
+        }},
+        {"$lookup": {
+            "from": CHAT_MESSAGES_COLLECTION, "localField": "_id", "foreignField": "session_id", "as": "last_message",
+            "pipeline": [
+                {"$sort": {"timestamp": -1}},
+                {"$limit": 1},
+                {"$project": {"_id": 0, "role": 1, "preview": {"$substrCP": [{"$ifNull": ["$content", ""]}, 0, SESSION_PREVIEW_CHARS]}}},
+            ],
+        }},
+        {"$project": {
+            "title": 1,
+            "last_updated": 1,
+            "message_count": {"$ifNull": [{"$first": "$message_count.n"}, 0]},
+            "last_message": {"$first": "$last_message"},
+        }},
+    ]
+
 @app.get("/api/chat/sessions", response_model=ChatSessionsResponse)
-async def get_chat_sessions(current_user: dict = Depends(get_current_user)):
+async def get_chat_sessions(limit: int = SESSION_PAGE_DEFAULT, cursor: Optional[str] = None, current_user: dict = Depends(get_token_claims)):
     """
-    Obtiene todas las sesiones de chat del usuario actual.
+    Lista paginada de las sesiones de chat del usuario (más recientes primero).
+    Solo devuelve título, fecha, número de mensajes y un extracto del último; los
+    mensajes completos se piden por sesión en /api/chat/sessions/{session_id}.
     """
     if db is None:
         raise HTTPException(status_code=503, detail="Database connection not available")
-    
-    user_id = current_user["_id"]
-    print(f"Finding chat sessions for user ID: {user_id}")
-    
+
+    limit = max(1, min(limit, SESSION_PAGE_MAX))
+    match = {"user_id": current_user["_id"]}
+    if cursor:
+        match.update(decode_cursor(cursor, "last_updated"))
+
     try:
-        # Obtener todas las sesiones del usuario
-        # Convertir ObjectId a str para debugging
-        user_id_str = str(user_id)
-        print(f"User ID (str): {user_id_str}")
-        
-        # Verificar que la colección existe
-        collections = db.list_collection_names()
-        print(f"Collections in database: {collections}")
-        if CHAT_SESSIONS_COLLECTION not in collections: # UPDATED
-            print(f"{CHAT_SESSIONS_COLLECTION} collection does not exist in database") # UPDATED
-            return {"sessions": []}
-        
-        # Contar documentos en la colección para debug
-        total_sessions = db[CHAT_SESSIONS_COLLECTION].count_documents({}) # UPDATED
-        user_sessions_count = db[CHAT_SESSIONS_COLLECTION].count_documents({"user_id": user_id}) # UPDATED
-        print(f"Total sessions in DB: {total_sessions}, User sessions: {user_sessions_count}")
-        
-        # Obtener las sesiones usando find
-        sessions_cursor = db[CHAT_SESSIONS_COLLECTION].find({"user_id": user_id}).sort("last_updated", -1) # UPDATED
-        sessions_list = list(sessions_cursor)
-        print(f"Found {len(sessions_list)} sessions for user {user_id_str}")
-        
-        if len(sessions_list) == 0:
-            print("No sessions found for this user")
-            return {"sessions": []}
-        
-        sessions = []
-        
-        # Función no asíncrona para obtener mensajes
-        def get_messages_for_session(session_id):
-            if db is not None:
-                messages_cursor = db[CHAT_MESSAGES_COLLECTION].find({"session_id": ObjectId(session_id)}).sort("timestamp", 1) # UPDATED
-            else:
-                raise HTTPException(status_code=503, detail="Database connection not available")
-            messages = []
-            for msg in messages_cursor:
-                message = {
-                    "id": str(msg["_id"]),
-                    "content": msg["content"],
-                    "role": msg["role"],
-                    "timestamp": msg["timestamp"]
-                }
-                
-                if "paper_data" in msg:
-                    message["paperData"] = msg["paper_data"]
-                if "processed_data" in msg:
-                    message["processedData"] = msg["processed_data"]
-                
-                messages.append(ChatMessage(**message))
-            
-            return messages
-        
-        # Procesar cada sesión
-        for session in sessions_list:
-            session_id = session["_id"]
-            
-            # Debug info
-            print(f"Processing session: {session_id}, title: {session.get('title', 'No title')}")
-            
-            messages = get_messages_for_session(session_id)
-            print(f"Found {len(messages)} messages for session {session_id}")
-            
-            sessions.append(
-                ChatSession(
-                    id=str(session_id),
-                    title=session.get("title", "Untitled"),  # Usar get con valor por defecto
-                    lastUpdated=session.get("last_updated", datetime.utcnow()),  # Usar get con valor por defecto
-                    messages=messages
-                )
-            )
-        
-        print(f"Returning {len(sessions)} sessions for user {user_id_str}")
-        return {"sessions": sessions}
-    
+        # Se pide uno más para saber si hay página siguiente
+        rows = await db[CHAT_SESSIONS_COLLECTION].aggregate(session_summaries_pipeline(match, limit + 1)).to_list(length=limit + 1)
     except Exception as e:
         print(f"Error getting chat sessions: {str(e)}")
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Error getting chat sessions: {str(e)}")
 
+    page = rows[:limit]
+    sessions = []
+    for row in page:
+        last_message = row.get("last_message") or {}
+        sessions.append(ChatSessionSummary(
+            id=str(row["_id"]),
+            title=row.get("title", "Untitled"),
+            lastUpdated=row["last_updated"],
+            messageCount=row["message_count"],
+            lastMessagePreview=last_message.get("preview"),
+            lastMessageRole=last_message.get("role"),
+        ))
+    next_cursor = encode_cursor(page[-1]["last_updated"], page[-1]["_id"]) if len(rows) > limit else None
+    return {"sessions": sessions, "next_cursor": next_cursor}
+
+async def get_owned_session(session_id: str, user_id: ObjectId) -> Dict[str, Any]:
+    """The session document if it belongs to the user; 400/404 otherwise."""
+    try:
+        session_object_id = ObjectId(session_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"Invalid session ID format: {session_id}")
+    session = await db[CHAT_SESSIONS_COLLECTION].find_one(
+        {"_id": session_object_id, "user_id": user_id},
+        {"title": 1, "last_updated": 1, "version": 1},
+    )
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    return session
+
 @app.get("/api/chat/sessions/{session_id}", response_model=ChatSessionResponse)
-async def get_chat_session(session_id: str, current_user: dict = Depends(get_current_user)):
+async def get_chat_session(session_id: str, limit: int = MESSAGE_PAGE_DEFAULT, before: Optional[str] = None,
+                           after: Optional[str] = None, include_payloads: bool = True,
+                           current_user: dict = Depends(get_token_claims)):
     """
-    Obtiene una sesión de chat específica con todos sus mensajes.
+    Obtiene una sesión de chat con una página de sus mensajes (por defecto los más
+    recientes). `before`/`after` son los cursores devueltos en la página anterior.
+    Con include_payloads=false no se envían paperData/processedData; se piden por
+    mensaje en /api/chat/sessions/{session_id}/messages/{message_id}/payload.
     """
     if db is None:
         raise HTTPException(status_code=503, detail="Database connection not available")
     
-    user_id = current_user["_id"]
-    
     try:
-        # Verificar que la sesión pertenezca al usuario
-        session = db[CHAT_SESSIONS_COLLECTION].find_one({ # UPDATED
-            "_id": ObjectId(session_id),
-            "user_id": user_id
-        })
-        
-        if not session:
-            raise HTTPException(status_code=404, detail="Chat session not found")
-    
-        # Obtener todos los mensajes de la sesión
-        messages_cursor = db[CHAT_MESSAGES_COLLECTION].find({"session_id": ObjectId(session_id)}).sort("timestamp", 1) # UPDATED
-        messages = []
-        
-        for msg in messages_cursor:
-            message = {
-                "id": str(msg["_id"]),
-                "content": msg["content"],
-                "role": msg["role"],
-                "timestamp": msg["timestamp"]
-            }
-            
-            if "paper_data" in msg:
-                message["paperData"] = msg["paper_data"]
-            if "processed_data" in msg:
-                message["processedData"] = msg["processed_data"]
-            
-            messages.append(ChatMessage(**message))
-        
+        session = await get_owned_session(session_id, current_user["_id"])
+        page = await load_message_page(session["_id"], limit, before, after, include_payloads)
         return {
             "id": session_id,
             "title": session["title"],
             "lastUpdated": session["last_updated"],
-            "messages": messages
+            "version": session.get("version", 0),
+            **page
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error getting chat session: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error getting chat session: {str(e)}")
 
+@app.get("/api/chat/sessions/{session_id}/messages/{message_id}/payload", response_model=ChatMessagePayload)
+async def get_chat_message_payload(session_id: str, message_id: str, current_user: dict = Depends(get_token_claims)):
+    """
+    paperData y processedData de un mensaje, para cargarlos solo cuando se necesitan.
+    """
+    if db is None:
+        raise HTTPException(status_code=503, detail="Database connection not available")
+
+    session = await get_owned_session(session_id, current_user["_id"])
+    message = await db[CHAT_MESSAGES_COLLECTION].find_one(
+        {"session_id": session["_id"], **message_match(message_id)},
+        {field: 1 for field in MESSAGE_PAYLOAD_FIELDS},
+    )
+    if not message:
+        raise HTTPException(status_code=404, detail="Chat message not found")
+    return {"id": message_id, **{key: message.get(field) for field, key in MESSAGE_PAYLOAD_FIELDS.items()}}
+
 @app.delete("/api/chat/sessions/{session_id}", status_code=204) # Added status_code for no content
-async def delete_chat_session_endpoint(session_id: str, current_user: dict = Depends(get_current_user)):
+async def delete_chat_session_endpoint(session_id: str, current_user: dict = Depends(get_token_claims)):
     """
     Elimina una sesión de chat específica y todos sus mensajes asociados.
     """
@@ -1339,7 +2476,7 @@ async def delete_chat_session_endpoint(session_id: str, current_user: dict = Dep
         raise HTTPException(status_code=400, detail=f"Invalid session ID format: {session_id}")
 
     # Primero, verificar que la sesión pertenece al usuario y existe
-    session_to_delete = db[CHAT_SESSIONS_COLLECTION].find_one({
+    session_to_delete = await db[CHAT_SESSIONS_COLLECTION].find_one({
         "_id": session_object_id,
         "user_id": user_id
     })
@@ -1349,14 +2486,16 @@ async def delete_chat_session_endpoint(session_id: str, current_user: dict = Dep
         raise HTTPException(status_code=404, detail="Chat session not found or access denied")
 
     # Eliminar los mensajes asociados a la sesión
-    delete_messages_result = db[CHAT_MESSAGES_COLLECTION].delete_many({
+    delete_messages_result = await db[CHAT_MESSAGES_COLLECTION].delete_many({
         "session_id": session_object_id,
         "user_id": user_id  # Asegurar que solo se borran mensajes del usuario propietario de la sesión
     })
     print(f"Deleted {delete_messages_result.deleted_count} message(s) for session ID: {session_id}")
 
+    await chat_context_store.delete(session_object_id, user_id)
+
     # Eliminar la sesión de chat
-    delete_session_result = db[CHAT_SESSIONS_COLLECTION].delete_one({
+    delete_session_result = await db[CHAT_SESSIONS_COLLECTION].delete_one({
         "_id": session_object_id,
         "user_id": user_id
     })
@@ -1380,23 +2519,23 @@ async def get_db_status():
     try:
         # Verificar la conexión a MongoDB
         if client:
-            client.admin.command('ping')
+            await client.admin.command('ping')
         
         # Obtener información sobre las colecciones
-        collections = db.list_collection_names()
+        collections = await db.list_collection_names()
         collection_info = {}
         
         for collection_name in collections:
-            collection_info[collection_name] = db[collection_name].count_documents({})
+            collection_info[collection_name] = await db[collection_name].count_documents({})
             
             # Para chat_sessions, mostrar información más detallada
             if collection_name == CHAT_SESSIONS_COLLECTION: # UPDATED
                 # Obtener todos los user_ids únicos
-                user_ids = db[collection_name].distinct("user_id")
+                user_ids = await db[collection_name].distinct("user_id")
                 users_with_sessions = []
                 
                 for uid in user_ids:
-                    session_count = db[collection_name].count_documents({"user_id": uid})
+                    session_count = await db[collection_name].count_documents({"user_id": uid})
                     users_with_sessions.append({
                         "user_id": str(uid),
                         "session_count": session_count
@@ -1405,7 +2544,7 @@ async def get_db_status():
                 collection_info["chat_sessions_by_user"] = users_with_sessions
                 
                 # Mostrar una muestra de sesiones para diagnóstico
-                sample_sessions = list(db[collection_name].find().limit(5))
+                sample_sessions = await db[collection_name].find().limit(5).to_list(length=5)
                 sample_data = []
                 
                 for session in sample_sessions:
@@ -1430,6 +2569,57 @@ async def get_db_status():
             "message": f"Error checking database: {str(e)}"
         }
 
+@app.get("/api/debug/extraction-cache")
+async def get_extraction_cache_stats():
+    """
+    Contadores de aciertos/fallos y ocupación de la caché de extracción de PDFs
+    """
+    return extraction_cache.stats()
+
+@app.get("/api/debug/result-cache")
+async def get_result_cache_stats():
+    """
+    Estado de la caché global de papers procesados (modelo, versión de prompts, aciertos)
+    """
+    return {**result_cache.stats(), "in_flight": paper_flights.stats()}
+
+@app.get("/api/debug/llm-gateway")
+async def get_llm_gateway_stats():
+    return llm_gateway.stats()
+
+@app.get("/api/debug/jobs")
+async def get_job_pool_stats():
+    return job_pool.stats()
+
+@app.get("/api/debug/credit-ledger")
+async def get_credit_ledger_stats():
+    return credit_ledger.stats()
+
+@app.get("/api/debug/password-hashing")
+async def get_password_hashing_stats():
+    """Profundidad de la cola, rechazos y tiempos del pool de bcrypt."""
+    return password_hasher.stats()
+
+@app.get("/api/debug/chat-context")
+async def get_chat_context_stats():
+    """Prefijos del chatbot renderizados, reutilizados y rehechos por cambio de versión, y compactaciones de la memoria."""
+    return {**chat_context_store.stats(), "memory": conversation_memory.stats()}
+
+@app.get("/api/debug/paper-index")
+async def get_paper_index_stats():
+    """Índices BM25 construidos, cargados de la colección y en memoria, y tiempos de consulta."""
+    return paper_index_store.stats()
+
+@app.get("/api/debug/user-cache")
+async def get_user_cache_stats():
+    """Aciertos, caducados y escrituras de créditos de la caché de usuarios."""
+    return {**user_cache.stats(), "loads_in_flight": user_loads.in_flight()}
+
+@app.get("/api/debug/indexes")
+async def get_index_report():
+    """Resultado de la reconciliación de índices del arranque."""
+    return getattr(app.state, "index_report", None) or {"status": "not reconciled"}
+
 @app.get("/api/health")
 async def health_check():
     """
@@ -1449,15 +2639,15 @@ async def health_check():
             status["mongodb_error"] = "Database connection not established during startup"
         else:
             # Intentar hacer una operación simple para verificar que la conexión está viva
-            db.command("ping")
+            await db.command("ping")
             status["mongodb"] = "connected"
             
             # Información adicional sobre colecciones
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 status["mongodb_collections"] = collections
                 status["mongodb_details"] = {
-                    "users_count": db[USERS_COLLECTION].count_documents({}) if USERS_COLLECTION in collections else 0
+                    "users_count": await db[USERS_COLLECTION].count_documents({}) if USERS_COLLECTION in collections else 0
                 }
             except Exception as e:
                 status["mongodb_details_error"] = str(e)
@@ -1466,10 +2656,12 @@ async def health_check():
         status["mongodb_error"] = str(e)
     
     # Verificar estado de servicios de IA
-    if hasattr(app.state, "google_ai_client") and app.state.google_ai_client:
+    if getattr(app.state, "llm_provider", None):
         status["ai_services"]["google_ai"] = "configured"
     else:
         status["ai_services"]["google_ai"] = "not_configured"
+    status["ai_services"]["provider"] = LLM_PROVIDER
+    status["ai_services"]["cassettes"] = LLM_CASSETTE_MODE
         
     # Verificar variables de entorno (sin mostrar valores sensibles)
     status["env_check"] = {
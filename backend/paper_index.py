@@ -0,0 +1,339 @@
+"""
+Índice BM25 local sobre fragmentos del paper, para que el chatbot cite el texto original.
+
+El chatbot solo veía el resumen y el código (recortados al presupuesto del prefijo);
+mandar el paper entero en cada mensaje sería carísimo. Ahora:
+
+- El texto del documento se parte en fragmentos de PAPER_INDEX_CHUNK_WORDS
+  palabras (con solape, sin cruzar secciones y sin referencias ni agradecimientos) y
+  se indexa con BM25. Todo en proceso, sin GPU ni servicios externos.
+- Las listas de postings son arrays de enteros contiguos (formato CSR: offsets por
+  término, ids de fragmento y frecuencias), no dicts de listas: unos pocos bytes por
+  posting y se serializan con tobytes() sin recorrerlas.
+- Un fragmento se guarda como (inicio, fin) en el texto del documento, no como texto:
+  el texto ya está en la caché de extracciones (document_store).
+- El índice se persiste por document_id (colección paper_indexes), se construye una
+  sola vez y se carga de forma perezosa la primera vez que lo pide el chatbot, con un
+  LRU acotado por bytes delante. No se construye al subir el PDF (la mayoría de las
+  subidas, anónimas incluidas, nunca abren un chat): se adelanta en segundo plano
+  cuando una sesión autenticada guarda su contexto de chat con el document_id, y si
+  no, lo construye el primer retrieve(). Si cambian los parámetros de troceado (otra
+  versión) se reconstruye.
+- retrieve() devuelve los top-k fragmentos de una pregunta que caben en un
+  presupuesto de tokens; el número de tokens de cada fragmento se cuenta al construir.
+"""
+import asyncio
+import heapq
+import math
+import os
+import re
+import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from lru import LRUCache
+from pdf_extraction import BACK_MATTER_SECTIONS
+from singleflight import SingleFlight
+
+PAPER_INDEX_CHUNK_WORDS = int(os.getenv("PAPER_INDEX_CHUNK_WORDS", "160"))
+PAPER_INDEX_CHUNK_OVERLAP = int(os.getenv("PAPER_INDEX_CHUNK_OVERLAP", "32"))
+PAPER_INDEX_CACHE_MAX_BYTES = int(os.getenv("PAPER_INDEX_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Cambia si cambia cómo se trocea o se tokeniza: los índices guardados con otra versión se reconstruyen
+PAPER_INDEX_VERSION = f"bm25-r1-{PAPER_INDEX_CHUNK_WORDS}-{PAPER_INDEX_CHUNK_OVERLAP}"
+
+WORD_PATTERN = re.compile(r"\S+")
+TERM_PATTERN = re.compile(r"[^\W_]+")
+MAX_TERM_LENGTH = 40
+STOPWORDS = frozenset("""
+a an and are as at be been but by can for from has have in into is it its of on or that the their there these this
+those to was were which with we our not also than then such via using use used may more most other both each
+""".split())
+PREAMBLE_KIND = "preamble"  # Texto antes de la primera sección detectada (título, autores, abstract)
+PASSAGES_HEADER = "FRAGMENTOS DEL PAPER RELEVANTES PARA LA PREGUNTA (texto original):\n"
+
+# Arrays del índice: nombre -> typecode. I: 4 bytes, H: 2 bytes, B: 1 byte
+ARRAY_TYPES = {
+    "offsets": "I",        # Por término: inicio de sus postings (uno más que términos)
+    "postings": "I",       # Id de fragmento de cada posting
+    "frequencies": "H",    # Frecuencia del término en el fragmento
+    "lengths": "H",        # Por fragmento: número de términos
+    "starts": "I",         # Por fragmento: offsets en el texto del documento
+    "ends": "I",
+    "pages": "H",
+    "token_counts": "H",   # Tokens del fragmento (para el presupuesto del prompt)
+    "chunk_kinds": "B",    # Índice en PaperIndex.kinds
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [term for term in TERM_PATTERN.findall(text.lower())
+            if 1 < len(term) <= MAX_TERM_LENGTH and term not in STOPWORDS]
+
+
+def document_regions(text: str, sections: List[Dict[str, Any]]) -> List[Tuple[int, int, str]]:
+    """(inicio, fin, tipo) de las partes del texto que se indexan, en orden."""
+    ordered = sorted(sections, key=lambda section: section["start"])
+    regions = []
+    first_start = ordered[0]["start"] if ordered else len(text)
+    if first_start > 0:
+        regions.append((0, first_start, PREAMBLE_KIND))
+    for section in ordered:
+        if section["kind"] not in BACK_MATTER_SECTIONS:
+            regions.append((section["start"], section["end"], section["kind"]))
+    return regions
+
+
+def chunk_spans(text: str, sections: List[Dict[str, Any]], words: int = PAPER_INDEX_CHUNK_WORDS,
+                overlap: int = PAPER_INDEX_CHUNK_OVERLAP) -> List[Tuple[int, int, str]]:
+    """Fragmentos (inicio, fin, tipo) de `words` palabras con `overlap` de solape, sin cruzar secciones."""
+    stride = max(1, words - overlap)
+    spans = []
+    for start, end, kind in document_regions(text, sections):
+        bounds = [(match.start(), match.end()) for match in WORD_PATTERN.finditer(text, start, end)]
+        for first in range(0, len(bounds), stride):
+            last = min(first + words, len(bounds)) - 1
+            spans.append((bounds[first][0], bounds[last][1], kind))
+            if last == len(bounds) - 1:
+                break
+    return spans
+
+
+class PaperIndex:
+    """BM25 sobre los fragmentos de un documento, con los postings en arrays contiguos."""
+
+    def __init__(self, terms: List[str], kinds: List[str], arrays: Dict[str, array]):
+        self.terms = terms
+        self.vocabulary = {term: term_id for term_id, term in enumerate(terms)}
+        self.kinds = kinds
+        self.arrays = arrays
+        for name in ARRAY_TYPES:
+            setattr(self, name, arrays[name])
+        self.average_length = (sum(self.lengths) / len(self.lengths) if self.lengths else 0.0) or 1.0
+
+    @property
+    def chunk_count(self) -> int:
+        return len(self.starts)
+
+    def kind_of(self, chunk_id: int) -> str:
+        return self.kinds[self.chunk_kinds[chunk_id]]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.itemsize * len(values) for values in self.arrays.values()) + sum(len(term) + 1 for term in self.terms)
+
+    @classmethod
+    def build(cls, text: str, sections: List[Dict[str, Any]], page_offsets: Optional[List[int]],
+              count_tokens: Callable[[str], int]) -> "PaperIndex":
+        columns = {name: array(typecode) for name, typecode in ARRAY_TYPES.items()}
+        kinds: List[str] = []
+        vocabulary: Dict[str, int] = {}
+        term_postings: List[array] = []
+        term_frequencies: List[array] = []
+        for chunk_id, (start, end, kind) in enumerate(chunk_spans(text, sections)):
+            chunk = text[start:end]
+            counts = Counter(tokenize(chunk))
+            for term, frequency in counts.items():
+                term_id = vocabulary.get(term)
+                if term_id is None:
+                    term_id = vocabulary[term] = len(vocabulary)
+                    term_postings.append(array(ARRAY_TYPES["postings"]))
+                    term_frequencies.append(array(ARRAY_TYPES["frequencies"]))
+                term_postings[term_id].append(chunk_id)
+                term_frequencies[term_id].append(min(frequency, 0xFFFF))
+            if kind not in kinds:
+                kinds.append(kind)
+            columns["lengths"].append(min(sum(counts.values()), 0xFFFF))
+            columns["starts"].append(start)
+            columns["ends"].append(end)
+            columns["pages"].append(max(0, bisect_right(page_offsets, start) - 1) + 1 if page_offsets else 1)
+            columns["token_counts"].append(min(count_tokens(chunk), 0xFFFF))
+            columns["chunk_kinds"].append(kinds.index(kind))
+
+        columns["offsets"].append(0)
+        for postings, frequencies in zip(term_postings, term_frequencies):
+            columns["postings"].extend(postings)
+            columns["frequencies"].extend(frequencies)
+            columns["offsets"].append(len(columns["postings"]))
+        return cls(list(vocabulary), kinds, columns)
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        """Los top_k fragmentos por puntuación BM25, de mayor a menor (sin los de puntuación 0)."""
+        chunk_count = self.chunk_count
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            low, high = self.offsets[term_id], self.offsets[term_id + 1]
+            idf = math.log(1 + (chunk_count - (high - low) + 0.5) / ((high - low) + 0.5))
+            for position in range(low, high):
+                chunk_id = self.postings[position]
+                frequency = self.frequencies[position]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[chunk_id] / self.average_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def to_document(self) -> Dict[str, Any]:
+        return {
+            "version": PAPER_INDEX_VERSION,
+            "chunk_count": self.chunk_count,
+            "byteorder": sys.byteorder,
+            "kinds": self.kinds,
+            "terms": zlib.compress("\n".join(self.terms).encode("utf-8")),
+            "arrays": {name: zlib.compress(values.tobytes()) for name, values in self.arrays.items()},
+        }
+
+    @classmethod
+    def from_document(cls, stored: Dict[str, Any]) -> "PaperIndex":
+        arrays = {}
+        for name, typecode in ARRAY_TYPES.items():
+            values = array(typecode)
+            values.frombytes(zlib.decompress(stored["arrays"][name]))
+            if stored.get("byteorder", sys.byteorder) != sys.byteorder:
+                values.byteswap()
+            arrays[name] = values
+        terms = zlib.decompress(stored["terms"]).decode("utf-8")
+        return cls(terms.split("\n") if terms else [], stored["kinds"], arrays)
+
+
+class Retrieval:
+    """Fragmentos elegidos para una pregunta y lo que ocupan en el prompt."""
+
+    def __init__(self, passages: Optional[List[Dict[str, Any]]] = None, tokens: int = 0, candidates: int = 0):
+        self.passages = passages or []  # En orden de documento
+        self.tokens = tokens
+        self.candidates = candidates
+
+    def render(self) -> str:
+        if not self.passages:
+            return ""
+        return PASSAGES_HEADER + "".join(f"{passage['label']}\n{passage['text']}\n\n" for passage in self.passages)
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "tokens": self.tokens,
+            "candidates": self.candidates,
+            "passages": [{key: passage[key] for key in ("section", "page", "score")} for passage in self.passages],
+        }
+
+
+class PaperIndexStore:
+    """
+    Índices por document_id: LRU en memoria, después la colección, y si no está (o es de
+    otra versión) se construye a partir del documento guardado. load_document(document_id)
+    devuelve el documento de document_store (content, sections, page_offsets).
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], load_document: Callable[[str], Awaitable[Optional[Dict[str, Any]]]],
+                 collection=None, max_bytes: int = PAPER_INDEX_CACHE_MAX_BYTES):
+        self.count_tokens = count_tokens
+        self.load_document = load_document
+        self.collection = collection
+        self.memory = LRUCache(max_entries=256, max_bytes=max_bytes, sizeof=lambda index: index.nbytes)
+        self.builds = SingleFlight()
+        self._background: set = set()
+        self.counters = {"built": 0, "loaded": 0, "missing": 0, "failed": 0, "queries": 0}
+        self.build_seconds = 0.0
+        self.query_seconds = 0.0
+
+    async def _build(self, document_id: str, document: Optional[Dict[str, Any]]) -> Optional[PaperIndex]:
+        if self.collection is not None:
+            stored = await self.collection.find_one({"_id": document_id})
+            if stored is not None and stored.get("version") == PAPER_INDEX_VERSION:
+                index = PaperIndex.from_document(stored)
+                self.counters["loaded"] += 1
+                self.memory.put(document_id, index)
+                return index
+        document = document or await self.load_document(document_id)
+        if document is None:
+            self.counters["missing"] += 1
+            return None
+        started = time.perf_counter()
+        # Tokenizar el paper entero es CPU: fuera del event loop
+        index = await asyncio.to_thread(
+            PaperIndex.build, document["content"], document.get("sections") or [], document.get("page_offsets"), self.count_tokens)
+        self.build_seconds += time.perf_counter() - started
+        self.counters["built"] += 1
+        self.memory.put(document_id, index)
+        if self.collection is not None:
+            try:
+                await self.collection.replace_one(
+                    {"_id": document_id}, {**index.to_document(), "created_at": datetime.utcnow()}, upsert=True)
+            except Exception as e:
+                # Se queda en memoria; se volverá a construir si se expulsa del LRU
+                print(f"Error saving paper index {document_id}: {type(e).__name__}: {e}")
+        return index
+
+    async def get(self, document_id: str, document: Optional[Dict[str, Any]] = None) -> Optional[PaperIndex]:
+        """El índice del documento, cargándolo o construyéndolo una sola vez aunque lo pidan varios a la vez."""
+        index = self.memory.get(document_id)
+        if index is not None:
+            return index
+        try:
+            index, _ = await self.builds.do(document_id, lambda: self._build(document_id, document))
+        except Exception as e:
+            print(f"Error building paper index {document_id}: {type(e).__name__}: {e}")
+            self.counters["failed"] += 1
+            return None
+        return index
+
+    def schedule(self, document_id: str, document: Optional[Dict[str, Any]] = None):
+        """Construye el índice en segundo plano (al guardar el contexto de un chat), sin retrasar la respuesta."""
+        task = asyncio.create_task(self.get(document_id, document))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def retrieve(self, document_id: Optional[str], query: str, max_tokens: int, top_k: int) -> Retrieval:
+        """Los fragmentos más relevantes para la pregunta que caben en max_tokens (etiquetas incluidas)."""
+        if not document_id or max_tokens <= 0 or top_k <= 0:
+            return Retrieval()
+        index = await self.get(document_id)
+        document = await self.load_document(document_id) if index is not None else None
+        if index is None or document is None:
+            return Retrieval()
+        started = time.perf_counter()
+        hits = index.search(query, top_k)
+        used = self.count_tokens(PASSAGES_HEADER)
+        chosen = []
+        for chunk_id, score in hits:
+            label = f"[{index.kind_of(chunk_id)}, pág. {index.pages[chunk_id]}]"
+            tokens = index.token_counts[chunk_id] + self.count_tokens(label) + 1
+            if used + tokens > max_tokens:
+                continue
+            used += tokens
+            chosen.append((chunk_id, score, label))
+        passages = []
+        previous_end = 0
+        for chunk_id, score, label in sorted(chosen, key=lambda item: index.starts[item[0]]):
+            # Fragmentos contiguos se solapan: el texto repetido no se vuelve a incluir
+            start = max(index.starts[chunk_id], previous_end)
+            previous_end = index.ends[chunk_id]
+            passages.append({
+                "section": index.kind_of(chunk_id),
+                "page": index.pages[chunk_id],
+                "score": round(score, 3),
+                "label": label,
+                "text": document["content"][start:previous_end],
+            })
+        self.counters["queries"] += 1
+        self.query_seconds += time.perf_counter() - started
+        return Retrieval(passages, used if passages else 0, len(hits))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "version": PAPER_INDEX_VERSION,
+            **self.counters,
+            "cached": len(self.memory),
+            "cached_bytes": self.memory.total_bytes,
+            "building": self.builds.in_flight(),
+            "avg_build_ms": round(self.build_seconds / self.counters["built"] * 1000, 1) if self.counters["built"] else None,
+            "avg_query_ms": round(self.query_seconds / self.counters["queries"] * 1000, 2) if self.counters["queries"] else None,
+        }
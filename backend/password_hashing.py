@@ -0,0 +1,140 @@
+"""
+bcrypt fuera del event loop, en un pool acotado.
+
+register y login llamaban a bcrypt.hashpw/checkpw dentro del handler: cada llamada
+son ~250 ms de CPU con el event loop parado, y una ráfaga de logins (toda una clase
+entrando a la vez) congelaba el chat y los streams SSE del resto de usuarios.
+
+- Las operaciones van a un ThreadPoolExecutor de PASSWORD_HASH_WORKERS hilos (bcrypt
+  suelta el GIL mientras calcula). Un semáforo deja pasar al pool solo tantas como
+  hilos hay; el resto espera en el event loop, donde se puede medir y cancelar. El
+  hueco se devuelve desde el callback del future del pool, cuando el hilo acaba: una
+  petición cancelada no libera su hueco mientras bcrypt siga calculando, así que la
+  cola interna del executor nunca pasa de PASSWORD_HASH_WORKERS trabajos.
+- Contrapresión: con más de PASSWORD_HASH_MAX_QUEUE operaciones esperando, o si una
+  espera más de PASSWORD_HASH_QUEUE_TIMEOUT segundos, se rechaza con
+  PasswordHasherBusy (503 con Retry-After) en lugar de acumular latencia.
+- El coste es PASSWORD_BCRYPT_ROUNDS. needs_rehash() detecta los hashes con otro
+  coste; login los recalcula después de una comprobación correcta.
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+import bcrypt
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+PASSWORD_HASH_QUEUE_TIMEOUT = float(os.getenv("PASSWORD_HASH_QUEUE_TIMEOUT", "5"))  # segundos
+PASSWORD_BCRYPT_ROUNDS = int(os.getenv("PASSWORD_BCRYPT_ROUNDS", "12"))
+
+
+class PasswordHasherBusy(Exception):
+    """La cola del pool está llena (o la espera fue demasiado larga): reintentar más tarde."""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def hash_rounds(hashed: str) -> Optional[int]:
+    """Coste de un hash bcrypt ("$2b$12$..."), o None si no tiene ese formato."""
+    parts = hashed.split("$")
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2])
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+                 queue_timeout: float = PASSWORD_HASH_QUEUE_TIMEOUT, rounds: int = PASSWORD_BCRYPT_ROUNDS):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rounds = rounds
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.queued = 0
+        self.running = 0
+        self.counters = {"hashed": 0, "verified": 0, "rehashed": 0, "rejected": 0, "timed_out": 0, "peak_queue": 0}
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, fn: Callable[..., Any], *args) -> Any:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        if self.queued >= self.max_queue:
+            self.counters["rejected"] += 1
+            raise PasswordHasherBusy(f"Password hashing queue is full ({self.queued} waiting)")
+        self.queued += 1
+        self.counters["peak_queue"] = max(self.counters["peak_queue"], self.queued)
+        queued_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.counters["timed_out"] += 1
+            raise PasswordHasherBusy(f"Password hashing queue wait exceeded {self.queue_timeout:.0f}s")
+        finally:
+            self.queued -= 1
+        started = time.perf_counter()
+        self.wait_seconds += started - queued_at
+        loop = asyncio.get_running_loop()
+        try:
+            job = self._pool().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.running += 1
+        # El hueco se libera cuando termina el hilo, no cuando deja de esperar el handler:
+        # si la petición se cancela, bcrypt sigue ocupando ese hilo hasta acabar.
+        job.add_done_callback(lambda _: self._finished(loop, started))
+        return await asyncio.wrap_future(job, loop=loop)
+
+    def _finished(self, loop: asyncio.AbstractEventLoop, started: float):
+        try:
+            loop.call_soon_threadsafe(self._release, started)
+        except RuntimeError:
+            pass  # Event loop ya cerrado (apagado)
+
+    def _release(self, started: float):
+        self.running -= 1
+        self.run_seconds += time.perf_counter() - started
+        self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        hashed = await self._run(lambda: bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(self.rounds)))
+        self.counters["hashed"] += 1
+        return hashed.decode("utf-8")
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        matches = await self._run(bcrypt.checkpw, password.encode("utf-8"), hashed.encode("utf-8"))
+        self.counters["verified"] += 1
+        return matches
+
+    def needs_rehash(self, hashed: str) -> bool:
+        return hash_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Any]:
+        operations = self.counters["hashed"] + self.counters["verified"]
+        return {
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "max_queue": self.max_queue,
+            "queued": self.queued,
+            "running": self.running,
+            **self.counters,
+            "avg_wait_ms": round(self.wait_seconds / operations * 1000, 1) if operations else None,
+            "avg_run_ms": round(self.run_seconds / operations * 1000, 1) if operations else None,
+        }
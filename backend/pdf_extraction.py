@@ -0,0 +1,311 @@
+"""
+Motor de extracción de texto de PDFs.
+
+PyPDF2 es puramente CPU: parsear un paper de 40 páginas dentro del handler async
+bloquea el event loop de uvicorn durante segundos. Este módulo extrae en un
+ProcessPoolExecutor acotado: los documentos normales en una sola tarea, y solo los
+muy largos (PDF_PARALLEL_MIN_PAGES, con más de un worker) se reparten por rangos de
+páginas. Cada página se extrae una sola vez, el resultado se ensambla con un único
+join y se deja de pedir páginas en cuanto se alcanza el límite de caracteres.
+
+El resultado es un documento estructurado: además del texto incluye el offset
+de inicio de cada página y un índice de secciones (Abstract, Introduction,
+Method, Experiments, References...) que permite construir prompts con las
+secciones relevantes en lugar de un prefijo arbitrario.
+"""
+import asyncio
+import bisect
+import os
+import re
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from typing import Iterable, List, Optional, Tuple
+
+import PyPDF2
+from pydantic import BaseModel
+
+PDF_TEXT_LIMIT = 300000  # Máximo de caracteres que se devuelven por documento
+PDF_EXTRACTION_WORKERS = int(os.getenv("PDF_EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+# Por debajo de este número de páginas repartir por rangos no compensa: cada tarea vuelve a
+# serializar y parsear el PDF entero. Con un solo worker nunca se reparte.
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "64"))
+ABSTRACT_SCAN_PAGES = 2  # Páginas iniciales donde se busca el abstract
+
+ABSTRACT_PATTERN = re.compile(
+    r"(?i)(?:Abstract|Summary)(?:[:.\s\n]|$)(.*?)(?:\n\n|Keywords|Introduction|1\.\s|I\.\s|Motivation|Background|Related Work|$)",
+    re.DOTALL,
+)
+ABSTRACT_PREFIX_PATTERN = re.compile(
+    r"^(?:[\d.]*\s*)?(?:Introduction|Motivation|Background|Related Work)\s*", re.IGNORECASE
+)
+
+# Tipos de sección en el orden habitual de un paper, con los títulos que los identifican
+SECTION_KINDS = [
+    ("abstract", r"abstract|summary"),
+    ("introduction", r"introduction|motivation"),
+    ("related_work", r"related\s+work|background|preliminaries"),
+    ("method", r"methods?|methodology|(?:proposed\s+|our\s+)?approach|proposed\s+method|model(?:\s+architecture)?|framework"),
+    ("experiments", r"experiments?|experimental\s+(?:setup|results|evaluation)|evaluation"),
+    ("results", r"results(?:\s+and\s+discussion)?|discussion|analysis"),
+    ("conclusion", r"conclusions?(?:\s+and\s+future\s+work)?|future\s+work"),
+    ("acknowledgements", r"acknowledge?ments?"),
+    ("references", r"references|bibliography"),
+    ("appendix", r"appendix(?:\s+[A-Z])?|appendices|supplementary\s+material"),
+]
+# Un título ocupa una línea completa, opcionalmente numerado: "3", "3.", "III.", "A.", "3.1"
+SECTION_HEADING_PATTERN = re.compile(
+    r"^[ \t]*(?:(?:\d+(?:\.\d+)*|[IVX]+|[A-H])\.?[ \t]+)?(?:"
+    + "|".join(f"(?P<{kind}>{pattern})" for kind, pattern in SECTION_KINDS)
+    + r")[ \t]*[:.]?[ \t]*$",
+    re.IGNORECASE | re.MULTILINE,
+)
+BACK_MATTER_SECTIONS = ("acknowledgements", "references")
+
+
+class DocumentSection(BaseModel):
+    kind: str
+    heading: str
+    start: int
+    end: int
+    page: int
+
+
+class ExtractedPdf(BaseModel):
+    text: str
+    page_count: int
+    pages_extracted: int
+    truncated: bool = False
+    abstract: Optional[str] = None
+    authors: Optional[str] = None
+    page_offsets: List[int] = []  # Offset en `text` donde empieza cada página extraída
+    sections: List[DocumentSection] = []
+
+
+# Worker functions (se ejecutan en los procesos hijos, deben ser picklables)
+def _page_chars(page_text: str) -> int:
+    """Caracteres que aporta una página al texto ensamblado (las vacías no cuentan)."""
+    return len(page_text) + 1 if page_text else 0
+
+
+def _extract_document(contents: bytes, parallel_min_pages: Optional[int], char_budget: int) -> Tuple[int, Optional[List[str]]]:
+    """
+    Cuenta las páginas y, si el documento no se va a repartir (menos de parallel_min_pages,
+    o None), extrae todas en orden hasta agotar char_budget con un único parseo.
+    Devuelve (page_count, page_texts); page_texts es None si hay que repartir por rangos.
+    """
+    reader = PyPDF2.PdfReader(BytesIO(contents))
+    page_count = len(reader.pages)
+    if parallel_min_pages is not None and page_count >= parallel_min_pages:
+        return page_count, None
+    page_texts = []
+    collected = 0
+    for page in reader.pages:
+        page_text = page.extract_text() or ""
+        page_texts.append(page_text)
+        collected += _page_chars(page_text)
+        if collected >= char_budget:
+            break
+    return page_count, page_texts
+
+
+def _extract_page_range(contents: bytes, start: int, end: int) -> List[str]:
+    """Extrae el texto de todas las páginas [start, end); el límite lo aplica el proceso padre."""
+    reader = PyPDF2.PdfReader(BytesIO(contents))
+    return [reader.pages[page_num].extract_text() or "" for page_num in range(start, min(end, len(reader.pages)))]
+
+
+def find_abstract(page_texts: List[str]) -> Optional[str]:
+    """Heurística básica para localizar el abstract en las primeras páginas."""
+    for page_text in page_texts[:ABSTRACT_SCAN_PAGES]:
+        if not page_text:
+            continue
+        abstract_match = ABSTRACT_PATTERN.search(page_text)
+        if abstract_match:
+            abstract_candidate = abstract_match.group(1).strip()
+            abstract_candidate = ABSTRACT_PREFIX_PATTERN.sub("", abstract_candidate).strip()
+            if len(abstract_candidate) > 50:  # Basic check for meaningful abstract
+                return abstract_candidate[:4000]
+    return None
+
+
+def assemble_pages(page_texts: List[str], text_limit: int = PDF_TEXT_LIMIT) -> Tuple[str, List[int]]:
+    """
+    Une las páginas con un salto de línea, ignorando las vacías, sin copias cuadráticas.
+    Devuelve el texto y el offset donde empieza cada página (solo las que caben en el límite).
+    """
+    parts = []
+    page_offsets = []
+    offset = 0
+    for page_text in page_texts:
+        if offset >= text_limit:
+            break
+        page_offsets.append(offset)
+        if page_text:
+            parts.append(page_text + "\n")
+            offset += len(page_text) + 1
+    return "".join(parts)[:text_limit], page_offsets
+
+
+def build_section_index(text: str, page_offsets: Optional[List[int]] = None) -> List[DocumentSection]:
+    """
+    Detecta las secciones principales a partir de los títulos en línea propia.
+    Se queda con la primera aparición de cada tipo; tras References solo se acepta Appendix.
+    """
+    found = []
+    seen = set()
+    in_back_matter = False
+    for match in SECTION_HEADING_PATTERN.finditer(text):
+        kind = match.lastgroup
+        if kind in seen or (in_back_matter and kind != "appendix"):
+            continue
+        seen.add(kind)
+        found.append((match.start(), kind, match.group(0).strip()))
+        if kind == "references":
+            in_back_matter = True
+
+    if "abstract" not in seen:
+        # Mismo criterio que el heurístico del abstract: "Abstract" pegado al texto en las primeras páginas
+        scan_end = page_offsets[ABSTRACT_SCAN_PAGES] if page_offsets and len(page_offsets) > ABSTRACT_SCAN_PAGES else len(text)
+        abstract_match = ABSTRACT_PATTERN.search(text, 0, scan_end)
+        if abstract_match and len(abstract_match.group(1).strip()) > 50:
+            first_other = found[0][0] if found else len(text)
+            if abstract_match.start() < first_other:
+                found.insert(0, (abstract_match.start(), "abstract", "Abstract"))
+
+    sections = []
+    for i, (start, kind, heading) in enumerate(found):
+        end = found[i + 1][0] if i + 1 < len(found) else len(text)
+        page = bisect.bisect_right(page_offsets, start) - 1 if page_offsets else 0
+        sections.append(DocumentSection(kind=kind, heading=heading, start=start, end=end, page=max(page, 0)))
+    return sections
+
+
+def select_sections(text: str, sections: List[DocumentSection], kinds: Iterable[str], max_chars: int) -> str:
+    """Concatena (en orden de documento) las secciones de los tipos pedidos, hasta max_chars."""
+    kinds = set(kinds)
+    parts = []
+    remaining = max_chars
+    for section in sections:
+        if section.kind in kinds and remaining > 0:
+            chunk = text[section.start:section.end][:remaining]
+            parts.append(chunk)
+            remaining -= len(chunk)
+    return "".join(parts)
+
+
+def strip_sections(text: str, sections: List[DocumentSection], kinds: Iterable[str] = BACK_MATTER_SECTIONS) -> str:
+    """Devuelve el texto sin las secciones indicadas (por defecto, referencias y agradecimientos)."""
+    kinds = set(kinds)
+    parts = []
+    cursor = 0
+    for section in sections:
+        if section.kind in kinds:
+            parts.append(text[cursor:section.start])
+            cursor = section.end
+    parts.append(text[cursor:])
+    return "".join(parts)
+
+
+class PdfExtractionEngine:
+    """
+    Extrae PDFs en un pool de procesos; los muy largos se reparten en rangos de páginas.
+
+    El pool se crea de forma perezosa; si la plataforma no permite procesos hijos
+    (p. ej. funciones serverless sin /dev/shm) se usa un pool de hilos, que al menos
+    mantiene el event loop libre.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = PDF_EXTRACTION_WORKERS,
+        pages_per_task: int = PDF_PAGES_PER_TASK,
+        text_limit: int = PDF_TEXT_LIMIT,
+        parallel_min_pages: int = PDF_PARALLEL_MIN_PAGES,
+    ):
+        self.max_workers = max(1, max_workers)
+        self.pages_per_task = max(1, pages_per_task)
+        self.parallel_min_pages = max(1, parallel_min_pages)
+        self.text_limit = text_limit
+        self._executor: Optional[Executor] = None
+
+    def start(self) -> Executor:
+        if self._executor is None:
+            try:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                print(f"PDF extraction engine started with {self.max_workers} worker process(es)")
+            except (OSError, NotImplementedError, ImportError) as e:
+                print(f"Process pool not available ({e}), falling back to threads for PDF extraction")
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="pdf-extract")
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def extract(self, contents: bytes) -> ExtractedPdf:
+        try:
+            return await self._extract(contents)
+        except BrokenProcessPool:
+            # Un worker murió (OOM, señal...): se recrea el pool y se reintenta una vez
+            print("PDF extraction pool broken, restarting it")
+            self.shutdown()
+            return await self._extract(contents)
+
+    async def _extract(self, contents: bytes) -> ExtractedPdf:
+        loop = asyncio.get_running_loop()
+        executor = self.start()
+        parallel_min_pages = self.parallel_min_pages if self.max_workers > 1 else None
+        page_count, page_texts = await loop.run_in_executor(executor, _extract_document, contents, parallel_min_pages, self.text_limit)
+        if page_texts is None:
+            page_texts = await self._extract_ranges(loop, executor, contents, page_count)
+
+        collected = sum(_page_chars(page_text) for page_text in page_texts)
+        truncated = collected > self.text_limit or len(page_texts) < page_count
+        text, page_offsets = assemble_pages(page_texts, self.text_limit)
+        return ExtractedPdf(
+            text=text,
+            page_count=page_count,
+            pages_extracted=len(page_texts),
+            truncated=truncated,
+            abstract=find_abstract(page_texts),
+            page_offsets=page_offsets,
+            sections=build_section_index(text, page_offsets),
+        )
+
+    async def _extract_ranges(self, loop, executor: Executor, contents: bytes, page_count: int) -> List[str]:
+        """
+        Reparte el documento en rangos completos y aplica el límite de caracteres una sola
+        vez, en orden de página: nunca quedan huecos entre rangos.
+        """
+        page_texts: List[str] = []
+        collected = 0
+        next_start = 0
+        in_flight = deque()
+
+        def submit_next():
+            nonlocal next_start
+            end = min(next_start + self.pages_per_task, page_count)
+            in_flight.append(loop.run_in_executor(executor, _extract_page_range, contents, next_start, end))
+            next_start = end
+
+        # Ventana acotada de rangos en vuelo: permite cortar en cuanto se llega al límite
+        while next_start < page_count and len(in_flight) < self.max_workers:
+            submit_next()
+
+        try:
+            while in_flight:
+                for page_text in await in_flight.popleft():
+                    page_texts.append(page_text)
+                    collected += _page_chars(page_text)
+                    if collected >= self.text_limit:
+                        return page_texts
+                if next_start < page_count:
+                    submit_next()
+        finally:
+            for pending in in_flight:
+                pending.cancel()
+        return page_texts
@@ -0,0 +1,144 @@
+"""
+Planificador de prompts por presupuesto de tokens.
+
+Cada tipo de prompt (resumen, código, chatbot) tiene un presupuesto en tokens. Los
+huecos del prompt (título, resumen, secciones, archivos de código, historial...) se
+rellenan por prioridad con conteos exactos de tiktoken; lo que no cabe se trunca en
+un límite de token o se descarta, y el plan informa de qué se ha recortado.
+"""
+import os
+from typing import Dict, List, Optional
+
+from token_accounting import TOKEN_COUNT_OFFLOAD_CHARS, TOKEN_ENCODING, count_tokens_async, get_encoding, run_in_token_pool
+
+PROMPT_ENCODING = os.getenv("PROMPT_ENCODING", TOKEN_ENCODING)
+
+# Presupuestos de entrada por tipo de prompt (tokens)
+PROMPT_BUDGETS = {
+    "summary": int(os.getenv("PROMPT_BUDGET_SUMMARY", "32000")),
+    "code": int(os.getenv("PROMPT_BUDGET_CODE", "8000")),
+    "chatbot": int(os.getenv("PROMPT_BUDGET_CHATBOT", "6000")),
+}
+
+TRUNCATION_MARKER = "\n[... truncated {dropped} tokens]"
+
+
+def truncate_to_tokens(text: str, max_tokens: int, encoding=None) -> str:
+    """Corta el texto en un límite de token (nunca a mitad de un token multibyte)."""
+    encoding = encoding or get_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+
+class PromptSlot:
+    """
+    Un hueco del prompt. Prioridad menor = más importante. Un hueco truncable se
+    recorta si no cabe entero (siempre que queden al menos min_tokens); si no, se descarta.
+    tokens es el conteo del texto si el llamante ya lo tiene: si cabe entero no se vuelve a tokenizar.
+    """
+
+    def __init__(self, name: str, text: str, priority: int, truncatable: bool = True, min_tokens: int = 32,
+                 tokens: Optional[int] = None):
+        self.name = name
+        self.text = text or ""
+        self.priority = priority
+        self.truncatable = truncatable
+        self.min_tokens = min_tokens
+        self.tokens = tokens
+
+
+class PromptPlan:
+    def __init__(self, prompt_type: str, budget: int):
+        self.prompt_type = prompt_type
+        self.budget = budget
+        self.slots: Dict[str, str] = {}
+        self.used_tokens = 0
+        self.report: List[Dict] = []
+
+    @property
+    def dropped(self) -> List[str]:
+        return [entry["slot"] for entry in self.report if entry["status"] == "dropped"]
+
+    @property
+    def truncated(self) -> List[str]:
+        return [entry["slot"] for entry in self.report if entry["status"] == "truncated"]
+
+    def summary(self) -> Dict:
+        """Resumen compacto para logs y respuestas: solo lo que no entró completo."""
+        return {
+            "prompt_type": self.prompt_type,
+            "budget": self.budget,
+            "used_tokens": self.used_tokens,
+            "truncated": self.truncated,
+            "dropped": self.dropped,
+        }
+
+    def log_if_trimmed(self, label: str = ""):
+        if self.truncated or self.dropped:
+            print(f"Prompt plan {self.prompt_type} {label}: {self.summary()}")
+
+
+class PromptPlanner:
+    def __init__(self, budgets: Optional[Dict[str, int]] = None, encoding_name: str = PROMPT_ENCODING):
+        self.budgets = dict(budgets or PROMPT_BUDGETS)
+        self.encoding_name = encoding_name
+
+    @property
+    def encoding(self):
+        return get_encoding(self.encoding_name)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    async def count_async(self, text: str) -> int:
+        """count() con los textos grandes en el pool de tokenización."""
+        return await count_tokens_async(text, self.encoding_name)
+
+    def plan(self, prompt_type: str, slots: List[PromptSlot], scaffold: str = "", budget: Optional[int] = None) -> PromptPlan:
+        """
+        scaffold es el texto fijo de la plantilla (instrucciones), que se descuenta del
+        presupuesto antes de repartir el resto entre los huecos.
+        """
+        budget = budget if budget is not None else self.budgets[prompt_type]
+        plan = PromptPlan(prompt_type, budget)
+        remaining = budget - self.count(scaffold)
+        marker_tokens = self.count(TRUNCATION_MARKER.format(dropped=100000))
+
+        # sorted es estable: a igual prioridad se respeta el orden dado
+        for slot in sorted(slots, key=lambda slot: slot.priority):
+            encoded = None
+            if slot.tokens is not None:
+                tokens = slot.tokens
+            else:
+                encoded = self.encoding.encode(slot.text, disallowed_special=())
+                tokens = len(encoded)
+            if tokens <= remaining:
+                plan.slots[slot.name] = slot.text
+                remaining -= tokens
+                plan.report.append({"slot": slot.name, "tokens": tokens, "kept_tokens": tokens, "status": "kept"})
+                continue
+            room = remaining - marker_tokens
+            if slot.truncatable and room >= slot.min_tokens:
+                if encoded is None:
+                    encoded = self.encoding.encode(slot.text, disallowed_special=())
+                kept = self.encoding.decode(encoded[:room])
+                plan.slots[slot.name] = kept + TRUNCATION_MARKER.format(dropped=tokens - room)
+                remaining -= room + marker_tokens
+                plan.report.append({"slot": slot.name, "tokens": tokens, "kept_tokens": room, "status": "truncated"})
+            else:
+                plan.slots[slot.name] = ""
+                plan.report.append({"slot": slot.name, "tokens": tokens, "kept_tokens": 0, "status": "dropped"})
+
+        plan.used_tokens = budget - remaining
+        return plan
+
+    async def plan_async(self, prompt_type: str, slots: List[PromptSlot], scaffold: str = "", budget: Optional[int] = None) -> PromptPlan:
+        """plan() en el pool de tokenización cuando hay que tokenizar textos grandes (p. ej. el paper entero)."""
+        pending = sum(len(slot.text) for slot in slots if slot.tokens is None) + len(scaffold)
+        if pending < TOKEN_COUNT_OFFLOAD_CHARS:
+            return self.plan(prompt_type, slots, scaffold, budget)
+        return await run_in_token_pool(self.plan, prompt_type, slots, scaffold, budget)
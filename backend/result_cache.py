@@ -0,0 +1,135 @@
+"""
+Caché global (compartida entre usuarios) de papers ya procesados.
+
+La clave combina el hash del contenido normalizado, el del título normalizado (los
+prompts de resumen y de código lo incluyen), el modelo y la versión de los prompts, de modo que cambiar GOOGLE_MODEL_NAME o las plantillas invalida
+automáticamente las entradas anteriores. Nivel LRU en proceso delante de MongoDB.
+"""
+import hashlib
+import os
+import re
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from lru import LRUCache
+
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Política de cobro de los aciertos de caché:
+#   flat -> RESULT_CACHE_FLAT_COST créditos por petición
+#   free -> no se cobra
+#   full -> se cobra el coste en tokens que tuvo la generación original
+RESULT_CACHE_BILLING_POLICY = os.getenv("RESULT_CACHE_BILLING_POLICY", "flat")
+RESULT_CACHE_FLAT_COST = int(os.getenv("RESULT_CACHE_FLAT_COST", "1"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalized_content_hash(content: str) -> str:
+    """Hash del texto con los espacios colapsados: el mismo PDF extraído dos veces da el mismo hash."""
+    normalized = _WHITESPACE.sub(" ", content or "").strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def normalized_title_hash(title: str) -> str:
+    """Hash corto del título sin distinguir mayúsculas ni espacios."""
+    normalized = _WHITESPACE.sub(" ", title or "").strip().casefold()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def prompt_version(*templates: str, revision: int = 1) -> str:
+    """Versión de los prompts derivada de las plantillas: cualquier cambio de texto la modifica."""
+    digest = hashlib.sha256()
+    for template in templates:
+        digest.update(template.encode("utf-8"))
+        digest.update(b"\0")
+    return f"r{revision}-{digest.hexdigest()[:12]}"
+
+
+def cache_hit_cost(entry: Dict[str, Any], policy: str = RESULT_CACHE_BILLING_POLICY) -> int:
+    if policy == "free":
+        return 0
+    if policy == "full":
+        return int(entry.get("summary_cost", 0)) + int(entry.get("code_gen_cost", 0))
+    return RESULT_CACHE_FLAT_COST
+
+
+def _entry_size(entry: Dict[str, Any]) -> int:
+    size = len(entry.get("summary", ""))
+    for suggestion in entry.get("project_suggestions", []):
+        size += len(suggestion.get("description", ""))
+        size += sum(len(code_file.get("code", "")) for code_file in suggestion.get("codeImplementation", []))
+    return size + 256
+
+
+class ProcessedResultCache:
+    def __init__(self, model_name: str, prompt_version: str, collection=None):
+        self.model_name = model_name
+        self.prompt_version = prompt_version
+        self.collection = collection
+        self.memory = LRUCache(max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_BYTES, sizeof=_entry_size)
+        self.backing_hits = 0
+        self.backing_misses = 0
+
+    def key_for(self, content: str, title: str) -> str:
+        return f"{normalized_content_hash(content)}:{normalized_title_hash(title)}:{self.model_name}:{self.prompt_version}"
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry
+        if self.collection is None:
+            return None
+        try:
+            entry = await self.collection.find_one_and_update(
+                {"_id": key},
+                {"$inc": {"hits": 1}, "$set": {"last_hit": datetime.utcnow()}},
+            )
+        except Exception as e:
+            print(f"Result cache lookup failed: {e}")
+            return None
+        if entry is None:
+            self.backing_misses += 1
+            return None
+        self.backing_hits += 1
+        self.memory.put(key, entry)
+        return entry
+
+    async def put(self, key: str, summary: str, project_suggestions: List[Dict[str, Any]], summary_cost: int, code_gen_cost: int):
+        entry = {
+            "_id": key,
+            "summary": summary,
+            "project_suggestions": project_suggestions,
+            "model": self.model_name,
+            "prompt_version": self.prompt_version,
+            "summary_cost": summary_cost,
+            "code_gen_cost": code_gen_cost,
+            "created_at": datetime.utcnow(),
+            "hits": 0,
+        }
+        self.memory.put(key, entry)
+        if self.collection is None:
+            return
+        try:
+            await self.collection.replace_one({"_id": key}, entry, upsert=True)
+        except Exception as e:
+            print(f"Result cache store failed: {e}")
+
+    async def purge_stale(self) -> int:
+        """Borra las entradas generadas con otro modelo u otra versión de los prompts."""
+        if self.collection is None:
+            return 0
+        result = await self.collection.delete_many(
+            {"$or": [{"model": {"$ne": self.model_name}}, {"prompt_version": {"$ne": self.prompt_version}}]},
+        )
+        return result.deleted_count
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "prompt_version": self.prompt_version,
+            "billing_policy": RESULT_CACHE_BILLING_POLICY,
+            "memory": self.memory.stats(),
+            "backing": {"hits": self.backing_hits, "misses": self.backing_misses},
+        }
@@ -0,0 +1,71 @@
+"""
+Registro de peticiones en vuelo ("single-flight").
+
+Cuando llegan varias peticiones idénticas a la vez, solo la primera lanza el
+trabajo; el resto espera el mismo resultado. Si un llamante se cancela (p. ej. el
+cliente cierra la conexión) el trabajo sigue mientras quede alguien esperando, y
+solo se cancela cuando se han ido todos. Los errores se propagan a todos.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+        self.owner_claimed = False
+
+
+class SingleFlight:
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Ejecuta fn() una sola vez por clave entre los llamantes concurrentes.
+
+        Devuelve (resultado, owner): owner es True solo para un llamante por ejecución,
+        el primero que recibe el resultado (normalmente quien la lanzó). Sirve para
+        decidir quién paga el coste real del trabajo.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(fn()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda task: self._finish(key, flight, task))
+            self.started += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            result = await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Ya no queda nadie esperando: se cancela y se libera la clave para que
+                # una petición posterior no se enganche a un trabajo en cancelación
+                self._forget(key, flight)
+                flight.task.cancel()
+
+        owner = not flight.owner_claimed
+        flight.owner_claimed = True
+        return result, owner
+
+    def _forget(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def _finish(self, key: Hashable, flight: _Flight, task: asyncio.Task):
+        self._forget(key, flight)
+        if not task.cancelled():
+            task.exception()  # Marca la excepción como recuperada aunque nadie espere ya
+
+    def stats(self) -> Dict[str, int]:
+        return {"in_flight": self.in_flight(), "started": self.started, "coalesced": self.coalesced}
@@ -0,0 +1,60 @@
+"""
+Utilidades para respuestas en streaming (Server-Sent Events).
+"""
+import json
+import re
+from typing import Any, Dict, List, Optional
+
+CODE_IMPLEMENTATION_START = re.compile(r'"codeImplementation"\s*:\s*\[')
+
+
+def sse_event(event: str, data: Any) -> str:
+    """Formatea un evento SSE con payload JSON."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def chunk_text(chunk) -> str:
+    """Texto de un chunk de streaming de Gemini; los chunks sin texto (p. ej. solo safety) devuelven ''."""
+    try:
+        return chunk.text or ""
+    except (ValueError, AttributeError):
+        return ""
+
+
+class CodeFileStreamParser:
+    """
+    Extrae los objetos {"filename", "code"} de la lista "codeImplementation" a medida
+    que el JSON del modelo va llegando, sin esperar a que el documento esté completo.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._decoder = json.JSONDecoder()
+        self._pos: Optional[int] = None
+        self._done = False
+
+    def feed(self, text: str) -> List[Dict[str, str]]:
+        self.buffer += text
+        if self._pos is None:
+            match = CODE_IMPLEMENTATION_START.search(self.buffer)
+            if not match:
+                return []
+            self._pos = match.end()
+
+        files = []
+        while not self._done:
+            while self._pos < len(self.buffer) and self.buffer[self._pos] in " \t\r\n,":
+                self._pos += 1
+            if self._pos >= len(self.buffer):
+                break
+            if self.buffer[self._pos] == "]":
+                self._done = True
+                break
+            try:
+                file_obj, end = self._decoder.raw_decode(self.buffer, self._pos)
+            except json.JSONDecodeError:
+                break  # Objeto todavía incompleto: se reintenta con el siguiente chunk
+            self._pos = end
+            if isinstance(file_obj, dict) and "filename" in file_obj and "code" in file_obj:
+                files.append({"filename": str(file_obj["filename"]), "code": str(file_obj["code"])})
+        return files
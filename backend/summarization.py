@@ -0,0 +1,194 @@
+"""
+Resumen map-reduce para papers largos.
+
+Un único prompt con 300.000 caracteres tarda mucho en Gemini y obliga a tokenizar
+todo el documento de golpe. Por encima de MAP_REDUCE_TOKEN_THRESHOLD tokens el texto
+se parte en trozos acotados por tokens (respetando párrafos), cada trozo se resume
+en paralelo con una concurrencia acotada y una última llamada (reduce) combina los
+resúmenes parciales en el resumen final. Si los parciales no caben en el reduce se
+agrupan y se condensan con su propia plantilla (combine), que trata el texto como
+resúmenes y no como un trozo del paper. Si una llamada falla se cancelan las demás.
+"""
+import asyncio
+import os
+import re
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from token_accounting import run_in_token_pool
+
+MAP_REDUCE_TOKEN_THRESHOLD = int(os.getenv("MAP_REDUCE_TOKEN_THRESHOLD", "24000"))
+MAP_CHUNK_TOKENS = int(os.getenv("MAP_CHUNK_TOKENS", "6000"))
+MAP_CONCURRENCY = int(os.getenv("MAP_CONCURRENCY", "4"))
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n|\n(?=[A-Z0-9])")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+# generate(prompt) -> (texto, tokens de entrada, tokens de salida)
+Generate = Callable[[str], Awaitable[Tuple[str, int, int]]]
+CountTokens = Callable[[str], int]
+
+
+def _split_oversized(piece: str, max_tokens: int, count: CountTokens) -> List[str]:
+    """Parte un párrafo que por sí solo supera el límite: primero por frases, luego por caracteres."""
+    parts: List[str] = []
+    current = ""
+    for sentence in SENTENCE_BREAK.split(piece):
+        candidate = f"{current} {sentence}" if current else sentence
+        if count(candidate) <= max_tokens:
+            current = candidate
+            continue
+        if current:
+            parts.append(current)
+        if count(sentence) <= max_tokens:
+            current = sentence
+            continue
+        # Frase gigante (tablas, texto sin puntuación): corte por caracteres proporcional a los tokens
+        step = max(1, int(len(sentence) * max_tokens / count(sentence)))
+        parts.extend(sentence[i:i + step] for i in range(0, len(sentence), step))
+        current = ""
+    if current:
+        parts.append(current)
+    return parts
+
+
+def split_into_chunks(text: str, max_tokens: int, count: CountTokens) -> List[str]:
+    """Agrupa párrafos consecutivos en trozos de como mucho max_tokens tokens."""
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        tokens = count(paragraph)
+        if tokens > max_tokens:
+            pieces = _split_oversized(paragraph, max_tokens, count)
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            piece_tokens = tokens if len(pieces) == 1 else count(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+async def _bounded_gather(coros, limit: int):
+    """gather con concurrencia acotada; si una falla, se cancelan las que siguen en curso o en espera."""
+    semaphore = asyncio.Semaphore(max(1, limit))
+    coros = list(coros)
+    failed = False
+
+    async def run(coro):
+        nonlocal failed
+        async with semaphore:
+            if failed:
+                coro.close()  # En espera cuando otra falló: no llega a llamar al LLM
+                return None
+            try:
+                return await coro
+            except BaseException:
+                failed = True
+                raise
+
+    tasks = [asyncio.ensure_future(run(coro)) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for coro in coros:
+            coro.close()  # Las que se cancelaron antes de empezar
+        raise
+
+
+class MapReduceResult:
+    def __init__(self, summary: str, input_tokens: int, output_tokens: int, chunks: int, calls: int):
+        self.summary = summary
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.chunks = chunks
+        self.calls = calls
+
+
+async def map_partial_summaries(
+    title: str,
+    text: str,
+    generate: Generate,
+    count: CountTokens,
+    map_template: str,
+    combine_template: str,
+    chunk_tokens: int = MAP_CHUNK_TOKENS,
+    concurrency: int = MAP_CONCURRENCY,
+) -> MapReduceResult:
+    """
+    Fase map: devuelve en .summary los resúmenes parciales concatenados, listos para el
+    reduce. map_template recibe {title}, {part}, {parts} y {chunk}. Si los parciales no
+    caben en un trozo se agrupan y se condensan con combine_template, que recibe {title},
+    {group}, {groups} y {partial_summaries}.
+    """
+    # La tokenización de textos grandes va al pool de tokenización, fuera del event loop
+    chunks = await run_in_token_pool(split_into_chunks, text, chunk_tokens, count)
+    input_tokens = output_tokens = calls = 0
+    first_level_chunks = len(chunks)
+    template = map_template
+
+    while True:
+        if template is map_template:
+            prompts = [
+                map_template.format(title=title, part=index + 1, parts=len(chunks), chunk=chunk)
+                for index, chunk in enumerate(chunks)
+            ]
+        else:
+            prompts = [
+                combine_template.format(title=title, group=index + 1, groups=len(chunks), partial_summaries=chunk)
+                for index, chunk in enumerate(chunks)
+            ]
+        results = await _bounded_gather([generate(prompt) for prompt in prompts], concurrency)
+        calls += len(results)
+        input_tokens += sum(result[1] for result in results)
+        output_tokens += sum(result[2] for result in results)
+        partials = [result[0].strip() for result in results]
+        joined = "\n\n".join(f"[Part {index + 1}]\n{partial}" for index, partial in enumerate(partials))
+        if len(partials) == 1 or await run_in_token_pool(count, joined) <= chunk_tokens:
+            break
+        regrouped = await run_in_token_pool(split_into_chunks, joined, chunk_tokens, count)
+        if len(regrouped) >= len(partials):
+            break  # Los parciales ya no se reducen más: el reduce trabaja con lo que hay
+        chunks = regrouped
+        template = combine_template
+
+    return MapReduceResult(joined, input_tokens, output_tokens, first_level_chunks, calls)
+
+
+async def map_reduce_summary(
+    title: str,
+    text: str,
+    generate: Generate,
+    count: CountTokens,
+    map_template: str,
+    combine_template: str,
+    reduce_template: str,
+    chunk_tokens: int = MAP_CHUNK_TOKENS,
+    concurrency: int = MAP_CONCURRENCY,
+    reduce_generate: Optional[Generate] = None,
+) -> MapReduceResult:
+    """
+    Map + reduce; reduce_template recibe {title} y {partial_summaries}. reduce_generate
+    permite hacer la llamada final por otra ruta (por defecto, la misma que el map).
+    """
+    mapped = await map_partial_summaries(title, text, generate, count, map_template, combine_template, chunk_tokens, concurrency)
+    reduce_call = reduce_generate or generate
+    summary, reduce_input, reduce_output = await reduce_call(reduce_template.format(title=title, partial_summaries=mapped.summary))
+    return MapReduceResult(
+        summary=summary,
+        input_tokens=mapped.input_tokens + reduce_input,
+        output_tokens=mapped.output_tokens + reduce_output,
+        chunks=mapped.chunks,
+        calls=mapped.calls + 1,
+    )
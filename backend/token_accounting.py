@@ -0,0 +1,198 @@
+"""
+Contabilidad de tokens.
+
+- Un único encoder de tiktoken por proceso (cargarlo en cada llamada era el mayor
+  coste de CPU del handler).
+- Los textos grandes se tokenizan en un pool de hilos propio, nunca en el event loop.
+- Para facturar se usa el usage_metadata que devuelve el proveedor; tiktoken queda
+  solo para las estimaciones previas (y como respaldo si el proveedor no informa).
+- Cada petición acumula un RequestTokenRecord con los tokens y el coste de cada
+  llamada, que se devuelve en la respuesta y se guarda en el log de créditos.
+"""
+import asyncio
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import tiktoken
+
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", os.getenv("PROMPT_ENCODING", "cl100k_base"))
+# A partir de este tamaño (caracteres) el conteo va a un hilo
+TOKEN_COUNT_OFFLOAD_CHARS = int(os.getenv("TOKEN_COUNT_OFFLOAD_CHARS", "20000"))
+TOKEN_COUNT_WORKERS = int(os.getenv("TOKEN_COUNT_WORKERS", "2"))
+
+USAGE_SOURCE_PROVIDER = "provider"
+USAGE_SOURCE_ESTIMATE = "estimate"
+
+
+class ApproximateEncoding:
+    """
+    Sustituto cuando el vocabulario de tiktoken no se puede cargar (sin red): un token
+    por cada 4 caracteres. Cada token lleva sus caracteres (UTF-32 empaquetado en un
+    entero, con un bit centinela que marca la longitud), así que decode() de un prefijo
+    de tokens devuelve el prefijo del texto, igual que con tiktoken.
+    """
+
+    name = "approximate"
+    CHARS_PER_TOKEN = 4
+    BYTES_PER_TOKEN = CHARS_PER_TOKEN * 4
+
+    def encode(self, text: str, **kwargs) -> List[int]:
+        data = text.encode("utf-32-le")
+        step = self.BYTES_PER_TOKEN
+        whole = len(data) - len(data) % step
+        sentinel = 1 << (8 * step)
+        from_bytes = int.from_bytes
+        tokens = [from_bytes(data[i:i + step], "little") | sentinel for i in range(0, whole, step)]
+        if whole < len(data):
+            tokens.append(from_bytes(data[whole:], "little") | (1 << (8 * (len(data) - whole))))
+        return tokens
+
+    def decode(self, tokens: List[int]) -> str:
+        parts = []
+        for token in tokens:
+            size = (token.bit_length() - 1) // 8
+            parts.append((token ^ (1 << (8 * size))).to_bytes(size, "little"))
+        return b"".join(parts).decode("utf-32-le")
+
+
+_encodings: Dict[str, Any] = {}
+_encodings_lock = threading.Lock()
+
+
+def get_encoding(name: str = TOKEN_ENCODING):
+    """Encoder compartido por todo el proceso; se carga una sola vez aunque lo pidan varios hilos a la vez."""
+    encoding = _encodings.get(name)
+    if encoding is not None:
+        return encoding
+    with _encodings_lock:
+        encoding = _encodings.get(name)
+        if encoding is None:
+            try:
+                encoding = tiktoken.get_encoding(name)
+            except Exception as e:
+                print(f"tiktoken encoding '{name}' unavailable ({e}); using an approximate token count")
+                encoding = ApproximateEncoding()
+            _encodings[name] = encoding
+    return encoding
+
+
+def count_tokens(text: str, encoding_name: str = TOKEN_ENCODING) -> int:
+    if not text:
+        return 0
+    return len(get_encoding(encoding_name).encode(text, disallowed_special=()))
+
+
+_count_executor: Optional[ThreadPoolExecutor] = None
+
+
+async def run_in_token_pool(fn, *args):
+    """Ejecuta trabajo de tokenización (fn(*args)) en el pool propio, fuera del event loop."""
+    global _count_executor
+    if _count_executor is None:
+        _count_executor = ThreadPoolExecutor(max_workers=TOKEN_COUNT_WORKERS, thread_name_prefix="token-count")
+    return await asyncio.get_running_loop().run_in_executor(_count_executor, fn, *args)
+
+
+async def count_tokens_async(text: str, encoding_name: str = TOKEN_ENCODING) -> int:
+    """Textos cortos se cuentan en línea; los grandes en el pool de tokenización."""
+    if not text or len(text) < TOKEN_COUNT_OFFLOAD_CHARS:
+        return count_tokens(text, encoding_name)
+    return await run_in_token_pool(count_tokens, text, encoding_name)
+
+
+def shutdown():
+    global _count_executor
+    if _count_executor is not None:
+        _count_executor.shutdown(wait=False, cancel_futures=True)
+        _count_executor = None
+
+
+class TokenUsage:
+    """Tokens y coste de una llamada al LLM. source indica si vienen del proveedor o de tiktoken."""
+
+    def __init__(self, route: str, input_tokens: int, output_tokens: int, cost_per_token: float, source: str):
+        self.route = route
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cost_per_token = cost_per_token
+        self.source = source
+
+    @property
+    def cost(self) -> float:
+        return (self.input_tokens + self.output_tokens) * self.cost_per_token
+
+    @classmethod
+    async def from_response(cls, route: str, response, prompt: str, output_text: str, cost_per_token: float) -> "TokenUsage":
+        """Usa usage_metadata de la respuesta; solo cuenta con tiktoken lo que el proveedor no informe."""
+        usage = getattr(response, "usage_metadata", None)
+        input_tokens = getattr(usage, "prompt_token_count", None) if usage else None
+        output_tokens = getattr(usage, "candidates_token_count", None) if usage else None
+        source = USAGE_SOURCE_PROVIDER
+        if not input_tokens:
+            input_tokens = await count_tokens_async(prompt)
+            source = USAGE_SOURCE_ESTIMATE
+        if not output_tokens:
+            output_tokens = await count_tokens_async(output_text)
+            source = USAGE_SOURCE_ESTIMATE
+        return cls(route, input_tokens, output_tokens, cost_per_token, source)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "route": self.route,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cost": round(self.cost, 4),
+            "source": self.source,
+        }
+
+
+class RequestTokenRecord:
+    """
+    Registro de tokens de una petición. Las llamadas se agrupan por fase (summary,
+    code, chatbot...) y cada fase se factura en créditos enteros redondeando hacia arriba.
+    """
+
+    def __init__(self):
+        self.calls: List[TokenUsage] = []
+        self.phases: Dict[str, List[TokenUsage]] = {}
+
+    def add(self, phase: str, usage: TokenUsage) -> TokenUsage:
+        self.calls.append(usage)
+        self.phases.setdefault(phase, []).append(usage)
+        return usage
+
+    def input_tokens(self, phase: Optional[str] = None) -> int:
+        return sum(usage.input_tokens for usage in self._usages(phase))
+
+    def output_tokens(self, phase: Optional[str] = None) -> int:
+        return sum(usage.output_tokens for usage in self._usages(phase))
+
+    def credits(self, phase: Optional[str] = None) -> int:
+        if phase is not None:
+            return math.ceil(sum(usage.cost for usage in self._usages(phase)))
+        return sum(self.credits(name) for name in self.phases)
+
+    def _usages(self, phase: Optional[str]) -> List[TokenUsage]:
+        return self.calls if phase is None else self.phases.get(phase, [])
+
+    def as_dict(self) -> Dict[str, Any]:
+        sources = {usage.source for usage in self.calls}
+        return {
+            "input_tokens": self.input_tokens(),
+            "output_tokens": self.output_tokens(),
+            "credits": self.credits(),
+            "source": sources.pop() if len(sources) == 1 else "mixed",
+            "phases": {
+                phase: {
+                    "calls": len(usages),
+                    "input_tokens": self.input_tokens(phase),
+                    "output_tokens": self.output_tokens(phase),
+                    "credits": self.credits(phase),
+                }
+                for phase, usages in self.phases.items()
+            },
+            "calls": [usage.as_dict() for usage in self.calls],
+        }
@@ -0,0 +1,106 @@
+"""
+Caché en memoria de usuarios autenticados, por _id y con TTL.
+
+get_current_user hacía un find_one en users en cada petición autenticada, aunque la
+mayoría solo necesita el _id del token. Ahora:
+
+- Los usuarios se guardan sin el hash de la contraseña durante USER_CACHE_TTL
+  segundos, en un LRU acotado por USER_CACHE_MAX_ENTRIES.
+- Los cobros (reserva, liquidación, cobro directo y reembolso) escriben el saldo
+  nuevo en la caché (write-through), así /api/user y la siguiente petición ven los
+  créditos actualizados sin releer la base de datos.
+- invalidate() quita un usuario (o todos) explícitamente.
+- Una carga que empezó antes de una escritura no guarda su resultado: podría
+  traer un saldo anterior al cobro.
+
+Con varios procesos cada uno tiene su caché: los cambios hechos en otro proceso
+(p. ej. el worker de trabajos) se ven como mucho USER_CACHE_TTL segundos tarde. Los
+cobros no dependen de este saldo: la reserva es atómica en la base de datos.
+"""
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+from bson.objectid import ObjectId
+
+from lru import LRUCache
+
+USER_CACHE_ENABLED = os.getenv("USER_CACHE_ENABLED", "true").lower() == "true"
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))  # segundos
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+
+# Campos que nunca se guardan en la caché
+USER_CACHE_EXCLUDED_FIELDS = ("password",)
+
+
+class UserCache:
+    def __init__(self, ttl: float = USER_CACHE_TTL, max_entries: int = USER_CACHE_MAX_ENTRIES,
+                 enabled: bool = USER_CACHE_ENABLED, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.enabled = enabled and ttl > 0
+        self.clock = clock
+        self.entries = LRUCache(max_entries=max_entries)  # user_id -> (caduca_en, usuario)
+        self.writes = 0  # Sube con cada escritura o invalidación (ver begin_load)
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "loads_discarded": 0,
+                         "credit_writes": 0, "invalidations": 0, "claims_only": 0}
+
+    def get(self, user_id: ObjectId) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[0] <= self.clock():
+            self.entries.pop(user_id)
+            self.counters["expired"] += 1
+            entry = None
+        if entry is None:
+            self.counters["misses"] += 1
+            return None
+        self.counters["hits"] += 1
+        return dict(entry[1])  # Copia: el handler puede modificar su usuario
+
+    def begin_load(self) -> int:
+        """Marca el inicio de una lectura de la base de datos; se pasa a put()."""
+        return self.writes
+
+    def put(self, user: Dict[str, Any], load_started: Optional[int] = None):
+        if not self.enabled:
+            return
+        if load_started is not None and load_started != self.writes:
+            # Hubo un cobro o una invalidación mientras se leía: el documento puede ser anterior
+            self.counters["loads_discarded"] += 1
+            return
+        cached = {key: value for key, value in user.items() if key not in USER_CACHE_EXCLUDED_FIELDS}
+        self.entries.put(user["_id"], (self.clock() + self.ttl, cached))
+
+    def update_credits(self, user_id: ObjectId, balance: Optional[int]):
+        """Write-through del saldo tras un cobro; sin saldo conocido se invalida."""
+        self.writes += 1
+        if balance is None:
+            self.invalidate(user_id)
+            return
+        entry = self.entries.pop(user_id)
+        if entry is not None:
+            expires_at, user = entry
+            self.entries.put(user_id, (expires_at, {**user, "credits": balance}))
+        self.counters["credit_writes"] += 1
+
+    def invalidate(self, user_id: Optional[ObjectId] = None):
+        """Quita un usuario de la caché, o todos si no se indica ninguno."""
+        self.writes += 1
+        if user_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(user_id)
+        self.counters["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            "enabled": self.enabled,
+            "ttl": self.ttl,
+            "entries": len(self.entries),
+            "max_entries": self.entries.max_entries,
+            "evictions": self.entries.evictions,
+            **self.counters,
+            "hit_rate": round(self.counters["hits"] / lookups, 4) if lookups else None,
+        }
@@ -0,0 +1,28 @@
+"""
+Worker independiente de la cola de trabajos.
+
+Ejecuta los mismos handlers que la API pero en su propio proceso, reclamando
+trabajos de la colección de Mongo. Arrancar la API con JOB_WORKERS_IN_PROCESS=false
+y lanzar uno o varios de estos:  python worker.py
+"""
+import asyncio
+
+import main
+
+
+async def run_worker():
+    await main.startup_db_client()
+    if main.db is None:
+        raise SystemExit("MongoDB is required to run jobs outside the API process")
+    await main.job_pool.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await main.shutdown_db_client()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_worker())
+    except KeyboardInterrupt:
+        print("Worker stopped")
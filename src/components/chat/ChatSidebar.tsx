@@ -22,6 +22,8 @@ interface ChatSidebarProps {
   handleNewChat: () => void;
   onShowArxivSearch: () => void;
   handleDeleteSession: (sessionId: string) => void; // New prop for deleting a session
+  hasMoreSessions?: boolean;
+  onLoadMoreSessions?: () => void;
 }
 
 const ChatSidebar: React.FC<ChatSidebarProps> = ({
@@ -31,6 +33,8 @@ const ChatSidebar: React.FC<ChatSidebarProps> = ({
   handleNewChat,
   onShowArxivSearch,
   handleDeleteSession, // Use the new prop
+  hasMoreSessions = false,
+  onLoadMoreSessions,
 }) => {
   const { user, logout } = useAuth();
 
@@ -118,6 +122,18 @@ const ChatSidebar: React.FC<ChatSidebarProps> = ({
                   </div>
                 </SidebarMenuItem>
               ))}
+              {hasMoreSessions && onLoadMoreSessions && (
+                <SidebarMenuItem>
+                  <Button
+                    variant="ghost"
+                    size="sm"
+                    className="w-full text-xs text-sidebar-foreground/70 hover:bg-sidebar-accent"
+                    onClick={onLoadMoreSessions}
+                  >
+                    Load older chats
+                  </Button>
+                </SidebarMenuItem>
+              )}
               {chatSessions.length === 0 && (
                 <p className="p-4 text-sm text-sidebar-foreground/70 text-center">
                   Start a new chat or explore ArXiv.
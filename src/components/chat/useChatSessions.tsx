@@ -2,7 +2,7 @@ import { useState, useEffect, useCallback, useRef } from 'react';
 import { ChatSession, ChatMessage, PaperData, ProcessedPaper, ArxivPaper } from '@/lib/types';
 import { v4 as uuidv4 } from 'uuid';
 import { useToast } from '@/hooks/use-toast';
-import { extractTextFromPDF, processPaperWithLLM, saveUserChatSession, getUserChatSessions, deleteChatSession as apiDeleteChatSession } from '@/lib/api'; // Import deleteChatSession
+import { extractTextFromPDF, processPaperWithLLM, saveUserChatSession, syncUserChatSession, SessionVersionConflictError, getUserChatSessions, getUserChatSession, deleteChatSession as apiDeleteChatSession } from '@/lib/api'; // Import deleteChatSession
 import { useAuth } from '@/context/AuthContext';
 
 export function useChatSessions() {
@@ -25,14 +25,59 @@ export function useChatSessions() {
   const [isSavingSession, setIsSavingSession] = useState<boolean>(false);
   const [isLoadingSessions, setIsLoadingSessions] = useState<boolean>(false);
   const [isAutoProcessing, setIsAutoProcessing] = useState<boolean>(false); // Nuevo estado
+  // Cursor de la siguiente página del listado de sesiones (null si no hay más)
+  const [sessionsCursor, setSessionsCursor] = useState<string | null>(null);
   
   // En lugar de usar una ref que persiste entre recargas, usamos un estado
   const [sessionsAttempted, setSessionsAttempted] = useState<boolean>(false);
   
   // Usar un ref para evitar actualizaciones innecesarias del perfil
   const lastProfileRefresh = useRef<Date | null>(null);
-  // Usar un ref para rastrear la última sesión guardada
-  const lastSavedSession = useRef<{id: string, timestamp: Date} | null>(null);
+  // Último estado sincronizado de cada sesión (título y mensajes serializados por id):
+  // la sincronización solo envía lo que cambió desde entonces
+  const syncedSessions = useRef<Record<string, { title: string; messages: Record<string, string> }>>({});
+
+  const markSynced = (session: ChatSession) => {
+    syncedSessions.current[session.id] = {
+      title: session.title,
+      messages: Object.fromEntries(session.messages.map(m => [m.id, JSON.stringify(m)])),
+    };
+  };
+
+  const applyPaperDataFrom = (session?: ChatSession) => {
+    const lastUserMessageWithPaper = session?.messages
+      .filter(m => m.role === 'user' && m.paperData)
+      .pop();
+    setCurrentPaperData(lastUserMessageWithPaper?.paperData || null);
+    setCurrentProcessedData(lastUserMessageWithPaper?.processedData || null);
+  };
+
+  // El listado solo trae resúmenes: los mensajes de una sesión se piden al abrirla
+  const loadSessionMessages = async (session: ChatSession): Promise<ChatSession> => {
+    if (session.messagesLoaded !== false) return session;
+    try {
+      const fullSession = await getUserChatSession(session.id);
+      const loaded = { ...session, messages: fullSession.messages, messagesLoaded: true, version: fullSession.version };
+      markSynced(loaded);
+      setChatSessions(prev => prev.map(s => s.id === session.id ? loaded : s));
+      return loaded;
+    } catch (error) {
+      console.error(`Error loading messages for session ${session.id}:`, error);
+      toast({ variant: 'destructive', title: 'Error', description: 'Failed to load this chat. Please try again later.' });
+      return session;
+    }
+  };
+
+  const loadMoreSessions = async () => {
+    if (!sessionsCursor) return;
+    try {
+      const page = await getUserChatSessions(sessionsCursor);
+      setChatSessions(prev => [...prev, ...page.sessions.filter(s => !prev.some(p => p.id === s.id))]);
+      setSessionsCursor(page.nextCursor);
+    } catch (error) {
+      console.error('Error loading more chat sessions:', error);
+    }
+  };
 
   // Cargar sesiones de chat del usuario cuando se inicia sesión
   useEffect(() => {
@@ -66,7 +111,8 @@ export function useChatSessions() {
             console.error("Error checking database status:", debugError);
           }
           
-          const sessions = await getUserChatSessions();
+          const { sessions, nextCursor } = await getUserChatSessions();
+          setSessionsCursor(nextCursor);
           console.log(`Fetched ${sessions.length} sessions`);
           
           if (sessions && sessions.length > 0) {
@@ -83,14 +129,7 @@ export function useChatSessions() {
             console.log("Selected session:", mostRecentSession.id);
             
             // Actualizamos paper data si está disponible
-            const lastUserMessageWithPaper = mostRecentSession.messages
-              .filter(m => m.role === 'user' && m.paperData)
-              .pop();
-              
-            if (lastUserMessageWithPaper) {
-              setCurrentPaperData(lastUserMessageWithPaper.paperData);
-              setCurrentProcessedData(lastUserMessageWithPaper.processedData || null);
-            }
+            applyPaperDataFrom(await loadSessionMessages(mostRecentSession));
           } else {
             console.log("No sessions found, using default");
           }
@@ -114,6 +153,7 @@ export function useChatSessions() {
   useEffect(() => {
     if (!isAuthenticated) {
       setSessionsAttempted(false);
+      setSessionsCursor(null);
       // Volver a la sesión default cuando se cierra sesión
       setChatSessions([{
         id: 'default',
@@ -144,25 +184,36 @@ export function useChatSessions() {
       if (isAuthenticated && user && currentSessionId !== 'default' && currentSessionId !== 'new') {
         const currentSession = chatSessions.find(s => s.id === currentSessionId);
         
-        // Solo guardar si hay mensajes en la sesión y no se está guardando actualmente
-        if (currentSession && currentSession.messages.length > 0 && !isSavingSession) {
-          // Verificar si esta sesión ya se guardó recientemente (últimos 5 segundos)
-          const shouldSave = 
-            !lastSavedSession.current || 
-            lastSavedSession.current.id !== currentSessionId ||
-            new Date().getTime() - lastSavedSession.current.timestamp.getTime() > 5000;
-            
-          if (shouldSave) {
+        // Solo sincronizar sesiones ya creadas en el servidor (con versión), con sus mensajes
+        // cargados y si no se está guardando actualmente
+        if (currentSession && currentSession.version !== undefined && currentSession.messagesLoaded !== false
+            && currentSession.messages.length > 0 && !isSavingSession) {
+          const synced = syncedSessions.current[currentSession.id];
+          const upserts = currentSession.messages.filter(m => synced?.messages[m.id] !== JSON.stringify(m));
+          const deletedIds = synced
+            ? Object.keys(synced.messages).filter(id => !currentSession.messages.some(m => m.id === id))
+            : [];
+
+          if (upserts.length > 0 || deletedIds.length > 0 || synced?.title !== currentSession.title) {
             setIsSavingSession(true);
             try {
-              await saveUserChatSession(currentSession);
-              lastSavedSession.current = {
-                id: currentSessionId,
-                timestamp: new Date()
-              };
-              console.log(`Saved session ${currentSessionId} successfully`);
+              const result = await syncUserChatSession(currentSession, upserts, deletedIds);
+              markSynced(currentSession);
+              setChatSessions(prev => prev.map(s => s.id === currentSession.id ? { ...s, version: result.version } : s));
+              console.log(`Synced session ${currentSessionId} (${upserts.length} message(s), version ${result.version})`);
             } catch (error) {
-              console.error('Error saving chat session:', error);
+              if (error instanceof SessionVersionConflictError) {
+                // Otra pestaña guardó antes: se recarga la sesión y se conservan los mensajes locales que falten
+                const fresh = await getUserChatSession(currentSession.id);
+                markSynced(fresh);
+                setChatSessions(prev => prev.map(s => {
+                  if (s.id !== currentSession.id) return s;
+                  const localOnly = s.messages.filter(m => !fresh.messages.some(f => f.id === m.id));
+                  return { ...s, messages: [...fresh.messages, ...localOnly], version: fresh.version, messagesLoaded: true };
+                }));
+              } else {
+                console.error('Error saving chat session:', error);
+              }
             } finally {
               setIsSavingSession(false);
             }
@@ -217,19 +268,16 @@ export function useChatSessions() {
 
         // Si el backend devuelve un ID diferente (o el mismo), actualiza el estado
         // Esto es importante si el backend genera/confirma el ID.
+        setChatSessions(prev => 
+          prev.map(session => 
+            session.id === newSessionId ? { ...session, id: savedSession.id, title: savedSession.title, version: savedSession.version } : session
+          )
+        );
         if (savedSession.id !== newSessionId) {
-          setChatSessions(prev => 
-            prev.map(session => 
-              session.id === newSessionId ? { ...session, id: savedSession.id, title: savedSession.title } : session
-            )
-          );
           setCurrentSessionId(savedSession.id);
         }
-        
-        lastSavedSession.current = {
-          id: savedSession.id,
-          timestamp: new Date()
-        };
+        // Los mensajes añadidos mientras se creaba se enviarán en la siguiente sincronización
+        syncedSessions.current[savedSession.id] = { title: savedSession.title, messages: {} };
 
         if (autoProcessPaper) {
           // Inmediatamente después de crear la sesión, procesar el paper de ArXiv
@@ -322,21 +370,16 @@ export function useChatSessions() {
     }
   };
 
-  const handleSessionSelect = (sessionId: string) => {
+  const handleSessionSelect = async (sessionId: string) => {
     if (sessionId === currentSessionId) return; // No hacer nada si ya es la sesión actual
     
     setCurrentSessionId(sessionId);
     
-    // Find the session data
+    // Find the session data (its messages are fetched on first open)
     const session = chatSessions.find(s => s.id === sessionId);
     
     // Set the current paper data based on the last user message with paper data
-    const lastUserMessageWithPaper = session?.messages
-      .filter(m => m.role === 'user' && m.paperData)
-      .pop();
-      
-    setCurrentPaperData(lastUserMessageWithPaper?.paperData || null);
-    setCurrentProcessedData(lastUserMessageWithPaper?.processedData || null);
+    applyPaperDataFrom(session && await loadSessionMessages(session));
     
     // Actualizar el perfil del usuario, pero de forma optimizada
     refreshUserProfileOptimized();
@@ -463,11 +506,7 @@ export function useChatSessions() {
         )[0];
         setCurrentSessionId(mostRecentSession.id);
         // Update paper data for the new current session
-        const lastUserMessageWithPaper = mostRecentSession.messages
-          .filter(m => m.role === 'user' && m.paperData)
-          .pop();
-        setCurrentPaperData(lastUserMessageWithPaper?.paperData || null);
-        setCurrentProcessedData(lastUserMessageWithPaper?.processedData || null);
+        loadSessionMessages(mostRecentSession).then(applyPaperDataFrom);
       } else {
         // If no sessions left, create a new default one (or handle as appropriate)
         handleNewChat(); // This will create a new default session
@@ -506,6 +545,8 @@ export function useChatSessions() {
     isAutoProcessing, // Exponer el nuevo estado
     handleNewChat,
     handleSessionSelect,
+    hasMoreSessions: sessionsCursor !== null,
+    loadMoreSessions,
     handleFileSelected,
     handleAddMessage,
     handleNewChatWithArxivPaper, // Exponer la nueva función
@@ -1,4 +1,4 @@
-import { PaperData, ProcessedPaper, UserData, ChatSession } from "./types";
+import { PaperData, ProcessedPaper, UserData, ChatMessage, ChatSession, ChatSessionsPage, ProcessedPaperHistoryPage } from "./types";
 import BASE_URL from "./utils";
 
 const API_URL = import.meta.env.VITE_API_URL || '/api';
@@ -36,7 +36,7 @@ export async function registerUser(name: string, email: string, password: string
   return { token: data.access_token }; // Asegúrate de convertir access_token a token
 }
 
-export async function loginUser(email: string, password: string): Promise<{ token: string, user: UserData, processed_paper_messages?: any[] }> {
+export async function loginUser(email: string, password: string): Promise<{ token: string, user: UserData }> {
   console.log('Intentando login con:', { email });
   
   try {
@@ -75,11 +75,10 @@ export async function loginUser(email: string, password: string): Promise<{ toke
       user: data.user ? 'presente' : 'ausente'
     });
     
-    // Devolvemos un objeto con token, user y posiblemente processed_paper_messages
+    // El historial de papers procesados se pide aparte (getProcessedPaperHistory)
     return { 
       token: data.access_token,
-      user: data.user,
-      processed_paper_messages: data.processed_paper_messages
+      user: data.user
     };
   } catch (error) {
     console.error('Error durante login:', error);
@@ -87,6 +86,34 @@ export async function loginUser(email: string, password: string): Promise<{ toke
   }
 }
 
+// Historial de resúmenes y código generados, paginado (solo extractos)
+export async function getProcessedPaperHistory(cursor?: string | null): Promise<ProcessedPaperHistoryPage> {
+  const token = localStorage.getItem('auth_token');
+  if (!token) {
+    throw new Error('Authentication required');
+  }
+
+  const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+  const response = await fetch(`${BASE_URL}/api/history/processed-papers${query}`, {
+    headers: {
+      'Authorization': `Bearer ${token}`,
+    },
+  });
+
+  if (!response.ok) {
+    const errorText = await response.text();
+    try {
+      const errorData = JSON.parse(errorText);
+      throw new Error(errorData.detail || 'Failed to fetch processed paper history');
+    } catch (parseError) {
+      throw new Error(`Failed to fetch processed paper history: ${errorText}`);
+    }
+  }
+
+  const data = await response.json();
+  return { items: data.items || [], nextCursor: data.next_cursor || null };
+}
+
 export async function getUserProfile(token: string): Promise<UserData> {
   const response = await fetch(`${BASE_URL}/api/user`, {
     headers: {
@@ -195,7 +222,52 @@ export async function saveUserChatSession(session: ChatSession): Promise<ChatSes
   return await response.json();
 }
 
-export async function getUserChatSessions(): Promise<ChatSession[]> {
+export class SessionVersionConflictError extends Error {}
+
+// Sincronización incremental: solo los mensajes nuevos o modificados y la versión de la que parten
+export async function syncUserChatSession(
+  session: ChatSession,
+  upserts: ChatMessage[],
+  deletedIds: string[] = [],
+): Promise<{ id: string; version: number }> {
+  const token = localStorage.getItem('auth_token');
+  if (!token) {
+    throw new Error('Authentication required');
+  }
+
+  const response = await fetch(`${BASE_URL}/api/chat/sessions/sync`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${token}`,
+    },
+    body: JSON.stringify({
+      id: session.id,
+      title: session.title,
+      lastUpdated: session.lastUpdated,
+      base_version: session.version ?? 0,
+      upserts,
+      deleted_ids: deletedIds,
+    }),
+  });
+
+  if (response.status === 409) {
+    throw new SessionVersionConflictError('Chat session was updated elsewhere');
+  }
+  if (!response.ok) {
+    const errorText = await response.text();
+    try {
+      const errorData = JSON.parse(errorText);
+      throw new Error(errorData.detail || 'Failed to sync chat session');
+    } catch (parseError) {
+      throw new Error(`Failed to sync chat session: ${errorText}`);
+    }
+  }
+
+  return await response.json();
+}
+
+export async function getUserChatSessions(cursor?: string | null): Promise<ChatSessionsPage> {
   const token = localStorage.getItem('auth_token');
   if (!token) {
     throw new Error('Authentication required');
@@ -204,7 +276,8 @@ export async function getUserChatSessions(): Promise<ChatSession[]> {
   console.log('Fetching chat sessions from API...');
   
   try {
-    const response = await fetch(`${BASE_URL}/api/chat/sessions`, {
+    const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+    const response = await fetch(`${BASE_URL}/api/chat/sessions${query}`, {
       headers: {
         'Authorization': `Bearer ${token}`,
       },
@@ -223,7 +296,17 @@ export async function getUserChatSessions(): Promise<ChatSession[]> {
 
     const data = await response.json();
     console.log('Received sessions data:', data);
-    return data.sessions || [];
+    // El listado solo trae un resumen de cada sesión; los mensajes se piden con getUserChatSession
+    const sessions: ChatSession[] = (data.sessions || []).map((session: any) => ({
+      id: session.id,
+      title: session.title,
+      lastUpdated: session.lastUpdated,
+      messages: [],
+      messageCount: session.messageCount,
+      lastMessagePreview: session.lastMessagePreview,
+      messagesLoaded: !session.messageCount,
+    }));
+    return { sessions, nextCursor: data.next_cursor || null };
   } catch (error) {
     console.error('Error fetching chat sessions:', error);
     throw error;
@@ -236,23 +319,34 @@ export async function getUserChatSession(sessionId: string): Promise<ChatSession
     throw new Error('Authentication required');
   }
 
-  const response = await fetch(`${BASE_URL}/api/chat/sessions/${sessionId}`, {
-    headers: {
-      'Authorization': `Bearer ${token}`,
-    },
-  });
+  // Los mensajes llegan paginados (más recientes primero): se piden las páginas
+  // anteriores hasta tener la conversación completa
+  let session: ChatSession | null = null;
+  let before: string | null = null;
+  do {
+    const query = before ? `?before=${encodeURIComponent(before)}` : '';
+    const response = await fetch(`${BASE_URL}/api/chat/sessions/${sessionId}${query}`, {
+      headers: {
+        'Authorization': `Bearer ${token}`,
+      },
+    });
 
-  if (!response.ok) {
-    const errorText = await response.text();
-    try {
-      const errorData = JSON.parse(errorText);
-      throw new Error(errorData.detail || 'Failed to fetch chat session');
-    } catch (parseError) {
-      throw new Error(`Failed to fetch chat session: ${errorText}`);
+    if (!response.ok) {
+      const errorText = await response.text();
+      try {
+        const errorData = JSON.parse(errorText);
+        throw new Error(errorData.detail || 'Failed to fetch chat session');
+      } catch (parseError) {
+        throw new Error(`Failed to fetch chat session: ${errorText}`);
+      }
     }
-  }
 
-  return await response.json();
+    const page = await response.json();
+    session = session ? { ...session, messages: [...page.messages, ...session.messages] } : page;
+    before = page.has_more_before ? page.before_cursor : null;
+  } while (before);
+
+  return session as ChatSession;
 }
 
 export async function getChatSessions(): Promise<ChatSession[]> {
@@ -300,12 +394,47 @@ export async function postChatMessage(sessionId: string, message: { role: 'user'
 }
 
 // Chatbot API
-export async function sendChatbotMessage(
+// El servidor respondió 409: la sesión todavía no tiene el contexto del paper guardado
+export class ChatContextMissingError extends Error {}
+
+// Guarda en el servidor el contexto del paper de la sesión; luego los mensajes solo llevan el texto
+export async function setChatbotContext(
   sessionId: string,
-  message: string,
   paperTitle: string,
   paperSummary: string,
-  codeSuggestions: any[]
+  codeSuggestions: any[],
+  documentId?: string | null
+): Promise<{ session_id: string; digest: string; prefix_tokens: number }> {
+  const token = localStorage.getItem('auth_token');
+  if (!token) {
+    throw new Error('Authentication required');
+  }
+
+  const response = await fetch(`${BASE_URL}/api/chat/sessions/${sessionId}/context`, {
+    method: 'PUT',
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${token}`,
+    },
+    body: JSON.stringify({
+      paper_title: paperTitle,
+      paper_summary: paperSummary,
+      code_suggestions: codeSuggestions,
+      document_id: documentId ?? null
+    }),
+  });
+
+  if (!response.ok) {
+    const errorData = await response.json().catch(() => ({}));
+    throw new Error(errorData.detail || 'Failed to set chatbot context');
+  }
+
+  return await response.json();
+}
+
+export async function sendChatbotMessage(
+  sessionId: string,
+  message: string
 ): Promise<{ response: string; credits_remaining: number; tokens_used: any }> {
   const token = localStorage.getItem('auth_token');
   if (!token) {
@@ -320,13 +449,14 @@ export async function sendChatbotMessage(
     },
     body: JSON.stringify({
       session_id: sessionId,
-      message,
-      paper_title: paperTitle,
-      paper_summary: paperSummary,
-      code_suggestions: codeSuggestions
+      message
     }),
   });
 
+  if (response.status === 409) {
+    throw new ChatContextMissingError('Paper context not set for this chat session');
+  }
+
   if (!response.ok) {
     const errorText = await response.text();
     try {
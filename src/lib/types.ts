@@ -1,6 +1,7 @@
 export interface PaperData {
   title: string;
   content: string;
+  document_id?: string | null;
   authors?: string[];
   date?: string;
   abstract?: string;
@@ -43,7 +44,20 @@ export interface LoginResponse {
   access_token: string;
   token_type: string;
   user: User;
-  processed_paper_messages?: ChatMessage[]; // Optional: messages from paper processing
+}
+
+export interface ProcessedPaperHistoryItem {
+  id: string;
+  content_type: 'summary' | 'code_suggestion' | string;
+  title?: string | null;
+  document_id?: string | null;
+  preview: string;
+  timestamp: string;
+}
+
+export interface ProcessedPaperHistoryPage {
+  items: ProcessedPaperHistoryItem[];
+  nextCursor: string | null;
 }
 
 export interface AuthState {
@@ -70,6 +84,17 @@ export interface ChatSession {
   title: string;
   lastUpdated: Date;
   messages: ChatMessage[];
+  // Del listado paginado: los mensajes se cargan al abrir la sesión
+  messageCount?: number;
+  lastMessagePreview?: string | null;
+  messagesLoaded?: boolean;
+  // Versión en el servidor sobre la que se aplican los cambios de la sincronización
+  version?: number;
+}
+
+export interface ChatSessionsPage {
+  sessions: ChatSession[];
+  nextCursor: string | null;
 }
 
 export interface AuthContextType extends AuthState {
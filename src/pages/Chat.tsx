@@ -14,7 +14,7 @@ import LoadingState from '@/components/LoadingState';
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '@/components/ui/tabs';
 import { Textarea } from '@/components/ui/textarea';
 import CodeImplementation from '@/components/CodeImplementation';
-import { sendChatbotMessage } from '@/lib/api';
+import { ChatContextMissingError, sendChatbotMessage, setChatbotContext } from '@/lib/api';
 import { useToast } from '@/hooks/use-toast';
 
 const Chat = () => {
@@ -38,6 +38,8 @@ const Chat = () => {
     isAutoProcessing,
     handleNewChat,
     handleSessionSelect,
+    hasMoreSessions,
+    loadMoreSessions,
     handleFileSelected,
     handleNewChatWithArxivPaper,
     deleteChatSession,
@@ -46,6 +48,8 @@ const Chat = () => {
   
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const chatMessagesEndRef = useRef<HTMLDivElement>(null);
+  // Session and processed data whose chatbot context is already stored on the server
+  const chatbotContextRef = useRef<{ sessionId: string; processedData: unknown } | null>(null);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -107,14 +111,33 @@ const Chat = () => {
         const messageToSend = chatMessage.trim();
         setChatMessage("");
         
-        // Send message to chatbot API
-        const response = await sendChatbotMessage(
-          currentSessionId,
-          messageToSend,
-          currentPaperData.title,
-          currentProcessedData.summary,
-          currentProcessedData.projectSuggestions || []
-        );
+        // The paper context is uploaded once per session (and again if the processed data changes)
+        const uploadContext = async () => {
+          await setChatbotContext(
+            currentSessionId,
+            currentPaperData.title,
+            currentProcessedData.summary,
+            currentProcessedData.projectSuggestions || [],
+            currentPaperData.document_id
+          );
+          chatbotContextRef.current = { sessionId: currentSessionId, processedData: currentProcessedData };
+        };
+        const uploaded = chatbotContextRef.current;
+        if (!uploaded || uploaded.sessionId !== currentSessionId || uploaded.processedData !== currentProcessedData) {
+          await uploadContext();
+        }
+
+        // Send message to chatbot API (only the session id and the question)
+        let response;
+        try {
+          response = await sendChatbotMessage(currentSessionId, messageToSend);
+        } catch (error) {
+          if (!(error instanceof ChatContextMissingError)) {
+            throw error;
+          }
+          await uploadContext();
+          response = await sendChatbotMessage(currentSessionId, messageToSend);
+        }
         
         // Add bot response to chat
         const botMessage = {
@@ -173,6 +196,8 @@ const Chat = () => {
             handleNewChat={handleNewChatAndHideArxiv} 
             onShowArxivSearch={showArxivSearch} 
             handleDeleteSession={deleteChatSession}
+            hasMoreSessions={hasMoreSessions}
+            onLoadMoreSessions={loadMoreSessions}
           />
         </Sidebar>
         